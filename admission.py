@@ -0,0 +1,128 @@
+# 充電樁重連風暴的准入控制（admission control）
+#
+# 站點停電復電或伺服器重新部署後，所有充電樁會同時重新連線並送出 BootNotification；
+# 若全部回 Accepted 且 interval 相同，之後的 Heartbeat 也會同步湧入。這裡做三件事：
+# - 連線速率限制：WebSocket 握手前以 token bucket 檢查，超過時回 HTTP 503 + Retry-After
+# - BootNotification 速率限制：超過時回 Pending
+#   兩者的重試秒數都在 [BOOT_RETRY_MIN, 上限] 隨機分散，上限隨等待中的充電樁數量放大
+#   （約為以設定速率消化完等待數量所需的秒數），避免被拒絕的充電樁再同時重試
+# - Heartbeat 間隔依充電樁 ID 固定分散在 HEARTBEAT_INTERVAL ~ HEARTBEAT_INTERVAL × (1 + HEARTBEAT_SPREAD)
+#
+# 環境變數：ADMISSION_CONNECT_RATE / ADMISSION_CONNECT_BURST（每秒連線數，0 表示不限制）、
+# ADMISSION_BOOT_RATE / ADMISSION_BOOT_BURST（每秒 Accepted 的 BootNotification 數，0 表示不限制）、
+# BOOT_RETRY_MIN / BOOT_RETRY_MAX（秒）、HEARTBEAT_INTERVAL（秒）、HEARTBEAT_SPREAD（比例）
+
+import os
+import random
+import time
+import zlib
+
+ADMISSION_CONNECT_RATE = float(os.getenv("ADMISSION_CONNECT_RATE", "100"))
+ADMISSION_CONNECT_BURST = float(os.getenv("ADMISSION_CONNECT_BURST", "200"))
+ADMISSION_BOOT_RATE = float(os.getenv("ADMISSION_BOOT_RATE", "50"))
+ADMISSION_BOOT_BURST = float(os.getenv("ADMISSION_BOOT_BURST", "100"))
+BOOT_RETRY_MIN = float(os.getenv("BOOT_RETRY_MIN", "10"))
+BOOT_RETRY_MAX = float(os.getenv("BOOT_RETRY_MAX", "60"))
+HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "10"))
+HEARTBEAT_SPREAD = float(os.getenv("HEARTBEAT_SPREAD", "0.5"))
+
+PENDING_TTL = 600  # 超過這麼久沒再重試的等待紀錄視為已離線
+
+
+class TokenBucket:
+    # rate <= 0 表示不限制
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AdmissionController:
+    def __init__(self, connect_rate=ADMISSION_CONNECT_RATE, connect_burst=ADMISSION_CONNECT_BURST,
+                 boot_rate=ADMISSION_BOOT_RATE, boot_burst=ADMISSION_BOOT_BURST,
+                 retry_min=BOOT_RETRY_MIN, retry_max=BOOT_RETRY_MAX,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_spread=HEARTBEAT_SPREAD,
+                 clock=time.monotonic, rng=None):
+        self.connections = TokenBucket(connect_rate, connect_burst, clock)
+        self.boots = TokenBucket(boot_rate, boot_burst, clock)
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.heartbeat_base = heartbeat_interval
+        self.heartbeat_spread = heartbeat_spread
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.waiting = {}         # cp_id -> 最後一次拒絕連線的時間
+        self.pending = {}         # cp_id -> 最後一次回 Pending 的時間
+        self._pruned = clock()
+        self.stats = {"connectAccepted": 0, "connectRejected": 0, "bootAccepted": 0, "bootPending": 0}
+
+    def _prune(self, now):
+        if now - self._pruned > 60:
+            self.waiting = {k: t for k, t in self.waiting.items() if now - t < PENDING_TTL}
+            self.pending = {k: t for k, t in self.pending.items() if now - t < PENDING_TTL}
+            self._pruned = now
+
+    def _retry(self, bucket, waiting):
+        # 等待中的充電樁平均分散在以 bucket 速率消化完所需的時間內，至少 retry_max 秒
+        upper = self.retry_max
+        if bucket.rate > 0:
+            upper = max(upper, waiting / bucket.rate)
+        return max(1, int(self.rng.uniform(self.retry_min, max(upper, self.retry_min))))
+
+    def admit_connection(self, cp_id):
+        # 回傳 (是否接受, 建議重試秒數)
+        now = self.clock()
+        self._prune(now)
+        if self.connections.take():
+            self.waiting.pop(cp_id, None)
+            self.stats["connectAccepted"] += 1
+            return True, 0
+        self.waiting[cp_id] = now
+        self.stats["connectRejected"] += 1
+        return False, self._retry(self.connections, len(self.waiting))
+
+    def admit_boot(self, cp_id):
+        # 回傳 (status, interval)：Accepted 時 interval 為 heartbeat 間隔，Pending 時為重試間隔
+        now = self.clock()
+        self._prune(now)
+        if self.boots.take():
+            self.pending.pop(cp_id, None)
+            self.stats["bootAccepted"] += 1
+            return "Accepted", self.heartbeat_interval(cp_id)
+        self.pending[cp_id] = now
+        self.stats["bootPending"] += 1
+        return "Pending", self._retry(self.boots, len(self.pending))
+
+    def heartbeat_interval(self, cp_id):
+        # 同一充電樁每次得到相同間隔；不同充電樁均勻分布在 [base, base × (1 + spread)]
+        slot = zlib.crc32(cp_id.encode()) % 1000 / 1000
+        return int(round(self.heartbeat_base * (1 + self.heartbeat_spread * slot)))
+
+    def info(self):
+        return {
+            **self.stats,
+            "waitingConnections": len(self.waiting),
+            "pendingChargePoints": len(self.pending),
+            "connectRate": self.connections.rate,
+            "bootRate": self.boots.rate,
+            "heartbeatInterval": [self.heartbeat_base, self.heartbeat_interval_max()],
+        }
+
+    def heartbeat_interval_max(self):
+        return int(round(self.heartbeat_base * (1 + self.heartbeat_spread)))
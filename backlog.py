@@ -0,0 +1,170 @@
+# 充電樁斷線重連後的補傳（backlog）批次寫入
+#
+# 充電樁離線期間累積的 MeterValues 會在重新連線後連續送出，最後常跟著一筆帶 transactionData
+# 的 StopTransaction。一般路徑每則訊息各自 commit；補傳模式改為：
+# - 偵測：取樣時間比現在早 BACKLOG_AGE 秒以上的訊息視為補傳，該連線進入補傳模式，
+#   直到 BACKLOG_IDLE 秒內沒有新的補傳訊息、收到即時資料或斷線為止（drain）
+# - 補傳期間的量測資料只放進緩衝區，訊息立即回覆；drain 時（或累積 BACKLOG_MAX_ROWS 筆時）
+#   依取樣時間排序、去除重複（同一批內與資料庫內已有的）後以一次交易寫入
+# - StopTransaction 的扣款延到 drain 寫完量測資料之後才執行；交易結束時已寫入待扣款標記
+#   （pending_billing），程序在 drain 前中止時由下次啟動補扣，不會遺失
+# - 寫入失敗時資料放回緩衝區，BACKLOG_IDLE 後重試；延後的扣款不受影響
+#
+# 可調整：BACKLOG_AGE（秒，預設 120）、BACKLOG_IDLE（秒，預設 1）、BACKLOG_MAX_ROWS（預設 5000）
+
+import asyncio
+import logging
+import os
+import time
+
+from reservation_index import to_epoch
+
+BACKLOG_AGE = float(os.getenv("BACKLOG_AGE", "120"))
+BACKLOG_IDLE = float(os.getenv("BACKLOG_IDLE", "1"))
+BACKLOG_MAX_ROWS = int(os.getenv("BACKLOG_MAX_ROWS", "5000"))
+
+
+def sample_epoch(timestamp):
+    # 無法解析的時間回傳 None（不觸發補傳模式）
+    try:
+        return to_epoch(timestamp.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+
+
+def meter_rows(transaction_id, charge_point_id, connector_id, meter_value):
+    # OCPP meterValue / transactionData 轉成 repository.add_meter_values 的資料列
+    rows = []
+    for entry in meter_value or []:
+        timestamp = entry.get("timestamp")
+        for sampled_value in entry.get("sampled_value", []):
+            rows.append((
+                transaction_id, charge_point_id, connector_id, timestamp,
+                float(sampled_value.get("value")),
+                sampled_value.get("measurand", "Energy.Active.Import.Register"),
+                sampled_value.get("unit", "Wh"),
+                sampled_value.get("context"), sampled_value.get("format"),
+                sampled_value.get("phase"), sampled_value.get("location")
+            ))
+    return rows
+
+
+def _row_key(row):
+    # (transaction_id, connector_id, timestamp, measurand, phase, location)：三相的 Current.Import / Voltage
+    # 同一時間各相各一筆，不可合併
+    return row[0], row[2], row[3], row[5], row[9], row[10]
+
+
+def _sort_key(row):
+    epoch = sample_epoch(row[3])
+    return (float("inf") if epoch is None else epoch, row[2] or 0, row[5] or "", row[9] or "", row[10] or "")
+
+
+class BacklogBuffer:
+    # 每條連線一個，以 __slots__ 減少上萬條連線時的記憶體
+    __slots__ = ("charge_point_id", "repo", "on_flush", "age", "idle", "max_rows", "active", "rows",
+                 "deferred", "stats", "_timer", "_task", "_lock")
+
+    def __init__(self, charge_point_id, repo, on_flush=None,
+                 age=BACKLOG_AGE, idle=BACKLOG_IDLE, max_rows=BACKLOG_MAX_ROWS):
+        self.charge_point_id = charge_point_id
+        self.repo = repo
+        self.on_flush = on_flush          # on_flush(寫入筆數)，例如更新 table_versions
+        self.age = age
+        self.idle = idle
+        self.max_rows = max_rows
+        self.active = False
+        self.rows = []
+        self.deferred = []                # drain 寫完資料後依序執行的 coroutine function
+        self.stats = {"bursts": 0, "messages": 0, "rows": 0, "duplicates": 0, "flushes": 0}
+        self._timer = None
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def wants(self, timestamps):
+        # 這則訊息是否走補傳路徑：最新的取樣時間仍早於 now - age
+        epochs = [e for e in map(sample_epoch, timestamps) if e is not None]
+        if not epochs or max(epochs) >= time.time() - self.age:
+            return False
+        if not self.active:
+            self.active = True
+            self.stats["bursts"] += 1
+            logging.info(f"📦 補傳模式開始 | CP={self.charge_point_id} | 落後 {time.time() - max(epochs):.0f} 秒")
+        self.stats["messages"] += 1
+        self._restart_timer()
+        return True
+
+    def add(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.max_rows:
+            self._spawn(self.flush())
+
+    def defer(self, fn):
+        self.deferred.append(fn)
+
+    def _spawn(self, coro):
+        self._task = asyncio.ensure_future(coro)
+        self._task.add_done_callback(self._log_failure)
+
+    def _log_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"⚠️ 補傳背景寫入失敗 | CP={self.charge_point_id}", exc_info=task.exception())
+
+    def _restart_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self.idle, lambda: self._spawn(self.drain()))
+
+    async def flush(self):
+        async with self._lock:
+            rows, self.rows = self.rows, []
+            if not rows:
+                return 0
+            unique = {}
+            for row in rows:
+                unique.setdefault(_row_key(row), row)
+            timestamps = [row[3] for row in unique.values() if row[3]]
+            existing = set()
+            if timestamps:
+                existing = await self.repo.meter_value_keys(self.charge_point_id, min(timestamps), max(timestamps))
+            fresh = sorted((row for key, row in unique.items() if key not in existing), key=_sort_key)
+            try:
+                if fresh:
+                    await self.repo.add_meter_values(fresh)
+            except Exception:
+                # 寫入失敗：資料放回緩衝區，下次 flush / drain 再寫
+                self.rows[:0] = rows
+                raise
+            self.stats["flushes"] += 1
+            self.stats["rows"] += len(fresh)
+            self.stats["duplicates"] += len(rows) - len(fresh)
+            if fresh and self.on_flush:
+                self.on_flush(len(fresh))
+            return len(fresh)
+
+    async def drain(self):
+        # 寫入緩衝區並執行延後的扣款，結束補傳模式
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.active and not self.rows and not self.deferred:
+            return
+        try:
+            written = await self.flush()
+        except Exception:
+            # 量測資料留在緩衝區，BACKLOG_IDLE 後再試；扣款照常執行（不依賴量測資料），
+            # 不讓錯誤冒到觸發 drain 的其他訊息 handler
+            logging.exception(f"⚠️ 補傳資料寫入失敗，稍後重試 | CP={self.charge_point_id} | 緩衝 {len(self.rows)} 筆")
+            written = 0
+            self._restart_timer()
+        deferred, self.deferred = self.deferred, []
+        self.active = False
+        for fn in deferred:
+            try:
+                await fn()
+            except Exception:
+                logging.exception(f"⚠️ 補傳延後處理失敗 | CP={self.charge_point_id}")
+        logging.info(
+            f"📦 補傳模式結束 | CP={self.charge_point_id} | 本次寫入 {written} 筆 | 延後扣款 {len(deferred)} 筆"
+            f" | 累計 {self.stats['rows']} 筆（重複 {self.stats['duplicates']}）"
+        )
@@ -0,0 +1,82 @@
+# 補傳寫入比較：逐則 commit（一般路徑） vs BacklogBuffer 批次寫入
+#
+#   python bench_backlog.py [訊息數] [每則取樣數]
+#
+# 在暫存目錄建立 meter_values 表（balanced profile），模擬一個充電樁離線一段時間後補傳的 MeterValues，
+# 其中最後 10% 為重送的重複訊息。
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import storage
+from backlog import BacklogBuffer, meter_rows
+from repository import SQLiteRepository
+
+
+def setup(db_file):
+    conn = storage.connect(db_file)
+    conn.execute('''
+        CREATE TABLE meter_values (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_id INTEGER, charge_point_id TEXT,
+            connector_id INTEGER, timestamp TEXT, value REAL, measurand TEXT, unit TEXT, context TEXT, format TEXT,
+            phase TEXT, location TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_meter_values_cp_ts ON meter_values (charge_point_id, timestamp)")
+    conn.commit()
+    return conn
+
+
+def messages(count, samples):
+    base = datetime.utcnow() - timedelta(days=1, seconds=10 * count)
+    result = []
+    for i in list(range(count)) + list(range(count - count // 10, count)):
+        ts = (base + timedelta(seconds=10 * i)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        result.append([{"timestamp": ts, "sampled_value": [
+            {"value": str(i * 10 + k), "measurand": f"M{k}", "unit": "Wh"} for k in range(samples)
+        ]}])
+    return result
+
+
+async def per_message(repo, msgs):
+    for meter_value in msgs:
+        await repo.add_meter_values(meter_rows(1, "CP1", 1, meter_value))
+
+
+async def buffered(repo, msgs):
+    buffer = BacklogBuffer("CP1", repo)
+    for meter_value in msgs:
+        if buffer.wants([entry["timestamp"] for entry in meter_value]):
+            buffer.add(meter_rows(1, "CP1", 1, meter_value))
+    await buffer.drain()
+    return buffer.stats
+
+
+def run(name, fn, msgs):
+    tmp = tempfile.mkdtemp(prefix="bench_backlog_")
+    conn = setup(os.path.join(tmp, "bench.db"))
+    t0 = time.perf_counter()
+    stats = asyncio.run(fn(SQLiteRepository(conn), msgs))
+    elapsed = time.perf_counter() - t0
+    rows = conn.execute("SELECT COUNT(*) FROM meter_values").fetchone()[0]
+    print(f"[{name}] {len(msgs) / elapsed:,.0f} msgs/s  elapsed={elapsed * 1000:.0f} ms  rows={rows}"
+          + (f"  duplicates={stats['duplicates']}" if stats else ""))
+    conn.close()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    msgs = messages(count, samples)
+    run("per-message", per_message, msgs)
+    run("backlog", buffered, msgs)
+
+
+if __name__ == "__main__":
+    main()
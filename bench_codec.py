@@ -0,0 +1,101 @@
+# OCPP 訊息處理與 REST 回應序列化效能比較（每秒訊息數）
+#
+#   python bench_codec.py [訊息數量]
+#
+# 比較 ocpp 原生 ChargePoint（標準 json + 每次驗證）、FastChargePoint（orjson +
+# 快取驗證器）與信任充電樁模式（MeterValues 略過驗證）。
+
+import asyncio
+import json
+import sys
+import time
+
+from fastapi.responses import JSONResponse
+from ocpp.routing import on
+from ocpp.v16 import ChargePoint as OcppChargePoint
+from ocpp.v16.call_result import MeterValuesPayload, HeartbeatPayload
+from ocpp.v16.enums import Action
+
+import codec
+
+
+class NullConnection:
+    async def send(self, message):
+        pass
+
+
+class Handlers:
+    @on(Action.MeterValues)
+    async def on_meter_values(self, connector_id, meter_value, **kwargs):
+        return MeterValuesPayload()
+
+    @on(Action.Heartbeat)
+    async def on_heartbeat(self):
+        return HeartbeatPayload(current_time="2025-07-01T00:00:00+00:00")
+
+
+class LibraryCP(Handlers, OcppChargePoint):
+    pass
+
+
+class FastCP(Handlers, codec.FastChargePoint):
+    pass
+
+
+def meter_values_frame(i):
+    return json.dumps([2, str(i), "MeterValues", {
+        "connectorId": 1,
+        "transactionId": 1234,
+        "meterValue": [{
+            "timestamp": "2025-07-01T10:00:00Z",
+            "sampledValue": [
+                {"value": str(1000 + i), "measurand": "Energy.Active.Import.Register", "unit": "Wh",
+                 "context": "Sample.Periodic", "format": "Raw"},
+                {"value": "7200", "measurand": "Power.Active.Import", "unit": "W",
+                 "context": "Sample.Periodic", "format": "Raw"},
+                {"value": "32.0", "measurand": "Current.Import", "unit": "A", "phase": "L1"},
+            ],
+        }],
+    }])
+
+
+async def run(cp, frames):
+    t0 = time.perf_counter()
+    for frame in frames:
+        await cp.route_message(frame)
+    return len(frames) / (time.perf_counter() - t0)
+
+
+async def bench_ocpp(n):
+    import logging
+    logging.getLogger("ocpp").setLevel(logging.WARNING)
+    frames = [meter_values_frame(i) for i in range(n)]
+    lib = await run(LibraryCP("CP1", NullConnection()), frames)
+    fast = await run(FastCP("CP1", NullConnection()), frames)
+    trusted_cp = FastCP("CP1", NullConnection())
+    trusted_cp.trusted = True
+    trusted = await run(trusted_cp, frames)
+    print(f"MeterValues x{n}")
+    print(f"  ocpp ChargePoint      : {lib:10,.0f} msg/s")
+    print(f"  FastChargePoint       : {fast:10,.0f} msg/s  ({fast / lib:.1f}x)")
+    print(f"  FastChargePoint 信任  : {trusted:10,.0f} msg/s  ({trusted / lib:.1f}x)")
+
+
+def bench_rest(rows=5000, rounds=50):
+    content = [{
+        "transactionId": i, "chargePointId": f"CP{i % 50}", "connectorId": 1, "idTag": f"TAG{i}",
+        "meterStart": 0, "startTimestamp": "2025-07-01T10:00:00", "meterStop": 12345,
+        "stopTimestamp": "2025-07-01T12:00:00", "reason": "Local",
+    } for i in range(rows)]
+    for name, cls in (("JSONResponse", JSONResponse), ("FastJSONResponse", codec.FastJSONResponse)):
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            cls(content=content)
+        print(f"  {name:<17}: {rounds / (time.perf_counter() - t0):8,.1f} responses/s ({rows} rows)")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    asyncio.run(bench_ocpp(n))
+    print("REST")
+    bench_rest()
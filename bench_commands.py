@@ -0,0 +1,112 @@
+# 批次指令（POST /api/commands，commands.py）的完成時間
+#
+#   python bench_commands.py [充電樁數] [--action ChangeConfiguration] [--concurrency 500] [--delay-ms 0]
+#
+# 在暫存目錄啟動主程式（高密度模式），建立 N 條充電樁連線，每條收到 Call 後等 --delay-ms 毫秒
+# （模擬充電樁處理與網路延遲）回 Accepted；接著以 match 對全部充電樁送出一次指令，
+# 讀完 NDJSON 串流後列出總時間、各狀態數量與單一充電樁的回應時間分布。
+
+import argparse
+import asyncio
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+import requests
+
+from bench_density import OCPP_PORT, start_server
+from bench_storm import percentile
+
+HTTP_PORT = 8124
+CONNECT_CONCURRENCY = 200
+PARAMS = {
+    "ChangeConfiguration": {"key": "HeartbeatInterval", "value": "300"},
+    "TriggerMessage": {"requestedMessage": "StatusNotification"},
+    "Reset": {"type": "Soft"},
+}
+
+
+async def charger_fleet(count, delay):
+    import websockets
+
+    sockets = []
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(i):
+        async with semaphore:
+            ws = await websockets.connect(f"ws://127.0.0.1:{OCPP_PORT}/CMD{i:05d}", subprotocols=["ocpp1.6"],
+                                          open_timeout=60, ping_interval=None)
+            await ws.send(json.dumps([2, "b", "BootNotification", {"chargePointModel": "Cmd", "chargePointVendor": "Bench"}]))
+            await ws.recv()
+            sockets.append(ws)
+
+    async def respond(ws):
+        try:
+            async for raw in ws:
+                msg = json.loads(raw)
+                if msg[0] == 2:
+                    if delay:
+                        await asyncio.sleep(delay)
+                    await ws.send(json.dumps([3, msg[1], {"status": "Accepted"}]))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    await asyncio.gather(*(connect(i) for i in range(count)))
+    return sockets, [asyncio.ensure_future(respond(ws)) for ws in sockets]
+
+
+def post_command(action, concurrency):
+    started = time.perf_counter()
+    first = None
+    lines = []
+    with requests.post(f"http://127.0.0.1:{HTTP_PORT}/api/commands", stream=True, json={
+        "action": action, "params": PARAMS[action], "match": "CMD*", "concurrency": concurrency,
+    }) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if first is None:
+                first = time.perf_counter() - started
+            lines.append(json.loads(line))
+    return time.perf_counter() - started, first, lines
+
+
+async def run(count, action, concurrency, delay):
+    sockets, tasks = await charger_fleet(count, delay)
+    print(f"已連線 {len(sockets):,} 個充電樁")
+    elapsed, first, lines = await asyncio.to_thread(post_command, action, concurrency)
+    summary = lines[-1]["summary"]
+    latencies = [item["elapsedMs"] for item in lines[:-1] if "elapsedMs" in item]
+    print(f"{action} × {summary['targets']:,}：{elapsed:.2f} s（第一筆結果 {first * 1000:.0f} ms）"
+          f"  {count / elapsed:,.0f} 個/s")
+    print(f"  ok={summary['ok']} rejected={summary['rejected']} error={summary['error']}"
+          f" timeout={summary['timeout']} offline={summary['offline']}")
+    print(f"  單一充電樁 p50={percentile(latencies, 0.5):.1f} ms p99={percentile(latencies, 0.99):.1f} ms")
+    for ws in sockets:
+        await ws.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批次指令完成時間")
+    parser.add_argument("chargers", nargs="?", type=int, default=5000)
+    parser.add_argument("--action", choices=sorted(PARAMS), default="ChangeConfiguration")
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--delay-ms", type=float, default=0)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="bench_commands_")
+    proc = start_server("dense", workdir, HTTP_PORT)
+    try:
+        asyncio.run(run(args.chargers, args.action, args.concurrency, args.delay_ms / 1000))
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# 每條充電樁連線的記憶體（RSS）與 CPU 成本：一般模式 vs 高密度模式（density.py）
+#
+#   python bench_density.py [連線數 ...] [--mode default|dense|both] [--idle 秒] [--active 秒] [--interval 秒]
+#   python bench_density.py 2000 --url ws://localhost:9000 --pid <主程式 PID>     # 量測執行中的主程式
+#
+# 預設對 1000、5000、10000 條連線，各以一般模式與高密度模式啟動一次主程式（uvicorn main:app，
+# 在暫存目錄執行，使用全新的資料庫）：
+# 1. 啟動後記錄基準 RSS
+# 2. 建立 N 條連線，各送一次 BootNotification，之後閒置 --idle 秒：
+#    每條閒置連線的 RSS 增量與 CPU（只有 keepalive ping）
+# 3. 每條連線每 --interval 秒送一則 MeterValues，持續 --active 秒：
+#    每條活躍連線的 RSS 增量與 CPU，以及實際的訊息速率與回覆延遲（確認伺服器沒有飽和）
+# 充電樁端沿用 websockets 的預設值（會提議 permessage-deflate），與一般充電樁相同。
+# 用戶端與伺服器在同一台機器上執行，CPU 只計算伺服器程序（/proc/<pid>/stat）。
+# 10,000 條連線需要 ulimit -n 超過 10,000（伺服器與本程式各自）。
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_storm import cpu_seconds, percentile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+OCPP_PORT = 9000
+CONNECT_CONCURRENCY = 200
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def wait_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"埠 {port} 沒有開啟")
+
+
+def start_server(mode, workdir, http_port=0):
+    # 在 workdir 以全新的資料庫啟動主程式；OCPP 固定在 OCPP_PORT，HTTP 在 http_port（0 為任意）
+    env = dict(
+        os.environ,
+        PYTHONPATH=HERE,
+        OCPP_HIGH_DENSITY="1" if mode == "dense" else "0",
+        LOG_LEVEL="WARNING",
+        ADMISSION_CONNECT_RATE="0",
+        ADMISSION_BOOT_RATE="0",
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(http_port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, "server.log"), "w"),
+    )
+    wait_port(OCPP_PORT)
+    time.sleep(2)
+    return proc
+
+
+class Fleet:
+    def __init__(self, url, count):
+        self.url = url.rstrip("/")
+        self.count = count
+        self.sockets = []
+        self.latencies = []
+        self.sent = 0
+        self.errors = 0
+
+    async def connect(self):
+        import websockets
+
+        semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def one(i):
+            async with semaphore:
+                try:
+                    ws = await websockets.connect(f"{self.url}/DENSE{i:05d}", subprotocols=["ocpp1.6"],
+                                                  open_timeout=60, ping_interval=None)
+                    await ws.send(json.dumps([2, "b", "BootNotification",
+                                              {"chargePointModel": "Dense", "chargePointVendor": "Bench"}]))
+                    await ws.recv()
+                    self.sockets.append(ws)
+                except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException):
+                    self.errors += 1
+
+        await asyncio.gather(*(one(i) for i in range(self.count)))
+
+    async def active(self, seconds, interval):
+        deadline = time.monotonic() + seconds
+
+        async def one(ws):
+            await asyncio.sleep(random.uniform(0, interval))
+            n = 0
+            while time.monotonic() < deadline:
+                n += 1
+                frame = json.dumps([2, f"m{n}", "MeterValues", {"connectorId": 1, "meterValue": [{
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "sampledValue": [{"value": str(n * 10), "measurand": "Energy.Active.Import.Register", "unit": "Wh"}],
+                }]}])
+                t0 = time.perf_counter()
+                try:
+                    await ws.send(frame)
+                    await ws.recv()
+                except Exception:
+                    self.errors += 1
+                    return
+                self.sent += 1
+                self.latencies.append((time.perf_counter() - t0) * 1000)
+                await asyncio.sleep(max(interval - (time.perf_counter() - t0), 0))
+
+        await asyncio.gather(*(one(ws) for ws in self.sockets))
+
+    async def close(self):
+        await asyncio.gather(*(ws.close() for ws in self.sockets), return_exceptions=True)
+
+
+async def measure(url, pid, count, idle, active, interval):
+    fleet = Fleet(url, count)
+    rss0, cpu0 = rss_kb(pid), cpu_seconds(pid)
+    t0 = time.monotonic()
+    await fleet.connect()
+    connect_s = time.monotonic() - t0
+    connect_cpu = cpu_seconds(pid) - cpu0
+    n = len(fleet.sockets)
+    await asyncio.sleep(2)
+
+    cpu_a, t_a = cpu_seconds(pid), time.monotonic()
+    await asyncio.sleep(idle)
+    idle_cpu = (cpu_seconds(pid) - cpu_a) / (time.monotonic() - t_a)
+    rss_idle = rss_kb(pid)
+
+    cpu_b, t_b = cpu_seconds(pid), time.monotonic()
+    await fleet.active(active, interval)
+    elapsed = time.monotonic() - t_b
+    active_cpu = (cpu_seconds(pid) - cpu_b) / elapsed
+    rss_active = rss_kb(pid)
+    await fleet.close()
+
+    per = max(n, 1)
+    return {
+        "connections": n,
+        "errors": fleet.errors,
+        "connectS": round(connect_s, 1),
+        "connectCpuMsPerConn": round(connect_cpu * 1000 / per, 2),
+        "baseRssMb": round(rss0 / 1024, 1),
+        "idleRssKbPerConn": round((rss_idle - rss0) / per, 1),
+        "idleCpuUsPerConnS": round(idle_cpu * 1e6 / per, 2),
+        "activeRssKbPerConn": round((rss_active - rss0) / per, 1),
+        "activeCpuUsPerConnS": round(active_cpu * 1e6 / per, 2),
+        "activeCpuPct": round(active_cpu * 100, 1),
+        "msgsPerS": round(fleet.sent / elapsed, 1),
+        "latencyP50Ms": round(percentile(fleet.latencies, 0.5), 1),
+        "latencyP99Ms": round(percentile(fleet.latencies, 0.99), 1),
+    }
+
+
+def report(mode, result):
+    r = result
+    print(f"[{mode:7}] 連線 {r['connections']:>6,}（失敗 {r['errors']}）建立 {r['connectS']} s"
+          f"，每條 {r['connectCpuMsPerConn']} ms CPU | 基準 RSS {r['baseRssMb']} MB")
+    print(f"          閒置：每條 {r['idleRssKbPerConn']} KB RSS，{r['idleCpuUsPerConnS']} µs CPU/s")
+    print(f"          活躍：每條 {r['activeRssKbPerConn']} KB RSS，{r['activeCpuUsPerConnS']} µs CPU/s"
+          f"（伺服器 {r['activeCpuPct']}%，{r['msgsPerS']} msg/s，p50 {r['latencyP50Ms']} ms，"
+          f"p99 {r['latencyP99Ms']} ms）")
+
+
+def run_local(counts, modes, idle, active, interval):
+    results = []
+    for count in counts:
+        for mode in modes:
+            workdir = tempfile.mkdtemp(prefix="bench_density_")
+            proc = start_server(mode, workdir)
+            try:
+                result = asyncio.run(measure(f"ws://127.0.0.1:{OCPP_PORT}", proc.pid, count, idle, active, interval))
+            finally:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                shutil.rmtree(workdir, ignore_errors=True)
+            report(mode, result)
+            results.append({"mode": mode, **result})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="每條連線的 RSS / CPU 成本")
+    parser.add_argument("counts", nargs="*", type=int, default=[1000, 5000, 10000])
+    parser.add_argument("--mode", choices=["default", "dense", "both"], default="both")
+    parser.add_argument("--idle", type=float, default=30, help="閒置量測秒數（預設 30，涵蓋一般模式的 ping 週期）")
+    parser.add_argument("--active", type=float, default=30, help="活躍量測秒數")
+    parser.add_argument("--interval", type=float, default=10, help="活躍階段每條連線送 MeterValues 的間隔秒數")
+    parser.add_argument("--url", help="量測執行中的主程式，例如 ws://localhost:9000（需搭配 --pid）")
+    parser.add_argument("--pid", type=int)
+    parser.add_argument("--json", help="另存結果為 JSON 檔")
+    args = parser.parse_args()
+    if args.url:
+        if not args.pid:
+            parser.error("--url 需要 --pid")
+        results = []
+        for count in args.counts:
+            result = asyncio.run(measure(args.url, args.pid, count, args.idle, args.active, args.interval))
+            report("running", result)
+            results.append({"mode": "running", **result})
+    else:
+        modes = ["default", "dense"] if args.mode == "both" else [args.mode]
+        results = run_local(args.counts, modes, args.idle, args.active, args.interval)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
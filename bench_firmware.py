@@ -0,0 +1,111 @@
+# 韌體下載伺服器（firmware.py）同時下載的吞吐量與伺服器資源
+#
+#   python bench_firmware.py [同時下載數] [--size-mb 50] [--range]
+#
+# 在暫存目錄啟動主程式，上傳一個 --size-mb MB 的隨機映像檔（核對 SHA-256），接著以 N 條連線同時下載整個檔案
+# （--range 時每條連線分成 4 段 Range 請求，在同一條 keep-alive 連線上依序下載），逐一核對 SHA-256。
+# 列出總時間、總吞吐量、伺服器 RSS 增量與 CPU 時間（/proc/<pid>），確認檔案內容沒有經過 Python 記憶體。
+
+import argparse
+import asyncio
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import requests
+
+from bench_density import rss_kb, start_server, wait_port
+from bench_storm import cpu_seconds
+
+HTTP_PORT = 8125
+FIRMWARE_PORT = 9001
+
+
+async def download(url, size, parts):
+    reader, writer = await asyncio.open_connection("127.0.0.1", FIRMWARE_PORT)
+    digest = hashlib.sha256()
+    step = -(-size // parts)
+    try:
+        for start in range(0, size, step):
+            end = min(start + step, size) - 1
+            range_header = f"Range: bytes={start}-{end}\r\n" if parts > 1 else ""
+            writer.write(f"GET {url} HTTP/1.1\r\nHost: bench\r\n{range_header}\r\n".encode())
+            head = await reader.readuntil(b"\r\n\r\n")
+            status = head.split(b" ", 2)[1]
+            if status not in (b"200", b"206"):
+                raise RuntimeError(head.decode())
+            length = int(next(line.split(b":")[1] for line in head.split(b"\r\n")
+                              if line.lower().startswith(b"content-length:")))
+            while length:
+                chunk = await reader.read(min(length, 1 << 20))
+                if not chunk:
+                    raise RuntimeError("連線中斷")
+                digest.update(chunk)
+                length -= len(chunk)
+    finally:
+        writer.close()
+    return digest.hexdigest()
+
+
+async def run(pid, url, size, sha256, count, parts):
+    rss0, cpu0 = rss_kb(pid), cpu_seconds(pid)
+    peak = rss0
+    done = asyncio.Event()
+
+    async def sample():
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, rss_kb(pid))
+            await asyncio.sleep(0.1)
+
+    sampler = asyncio.ensure_future(sample())
+    started = time.perf_counter()
+    results = await asyncio.gather(*(download(url, size, parts) for _ in range(count)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    done.set()
+    await sampler
+    ok = sum(1 for r in results if r == sha256)
+    errors = [r for r in results if isinstance(r, Exception)]
+    total = size * ok
+    print(f"{count} 個同時下載 {size / 1048576:.0f} MB（{'Range ×' + str(parts) if parts > 1 else '整檔'}）："
+          f"{elapsed:.2f} s，SHA-256 正確 {ok}/{count}，錯誤 {len(errors)}")
+    print(f"  總量 {total / 1048576:,.0f} MB，{total / 1048576 / elapsed:,.0f} MB/s")
+    print(f"  伺服器 RSS {rss0 / 1024:.0f} MB → 峰值 {peak / 1024:.0f} MB（+{(peak - rss0) / 1024:.1f} MB），"
+          f"CPU {cpu_seconds(pid) - cpu0:.2f} s")
+    if errors:
+        print(f"  第一個錯誤：{errors[0]!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="韌體下載伺服器同時下載")
+    parser.add_argument("downloads", nargs="?", type=int, default=300)
+    parser.add_argument("--size-mb", type=float, default=50)
+    parser.add_argument("--range", action="store_true", help="每條連線分 4 段 Range 請求下載")
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="bench_firmware_")
+    image = os.urandom(int(args.size_mb * 1024 * 1024))
+    sha256 = hashlib.sha256(image).hexdigest()
+    proc = start_server("dense", workdir, HTTP_PORT)
+    try:
+        wait_port(FIRMWARE_PORT)
+        resp = requests.post(f"http://127.0.0.1:{HTTP_PORT}/api/firmware", data=image,
+                             params={"version": "bench", "model": "Bench", "filename": "bench.bin", "sha256": sha256})
+        resp.raise_for_status()
+        del image
+        url = "/" + resp.json()["location"].split("/", 3)[3]
+        asyncio.run(run(proc.pid, url, int(args.size_mb * 1024 * 1024), sha256, args.downloads,
+                        4 if args.range else 1))
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# 站點功率分配效能測試：2,000 個充電中連接器重新計算需在 10 ms 內完成
+#
+#   python bench_load_management.py [連接器數量] [重複次數]
+
+import random
+import sys
+import time
+
+from load_management import SiteAllocator, ENERGY_MEASURAND
+
+BUDGET_MS = 10.0
+
+
+def build(n):
+    random.seed(42)
+    alloc = SiteAllocator(capacity_w=n * 7000)
+    for i in range(n):
+        cp_id = f"CP{i // 2:04d}"
+        connector_id = i % 2 + 1
+        alloc.start_transaction(cp_id, connector_id, i + 1, f"TAG{i}", random.choice([20, 150, 800, 5000]))
+        alloc.update_meter(cp_id, connector_id, ENERGY_MEASURAND, 1000.0, "Wh", "2025-07-01T10:00:00")
+        alloc.update_meter(cp_id, connector_id, ENERGY_MEASURAND, 1000.0 + random.uniform(0, 400), "Wh", "2025-07-01T10:01:00")
+    # 第一次分配後視為已全部送出，之後量測才會影響需求估計
+    for cp_id, connector_id, _, limit in alloc.changes(price=5.0):
+        alloc.mark_sent(cp_id, connector_id, limit)
+    return alloc
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    alloc = build(n)
+    keys = list(alloc.connectors)
+
+    samples = []
+    changed = 0
+    for r in range(rounds):
+        # 每輪模擬 5% 連接器有新的量測值
+        for key in random.sample(keys, n // 20):
+            c = alloc.connectors[key]
+            c.power_w = random.uniform(0, c.max_w)
+        t0 = time.perf_counter()
+        out = alloc.changes(price=5.0)
+        samples.append((time.perf_counter() - t0) * 1000)
+        for cp_id, connector_id, _, limit in out:
+            alloc.mark_sent(cp_id, connector_id, limit)
+        changed += len(out)
+
+    samples.sort()
+    median = samples[len(samples) // 2]
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    print(f"connectors={n} rounds={rounds}")
+    print(f"median={median:.3f} ms  p99={p99:.3f} ms  max={samples[-1]:.3f} ms")
+    print(f"avg changed limits per round={changed / rounds:.1f}")
+    if p99 > BUDGET_MS:
+        print(f"❌ p99 超過 {BUDGET_MS} ms")
+        sys.exit(1)
+    print(f"✅ p99 < {BUDGET_MS} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# logging 開銷比較：原本的 basicConfig + f-string vs log_pipeline（佇列 + 背景執行緒）
+#
+#   python bench_logging.py [筆數]
+#
+# 模擬 OCPP handler 的 Heartbeat / MeterValues 紀錄，量測呼叫端（事件迴圈）每筆花費的時間，
+# 以及含背景執行緒寫完檔案的總時間。輸出寫到暫存檔，不影響終端機。
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import log_pipeline
+
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+
+def workload(n, lazy):
+    heartbeat = log_pipeline.action_logger("Heartbeat")
+    meter = log_pipeline.action_logger("MeterValues")
+    t0 = time.perf_counter()
+    for i in range(n):
+        cp_id = f"CP{i % 500:03d}"
+        if lazy:
+            heartbeat.info("❤️ Heartbeat | CP=%s", cp_id)
+            meter.info("📈 MeterValues | CP=%s | 筆數=%d", cp_id, i % 4)
+        else:
+            logging.info(f"❤️ Heartbeat | CP={cp_id}")
+            logging.info(f"📈 MeterValues | CP={cp_id} | 筆數={i % 4}")
+    return time.perf_counter() - t0
+
+
+def run(name, n, path, **pipeline):
+    reset_root()
+    t0 = time.perf_counter()
+    if pipeline:
+        log_pipeline.setup(log_file=path, **pipeline)
+        caller = workload(n, lazy=True)
+        log_pipeline.shutdown()
+    else:
+        logging.basicConfig(level=logging.INFO, filename=path, format=log_pipeline.TEXT_FORMAT)
+        caller = workload(n, lazy=False)
+    total = time.perf_counter() - t0
+    reset_root()
+    size = os.path.getsize(path)
+    os.remove(path)
+    calls = n * 2
+    print(f"[{name}] caller {caller / calls * 1e6:6.2f} µs/msg   total {total / calls * 1e6:6.2f} µs/msg"
+          f"   file {size / 1024:,.0f} KB")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    path = os.path.join(tempfile.gettempdir(), "bench_logging.log")
+    run("basicConfig f-string ", n, path)
+    run("pipeline text        ", n, path, fmt="text", sample="", rate="")
+    run("pipeline json        ", n, path, fmt="json", sample="", rate="")
+    run("pipeline sample 1/1000", n, path, fmt="text", sample="Heartbeat=1000,MeterValues=1000", rate="")
+    run("pipeline rate 100/s  ", n, path, fmt="json", sample="", rate="Heartbeat=100,MeterValues=100")
+
+
+if __name__ == "__main__":
+    main()
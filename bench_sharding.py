@@ -0,0 +1,92 @@
+# 分片寫入吞吐量比較：單一 ocpp_data.db vs 依場域分片（sharding.py）
+#
+#   python bench_sharding.py [場域數] [每場域充電樁數] [每樁寫入次數]
+#
+# 每個充電樁依序送出 MeterValues（每則一次 commit），所有充電樁同時進行；
+# 比較全部寫進同一個資料庫（原本的 SQLiteRepository）與每個場域一個資料庫檔的每秒寫入筆數。
+# 預設使用 SQLITE_PROFILE=durable（每次 commit 都 fsync），最能看出單一寫入鎖的影響；
+# 分片的寫入執行緒會把排隊中的寫入合併 commit，一併列出 commit（fsync）次數。
+# 可平行的程度取決於 CPU 核心數與磁碟 fsync 延遲，單核心、fsync 很快的環境差異較小。
+
+import os
+
+os.environ.setdefault("SQLITE_PROFILE", "durable")
+
+import asyncio
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import storage
+import sharding
+from repository import SQLiteRepository
+
+
+def main_db(path):
+    conn = storage.connect(path, check_same_thread=False)
+    for statement in sharding.SHARD_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+async def workload(repo, sites, chargers, writes):
+    async def charger(site, i):
+        cp_id = f"S{site}-{i:03d}"
+        for n in range(writes):
+            await repo.add_meter_values([(
+                site * 1000 + i, cp_id, 1, f"2024-01-01T00:{n // 60:02d}:{n % 60:02d}",
+                n * 10.0, "Energy.Active.Import.Register", "Wh", "Sample.Periodic", "Raw", None, None,
+            )])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(charger(s, i) for s in range(sites) for i in range(chargers)))
+    return time.perf_counter() - started
+
+
+def count_rows(files):
+    total = 0
+    for path in files:
+        c = sqlite3.connect(path)
+        total += c.execute("SELECT COUNT(*) FROM meter_values").fetchone()[0]
+        c.close()
+    return total
+
+
+def run(name, sites, chargers, writes, sharded):
+    tmp = tempfile.mkdtemp(prefix="bench_sharding_")
+    try:
+        path = os.path.join(tmp, "ocpp_data.db")
+        conn = main_db(path)
+        repo, shards = SQLiteRepository(conn), None
+        if sharded:
+            rules = ";".join(f"site{s}=S{s}-*" for s in range(sites))
+            repo, shards = sharding.create_sharded_repository(repo, path, rules, os.path.join(tmp, "shards"))
+        elapsed = asyncio.run(workload(repo, sites, chargers, writes))
+        files = shards.files() if shards else [path]
+        commits = sum(s["commits"] for s in shards.info()) if shards else None
+        if shards:
+            shards.close()
+        rows = count_rows(files)
+        conn.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"[{name}] {rows:,} 筆 / {elapsed:.2f} s = {rows / elapsed:,.0f} 筆/s"
+          f"   commit {commits if commits is not None else rows:,} 次")
+    return rows / elapsed
+
+
+def main():
+    sites = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    chargers = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    writes = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    print(f"profile={storage.PROFILE['name']} 場域={sites} 每場域充電樁={chargers} 每樁寫入={writes}")
+    single = run("單一資料庫    ", sites, chargers, writes, sharded=False)
+    sharded = run(f"{sites} 個場域分片", sites, chargers, writes, sharded=True)
+    print(f"倍數：{sharded / single:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
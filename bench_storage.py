@@ -0,0 +1,128 @@
+# SQLite storage profile 比較：一個寫入執行緒（模擬 OCPP 每筆 commit）+ 多個讀取執行緒（API 查詢）
+#
+#   python bench_storage.py [秒數] [讀取執行緒數]
+#
+# 每個 profile 在暫存目錄建立獨立資料庫，量測寫入/讀取吞吐量、讀取延遲與 locked 錯誤次數，
+# 最後在寫入進行中做一次線上備份，量測備份期間的最長寫入延遲。
+
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import storage
+
+
+def setup(db_file, profile):
+    conn = storage.connect(db_file, profile)
+    conn.execute('''
+        CREATE TABLE transactions (
+            transaction_id INTEGER PRIMARY KEY, charge_point_id TEXT, connector_id INTEGER,
+            id_tag TEXT, meter_start INTEGER, start_timestamp TEXT,
+            meter_stop INTEGER, stop_timestamp TEXT, reason TEXT
+        )
+    ''')
+    rows = [
+        (i, f"CP{i % 200:03d}", 1, f"TAG{i % 500}", 0, f"2025-07-{i % 28 + 1:02d}T10:00:00",
+         random.randint(1000, 50000), f"2025-07-{i % 28 + 1:02d}T11:00:00", "Local")
+        for i in range(1, 50001)
+    ]
+    conn.executemany("INSERT INTO transactions VALUES (?,?,?,?,?,?,?,?,?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def run(profile_name, seconds, readers):
+    profile = storage.load_profile(profile_name)
+    tmp = tempfile.mkdtemp(prefix="bench_storage_")
+    db_file = os.path.join(tmp, "bench.db")
+    setup(db_file, profile)
+
+    stop = threading.Event()
+    stats = {"writes": 0, "reads": 0, "locked": 0}
+    write_lat, read_lat = [], []
+    lock = threading.Lock()
+
+    def writer():
+        conn = storage.connect(db_file, profile, timeout=5)
+        tid = 100000
+        while not stop.is_set():
+            tid += 1
+            t0 = time.perf_counter()
+            try:
+                conn.execute(
+                    "INSERT INTO transactions VALUES (?,?,?,?,?,?,?,?,?)",
+                    (tid, "CP001", 1, "TAG1", 0, "2025-07-30T10:00:00", None, None, None)
+                )
+                conn.commit()
+            except sqlite3.OperationalError:
+                with lock:
+                    stats["locked"] += 1
+                continue
+            write_lat.append((time.perf_counter() - t0) * 1000)
+            stats["writes"] += 1
+        conn.close()
+
+    def reader():
+        conn = storage.connect(db_file, profile, timeout=5)
+        local = []
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                conn.execute('''
+                    SELECT charge_point_id, SUM(meter_stop - meter_start) FROM transactions
+                    WHERE id_tag = ? GROUP BY charge_point_id
+                ''', (f"TAG{random.randint(0, 499)}",)).fetchall()
+            except sqlite3.OperationalError:
+                with lock:
+                    stats["locked"] += 1
+                continue
+            local.append((time.perf_counter() - t0) * 1000)
+        conn.close()
+        with lock:
+            read_lat.extend(local)
+            stats["reads"] += len(local)
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+
+    # 寫入持續進行時做一次線上備份
+    mark = len(write_lat)
+    result = storage.backup(db_file, os.path.join(tmp, "backup.db"))
+    time.sleep(0.2)
+    during_backup = max(write_lat[mark:], default=0.0)
+
+    stop.set()
+    for t in threads:
+        t.join()
+
+    print(f"[{profile_name}] journal={profile['journal_mode']} synchronous={profile['synchronous']}")
+    print(f"  writes/s={stats['writes'] / seconds:,.0f}  write p99={percentile(write_lat, 0.99):.2f} ms")
+    print(f"  reads/s={stats['reads'] / seconds:,.0f}  read p50={percentile(read_lat, 0.5):.2f} ms"
+          f"  p99={percentile(read_lat, 0.99):.2f} ms  locked={stats['locked']}")
+    print(f"  backup={result['durationMs']:.0f} ms  max write latency during backup={during_backup:.2f} ms")
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    for name in ("legacy", "durable", "balanced"):
+        run(name, seconds, readers)
+
+
+if __name__ == "__main__":
+    main()
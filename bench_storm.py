@@ -0,0 +1,195 @@
+# 重連風暴模擬：比較沒有准入控制（全部 Accepted、interval 固定 10 秒）與 admission.py 的設定
+#
+#   python bench_storm.py [充電樁數] [模擬秒數]
+#       以模擬時鐘跑事件模擬（不需啟動伺服器），統計每秒訊息數（CPU 負載）與每秒 DB 寫入數
+#   python bench_storm.py 2000 120 --url ws://localhost:9000 [--pid 伺服器 PID]
+#       對執行中的中央系統實際建立連線，回報每秒訊息數、回覆延遲；指定 --pid 時同時取樣伺服器 CPU%
+#
+# 每個充電樁在 0~2 秒內重新連線：連線 -> BootNotification（Pending 時依 interval 重送）
+# -> 每個連接器一則 StatusNotification（狀態有變化時寫入 status_intervals）-> 依 interval 送 Heartbeat。
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import time
+from collections import Counter
+
+from admission import AdmissionController
+
+CONNECTORS = 2
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(controller_factory, chargers, seconds, seed=1):
+    clock = SimClock()
+    controller = controller_factory(clock)
+    rng = random.Random(seed)
+    events = [(rng.uniform(0, 2), i, "connect") for i in range(chargers)]
+    heapq.heapify(events)
+    messages, writes = Counter(), Counter()
+    accepted_at = {}
+    while events:
+        at, i, kind = heapq.heappop(events)
+        if at >= seconds:
+            break
+        clock.now = at
+        second = int(at)
+        cp_id = f"CP{i:05d}"
+        if kind == "connect":
+            messages[second] += 1
+            ok, retry_after = controller.admit_connection(cp_id)
+            heapq.heappush(events, (at + (0.05 if ok else retry_after), i, "boot" if ok else "connect"))
+        elif kind == "boot":
+            messages[second] += 1
+            status, interval = controller.admit_boot(cp_id)
+            if status == "Accepted":
+                accepted_at[i] = at
+                messages[second] += CONNECTORS
+                writes[second] += CONNECTORS
+                heapq.heappush(events, (at + interval, i, "heartbeat"))
+            else:
+                heapq.heappush(events, (at + interval, i, "boot"))
+        else:
+            messages[second] += 1
+            heapq.heappush(events, (at + controller.heartbeat_interval(cp_id), i, "heartbeat"))
+    per_second = [messages[s] for s in range(int(seconds))]
+    # 穩定期（全部接受之後）的 heartbeat 每秒分布
+    settled = int(max(accepted_at.values(), default=0)) + 1
+    steady = per_second[settled:] or [0]
+    return {
+        "peakMsgs": max(per_second),
+        "p99Msgs": percentile(per_second, 0.99),
+        "peakWrites": max(writes.values(), default=0),
+        "accepted": len(accepted_at),
+        "allAcceptedAt": max(accepted_at.values(), default=0),
+        "steadyPeak": max(steady),
+        "steadyMean": sum(steady) / len(steady),
+        **controller.stats,
+    }
+
+
+def run_simulation(chargers, seconds):
+    scenarios = {
+        "baseline": lambda clock: AdmissionController(0, 0, 0, 0, heartbeat_interval=10, heartbeat_spread=0,
+                                                      clock=clock, rng=random.Random(2)),
+        "admission": lambda clock: AdmissionController(clock=clock, rng=random.Random(2)),
+    }
+    for name, factory in scenarios.items():
+        r = simulate(factory, chargers, seconds)
+        print(f"[{name}] chargers={chargers} accepted={r['accepted']} all accepted at {r['allAcceptedAt']:.1f} s")
+        print(f"  peak msgs/s={r['peakMsgs']:,}  p99 msgs/s={r['p99Msgs']:,}  peak DB writes/s={r['peakWrites']:,}")
+        print(f"  steady heartbeat msgs/s peak={r['steadyPeak']:,} mean={r['steadyMean']:,.0f}"
+              f"  connect rejected={r['connectRejected']:,}  boot pending={r['bootPending']:,}")
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def run_live(url, chargers, seconds, pid):
+    import websockets
+
+    messages, latencies, counts = Counter(), [], Counter()
+    started = time.monotonic()
+    deadline = started + seconds
+
+    async def call(ws, uid, action, payload):
+        t0 = time.perf_counter()
+        await ws.send(json.dumps([2, uid, action, payload]))
+        messages[int(time.monotonic() - started)] += 1
+        while True:
+            msg = json.loads(await ws.recv())
+            if msg[0] == 2:
+                await ws.send(json.dumps([4, msg[1], "NotSupported", "", {}]))
+                continue
+            latencies.append((time.perf_counter() - t0) * 1000)
+            return msg[2] if msg[0] == 3 else {}
+
+    async def charger(i):
+        await asyncio.sleep(random.uniform(0, 2))
+        cp_id = f"STORM{i:05d}"
+        while time.monotonic() < deadline:
+            try:
+                async with websockets.connect(f"{url.rstrip('/')}/{cp_id}", subprotocols=["ocpp1.6"],
+                                              open_timeout=30) as ws:
+                    counts["connected"] += 1
+                    n = 0
+                    while True:
+                        n += 1
+                        reply = await call(ws, f"b{n}", "BootNotification",
+                                           {"chargePointModel": "Storm", "chargePointVendor": "Bench"})
+                        if reply.get("status") == "Accepted":
+                            counts["accepted"] += 1
+                            break
+                        counts["pending"] += 1
+                        await asyncio.sleep(reply.get("interval", 10))
+                    for c in range(1, CONNECTORS + 1):
+                        await call(ws, f"s{c}", "StatusNotification",
+                                   {"connectorId": c, "errorCode": "NoError", "status": "Available"})
+                    while time.monotonic() < deadline:
+                        await asyncio.sleep(reply.get("interval", 10))
+                        await call(ws, f"h{n}", "Heartbeat", {})
+                        n += 1
+                return
+            except websockets.exceptions.InvalidStatus as e:
+                counts["rejected"] += 1
+                await asyncio.sleep(float(e.response.headers.get("Retry-After", 5)))
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
+                counts["errors"] += 1
+                await asyncio.sleep(5)
+
+    async def sample_cpu():
+        samples, last = [], cpu_seconds(pid)
+        while time.monotonic() < deadline:
+            await asyncio.sleep(1)
+            now = cpu_seconds(pid)
+            samples.append((now - last) * 100)
+            last = now
+        return samples
+
+    cpu_task = asyncio.ensure_future(sample_cpu()) if pid else None
+    await asyncio.gather(*(charger(i) for i in range(chargers)), return_exceptions=True)
+    per_second = [messages[s] for s in range(int(seconds))]
+    print(f"chargers={chargers} connected={counts['connected']} accepted={counts['accepted']}"
+          f" pending={counts['pending']} rejected={counts['rejected']} errors={counts['errors']}")
+    print(f"peak msgs/s={max(per_second, default=0):,}  latency p50={percentile(latencies, 0.5):.1f} ms"
+          f" p99={percentile(latencies, 0.99):.1f} ms")
+    if cpu_task:
+        cpu = await cpu_task
+        print(f"server CPU peak={max(cpu, default=0):.0f}%  mean={sum(cpu) / max(len(cpu), 1):.0f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重連風暴模擬")
+    parser.add_argument("chargers", nargs="?", type=int, default=5000)
+    parser.add_argument("seconds", nargs="?", type=float, default=300)
+    parser.add_argument("--url", help="對執行中的中央系統實測，例如 ws://localhost:9000")
+    parser.add_argument("--pid", type=int, help="取樣此 PID 的 CPU 使用率（僅 --url 模式）")
+    args = parser.parse_args()
+    if args.url:
+        asyncio.run(run_live(args.url, args.chargers, args.seconds, args.pid))
+    else:
+        run_simulation(args.chargers, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# 交易費用計算
+#
+# 由 /api/transactions/{id}/cost、/api/transactions/cost-summary 與背景工作（jobs.py）共用；
+# 資料經由傳入的 repository 取得：主程式的 repo、唯讀副本（replica.ReplicaRepository），
+# 或工作程序自己開啟的連線。
+
+import logging
+from datetime import datetime
+
+from repository import season_and_day_type
+
+
+def rule_price(rules, dt):
+    # rules：list_pricing_rules() 的 (season, day_type, start_time, end_time, price)；
+    # 時段可跨午夜，多筆符合時取開始時間最晚的一筆，沒有符合的時段時為 0
+    season, day_type = season_and_day_type(dt)
+    t = dt.strftime("%H:%M")
+    matches = [rule for rule in rules if rule[0] == season and rule[1] == day_type and (
+        (rule[2] <= rule[3] and rule[2] <= t < rule[3]) or
+        (rule[2] > rule[3] and (t >= rule[2] or t < rule[3]))
+    )]
+    return max(matches, key=lambda rule: rule[2])[4] if matches else 0
+
+
+def _time(text):
+    # 充電樁送來的時間通常帶 Z；電價時段以時間字串上的時刻判斷
+    return datetime.fromisoformat(text).replace(tzinfo=None)
+
+
+def calculate_transaction_cost(txn, meter_values, rules, base_rate):
+    # txn：transactions 資料列；meter_values：該交易依時間排序的 (timestamp, value, ...)；
+    # base_rate：get_base_rate() 的 (基本費, 超量門檻 kWh, 超量加價)
+    transaction_id, meter_start, start_timestamp, meter_stop, stop_timestamp = txn[0], txn[4], txn[5], txn[6], txn[7]
+    if base_rate is None:
+        raise LookupError("尚未設定基本費（base_rates）")
+
+    start_time = _time(start_timestamp)
+    stop_time = _time(stop_timestamp)
+    total_kwh = (meter_stop - meter_start) / 1000  # 以 Wh 計算轉換為 kWh
+
+    # 若資料筆數不足，直接以平均價計算
+    if len(meter_values) < 2:
+        price = rule_price(rules, start_time)
+        energy_cost = total_kwh * price
+        detail = [{
+            "from": start_time.isoformat(),
+            "to": stop_time.isoformat(),
+            "kWh": round(total_kwh, 3),
+            "price": price,
+            "cost": round(energy_cost, 2)
+        }]
+    else:
+        detail = []
+        energy_cost = 0
+        for i in range(1, len(meter_values)):
+            t1 = _time(meter_values[i - 1][0])
+            t2 = _time(meter_values[i][0])
+            v1 = float(meter_values[i - 1][1])
+            v2 = float(meter_values[i][1])
+            kwh = max((v2 - v1) / 1000, 0)
+            price = rule_price(rules, t1)
+            cost = kwh * price
+            energy_cost += cost
+            detail.append({
+                "from": t1.isoformat(),
+                "to": t2.isoformat(),
+                "kWh": round(kwh, 3),
+                "price": price,
+                "cost": round(cost, 2)
+            })
+
+    # 基本費與超量加價
+    basic_fee, threshold, delta = base_rate
+    over_kwh = max(total_kwh - threshold, 0)
+    overuse_fee = over_kwh * delta if over_kwh > 0 else 0
+
+    return {
+        "transactionId": transaction_id,
+        "totalCost": round(basic_fee + energy_cost + overuse_fee, 2),
+        "basicFee": round(basic_fee, 2),
+        "energyCost": round(energy_cost, 2),
+        "overuseFee": round(overuse_fee, 2),
+        "totalKWh": round(total_kwh, 3),
+        "unit": "kWh",
+        "details": detail
+    }
+
+
+async def transaction_cost(repo, transaction_id):
+    txn = await repo.get_transaction(transaction_id)
+    if not txn or txn[6] is None:
+        raise LookupError("Transaction not found or not completed.")
+    meter_values = (await repo.list_meter_values([transaction_id]))[transaction_id]
+    return calculate_transaction_cost(txn, meter_values, await repo.list_pricing_rules(), await repo.get_base_rate())
+
+
+async def transaction_costs(repo, txns, progress=None, chunk_size=200):
+    # 多筆已結束交易的費用，電錶資料每 chunk_size 筆交易查詢一次；計算失敗的交易記錄警告後略過。
+    # progress(已處理筆數) 在每一批開始前呼叫（背景工作回報進度、檢查取消）
+    rules = await repo.list_pricing_rules()
+    base_rate = await repo.get_base_rate()
+    result = []
+    for start in range(0, len(txns), chunk_size):
+        if progress is not None:
+            progress(start)
+        chunk = txns[start:start + chunk_size]
+        meter_values = await repo.list_meter_values([txn[0] for txn in chunk])
+        for txn in chunk:
+            try:
+                result.append(calculate_transaction_cost(txn, meter_values[txn[0]], rules, base_rate))
+            except Exception as e:
+                logging.warning(f"⚠️ 計算交易 {txn[0]} 失敗：{e}")
+    return result
@@ -0,0 +1,199 @@
+# 批次匯入（id_tags / users / cards）
+#
+# 以串流方式讀取 CSV 或 NDJSON 上傳內容，不把整個檔案載入記憶體：
+# 每 CHUNK_SIZE 筆驗證一次，通過的資料以 executemany 在同一個交易內寫入（獨立連線），
+# 驗證失敗的資料逐筆回報行號與原因。
+
+import csv
+import json
+from datetime import datetime
+
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+MAX_RECORD_BYTES = 1024 * 1024     # 單筆 CSV 紀錄（含引號內換行）的上限，避免未閉合的引號吃掉整個檔案
+
+ID_TAG_STATUSES = {"Accepted", "Blocked", "Expired", "Invalid", "ConcurrentTx"}
+
+
+def detect_format(request, fmt=None):
+    if fmt:
+        fmt = fmt.lower()
+    else:
+        content_type = request.headers.get("content-type", "")
+        fmt = "csv" if "csv" in content_type else "ndjson"
+    if fmt not in ("csv", "ndjson"):
+        raise ValueError("format 必須為 csv 或 ndjson")
+    return fmt
+
+
+def _decode(raw, first):
+    # 無法以 UTF-8 解碼的行回傳 None，由 iter_rows 回報為該行的錯誤
+    try:
+        return raw.decode("utf-8-sig" if first else "utf-8").rstrip("\r")
+    except UnicodeDecodeError:
+        return None
+
+
+async def iter_lines(request):
+    # 逐塊讀取 request body 並切成行，回傳 (行號, 文字)；文字為 None 表示該行不是有效的 UTF-8
+    buffer = b""
+    line_no = 0
+    first = True
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for raw in lines:
+            line_no += 1
+            text = _decode(raw, first)
+            first = False
+            yield line_no, text
+    if buffer:
+        yield line_no + 1, _decode(buffer, first)
+
+
+class _PendingLines:
+    # csv.reader 的行來源：每次放入一筆完整紀錄的所有行，讓同一個 reader 解析含換行的引號欄位
+    def __init__(self):
+        self.lines = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.pop(0)
+
+
+async def iter_rows(request, fmt):
+    # 回傳 (行號, dict)；無法解析的行回傳 (行號, 錯誤訊息字串)。CSV 的行號為該筆紀錄的第一行
+    header = None
+    source = _PendingLines()
+    reader = csv.reader(source)
+    record, start_no, quotes = [], 0, 0
+    async for line_no, text in iter_lines(request):
+        if text is None:
+            # 延續中的 CSV 紀錄一併作廢，錯誤回報在紀錄的第一行
+            yield (start_no if record else line_no), "不是有效的 UTF-8 文字"
+            record, quotes = [], 0
+            continue
+        if not record and not text.strip():
+            continue
+        if fmt == "csv":
+            # 引號數為奇數表示引號欄位內有換行，紀錄延續到下一行
+            if not record:
+                start_no = line_no
+            record.append(text + "\n")
+            quotes += text.count('"')
+            if quotes % 2:
+                if sum(map(len, record)) > MAX_RECORD_BYTES:
+                    yield start_no, "引號未閉合"
+                    return
+                continue
+            source.lines, record, quotes = record, [], 0
+            line_no = start_no
+            try:
+                values = next(reader)
+            except csv.Error as e:
+                source.lines = []
+                yield line_no, f"CSV 格式錯誤：{e}"
+                continue
+            if header is None:
+                header = [h.strip() for h in values]
+                continue
+            if len(values) != len(header):
+                yield line_no, f"欄位數量 {len(values)} 與標題 {len(header)} 不符"
+                continue
+            yield line_no, dict(zip(header, values))
+        else:
+            try:
+                row = json.loads(text)
+            except json.JSONDecodeError as e:
+                yield line_no, f"JSON 格式錯誤：{e.msg}"
+                continue
+            if not isinstance(row, dict):
+                yield line_no, "每行必須是 JSON 物件"
+                continue
+            yield line_no, row
+    if record:
+        yield start_no, "引號未閉合"
+
+
+def _text(row, key):
+    value = row.get(key)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def validate_id_tag(row):
+    id_tag = _text(row, "idTag")
+    if not id_tag:
+        raise ValueError("idTag is required")
+    status = _text(row, "status") or "Accepted"
+    if status not in ID_TAG_STATUSES:
+        raise ValueError(f"status 不合法：{status}")
+    valid_until = _text(row, "validUntil") or "2099-12-31T23:59:59"
+    try:
+        datetime.fromisoformat(valid_until)
+    except ValueError:
+        raise ValueError(f"validUntil 格式錯誤：{valid_until}")
+    return (id_tag, status, valid_until)
+
+
+def validate_user(row):
+    id_tag = _text(row, "idTag")
+    if not id_tag:
+        raise ValueError("idTag is required")
+    return (id_tag, _text(row, "name"), _text(row, "department"), _text(row, "cardNumber"))
+
+
+def validate_card_topup(row):
+    card_id = _text(row, "cardId") or _text(row, "idTag")
+    if not card_id:
+        raise ValueError("cardId is required")
+    try:
+        amount = float(row.get("amount"))
+    except (TypeError, ValueError):
+        raise ValueError("儲值金額錯誤")
+    if not amount > 0:
+        raise ValueError("儲值金額錯誤")
+    return (card_id, amount)
+
+
+async def import_rows(request, fmt, validate, write, chunk_size=CHUNK_SIZE):
+    # write(rows)：在一個交易內寫入一批資料，失敗時拋出例外並還原該批
+    result = {"imported": 0, "failed": 0, "errors": []}
+
+    def add_error(line_no, message):
+        result["failed"] += 1
+        if len(result["errors"]) < MAX_REPORTED_ERRORS:
+            result["errors"].append({"line": line_no, "error": message})
+
+    async def flush(batch):
+        if not batch:
+            return
+        try:
+            await write([params for _, params in batch])
+            result["imported"] += len(batch)
+        except Exception as e:
+            for line_no, _ in batch:
+                add_error(line_no, f"寫入失敗：{e}")
+
+    batch = []
+    async for line_no, row in iter_rows(request, fmt):
+        if isinstance(row, str):
+            add_error(line_no, row)
+            continue
+        try:
+            batch.append((line_no, validate(row)))
+        except ValueError as e:
+            add_error(line_no, str(e))
+            continue
+        if len(batch) >= chunk_size:
+            await flush(batch)
+            batch = []
+    await flush(batch)
+    return result
@@ -1,91 +1,244 @@
-import uuid  # 在檔案最上方加入
+# 場域集中器（edge concentrator）
+#
+# 部署在場域端，終止該場域所有充電樁的 WebSocket，只用一條多工連線（格式見 mux.py）連到主程式，
+# 減少主程式的連線數與每個充電樁跨 WAN 的來回次數：
+# - Heartbeat 在本地直接回覆，不轉送
+# - BootNotification 在本地回 Accepted（interval = CONCENTRATOR_HEARTBEAT_INTERVAL），並轉送給主程式記錄
+# - MeterValues 在本地立即回 {}，累積後每 CONCENTRATOR_BATCH_INTERVAL 秒（或滿 CONCENTRATOR_BATCH_MAX 則）
+#   合併成一則 batch 送出；本地已回覆的訊息主程式照常處理，但不再回覆
+# - 其餘 Call（Authorize、StartTransaction、StopTransaction、StatusNotification...）與充電樁對主程式 Call 的
+#   回覆原樣轉送；轉送前先送出排隊中的 batch，同一充電樁的訊息順序不變
+# - 主程式發出的 Call（RemoteStart、SetChargingProfile...）轉給對應的充電樁
+# 上行連線中斷時自動重連，重連後對所有在線充電樁重送 connect。斷線期間需要主程式回覆的 Call 直接回
+# CallError InternalError（充電樁會依自己的重試機制再送）；batch 留在記憶體，最多 CONCENTRATOR_BUFFER_MAX 則，
+# 超過時捨棄最舊的。集中器不驗證 payload，本地已回覆的訊息若格式錯誤只會記錄在主程式的 log。
+# 充電樁超過 heartbeat 間隔 × LIVENESS_MULTIPLIER 沒有任何訊息時由集中器關閉（見 liveness.py）。
+#
+# 環境變數：CONCENTRATOR_UPSTREAM（主程式 OCPP 位址，例如 ws://csms.example.com:9000，必填）、
+# CONCENTRATOR_SITE（場域名稱，預設 site）、CONCENTRATOR_PORT（充電樁連線的埠，預設 9000）、
+# CONCENTRATOR_TOKEN（與主程式相同）、CONCENTRATOR_HEARTBEAT_INTERVAL（秒，預設 300）、
+# CONCENTRATOR_BATCH_INTERVAL（秒，預設 1）、CONCENTRATOR_BATCH_MAX（預設 200）、CONCENTRATOR_BUFFER_MAX（預設 50000）
+
 import asyncio
 import logging
-from datetime import datetime
+import os
+from collections import Counter
+from datetime import datetime, timezone
 
+import websockets
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
 from websockets.server import serve
-from ocpp.routing import on
-from ocpp.v16 import call
-from ocpp.v16.enums import RegistrationStatus, Action
-from ocpp.v16 import ChargePoint as BaseChargePoint
-from ocpp.v16.call_result import BootNotification, Heartbeat, MeterValues, StartTransaction, StopTransaction
-from ocpp.v16.call_result import StopTransaction as StopTransactionPayload
-
-logging.basicConfig(level=logging.DEBUG)
-
-class ChargePoint(BaseChargePoint):
-    @on(Action.boot_notification)
-    async def on_boot_notification(self, charge_point_model, charge_point_vendor, **kwargs):
-        print(f"🔌 BootNotification 來自: {self.id} / {charge_point_vendor}")
-        return BootNotification(
-            current_time=datetime.utcnow().isoformat(),
-            interval=10,
-            status=RegistrationStatus.accepted
-        )
-
-
-    @on(Action.start_transaction)
-    async def on_start_transaction(self, connector_id, id_tag, meter_start, timestamp, **kwargs):
-        print(f"🔋 StartTransaction from {self.id} | connector: {connector_id}, idTag: {id_tag}, meterStart: {meter_start}, time: {timestamp}")
-        transaction_id = 1  # 這裡先用固定整數測試，之後可改成交易編號遞增系統
-        return StartTransaction(
-            transaction_id=transaction_id,
-            id_tag_info={
-                "status": "Accepted"
-            }
-        )
-
-
-    @on(Action.stop_transaction)
-    async def on_stop_transaction(self, transaction_id, meter_stop, timestamp, id_tag, reason, **kwargs):
-        print(f"🛑 StopTransaction from {self.id} | transactionId: {transaction_id}, meterStop: {meter_stop}, time: {timestamp}, idTag: {id_tag}, reason: {reason}")
-        return StopTransactionPayload(
-            id_tag_info={
-                "status": "Accepted"
-            }
-        )
-
-
-
-
-
-    @on(Action.heartbeat)
-    async def on_heartbeat(self):
-        now = datetime.utcnow().isoformat()
-        print(f"❤️ Heartbeat received from CP={self.id} at {now}")
-        return Heartbeat(current_time=now)
-
-    @on(Action.meter_values)
-    async def on_meter_values(self, connector_id, meter_value, **kwargs):
-        print(f"⚡ MeterValues 來自 {self.id} / connector {connector_id}")
-        for entry in meter_value:
-            timestamp = entry.get("timestamp")
-            for sampled_value in entry.get("sampledValue", []):
-                measurand = sampled_value.get("measurand", "Energy.Active.Import.Register")
-                value = sampled_value.get("value")
-                unit = sampled_value.get("unit", "Wh")
-                print(f"   - {timestamp} | {measurand}: {value} {unit}")
-        return MeterValues()
-
-async def on_connect(websocket, path):
-    from websockets.exceptions import ConnectionClosedOK
-    try:
+from ocpp.messages import MessageType
+
+import log_pipeline
+import mux
+from liveness import LivenessManager
+from codec import dumps, loads, JSONDecodeError
+
+# LOG_LEVEL=DEBUG 可看到完整除錯訊息（見 log_pipeline.py）
+log_pipeline.setup()
+
+CONCENTRATOR_UPSTREAM = os.getenv("CONCENTRATOR_UPSTREAM", "")
+CONCENTRATOR_SITE = os.getenv("CONCENTRATOR_SITE", "site")
+CONCENTRATOR_PORT = int(os.getenv("CONCENTRATOR_PORT", "9000"))
+CONCENTRATOR_HEARTBEAT_INTERVAL = int(os.getenv("CONCENTRATOR_HEARTBEAT_INTERVAL", "300"))
+CONCENTRATOR_BATCH_INTERVAL = float(os.getenv("CONCENTRATOR_BATCH_INTERVAL", "1"))
+CONCENTRATOR_BATCH_MAX = int(os.getenv("CONCENTRATOR_BATCH_MAX", "200"))
+CONCENTRATOR_BUFFER_MAX = int(os.getenv("CONCENTRATOR_BUFFER_MAX", "50000"))
+
+STATS_INTERVAL = 60
+RECONNECT_MAX = 30
+
+CALL, CALL_RESULT, CALL_ERROR = int(MessageType.Call), int(MessageType.CallResult), int(MessageType.CallError)
+BATCHED_ACTIONS = {"BootNotification", "MeterValues"}
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Concentrator:
+    def __init__(self, upstream, site, token=mux.CONCENTRATOR_TOKEN,
+                 heartbeat_interval=CONCENTRATOR_HEARTBEAT_INTERVAL, batch_interval=CONCENTRATOR_BATCH_INTERVAL,
+                 batch_max=CONCENTRATOR_BATCH_MAX, buffer_max=CONCENTRATOR_BUFFER_MAX):
+        self.url = f"{upstream.rstrip('/')}{mux.PATH_PREFIX}{site}"
+        self.site = site
+        self.headers = [(mux.TOKEN_HEADER, token)] if token else []
+        self.heartbeat_interval = heartbeat_interval
+        self.batch_interval = batch_interval
+        self.batch_max = batch_max
+        self.buffer_max = buffer_max
+        self.chargers = {}        # cp_id -> 充電樁的 websocket
+        self.batch = []           # [[cp_id, raw], ...] 本地已回覆、等待送出的 frame
+        self.uplink = None
+        self.stats = Counter()
+        self.liveness = LivenessManager()
+        self._flush_now = asyncio.Event()
+
+    # === 上行 ===
+
+    async def _send_up(self, message):
+        await self.uplink.send(dumps(message))
+        self.stats["upstreamMessages"] += 1
+
+    async def _notify(self, message):
+        # connect / disconnect：上行中斷時略過，重連後會重送目前在線的充電樁
+        if self.uplink is None:
+            return
+        try:
+            await self._send_up(message)
+        except ConnectionClosed:
+            pass
+
+    async def flush(self):
+        if not self.batch or self.uplink is None:
+            return
+        batch, self.batch = self.batch, []
+        try:
+            await self._send_up([mux.BATCH, batch])
+        except ConnectionClosed:
+            self.batch[:0] = batch
+            self._trim()
+            return
+        self.stats["batchedFrames"] += len(batch)
+
+    def _trim(self):
+        overflow = len(self.batch) - self.buffer_max
+        if overflow > 0:
+            del self.batch[:overflow]
+            self.stats["droppedFrames"] += overflow
+            logging.warning(f"⚠️ 上行中斷，batch 超過 {self.buffer_max} 則，捨棄最舊的 {overflow} 則")
+
+    async def run_uplink(self):
+        delay = 1
+        while True:
+            try:
+                async with websockets.connect(self.url, additional_headers=self.headers,
+                                              subprotocols=["ocpp1.6"], max_size=None) as ws:
+                    self.uplink = ws
+                    delay = 1
+                    logging.info(f"🛰️ 已連上主程式：{self.url}（在線充電樁 {len(self.chargers)}）")
+                    # 重送在線充電樁：充電樁與集中器的連線沒有中斷，主程式不對它們做連線速率限制
+                    for cp_id in list(self.chargers):
+                        await self._send_up([mux.CONNECT, cp_id, True])
+                    await self.flush()
+                    async for message in ws:
+                        await self._downstream(message)
+            except (OSError, asyncio.TimeoutError, InvalidHandshake, ConnectionClosed) as e:
+                logging.warning(f"⚠️ 主程式連線中斷：{e!r}，{delay} 秒後重連")
+            finally:
+                self.uplink = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    async def _downstream(self, message):
+        try:
+            msg = loads(message)
+            kind, cp_id = msg[0], msg[1]
+        except (JSONDecodeError, TypeError, IndexError, KeyError):
+            logging.warning(f"⚠️ 主程式送來無法解析的訊息：{message[:200]!r}")
+            return
+        websocket = self.chargers.get(cp_id)
+        if websocket is None:
+            if kind == mux.FRAME:
+                await self._notify([mux.DISCONNECT, cp_id])
+            return
+        if kind == mux.FRAME:
+            try:
+                await websocket.send(msg[2])
+                self.stats["downstreamFrames"] += 1
+            except ConnectionClosed:
+                pass
+        elif kind == mux.CLOSE:
+            logging.info(f"🚫 主程式拒絕充電樁 {cp_id}，關閉連線")
+            await websocket.close(1013, "Try again later")
+
+    async def run_batches(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.batch_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            logging.info(f"📊 集中器 {self.site} | 在線充電樁 {len(self.chargers)} | {dict(self.stats)}")
+
+    # === 充電樁 ===
+
+    async def on_charger(self, websocket, path):
         cp_id = path.strip("/")
-        cp = ChargePoint(cp_id, websocket)
-        logging.info(f"🪻 有充電樁嘗試連線：ID={cp_id}，IP={websocket.remote_address[0]} Port={websocket.remote_address[1]}")
-        await cp.start()
-    except ConnectionClosedOK:
-        logging.info("🔌 連線正常結束。")
+        old = self.chargers.get(cp_id)
+        self.chargers[cp_id] = websocket
+        if old is not None:
+            await old.close()
+        logging.info(f"🔌 充電樁已連線：{cp_id}，IP={websocket.remote_address[0]}")
+        self.liveness.register(cp_id, websocket.close, self.heartbeat_interval)
+        try:
+            await self._notify([mux.CONNECT, cp_id])
+            async for raw in websocket:
+                await self.on_frame(cp_id, websocket, raw)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.liveness.unregister(cp_id, websocket.close)
+            if self.chargers.get(cp_id) is websocket:
+                del self.chargers[cp_id]
+                await self._notify([mux.DISCONNECT, cp_id])
+            logging.info(f"🔌 充電樁已離線：{cp_id}")
+
+    async def on_frame(self, cp_id, websocket, raw):
+        self.stats["chargerFrames"] += 1
+        self.liveness.touch(cp_id)
+        try:
+            msg = loads(raw)
+            message_type, unique_id = msg[0], msg[1]
+            action = msg[2] if message_type == CALL else None
+        except (JSONDecodeError, TypeError, IndexError, KeyError):
+            # 交給主程式回報格式錯誤
+            message_type = unique_id = action = None
+
+        if action == "Heartbeat":
+            await websocket.send(dumps([CALL_RESULT, unique_id, {"currentTime": now_iso()}]))
+            self.stats["answeredLocally"] += 1
+        elif action in BATCHED_ACTIONS:
+            payload = {}
+            if action == "BootNotification":
+                payload = {"currentTime": now_iso(), "interval": self.heartbeat_interval, "status": "Accepted"}
+            await websocket.send(dumps([CALL_RESULT, unique_id, payload]))
+            self.stats["answeredLocally"] += 1
+            self.batch.append([cp_id, raw])
+            if len(self.batch) >= self.batch_max:
+                self._flush_now.set()
+            if self.uplink is None:
+                self._trim()
+        else:
+            await self.forward(cp_id, websocket, raw, message_type, unique_id)
+
+    async def forward(self, cp_id, websocket, raw, message_type, unique_id):
+        if self.uplink is not None:
+            try:
+                await self.flush()
+                await self._send_up([mux.FRAME, cp_id, raw])
+                return
+            except ConnectionClosed:
+                pass
+        if message_type == CALL:
+            await websocket.send(dumps([CALL_ERROR, unique_id, "InternalError", "Upstream unavailable", {}]))
+
 
 async def main():
-    server = await serve(
-        on_connect,
-        "0.0.0.0",
-        9000,
-        subprotocols=["ocpp1.6"]
-    )
-    print("🚀 OCPP Central System 啟動中：ws://localhost:9000")
-    await server.wait_closed()
+    if not CONCENTRATOR_UPSTREAM:
+        raise SystemExit("請設定 CONCENTRATOR_UPSTREAM，例如 ws://csms.example.com:9000")
+    concentrator = Concentrator(CONCENTRATOR_UPSTREAM, CONCENTRATOR_SITE)
+    server = await serve(concentrator.on_charger, "0.0.0.0", CONCENTRATOR_PORT, subprotocols=["ocpp1.6"])
+    logging.info(f"🚀 場域集中器 {CONCENTRATOR_SITE} 啟動：ws://0.0.0.0:{CONCENTRATOR_PORT} -> {concentrator.url}")
+    await asyncio.gather(concentrator.run_uplink(), concentrator.run_batches(), concentrator.report(),
+                         concentrator.liveness.run(), server.wait_closed())
+
 
 if __name__ == '__main__':
     asyncio.run(main())
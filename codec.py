@@ -0,0 +1,276 @@
+# JSON 編解碼層
+#
+# - OCPP：以 orjson 解析/輸出 OCPP-J frame，驗證器依 (訊息類型, action) 快取，
+#   camelCase <-> snake_case 的欄位名稱轉換結果也快取起來
+# - 「信任充電樁」模式：列在 OCPP_TRUSTED_CHARGERS 的充電樁，對
+#   OCPP_TRUSTED_ACTIONS（預設 MeterValues）略過 JSON schema 驗證
+# - REST：FastJSONResponse 以 orjson 序列化回應
+#
+# 未安裝 orjson 時退回標準函式庫 json，行為相同只是較慢。
+
+import asyncio
+import decimal
+import inspect
+import json
+import logging
+import os
+import re
+import uuid
+from dataclasses import asdict
+from functools import lru_cache
+
+from fastapi.responses import JSONResponse
+from ocpp.exceptions import (
+    FormatViolationError, OCPPError, ProtocolError,
+    PropertyConstraintViolationError, ValidationError,
+)
+from ocpp.messages import Call, CallError, CallResult, MessageType, get_validator
+from ocpp.routing import create_route_map
+from ocpp.v16 import ChargePoint as OcppChargePoint
+from jsonschema.exceptions import ValidationError as SchemaValidationError
+
+import tracing
+from frame_journal import IN, OUT
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 依部署環境而定
+    orjson = None
+
+LOGGER = logging.getLogger("ocpp")
+
+TRUSTED_CHARGERS = {cp for cp in os.getenv("OCPP_TRUSTED_CHARGERS", "").split(",") if cp}
+TRUSTED_ACTIONS = {a for a in os.getenv("OCPP_TRUSTED_ACTIONS", "MeterValues").split(",") if a}
+
+# 這些訊息的 schema 需以 Decimal 解析浮點數（見 ocpp.messages.validate_payload）
+_DECIMAL_CALLS = {"SetChargingProfile", "RemoteStartTransaction"}
+_DECIMAL_RESULTS = {"GetCompositeSchedule"}
+
+
+def _default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return float("%.1f" % obj)
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default, option=_OPTIONS).decode()
+
+    def dumps_bytes(obj):
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    JSONDecodeError = orjson.JSONDecodeError
+else:
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_default)
+
+    def dumps_bytes(obj):
+        return dumps(obj).encode()
+
+    JSONDecodeError = json.JSONDecodeError
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps_bytes(content)
+
+
+# === camelCase <-> snake_case（結果快取） ===
+
+@lru_cache(maxsize=4096)
+def _snake(key):
+    s1 = re.sub("(.)([A-Z][a-z]+)", r"\1_\2", key)
+    return re.sub("([a-z0-9])([A-Z])(?=\\S)", r"\1_\2", s1).lower()
+
+
+@lru_cache(maxsize=4096)
+def _camel(key):
+    key = key.replace("soc", "SoC")
+    components = key.split("_")
+    return components[0] + "".join(x[:1].upper() + x[1:] for x in components[1:])
+
+
+def camel_to_snake_case(data):
+    if isinstance(data, dict):
+        return {_snake(k): camel_to_snake_case(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [camel_to_snake_case(v) for v in data]
+    return data
+
+
+def snake_to_camel_case(data):
+    # 同時移除值為 None 的欄位（等同 ocpp 的 remove_nones）
+    if isinstance(data, dict):
+        return {_camel(k): snake_to_camel_case(v) for k, v in data.items() if v is not None}
+    if isinstance(data, list):
+        return [snake_to_camel_case(v) for v in data if v is not None]
+    return data
+
+
+# === 驗證 ===
+
+@lru_cache(maxsize=None)
+def _validator(message_type_id, action, ocpp_version):
+    if message_type_id == MessageType.Call and action in _DECIMAL_CALLS or \
+            message_type_id == MessageType.CallResult and action in _DECIMAL_RESULTS:
+        return get_validator(message_type_id, action, ocpp_version, parse_float=decimal.Decimal), True
+    return get_validator(message_type_id, action, ocpp_version), False
+
+
+def validate(message, ocpp_version):
+    try:
+        validator, use_decimal = _validator(message.message_type_id, message.action, ocpp_version)
+    except (OSError, ValueError) as e:
+        raise ValidationError(f"Failed to load validation schema for action '{message.action}': {e}")
+    payload = message.payload
+    if use_decimal:
+        payload = json.loads(json.dumps(payload, default=_default), parse_float=decimal.Decimal)
+    try:
+        validator.validate(payload)
+    except SchemaValidationError as e:
+        raise ValidationError(f"Payload '{message.payload} for action '{message.action}' is not valid: {e}")
+
+
+def unpack(raw_msg):
+    try:
+        msg = loads(raw_msg)
+    except JSONDecodeError as e:
+        raise FormatViolationError(f"Message is not valid JSON: {e}")
+    if not isinstance(msg, list):
+        raise ProtocolError(f"OCPP message hasn't the correct format. It should be a list, but got {type(msg)} instead")
+    if not msg:
+        raise ProtocolError("Message doesn't contain MessageTypeID")
+    try:
+        if msg[0] == MessageType.Call:
+            return Call(*msg[1:])
+        if msg[0] == MessageType.CallResult:
+            return CallResult(*msg[1:])
+        if msg[0] == MessageType.CallError:
+            return CallError(*msg[1:])
+    except TypeError:
+        raise ProtocolError("OCPP message has the wrong number of elements")
+    raise PropertyConstraintViolationError(f"MessageTypeId '{msg[0]}' isn't valid")
+
+
+class FastChargePoint(OcppChargePoint):
+    # 與 ocpp.ChargePoint 相同的訊息流程，改用 orjson 與快取的驗證器
+
+    # 設定為 frame_journal.FrameJournal 時記錄所有收送的 frame
+    journal = None
+
+    def __init__(self, id, connection, response_timeout=30):
+        # 不呼叫 ocpp.ChargePoint.__init__：路由表每個類別只建一次（route_map），
+        # call() 用的 lock 與回覆佇列到第一次 call() 才建立，多數連線從頭到尾用不到
+        self.id = id
+        self._response_timeout = response_timeout
+        self._connection = connection
+        self._unique_id_generator = uuid.uuid4
+        self._lock = None
+        self._queue = None
+        self.trusted = id in TRUSTED_CHARGERS
+
+    @property
+    def route_map(self):
+        # {action: {"_on_action": 函式, ...}}，handler 以 handler(self, **kwargs) 呼叫
+        cls = type(self)
+        routes = cls.__dict__.get("_route_map")
+        if routes is None:
+            routes = create_route_map(cls)
+            cls._route_map = routes
+        return routes
+
+    @property
+    def _call_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def _response_queue(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def _send(self, message):
+        if self.journal is not None:
+            self.journal.record(self.id, OUT, message)
+        LOGGER.info("%s: send %s", self.id, message)
+        await self._connection.send(message)
+
+    async def route_message(self, raw_msg):
+        if self.journal is not None:
+            self.journal.record(self.id, IN, raw_msg)
+        try:
+            msg = unpack(raw_msg)
+        except OCPPError as e:
+            LOGGER.exception("Unable to parse message: '%s', it doesn't seem to be valid OCPP: %s", raw_msg, e)
+            return
+
+        if msg.message_type_id == MessageType.Call:
+            await self._handle_call(msg)
+        elif msg.message_type_id in (MessageType.CallResult, MessageType.CallError):
+            self._response_queue.put_nowait(msg)
+
+    async def _handle_call(self, msg):
+        # 每個收到的 Call 是一個 trace 的根 span（依 TRACE_SAMPLE_RATE 取樣，見 tracing.py）
+        with tracing.span(f"ocpp {msg.action}", tracing.SERVER, **{
+            "ocpp.charge_point": self.id, "ocpp.action": msg.action, "ocpp.unique_id": msg.unique_id,
+        }):
+            await self._dispatch_call(msg)
+
+    async def _dispatch_call(self, msg):
+        try:
+            handlers = self.route_map[msg.action]
+            handler = handlers["_on_action"]
+        except KeyError:
+            await self._send(dumps([
+                MessageType.CallError, msg.unique_id, "NotImplemented",
+                f"No handler for '{msg.action}' registered.", {},
+            ]))
+            return
+
+        skip = handlers.get("_skip_schema_validation", False) or \
+            (self.trusted and msg.action in TRUSTED_ACTIONS)
+
+        try:
+            if not skip:
+                try:
+                    validate(msg, self._ocpp_version)
+                except ValidationError as e:
+                    # 回覆 FormationViolation，而不是讓例外中斷整條連線
+                    raise FormatViolationError(str(e))
+            response = handler(self, **camel_to_snake_case(msg.payload))
+            if inspect.isawaitable(response):
+                response = await response
+        except Exception as e:
+            LOGGER.exception("Error while handling request '%s'", msg)
+            current = tracing.current_span()
+            if current is not None:
+                current.error = repr(e)
+            error = msg.create_call_error(e)
+            await self._send(dumps([
+                MessageType.CallError, error.unique_id, error.error_code,
+                error.error_description, error.error_details,
+            ]))
+            return
+
+        result = msg.create_call_result(snake_to_camel_case(asdict(response)))
+        if not skip:
+            validate(result, self._ocpp_version)
+        await self._send(dumps([MessageType.CallResult, result.unique_id, result.payload]))
+
+        after = handlers.get("_after_action")
+        if after is not None:
+            # 與 ocpp 相同：after handler 另開 task 執行，避免在其中呼叫 call() 時卡住
+            response = after(self, **camel_to_snake_case(msg.payload))
+            if inspect.isawaitable(response):
+                asyncio.ensure_future(response)
@@ -0,0 +1,153 @@
+# 對充電樁下 OCPP 指令（中央系統發起的 Call），可一次對整批充電樁
+#
+# POST /api/commands 指定 action、params（camelCase，與 OCPP 1.6 payload 相同）與目標：
+# chargePointIds（清單）、match（fnmatch 樣式）、site（集中器場域或 DB_SHARDS 場域），可同時指定，取交集。
+# - 指令在 OCPP 事件迴圈上並行送出，同時進行的數量以 semaphore 限制（concurrency，預設 COMMAND_CONCURRENCY），
+#   每個充電樁各自逾時（timeoutS，預設 COMMAND_TIMEOUT 秒）
+# - 結果以 NDJSON 串流回傳：每個充電樁完成就送出一行，最後一行是 summary；
+#   用戶端中途斷線時取消尚未完成的指令
+# - 每個充電樁同時只會有一個進行中的 Call（ocpp 的 call lock），同一充電樁的多個指令依序執行
+
+import asyncio
+import fnmatch
+import os
+import time
+from dataclasses import asdict
+
+from ocpp.exceptions import OCPPError, ValidationError
+from ocpp.messages import Call
+from ocpp.v16 import call
+
+from codec import camel_to_snake_case, dumps_bytes, snake_to_camel_case, validate
+
+COMMAND_CONCURRENCY = int(os.getenv("COMMAND_CONCURRENCY", "500"))
+COMMAND_TIMEOUT = float(os.getenv("COMMAND_TIMEOUT", "30"))
+
+# OCPP 1.6 中央系統可以發起的 Call
+ACTIONS = {
+    "CancelReservation", "ChangeAvailability", "ChangeConfiguration", "ClearCache", "ClearChargingProfile",
+    "DataTransfer", "GetCompositeSchedule", "GetConfiguration", "GetDiagnostics", "GetLocalListVersion",
+    "RemoteStartTransaction", "RemoteStopTransaction", "ReserveNow", "Reset", "SendLocalList",
+    "SetChargingProfile", "TriggerMessage", "UnlockConnector", "UpdateFirmware",
+}
+
+OK, REJECTED, ERROR, TIMEOUT, OFFLINE = "ok", "rejected", "error", "timeout", "offline"
+
+# 各指令回覆中表示成功的 status（未列出的指令只有 Accepted；沒有 status 欄位的回覆視為成功）
+SUCCESS_STATUSES = {
+    "ChangeAvailability": {"Accepted", "Scheduled"},
+    "ChangeConfiguration": {"Accepted", "RebootRequired"},
+    "UnlockConnector": {"Unlocked"},
+}
+
+
+def build_payload(action, params):
+    # 回傳 ocpp.v16.call 的 payload；action 或參數不正確時 ValueError
+    if action not in ACTIONS:
+        raise ValueError(f"不支援的指令：{action}，可用：{', '.join(sorted(ACTIONS))}")
+    if not isinstance(params, dict):
+        raise ValueError("params 必須為物件")
+    try:
+        payload = getattr(call, f"{action}Payload")(**camel_to_snake_case(params))
+    except TypeError as e:
+        raise ValueError(f"{action} 參數錯誤：{e}")
+    # 送出前先驗證一次，避免每個充電樁各自失敗
+    try:
+        validate(Call("0", action, snake_to_camel_case(asdict(payload))), "1.6")
+    except ValidationError as e:
+        raise ValueError(f"{action} 參數錯誤：{e}")
+    return payload
+
+
+def select(charge_points, charge_point_ids=None, match=None, site=None, site_of=None):
+    # charge_points: {cp_id: ChargePoint}；site_of(cp_id, cp) 回傳場域名稱
+    # 回傳 (連線中的目標, 指定了但不在線的 cp_id)
+    if charge_point_ids is None and match is None and site is None:
+        raise ValueError("請指定 chargePointIds、match 或 site")
+    if charge_point_ids is not None and not isinstance(charge_point_ids, list):
+        raise ValueError("chargePointIds 必須為陣列")
+    connected = dict(charge_points)
+    if charge_point_ids is not None:
+        wanted = list(dict.fromkeys(charge_point_ids))
+        offline = [cp_id for cp_id in wanted if cp_id not in connected]
+        candidates = [(cp_id, connected[cp_id]) for cp_id in wanted if cp_id in connected]
+    else:
+        offline = []
+        candidates = sorted(connected.items())
+    targets = [
+        (cp_id, cp) for cp_id, cp in candidates
+        if (match is None or fnmatch.fnmatchcase(cp_id, match)) and (site is None or site_of(cp_id, cp) == site)
+    ]
+    return targets, offline
+
+
+def _result(cp_id, status, started, response=None, error=None):
+    item = {"chargePointId": cp_id, "status": status, "elapsedMs": round((time.perf_counter() - started) * 1000, 1)}
+    if response is not None:
+        item["response"] = response
+    if error is not None:
+        item["error"] = error
+    return item
+
+
+async def send(cp, payload, timeout):
+    started = time.perf_counter()
+    try:
+        response = await asyncio.wait_for(cp.call(payload, suppress=False), timeout)
+    except asyncio.TimeoutError:
+        return _result(cp.id, TIMEOUT, started, error=f"{timeout:g} 秒內沒有回應")
+    except OCPPError as e:
+        # 充電樁回 CallError
+        return _result(cp.id, ERROR, started, error=f"{type(e).__name__}: {e.description}")
+    except Exception as e:
+        return _result(cp.id, ERROR, started, error=repr(e))
+    response = snake_to_camel_case(asdict(response)) if response is not None else {}
+    status = response.get("status")
+    success = SUCCESS_STATUSES.get(type(payload).__name__.removesuffix("Payload"), {"Accepted"})
+    return _result(cp.id, OK if status is None or status in success else REJECTED, started, response=response)
+
+
+async def fan_out(targets, payload, concurrency, timeout, emit):
+    # 在 OCPP 事件迴圈執行；每個結果呼叫 emit(dict)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(cp):
+        async with semaphore:
+            emit(await send(cp, payload, timeout))
+
+    await asyncio.gather(*(one(cp) for _, cp in targets))
+
+
+async def stream(ocpp_loop, action, targets, offline, payload, concurrency=COMMAND_CONCURRENCY,
+                 timeout=COMMAND_TIMEOUT):
+    # 在 API 事件迴圈執行的 async generator，產生 NDJSON 的每一行
+    api_loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    counts = {OK: 0, REJECTED: 0, ERROR: 0, TIMEOUT: 0, OFFLINE: len(offline)}
+    started = time.perf_counter()
+
+    def emit(item):
+        api_loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    async def run():
+        try:
+            await fan_out(targets, payload, concurrency, timeout, emit)
+        finally:
+            emit(None)
+
+    future = asyncio.run_coroutine_threadsafe(run(), ocpp_loop)
+    try:
+        for cp_id in offline:
+            yield dumps_bytes({"chargePointId": cp_id, "status": OFFLINE}) + b"\n"
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            counts[item["status"]] += 1
+            yield dumps_bytes(item) + b"\n"
+        yield dumps_bytes({"summary": {
+            "action": action, "targets": len(targets) + len(offline), **counts,
+            "elapsedMs": round((time.perf_counter() - started) * 1000, 1),
+        }}) + b"\n"
+    finally:
+        future.cancel()
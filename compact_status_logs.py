@@ -0,0 +1,227 @@
+# status_logs 一次性壓縮：把逐則記錄的 StatusNotification 轉成 status_intervals 的狀態區間
+#
+#   python compact_status_logs.py [資料庫檔 ...] [--dry-run] [--vacuum]
+#   DB_BACKEND=postgres DATABASE_URL=postgresql://... python compact_status_logs.py
+#
+# 未指定資料庫檔時處理主資料庫（ocpp_data.db）與 SHARD_DIR 下的所有場域分片。
+# - 依（充電樁, 連接器）分組，以解析後的時間排序（不是時間字串），連續相同的狀態合併成一段區間：
+#   每段結束於下一段開始的時間，最後一段為目前狀態（to_ts 為 NULL）。時間無法解析的紀錄略過並計數
+# - 升級後主程式已寫入 status_intervals 的連接器：舊資料接在既有的第一段之前，
+#   狀態相同時合併成一段（既有區間的開始時間往前延伸）
+# - 先在唯讀階段算出所有區間，再以一個短交易寫入區間並刪除已轉換的 status_logs；主程式執行中也可以執行
+# - 設定 DB_SHARDS 時，區間寫到該充電樁所屬的場域分片（主程式寫入目前狀態的檔案），並與分片中既有的區間銜接；
+#   各分片先 commit，最後才刪除來源的 status_logs
+# - --dry-run 只統計不寫入；--vacuum 完成後回收刪除的空間（SQLite）
+
+import argparse
+import asyncio
+import glob
+import itertools
+import os
+import sqlite3
+import time
+
+import sharding
+from repository import STATUS_INTERVALS_SCHEMA, parse_epoch_ms
+
+
+def compact_group(rows):
+    # rows：同一連接器的 [(id, status, timestamp)] -> ([[status, from_ts, to_ts]], 略過筆數)
+    ordered, skipped = [], 0
+    for row_id, status, timestamp in rows:
+        try:
+            ordered.append((parse_epoch_ms(timestamp), row_id, status))
+        except (AttributeError, ValueError):
+            skipped += 1
+    ordered.sort()
+    intervals = []
+    for ts, _, status in ordered:
+        if intervals and intervals[-1][0] == status:
+            continue
+        if intervals:
+            intervals[-1][2] = ts
+        intervals.append([status, ts, None])
+    return intervals, skipped
+
+
+def join_existing(intervals, first):
+    # 接在既有的第一段區間 first = (id, status, from_ts) 之前；回傳既有區間新的 from_ts（不需更新時為 None）
+    _, status, from_ts = first
+    extend_from = None
+    if intervals and intervals[-1][0] == status:
+        extend_from = min(intervals.pop()[1], from_ts)
+    if intervals:
+        last = intervals[-1]
+        last[2] = max(last[1], extend_from if extend_from is not None else from_ts)
+    return extend_from
+
+
+def report(name, stats, elapsed, dry_run):
+    ratio = stats["rows"] / stats["intervals"] if stats["intervals"] else 0
+    print(f"{name}：{stats['rows']:,} 筆 status_logs → {stats['intervals']:,} 段區間（{ratio:.1f}:1），"
+          f"{stats['connectors']:,} 個連接器，與既有區間合併 {stats['merged']}，"
+          f"無法解析時間略過 {stats['skipped']}，{elapsed:.1f} 秒{'（dry-run，未寫入）' if dry_run else ''}")
+
+
+def _new_stats():
+    return {"rows": 0, "connectors": 0, "intervals": 0, "merged": 0, "skipped": 0}
+
+
+# === SQLite ===
+
+def compact_sqlite(db_file, dry_run=False, vacuum=False, route=None):
+    # route(charge_point_id)：區間要寫入的資料庫檔，None 表示寫回 db_file
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+    targets = {os.path.abspath(db_file): conn}    # 資料庫檔 -> 寫入用連線（來源檔與各目標分片各一個交易）
+
+    def target(cp_id):
+        target_file = os.path.abspath((route(cp_id) if route and cp_id is not None else None) or db_file)
+        if target_file not in targets:
+            out = targets[target_file] = sqlite3.connect(target_file, timeout=30, isolation_level=None)
+            out.execute("BEGIN IMMEDIATE")
+            for statement in STATUS_INTERVALS_SCHEMA:
+                out.execute(statement)
+        return targets[target_file]
+
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'status_logs'").fetchone():
+            print(f"{db_file}：沒有 status_logs，略過")
+            return None
+        max_id = conn.execute("SELECT MAX(id) FROM status_logs").fetchone()[0] or 0
+
+        # 唯讀階段：逐連接器算出區間
+        stats, groups = _new_stats(), []
+        rows = conn.execute('''
+            SELECT charge_point_id, connector_id, id, status, timestamp FROM status_logs
+            WHERE id <= ? ORDER BY charge_point_id, connector_id
+        ''', (max_id,))
+        for key, group in itertools.groupby(rows, key=lambda r: (r[0], r[1])):
+            group = [(r[2], r[3], r[4]) for r in group]
+            intervals, skipped = compact_group(group)
+            stats["rows"] += len(group)
+            stats["connectors"] += 1
+            stats["skipped"] += skipped
+            groups.append((key, intervals))
+
+        # 寫入階段
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in STATUS_INTERVALS_SCHEMA:
+                conn.execute(statement)
+            for (cp_id, connector_id), intervals in groups:
+                out = target(cp_id)
+                first = out.execute('''
+                    SELECT id, status, from_ts FROM status_intervals
+                    WHERE charge_point_id IS ? AND connector_id IS ? ORDER BY from_ts, id LIMIT 1
+                ''', (cp_id, connector_id)).fetchone()
+                if first is not None:
+                    extend_from = join_existing(intervals, first)
+                    if extend_from is not None:
+                        stats["merged"] += 1
+                        out.execute("UPDATE status_intervals SET from_ts = ? WHERE id = ?", (extend_from, first[0]))
+                out.executemany('''
+                    INSERT INTO status_intervals (charge_point_id, connector_id, status, from_ts, to_ts)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(cp_id, connector_id, *interval) for interval in intervals])
+                stats["intervals"] += len(intervals)
+            conn.execute("DELETE FROM status_logs WHERE id <= ?", (max_id,))
+        except BaseException:
+            for target_conn in targets.values():
+                target_conn.execute("ROLLBACK")
+            raise
+        # 來源檔最後 commit：分片寫入失敗時 status_logs 仍在，可以重新執行
+        for target_conn in sorted(targets.values(), key=lambda c: c is conn):
+            target_conn.execute("ROLLBACK" if dry_run else "COMMIT")
+        if vacuum and not dry_run:
+            conn.execute("VACUUM")
+    finally:
+        for target_conn in targets.values():
+            target_conn.close()
+    report(db_file, stats, time.perf_counter() - started, dry_run)
+    return stats
+
+
+# === PostgreSQL ===
+
+async def compact_postgres(dsn, dry_run=False):
+    import asyncpg
+
+    started = time.perf_counter()
+    conn = await asyncpg.connect(dsn)
+    try:
+        if not await conn.fetchval("SELECT to_regclass('status_logs') IS NOT NULL"):
+            print("PostgreSQL：沒有 status_logs，略過")
+            return None
+        max_id = await conn.fetchval("SELECT MAX(id) FROM status_logs") or 0
+
+        stats, groups = _new_stats(), []
+        async with conn.transaction(readonly=True):
+            current, group = None, []
+            async for r in conn.cursor('''
+                SELECT charge_point_id, connector_id, id, status, timestamp FROM status_logs
+                WHERE id <= $1 ORDER BY charge_point_id, connector_id
+            ''', max_id, prefetch=10000):
+                key = (r[0], r[1])
+                if key != current and group:
+                    groups.append((current, group))
+                    group = []
+                current = key
+                group.append((r[2], r[3], r[4]))
+            if group:
+                groups.append((current, group))
+        compacted = []
+        for key, group in groups:
+            intervals, skipped = compact_group(group)
+            stats["rows"] += len(group)
+            stats["connectors"] += 1
+            stats["skipped"] += skipped
+            compacted.append((key, intervals))
+
+        tx = conn.transaction()
+        await tx.start()
+        try:
+            for (cp_id, connector_id), intervals in compacted:
+                first = await conn.fetchrow('''
+                    SELECT id, status, from_ts FROM status_intervals
+                    WHERE charge_point_id IS NOT DISTINCT FROM $1 AND connector_id IS NOT DISTINCT FROM $2
+                    ORDER BY from_ts, id LIMIT 1
+                ''', cp_id, connector_id)
+                if first is not None:
+                    extend_from = join_existing(intervals, tuple(first))
+                    if extend_from is not None:
+                        stats["merged"] += 1
+                        await conn.execute("UPDATE status_intervals SET from_ts = $1 WHERE id = $2", extend_from, first[0])
+                await conn.executemany('''
+                    INSERT INTO status_intervals (charge_point_id, connector_id, status, from_ts, to_ts)
+                    VALUES ($1, $2, $3, $4, $5)
+                ''', [(cp_id, connector_id, *interval) for interval in intervals])
+                stats["intervals"] += len(intervals)
+            await conn.execute("DELETE FROM status_logs WHERE id <= $1", max_id)
+        except BaseException:
+            await tx.rollback()
+            raise
+        await (tx.rollback() if dry_run else tx.commit())
+    finally:
+        await conn.close()
+    report("PostgreSQL", stats, time.perf_counter() - started, dry_run)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把 status_logs 壓縮成 status_intervals 狀態區間")
+    parser.add_argument("databases", nargs="*", help="SQLite 資料庫檔（預設：ocpp_data.db 與 SHARD_DIR/*.db）")
+    parser.add_argument("--dry-run", action="store_true", help="只統計，不寫入")
+    parser.add_argument("--vacuum", action="store_true", help="完成後 VACUUM 回收空間（SQLite）")
+    args = parser.parse_args(argv)
+    if os.getenv("DB_BACKEND", "sqlite") == "postgres" and not args.databases:
+        asyncio.run(compact_postgres(os.getenv("DATABASE_URL", ""), args.dry_run))
+        return
+    databases = args.databases or ["ocpp_data.db", *sorted(glob.glob(os.path.join(os.getenv("SHARD_DIR", "shards"), "*.db")))]
+    route = sharding.file_router() if sharding.DB_SHARDS else None
+    for db_file in databases:
+        compact_sqlite(db_file, args.dry_run, args.vacuum, route)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# 高密度連線模式（OCPP_HIGH_DENSITY）：單一程序承載上萬條充電樁連線
+#
+# 每條連線的固定成本大多在 websockets：permessage-deflate 的 zlib 壓縮 / 解壓縮狀態、
+# 讀寫緩衝、最多 max_queue 則的接收佇列與 keepalive ping task。OCPP 訊息很小、頻率很低，
+# 這些預設值是為一般網頁用途準備的。OCPP_HIGH_DENSITY=1 時改用：
+# - 壓縮預設關閉，只對 WS_COMPRESSION_CHARGERS（fnmatch 樣式，逗號分隔，例如走計量行動網路的
+#   "KHH-*,LTE-*"）協商 permessage-deflate；"*" 表示全部
+# - WS_MAX_SIZE 單則訊息上限 64 KiB（一般 1 MiB）、WS_MAX_QUEUE 4（一般 32）、
+#   WS_READ_LIMIT / WS_WRITE_LIMIT 16 KiB（一般 64 KiB）、WS_PING_INTERVAL 60 秒（一般 20，0 表示關閉）
+# 每個值都可以單獨以環境變數覆蓋，一般模式也適用。
+# ChargePoint 本身的每連線狀態（路由表、call 用的 lock / 回覆佇列）在 codec.FastChargePoint 共用或延遲建立，
+# 與模式無關。量測每條連線的 RSS / CPU：python bench_density.py
+
+import fnmatch
+import os
+
+from websockets.legacy.server import WebSocketServerProtocol
+
+import mux
+
+HIGH_DENSITY = os.getenv("OCPP_HIGH_DENSITY", "0").lower() in ("1", "true", "yes")
+
+_DEFAULTS = {
+    # 名稱: (一般模式, 高密度模式)
+    "WS_MAX_SIZE": (2 ** 20, 2 ** 16),
+    "WS_MAX_QUEUE": (32, 4),
+    "WS_READ_LIMIT": (2 ** 16, 2 ** 14),
+    "WS_WRITE_LIMIT": (2 ** 16, 2 ** 14),
+    "WS_PING_INTERVAL": (20, 60),
+}
+
+
+def _setting(name):
+    return int(os.getenv(name, _DEFAULTS[name][HIGH_DENSITY]))
+
+
+WS_MAX_SIZE = _setting("WS_MAX_SIZE")
+WS_MAX_QUEUE = _setting("WS_MAX_QUEUE")
+WS_READ_LIMIT = _setting("WS_READ_LIMIT")
+WS_WRITE_LIMIT = _setting("WS_WRITE_LIMIT")
+WS_PING_INTERVAL = _setting("WS_PING_INTERVAL")
+WS_COMPRESSION_CHARGERS = [p for p in os.getenv("WS_COMPRESSION_CHARGERS", "" if HIGH_DENSITY else "*").split(",") if p]
+
+
+def compression_enabled(cp_id, patterns=None):
+    patterns = WS_COMPRESSION_CHARGERS if patterns is None else patterns
+    return any(fnmatch.fnmatchcase(cp_id, p) for p in patterns)
+
+
+class ChargerProtocol(WebSocketServerProtocol):
+    # 依充電樁 ID（連線路徑，集中器為 "concentrator/<場域>"）決定是否協商 permessage-deflate
+    compression_patterns = WS_COMPRESSION_CHARGERS
+
+    def process_extensions(self, headers, available_extensions):
+        if not compression_enabled(self.path.strip("/"), self.compression_patterns):
+            available_extensions = None
+        return super().process_extensions(headers, available_extensions)
+
+    def connection_open(self):
+        # 集中器的多工連線（見 mux.py）一則 batch 含數百個 frame，不套用單一充電樁的訊息上限
+        if self.path.startswith(mux.PATH_PREFIX):
+            self.max_size = None
+        super().connection_open()
+
+
+def serve_options():
+    # websockets.server.serve(...) 的連線參數
+    return {
+        "create_protocol": ChargerProtocol,
+        "max_size": WS_MAX_SIZE,
+        "max_queue": WS_MAX_QUEUE,
+        "read_limit": WS_READ_LIMIT,
+        "write_limit": WS_WRITE_LIMIT,
+        "ping_interval": WS_PING_INTERVAL or None,
+        "ping_timeout": WS_PING_INTERVAL or None,
+    }
+
+
+def info():
+    return {
+        "highDensity": HIGH_DENSITY,
+        "maxSize": WS_MAX_SIZE,
+        "maxQueue": WS_MAX_QUEUE,
+        "readLimit": WS_READ_LIMIT,
+        "writeLimit": WS_WRITE_LIMIT,
+        "pingInterval": WS_PING_INTERVAL,
+        "compressionChargers": WS_COMPRESSION_CHARGERS,
+    }
@@ -0,0 +1,274 @@
+# 診斷檔收集（GetDiagnostics）
+#
+# POST /api/diagnostics 對選定的充電樁（chargePointIds、match、site，同 /api/commands）送出 GetDiagnostics，
+# 每個請求各有一個隨機 token 的上傳位址（{DIAGNOSTICS_BASE_URL}/diagnostics/{token}），
+# DIAGNOSTICS_URL_TTL 秒（預設 6 小時）內有效，只能上傳一次。
+# - 充電樁以 HTTP PUT（body 為檔案）或 POST（原始 body 或 multipart/form-data）上傳；
+#   也接受在位址後加上檔名（/diagnostics/{token}/{fileName}），有些充電樁把 location 當成目錄
+# - body 邊收邊寫入 DIAGNOSTICS_DIR/{cp_id}/，同時計算 SHA-256，不把整個檔案讀進記憶體；
+#   multipart 以串流方式解析，只取第一個檔案欄位。超過 DIAGNOSTICS_MAX_MB 時中止並刪除（413）
+# - 請求狀態：Requested → Accepted（充電樁回覆檔名）/ NoFile（沒有可上傳的檔案）/ Error / Timeout
+#   → Received（上傳完成）；充電樁回報 UploadFailed 時為 UploadFailed，逾期未上傳為 Expired。
+#   DiagnosticsStatusNotification 的最後狀態另記於 chargerStatus
+# - 請求與檔案資訊存在 DIAGNOSTICS_DIR/index.json，可依充電樁查詢
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import uuid
+from dataclasses import replace
+from datetime import datetime, timezone
+
+import commands
+
+DIAGNOSTICS_DIR = os.getenv("DIAGNOSTICS_DIR", "diagnostics")
+DIAGNOSTICS_MAX_MB = float(os.getenv("DIAGNOSTICS_MAX_MB", "100"))
+DIAGNOSTICS_URL_TTL = int(os.getenv("DIAGNOSTICS_URL_TTL", str(6 * 3600)))
+DIAGNOSTICS_BASE_URL = os.getenv("DIAGNOSTICS_BASE_URL", "")
+
+MAX_PART_HEADER = 16 * 1024
+FILENAME = re.compile(r'filename="([^"]*)"|filename=([^;\s]+)', re.IGNORECASE)
+
+REQUESTED, ACCEPTED, NO_FILE, RECEIVED, UPLOAD_FAILED, EXPIRED = (
+    "Requested", "Accepted", "NoFile", "Received", "UploadFailed", "Expired")
+COMMAND_STATUS = {commands.ERROR: "Error", commands.REJECTED: "Error", commands.TIMEOUT: "Timeout"}
+# 仍可上傳的狀態（充電樁可能在回覆 GetDiagnostics 之前就開始上傳）
+OPEN = {REQUESTED, ACCEPTED}
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def safe_name(name):
+    name = os.path.basename((name or "").replace("\\", "/")).strip()
+    return re.sub(r"[^\w.\-]", "_", name) or "diagnostics"
+
+
+class MultipartFile:
+    # 串流解析 multipart/form-data，取出第一個帶 filename 的欄位：
+    #   filename = await part.open()；async for chunk in part.body(): ...
+    def __init__(self, chunks, boundary):
+        self.chunks = chunks.__aiter__()
+        self.delimiter = b"\r\n--" + boundary.encode("latin-1")
+        self.buf = b"\r\n"        # 第一個分隔線前面沒有 CRLF，補上後與其他分隔線相同
+
+    async def _more(self):
+        try:
+            self.buf += await self.chunks.__anext__()
+        except StopAsyncIteration:
+            raise ValueError("multipart 內容不完整")
+
+    async def _read_until(self, marker, limit=MAX_PART_HEADER):
+        while (i := self.buf.find(marker)) < 0:
+            if len(self.buf) > limit:
+                raise ValueError("multipart 標頭過長")
+            await self._more()
+        head, self.buf = self.buf[:i], self.buf[i + len(marker):]
+        return head
+
+    async def _skip_until(self, marker):
+        while (i := self.buf.find(marker)) < 0:
+            self.buf = self.buf[-(len(marker) - 1):]
+            await self._more()
+        self.buf = self.buf[i + len(marker):]
+
+    async def open(self):
+        await self._skip_until(self.delimiter)
+        while True:
+            if (await self._read_until(b"\r\n")).startswith(b"--"):
+                raise ValueError("multipart 中沒有檔案")
+            filename = None
+            while line := await self._read_until(b"\r\n"):
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-disposition" and (m := FILENAME.search(value)):
+                    filename = m.group(1) if m.group(1) is not None else m.group(2)
+            if filename is not None:
+                return filename
+            await self._skip_until(self.delimiter)
+
+    async def body(self):
+        keep = len(self.delimiter) - 1
+        while (i := self.buf.find(self.delimiter)) < 0:
+            if len(self.buf) > keep:
+                yield self.buf[:-keep]
+                self.buf = self.buf[-keep:]
+            await self._more()
+        if i:
+            yield self.buf[:i]
+
+
+class DiagnosticsStore:
+    def __init__(self, directory=DIAGNOSTICS_DIR, max_bytes=int(DIAGNOSTICS_MAX_MB * 1024 * 1024),
+                 ttl=DIAGNOSTICS_URL_TTL):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index_path = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()     # API 與 OCPP 兩個執行緒都會寫 index
+        os.makedirs(directory, exist_ok=True)
+        self.requests = {}                # id -> 請求與檔案資訊
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.requests = {r["id"]: r for r in json.load(f)}
+        self.tokens = {r["token"]: r for r in self.requests.values()}
+        self.uploading = set()            # 正在上傳的請求 id（充電樁重試時可能同時送來第二次上傳）
+
+    def save(self):
+        with self._lock:
+            tmp = f"{self.index_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(list(self.requests.values()), f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.index_path)
+
+    def path(self, record):
+        return os.path.join(self.dir, safe_name(record["chargePointId"]), f"{record['id']}-{record['fileName']}")
+
+    # === 請求 ===
+
+    def create(self, cp_id, base_url):
+        token = secrets.token_urlsafe(24)
+        record = {
+            "id": uuid.uuid4().hex[:12], "token": token, "chargePointId": cp_id,
+            "location": f"{base_url.rstrip('/')}/diagnostics/{token}",
+            "status": REQUESTED, "chargerStatus": None, "error": None,
+            "createdAt": now_iso(), "expiresAt": time.time() + self.ttl,
+            "fileName": None, "size": None, "sha256": None, "receivedAt": None,
+        }
+        self.requests[record["id"]] = record
+        self.tokens[token] = record
+        return record
+
+    def command_result(self, record, result):
+        # GetDiagnostics 的回覆：fileName 為空表示充電樁沒有可上傳的檔案
+        if record["status"] != REQUESTED:
+            return
+        if result["status"] == commands.OK:
+            file_name = result.get("response", {}).get("fileName")
+            record["status"] = ACCEPTED if file_name else NO_FILE
+            if file_name and record["fileName"] is None:
+                record["fileName"] = safe_name(file_name)
+        else:
+            record["status"] = COMMAND_STATUS[result["status"]]
+            record["error"] = result.get("error")
+
+    def status_notification(self, cp_id, status):
+        # DiagnosticsStatusNotification：更新該充電樁最近一個請求（Uploaded 通常在檔案收到之後才送來）
+        if status == "Idle":
+            return
+        records = [r for r in list(self.requests.values())
+                   if r["chargePointId"] == cp_id and (r["status"] in OPEN or r["status"] == RECEIVED)]
+        if not records:
+            return
+        record = max(records, key=lambda r: r["createdAt"])
+        record["chargerStatus"] = status
+        if status == "UploadFailed" and record["status"] in OPEN:
+            record["status"] = UPLOAD_FAILED
+        self.save()
+
+    def expire(self):
+        now = time.time()
+        for record in list(self.requests.values()):
+            if record["status"] in OPEN and record["expiresAt"] < now:
+                record["status"] = EXPIRED
+
+    def list(self, cp_id=None):
+        self.expire()
+        records = [r for r in list(self.requests.values()) if cp_id is None or r["chargePointId"] == cp_id]
+        return sorted(records, key=lambda r: r["createdAt"], reverse=True)
+
+    def delete(self, record_id):
+        record = self.requests.pop(record_id)
+        self.tokens.pop(record["token"], None)
+        if record["status"] == RECEIVED:
+            try:
+                os.remove(self.path(record))
+            except FileNotFoundError:
+                pass
+        self.save()
+
+    # === 上傳 ===
+
+    def check_upload(self, token, content_length=None):
+        record = self.tokens.get(token)
+        if record is None:
+            raise UploadRejected(404, "Unknown upload URL")
+        self.expire()
+        if record["status"] == RECEIVED:
+            raise UploadRejected(409, "Already uploaded")
+        if record["status"] not in OPEN:
+            raise UploadRejected(410, f"Upload URL is {record['status']}")
+        if record["id"] in self.uploading:
+            raise UploadRejected(409, "Upload in progress")
+        if content_length is not None and content_length > self.max_bytes:
+            raise UploadRejected(413, f"檔案超過 {self.max_bytes // (1024 * 1024)} MB")
+        return record
+
+    async def receive(self, record, chunks, file_name):
+        # chunks：檔案內容的 async iterator；寫入各次上傳自己的 .part 暫存檔，完成後改名
+        if record["id"] in self.uploading:
+            raise UploadRejected(409, "Upload in progress")
+        self.uploading.add(record["id"])
+        file_name = safe_name(file_name or record["fileName"])
+        directory = os.path.join(self.dir, safe_name(record["chargePointId"]))
+        tmp = os.path.join(directory, f".{record['id']}.{uuid.uuid4().hex}.part")
+        sha256, size = hashlib.sha256(), 0
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(tmp, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadRejected(413, f"檔案超過 {self.max_bytes // (1024 * 1024)} MB")
+                    sha256.update(chunk)
+                    f.write(chunk)
+            if self.requests.get(record["id"]) is not record:
+                # 上傳期間請求已被刪除：不留下沒有紀錄指向的檔案
+                raise UploadRejected(410, "Upload URL is deleted")
+            if record["status"] not in OPEN:
+                # 上傳期間請求已逾期
+                raise UploadRejected(410, f"Upload URL is {record['status']}")
+            record.update(fileName=file_name, size=size, sha256=sha256.hexdigest(), receivedAt=now_iso(),
+                          status=RECEIVED)
+            os.replace(tmp, self.path(record))
+        finally:
+            self.uploading.discard(record["id"])
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.save()
+        return record
+
+
+def view(record):
+    # API 回傳：不含 token（上傳位址另以 location 提供）
+    return {k: v for k, v in record.items() if k not in ("token", "expiresAt")} | {
+        "expiresAt": datetime.fromtimestamp(record["expiresAt"], timezone.utc).isoformat(),
+        "fileUrl": f"/api/diagnostics/{record['id']}/file" if record["status"] == RECEIVED else None,
+    }
+
+
+async def request_all(store, targets, base_url, payload, concurrency, timeout):
+    # 在 OCPP 事件迴圈執行：對每個充電樁建立請求，送出只有 location 不同的 GetDiagnostics
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(cp):
+        record = store.create(cp.id, base_url)
+        async with semaphore:
+            store.command_result(record, await commands.send(cp, replace(payload, location=record["location"]), timeout))
+        return record
+
+    records = await asyncio.gather(*(one(cp) for _, cp in targets))
+    store.save()
+    return records
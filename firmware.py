@@ -0,0 +1,404 @@
+# 韌體庫、韌體下載伺服器與 UpdateFirmware 分批推送
+#
+# 韌體庫（FIRMWARE_DIR，預設 firmware）：
+# - POST /api/firmware?version=...&model=...&filename=... 以 request body 上傳映像檔，邊收邊寫入暫存檔並計算
+#   SHA-256 / MD5，不把整個檔案讀進記憶體；可附 sha256= 讓伺服器核對，超過 FIRMWARE_MAX_MB 時中止
+# - 同一 model 的 version 不可重複；內容相同的映像檔只存一份（檔名為 SHA-256），資訊存在 FIRMWARE_DIR/index.json
+#
+# 下載伺服器（FIRMWARE_PORT，預設 9001；0 表示不啟動，改由 FIRMWARE_BASE_URL 指向的外部主機提供）：
+# - 充電樁收到 UpdateFirmware 後以 HTTP GET 下載 location（{FIRMWARE_BASE_URL}/firmware/{id}/{filename}）
+# - 在獨立的執行緒與事件迴圈上執行；檔案內容以 loop.sendfile（Linux 為 os.sendfile）由 page cache 直接送到 socket，
+#   不經過 Python 記憶體，數百個充電樁同時下載 50 MB 的映像檔時記憶體與 CPU 幾乎不增加
+# - 支援 HEAD、單一區段的 Range（206 / 416；多區段時回整個檔案）、ETag（SHA-256）/ If-Range 與 keep-alive，
+#   下載中斷的充電樁可以續傳
+#
+# 推送活動（campaign）：
+# - 目標與 /api/commands 相同（chargePointIds、match、site），依 batchSize 分批送出 UpdateFirmware
+# - 每批送出後等待該批充電樁以 FirmwareStatusNotification 回報 Installed / DownloadFailed / InstallationFailed，
+#   最多 batchTimeoutS 秒；失敗（含指令錯誤、逾時、時限內沒有回報完成）比例超過 maxFailureRate 時停止後續批次
+# - 批次之間至少間隔 batchIntervalS 秒；輪到時不在線的充電樁記為 Offline，不計入失敗比例
+# - 活動只保存在記憶體，重新啟動後不會繼續
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import formatdate
+from urllib.parse import quote, unquote
+
+import commands
+
+FIRMWARE_DIR = os.getenv("FIRMWARE_DIR", "firmware")
+FIRMWARE_MAX_MB = float(os.getenv("FIRMWARE_MAX_MB", "512"))
+FIRMWARE_PORT = int(os.getenv("FIRMWARE_PORT", "9001"))
+FIRMWARE_BASE_URL = os.getenv("FIRMWARE_BASE_URL", "")
+
+HEADER_TIMEOUT = 30
+MAX_HEADER_BYTES = 16 * 1024
+DOWNLOAD_PATH = re.compile(r"^/firmware/([0-9a-f]+)(?:/[^/]*)?$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+INSTALLED = "Installed"
+FAILED = {"DownloadFailed", "InstallationFailed"}
+# 送出指令後、充電樁回報之前，以及指令本身失敗時的狀態
+QUEUED, SENT, OFFLINE, ERROR, TIMEOUT, NO_REPORT = "Queued", "Sent", "Offline", "Error", "Timeout", "NoReport"
+COMMAND_STATUS = {commands.OK: SENT, commands.REJECTED: ERROR, commands.ERROR: ERROR, commands.TIMEOUT: TIMEOUT}
+
+
+class DuplicateVersion(Exception):
+    pass
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+# === 韌體庫 ===
+
+class FirmwareStore:
+    def __init__(self, directory=FIRMWARE_DIR, max_bytes=int(FIRMWARE_MAX_MB * 1024 * 1024)):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        os.makedirs(directory, exist_ok=True)
+        self.images = {}          # id -> 韌體資訊
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.images = {image["id"]: image for image in json.load(f)}
+
+    def path(self, image):
+        return os.path.join(self.dir, f"{image['sha256']}.bin")
+
+    def _save(self):
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(list(self.images.values()), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.index_path)
+
+    def _find(self, model, version):
+        return next((i for i in self.images.values() if i["model"] == model and i["version"] == version), None)
+
+    async def add(self, chunks, version, model=None, filename=None, expected_sha256=None):
+        # chunks：request body 的 async iterator；回傳韌體資訊
+        if not version:
+            raise ValueError("請指定 version")
+        if self._find(model, version):
+            raise DuplicateVersion(f"{model or '（未指定 model）'} 已有版本 {version}")
+        filename = os.path.basename(filename or f"firmware-{version}.bin")
+        sha256, md5, size = hashlib.sha256(), hashlib.md5(), 0
+        tmp = os.path.join(self.dir, f".upload-{uuid.uuid4().hex}")
+        try:
+            with open(tmp, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ImageTooLarge(f"映像檔超過 {self.max_bytes // (1024 * 1024)} MB")
+                    sha256.update(chunk)
+                    md5.update(chunk)
+                    f.write(chunk)
+            if size == 0:
+                raise ValueError("映像檔是空的")
+            digest = sha256.hexdigest()
+            if expected_sha256 and expected_sha256.lower() != digest:
+                raise ValueError(f"SHA-256 不符：收到 {digest}")
+            if self._find(model, version):
+                raise DuplicateVersion(f"{model or '（未指定 model）'} 已有版本 {version}")
+            os.replace(tmp, os.path.join(self.dir, f"{digest}.bin"))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        image = {
+            "id": uuid.uuid4().hex[:12], "model": model, "version": version, "filename": filename,
+            "size": size, "sha256": digest, "md5": md5.hexdigest(), "uploadedAt": now_iso(),
+        }
+        self.images[image["id"]] = image
+        self._save()
+        return image
+
+    def delete(self, image_id):
+        image = self.images.pop(image_id)
+        self._save()
+        if not any(i["sha256"] == image["sha256"] for i in self.images.values()):
+            try:
+                os.remove(self.path(image))
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        return sorted(self.images.values(), key=lambda i: i["uploadedAt"], reverse=True)
+
+
+def location(image, base_url):
+    return f"{base_url.rstrip('/')}/firmware/{image['id']}/{quote(image['filename'])}"
+
+
+# === 下載伺服器 ===
+
+def parse_range(header, size):
+    # 回傳 (start, end)（含 end）；不支援的格式回 None（回整個檔案）；超出範圍 raise ValueError（416）
+    m = RANGE.match(header.replace(" ", ""))
+    if m is None or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        if start >= size or end < start:
+            raise ValueError(header)
+        return start, end
+    suffix = int(m.group(2))
+    if suffix == 0:
+        raise ValueError(header)
+    return max(size - suffix, 0), size - 1
+
+
+class DownloadServer:
+    def __init__(self, store, host="0.0.0.0", port=FIRMWARE_PORT):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.active = 0
+        self.stats = Counter()
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port, limit=MAX_HEADER_BYTES)
+        logging.info(f"✅ 韌體下載伺服器已啟動 http://{self.host}:{self.port}/firmware/")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        self.active += 1
+        self.stats["peakActive"] = max(self.stats["peakActive"], self.active)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEADER_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    return
+                keep_alive = await self.respond(head, writer)
+        except ConnectionError:
+            pass
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def _send_head(self, writer, status, headers, keep_alive):
+        lines = [f"HTTP/1.1 {status}", f"Date: {formatdate(usegmt=True)}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{k}: {v}" for k, v in headers]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def _error(self, writer, status, keep_alive, headers=()):
+        await self._send_head(writer, status, [*headers, ("Content-Length", "0")], keep_alive)
+        return keep_alive
+
+    async def respond(self, head, writer):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            await self._error(writer, "400 Bad Request", False)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        self.stats["requests"] += 1
+
+        if method not in ("GET", "HEAD"):
+            return await self._error(writer, "405 Method Not Allowed", keep_alive, [("Allow", "GET, HEAD")])
+        m = DOWNLOAD_PATH.match(unquote(target.split("?", 1)[0]))
+        image = self.store.images.get(m.group(1)) if m else None
+        if image is None:
+            return await self._error(writer, "404 Not Found", keep_alive)
+
+        size = image["size"]
+        etag = f'"{image["sha256"]}"'
+        common = [("Accept-Ranges", "bytes"), ("ETag", etag), ("Content-Type", "application/octet-stream")]
+        start, end, status = 0, size - 1, "200 OK"
+        range_header = headers.get("range")
+        if range_header and headers.get("if-range", etag) == etag:
+            try:
+                parsed = parse_range(range_header, size)
+            except ValueError:
+                return await self._error(writer, "416 Range Not Satisfiable", keep_alive,
+                                         [("Content-Range", f"bytes */{size}")])
+            if parsed is not None:
+                start, end = parsed
+                status = "206 Partial Content"
+                common.append(("Content-Range", f"bytes {start}-{end}/{size}"))
+                self.stats["rangeRequests"] += 1
+        length = end - start + 1
+        await self._send_head(writer, status, [*common, ("Content-Length", str(length))], keep_alive)
+        if method == "HEAD":
+            return keep_alive
+
+        self.stats["downloads"] += 1
+        with open(self.store.path(image), "rb") as f:
+            await asyncio.get_running_loop().sendfile(writer.transport, f, start, length)
+        self.stats["bytesSent"] += length
+        return keep_alive
+
+    def info(self):
+        return {"port": self.port, "active": self.active, **self.stats}
+
+
+# === 推送活動 ===
+
+class Campaign:
+    def __init__(self, image, url, charge_point_ids, params, batch_size, batch_interval, batch_timeout,
+                 max_failure_rate, command_timeout):
+        self.id = uuid.uuid4().hex[:12]
+        self.image = image
+        self.location = url
+        self.params = params          # UpdateFirmware 的 retrieveDate / retries / retryInterval
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batch_timeout = batch_timeout
+        self.max_failure_rate = max_failure_rate
+        self.command_timeout = command_timeout
+        self.chargers = {cp_id: {"status": QUEUED, "batch": n // batch_size + 1, "updatedAt": None}
+                         for n, cp_id in enumerate(charge_point_ids)}
+        self.batches = (len(charge_point_ids) + batch_size - 1) // batch_size
+        self.current_batch = 0
+        self.status = "running"
+        self.error = None
+        self.created_at = now_iso()
+        self.finished_at = None
+        self.future = None
+        self._changed = None          # asyncio.Event，在 OCPP 事件迴圈上建立
+
+    def set_status(self, cp_id, status, error=None):
+        entry = self.chargers[cp_id]
+        entry["status"] = status
+        entry["updatedAt"] = now_iso()
+        if error is not None:
+            entry["error"] = error
+
+    def view(self, detail=False):
+        view = {
+            "id": self.id, "firmwareId": self.image["id"], "version": self.image["version"],
+            "location": self.location, "status": self.status, "error": self.error,
+            "batchSize": self.batch_size, "batches": self.batches, "currentBatch": self.current_batch,
+            "targets": len(self.chargers), "counts": dict(Counter(c["status"] for c in self.chargers.values())),
+            "createdAt": self.created_at, "finishedAt": self.finished_at,
+        }
+        if detail:
+            view["chargers"] = [{"chargePointId": cp_id, **entry} for cp_id, entry in self.chargers.items()]
+        return view
+
+
+class CampaignManager:
+    def __init__(self, charge_points):
+        self.charge_points = charge_points      # cp_id -> ChargePoint（連線中的充電樁）
+        self.campaigns = {}
+
+    def start(self, campaign, ocpp_loop):
+        # 由 API 事件迴圈呼叫；活動在 OCPP 事件迴圈上執行
+        self.campaigns[campaign.id] = campaign
+        campaign.future = asyncio.run_coroutine_threadsafe(self.run(campaign), ocpp_loop)
+        return campaign
+
+    def cancel(self, campaign):
+        campaign.future.cancel()
+
+    def running(self, image_id=None):
+        return [c for c in self.campaigns.values()
+                if c.status == "running" and (image_id is None or c.image["id"] == image_id)]
+
+    def status_notification(self, cp_id, status):
+        # FirmwareStatusNotification（在 OCPP 事件迴圈呼叫）：更新該充電樁所在、執行中的活動
+        if status == "Idle":
+            return
+        for campaign in self.running():
+            entry = campaign.chargers.get(cp_id)
+            if entry is not None and entry["status"] != QUEUED:
+                campaign.set_status(cp_id, status)
+                campaign._changed.set()
+
+    def _payload(self, campaign):
+        params = {"location": campaign.location, "retrieveDate": now_iso(), **campaign.params}
+        return commands.build_payload("UpdateFirmware", params)
+
+    async def run(self, campaign):
+        campaign._changed = asyncio.Event()
+        ids = list(campaign.chargers)
+        try:
+            for n in range(campaign.batches):
+                if n:
+                    await asyncio.sleep(campaign.batch_interval)
+                campaign.current_batch = n + 1
+                if not await self.run_batch(campaign, ids[n * campaign.batch_size:(n + 1) * campaign.batch_size]):
+                    campaign.status = "halted"
+                    return
+            campaign.status = "done"
+        except asyncio.CancelledError:
+            campaign.status = "cancelled"
+            raise
+        except Exception as e:
+            logging.exception(f"⚠️ 韌體推送 {campaign.id} 失敗")
+            campaign.status, campaign.error = "failed", repr(e)
+        finally:
+            campaign.finished_at = now_iso()
+            logging.info(f"📦 韌體推送 {campaign.id} 結束：{campaign.status} | {campaign.view()['counts']}")
+
+    async def run_batch(self, campaign, batch):
+        # 回傳是否繼續下一批
+        payload = self._payload(campaign)
+        live = []
+        for cp_id in batch:
+            cp = self.charge_points.get(cp_id)
+            if cp is None:
+                campaign.set_status(cp_id, OFFLINE)
+            else:
+                live.append(cp)
+        results = await asyncio.gather(*(commands.send(cp, payload, campaign.command_timeout) for cp in live))
+        sent = []
+        for result in results:
+            status = COMMAND_STATUS[result["status"]]
+            campaign.set_status(result["chargePointId"], status, result.get("error"))
+            if status == SENT:
+                sent.append(result["chargePointId"])
+        logging.info(f"📦 韌體推送 {campaign.id} 第 {campaign.current_batch}/{campaign.batches} 批："
+                     f"送出 {len(sent)}，離線 {len(batch) - len(live)}，失敗 {len(live) - len(sent)}")
+
+        # 等這一批回報完成（Installed 或失敗）
+        deadline = time.monotonic() + campaign.batch_timeout
+
+        def pending():
+            return [cp_id for cp_id in sent
+                    if campaign.chargers[cp_id]["status"] != INSTALLED and campaign.chargers[cp_id]["status"] not in FAILED]
+
+        while pending():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            campaign._changed.clear()
+            try:
+                await asyncio.wait_for(campaign._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        for cp_id in pending():
+            campaign.set_status(cp_id, NO_REPORT)
+
+        attempted = len(live)
+        failed = sum(1 for cp in live if campaign.chargers[cp.id]["status"] != INSTALLED)
+        if attempted and failed / attempted > campaign.max_failure_rate:
+            campaign.error = (f"第 {campaign.current_batch} 批失敗 {failed}/{attempted}，"
+                              f"超過 maxFailureRate {campaign.max_failure_rate:g}")
+            logging.warning(f"⛔ 韌體推送 {campaign.id} 停止：{campaign.error}")
+            return False
+        return True
@@ -0,0 +1,160 @@
+# OCPP frame 紀錄檔（journal）
+#
+# 記錄每一個收到/送出的 OCPP-J frame（含充電樁 ID 與 monotonic 時間），供事後重播與壓測。
+# - record() 只把資料放進佇列，壓縮與寫檔由背景執行緒處理，不占用 OCPP 事件迴圈
+# - 檔案格式：檔頭 MAGIC，之後是一連串區塊 [u32 長度][zlib 壓縮內容]；
+#   每個區塊解壓後是多筆紀錄 [i64 時間(ns)][u8 方向][u16 ID 長度][u32 frame 長度][ID][frame]
+# - 單一檔案超過 max_bytes 時換新檔，只保留最近 max_files 個
+#
+# 啟用：OCPP_JOURNAL_DIR=journal（另可設 OCPP_JOURNAL_MAX_MB、OCPP_JOURNAL_FILES）
+
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b"OCPPJRNL1\n"
+
+IN, OUT, CONNECT, CLOSE = 0, 1, 2, 3
+DIRECTIONS = {IN: "in", OUT: "out", CONNECT: "connect", CLOSE: "close"}
+
+_BLOCK = struct.Struct("<I")
+_RECORD = struct.Struct("<qBHI")
+
+JOURNAL_DIR = os.getenv("OCPP_JOURNAL_DIR", "")
+JOURNAL_MAX_MB = float(os.getenv("OCPP_JOURNAL_MAX_MB", "64"))
+JOURNAL_FILES = int(os.getenv("OCPP_JOURNAL_FILES", "10"))
+
+
+class FrameJournal:
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, max_files=10,
+                 block_frames=512, flush_interval=1.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.block_frames = block_frames
+        self.flush_interval = flush_interval
+        self.frames = 0
+        self.dropped = 0
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._size = 0
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._writer, name="frame-journal", daemon=True)
+        self._thread.start()
+
+    def record(self, cp_id, direction, frame):
+        if self._closed:
+            self.dropped += 1
+            return
+        if isinstance(frame, str):
+            frame = frame.encode()
+        self._queue.put((time.monotonic_ns(), direction, cp_id, frame))
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _open_next(self):
+        if self._file is not None:
+            self._file.close()
+        name = time.strftime("journal-%Y%m%d-%H%M%S") + f"-{time.monotonic_ns() % 1000000:06d}.bin"
+        self._file = open(os.path.join(self.directory, name), "wb")
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+        for old in journal_files(self.directory)[:-self.max_files]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def _write_block(self, records):
+        if self._file is None or self._size >= self.max_bytes:
+            self._open_next()
+        raw = bytearray()
+        for ts, direction, cp_id, frame in records:
+            cp = cp_id.encode()
+            raw += _RECORD.pack(ts, direction, len(cp), len(frame))
+            raw += cp
+            raw += frame
+        data = zlib.compress(bytes(raw), 6)
+        self._file.write(_BLOCK.pack(len(data)))
+        self._file.write(data)
+        self._file.flush()
+        self._size += _BLOCK.size + len(data)
+        self.frames += len(records)
+
+    def _writer(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item:
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            # 區塊滿了、超過 flush 間隔、或收到結束訊號時寫出
+            if pending and (item is None or item is False or len(pending) >= self.block_frames
+                            or time.monotonic() >= deadline):
+                try:
+                    self._write_block(pending)
+                except OSError as e:
+                    self.dropped += len(pending)
+                    logging.warning(f"⚠️ OCPP journal 寫入失敗：{e}")
+                pending = []
+                deadline = None
+            if item is None:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+
+def journal_files(path):
+    # 目錄內依檔名（即建立時間）排序的 journal 檔；傳入單一檔案則只回傳該檔
+    if os.path.isfile(path):
+        return [path]
+    return sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if name.startswith("journal-") and name.endswith(".bin")
+    )
+
+
+def read_journal(path):
+    # 逐筆產生 (時間 ns, 方向, cp_id, frame 字串)；最後一個區塊不完整（寫入中）時略過
+    for file_name in journal_files(path):
+        with open(file_name, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"不是 OCPP journal 檔：{file_name}")
+            while True:
+                header = f.read(_BLOCK.size)
+                if len(header) < _BLOCK.size:
+                    break
+                data = f.read(_BLOCK.unpack(header)[0])
+                try:
+                    raw = zlib.decompress(data)
+                except zlib.error:
+                    break
+                offset = 0
+                while offset < len(raw):
+                    ts, direction, cp_len, frame_len = _RECORD.unpack_from(raw, offset)
+                    offset += _RECORD.size
+                    cp_id = raw[offset:offset + cp_len].decode()
+                    offset += cp_len
+                    frame = raw[offset:offset + frame_len].decode()
+                    offset += frame_len
+                    yield ts, direction, cp_id, frame
+
+
+def from_env():
+    if not JOURNAL_DIR:
+        return None
+    return FrameJournal(JOURNAL_DIR, int(JOURNAL_MAX_MB * 1024 * 1024), JOURNAL_FILES)
@@ -0,0 +1,297 @@
+# 背景工作（報表、長區間費用統計、匯出）
+#
+# - 工作在 process pool 中執行，不占用 API 事件迴圈
+# - 每種工作類型有各自的同時執行上限
+# - 參數完全相同、尚未完成的工作不重複建立，直接回傳既有工作
+# - 進度由工作程序透過 multiprocessing queue 回報；取消以 JOB_DIR/{id}.cancel 標記
+# - 結果與工作資訊存放在 JOB_DIR，超過 JOB_RESULT_TTL 秒後清除
+# - 工作程序經由 repository 讀取資料：SQLite 以唯讀連線查詢主資料庫與各分片（FileRepository），
+#   DB_BACKEND=postgres 時自己建立 PostgreSQL 連線
+
+import asyncio
+import csv
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import billing
+import monthly_report
+from repository import SQLiteRepository
+from sharding import FleetQueries
+
+JOB_DIR = os.getenv("JOB_DIR", "jobs")
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", str(24 * 3600)))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+EXPORT_PAGE_SIZE = 5000
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# === 工作程序端 ===
+
+_progress_queue = None
+
+
+def _init_worker(queue):
+    global _progress_queue
+    _progress_queue = queue
+
+
+def report_progress(job_dir, job_id, progress):
+    if os.path.exists(os.path.join(job_dir, f"{job_id}.cancel")):
+        raise JobCancelled()
+    if _progress_queue is not None:
+        _progress_queue.put((job_id, progress))
+
+
+def _connect(db_file, main_file=None):
+    # 唯讀開啟，不與 OCPP 寫入爭搶寫鎖；場域分片另外 ATTACH 主資料庫（電價等共用資料表）
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_file)}?mode=ro", uri=True)
+    if main_file is not None:
+        conn.execute("ATTACH DATABASE ? AS shared", (f"file:{os.path.abspath(main_file)}?mode=ro",))
+    return conn
+
+
+class FileRepository(FleetQueries):
+    # 工作程序的唯讀 repository：db_files[0] 是主資料庫，其餘是場域分片（DB_SHARDS，見 sharding.py）
+
+    def __init__(self, db_files):
+        self.conns = [_connect(f, db_files[0] if i else None) for i, f in enumerate(db_files)]
+
+    async def _each(self, method, *args, charge_point_id=None):
+        return [await getattr(SQLiteRepository(conn), method)(*args) for conn in self.conns]
+
+    async def _main(self, method, *args):
+        return await getattr(SQLiteRepository(self.conns[0]), method)(*args)
+
+    async def close(self):
+        for conn in self.conns:
+            conn.close()
+
+
+def _run(source, job):
+    # source：SQLite 資料庫檔 list，或 PostgreSQL 的 DATABASE_URL；在工作程序自己的事件迴圈上執行 await job(repo)
+    async def run():
+        if isinstance(source, str):
+            from repository_pg import PostgresRepository
+            repo = PostgresRepository(source, min_size=1, max_size=1)
+        else:
+            repo = FileRepository(source)
+        try:
+            return await job(repo)
+        finally:
+            await repo.close()
+    return asyncio.run(run())
+
+
+def run_cost_summary(job_id, job_dir, source, start=None, end=None):
+    async def job(repo):
+        txns = [txn for txn in await repo.list_transactions(start=start, end=end) if txn[6] is not None]
+        return await billing.transaction_costs(
+            repo, txns, progress=lambda done: report_progress(job_dir, job_id, done / max(len(txns), 1))
+        )
+
+    result = _run(source, job)
+    name = f"{job_id}.json"
+    with open(os.path.join(job_dir, name), "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False)
+    return name, "application/json", "cost_summary.json"
+
+
+def run_monthly_report(job_id, job_dir, source, month):
+    month = monthly_report.normalize_month(month)
+    rows = _run(source, lambda repo: repo.monthly_usage(month))
+    report_progress(job_dir, job_id, 0.5)
+    name = f"{job_id}.pdf"
+    monthly_report.render_pdf(month, rows, os.path.join(job_dir, name))
+    return name, "application/pdf", f"monthly_report_{month}.pdf"
+
+
+def run_transactions_export(job_id, job_dir, source, idTag=None, chargePointId=None, start=None, end=None):
+    name = f"{job_id}.csv"
+
+    async def job(repo):
+        # 依 transaction_id 分頁讀取（各分片合併後仍依 transaction_id 排序），不需整批載入記憶體
+        with open(os.path.join(job_dir, name), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow([
+                "transactionId", "chargePointId", "connectorId", "idTag",
+                "meterStart", "startTimestamp", "meterStop", "stopTimestamp", "reason"
+            ])
+            after = None
+            while True:
+                batch = await repo.list_transactions(idTag, chargePointId, start, end, after, EXPORT_PAGE_SIZE)
+                if not batch:
+                    break
+                writer.writerows(batch)
+                after = batch[-1][0]
+                report_progress(job_dir, job_id, None)
+
+    _run(source, job)
+    return name, "text/csv", "transactions_export.csv"
+
+
+# 工作類型 -> (函式, 同時執行上限)
+JOB_TYPES = {
+    "cost_summary": (run_cost_summary, 1),
+    "monthly_report": (run_monthly_report, 2),
+    "transactions_export": (run_transactions_export, 2),
+}
+
+
+# === API 端 ===
+
+class JobManager:
+    def __init__(self, db_file, job_dir=JOB_DIR, workers=JOB_WORKERS, ttl=JOB_RESULT_TTL, shard_files=(), dsn=None):
+        self.db_file = db_file
+        self.db_files = [db_file, *shard_files]
+        self.source = dsn or self.db_files      # 有 dsn（DB_BACKEND=postgres）時工作程序改連 PostgreSQL
+        self.job_dir = job_dir
+        self.workers = workers
+        self.ttl = ttl
+        self.jobs = {}        # job_id -> dict
+        self._tasks = {}      # job_id -> asyncio.Task
+        self._pending = {}    # 去重用的 key -> job_id
+        self._limits = {t: asyncio.Semaphore(limit) for t, (_, limit) in JOB_TYPES.items()}
+        self._pool = None
+        self._queue = None
+        os.makedirs(job_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # 重新啟動後仍可下載先前完成的結果
+        for name in os.listdir(self.job_dir):
+            if name.endswith(".meta.json"):
+                try:
+                    with open(os.path.join(self.job_dir, name), encoding="utf-8") as f:
+                        job = json.load(f)
+                    if job["status"] in ("pending", "running"):
+                        job.update(status="failed", error="伺服器重新啟動，工作已中斷", finishedAt=time.time())
+                    self.jobs[job["id"]] = job
+                except (OSError, ValueError, KeyError):
+                    continue
+
+    def _save(self, job):
+        path = os.path.join(self.job_dir, f"{job['id']}.meta.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def _ensure_pool(self):
+        if self._pool is None:
+            # spawn：主程式有 OCPP 與通知執行緒，fork 並不安全
+            ctx = multiprocessing.get_context("spawn")
+            self._queue = ctx.Queue()
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=ctx,
+                initializer=_init_worker, initargs=(self._queue,)
+            )
+            threading.Thread(target=self._read_progress, daemon=True).start()
+        return self._pool
+
+    def _read_progress(self):
+        while True:
+            try:
+                job_id, progress = self._queue.get()
+            except (EOFError, OSError):
+                return
+            job = self.jobs.get(job_id)
+            if job is not None and job["status"] == "running":
+                job["progress"] = progress
+
+    def submit(self, job_type, params):
+        if job_type not in JOB_TYPES:
+            raise ValueError(f"未知的工作類型：{job_type}")
+        key = job_type + json.dumps(params, sort_keys=True)
+        existing = self._pending.get(key)
+        if existing is not None:
+            return self.jobs[existing], True
+
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id, "type": job_type, "params": params, "status": "pending",
+            "progress": 0, "error": None, "createdAt": time.time(), "finishedAt": None,
+            "result": None, "mediaType": None, "filename": None,
+        }
+        self.jobs[job_id] = job
+        self._pending[key] = job_id
+        self._tasks[job_id] = asyncio.get_running_loop().create_task(self._run(job, key))
+        return job, False
+
+    async def _run(self, job, key):
+        fn, _ = JOB_TYPES[job["type"]]
+        try:
+            async with self._limits[job["type"]]:
+                job["status"] = "running"
+                loop = asyncio.get_running_loop()
+                name, media_type, filename = await loop.run_in_executor(
+                    self._ensure_pool(),
+                    functools.partial(fn, job["id"], self.job_dir, self.source, **job["params"])
+                )
+            job.update(status="done", progress=1, result=name, mediaType=media_type, filename=filename)
+        except (asyncio.CancelledError, JobCancelled):
+            job["status"] = "cancelled"
+        except Exception as e:
+            job.update(status="failed", error=str(e))
+            logging.warning(f"⚠️ 背景工作失敗 | {job['type']} | {job['id']} | {e}")
+        finally:
+            job["finishedAt"] = time.time()
+            self._pending.pop(key, None)
+            self._tasks.pop(job["id"], None)
+            self._remove_file(f"{job['id']}.cancel")
+            if job["status"] != "done":
+                # 清除中止的工作留下的部分結果
+                for name in os.listdir(self.job_dir):
+                    if name.startswith(job["id"]) and not name.endswith(".meta.json"):
+                        self._remove_file(name)
+            self._save(job)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job["status"] == "pending":
+            self._tasks[job_id].cancel()
+        elif job["status"] == "running":
+            # 執行中的程序在下一次回報進度時看到標記後中止
+            open(os.path.join(self.job_dir, f"{job_id}.cancel"), "w").close()
+        return job
+
+    def delete(self, job_id):
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return False
+        if job["result"]:
+            self._remove_file(job["result"])
+        self._remove_file(f"{job_id}.meta.json")
+        return True
+
+    def result_path(self, job):
+        return os.path.join(self.job_dir, job["result"])
+
+    def _remove_file(self, name):
+        try:
+            os.remove(os.path.join(self.job_dir, name))
+        except OSError:
+            pass
+
+    async def cleanup_task(self, interval=600):
+        while True:
+            now = time.time()
+            for job_id, job in list(self.jobs.items()):
+                if job["finishedAt"] and now - job["finishedAt"] > self.ttl:
+                    self.delete(job_id)
+            await asyncio.sleep(interval)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
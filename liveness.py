@@ -0,0 +1,157 @@
+# 充電樁連線存活檢查（hashed timer wheel）
+#
+# 行動網路不穩時常留下半開（half-open）的 TCP 連線：充電樁早已離線，伺服器這端卻一直保留連線、
+# 記憶體與「已連線」的狀態。LivenessManager 記錄每個充電樁最後一次收到訊息的時間，
+# 超過 heartbeat 間隔 × LIVENESS_MULTIPLIER（預設 3）+ LIVENESS_GRACE 秒仍沒有任何訊息時關閉連線，
+# 並呼叫 on_stale(cp_id)（主程式把該充電樁的即時狀態標為 Unavailable）。
+#
+# - 收到訊息時只更新 last_seen（O(1)），不移動計時器
+# - 計時器放在 slots 個格子的時間輪上，每 LIVENESS_TICK 秒（預設 1）只處理目前這一格：
+#   到期的關閉；期間有收到訊息的依新的期限重新放進對應的格子。每次 tick 的工作量只與這一格的
+#   計時器數量有關，與連線總數無關，不需要掃描所有充電樁
+# - 期限超過一圈的計時器記錄所在的 tick，輪到時還沒到期就留在原格
+#
+# 環境變數：LIVENESS_MULTIPLIER、LIVENESS_GRACE（秒，預設 10）、LIVENESS_TICK（秒）、
+# LIVENESS_SLOTS（預設 512）；LIVENESS_MULTIPLIER=0 表示關閉
+
+import asyncio
+import inspect
+import logging
+import math
+import os
+import time
+
+LIVENESS_MULTIPLIER = float(os.getenv("LIVENESS_MULTIPLIER", "3"))
+LIVENESS_GRACE = float(os.getenv("LIVENESS_GRACE", "10"))
+LIVENESS_TICK = float(os.getenv("LIVENESS_TICK", "1"))
+LIVENESS_SLOTS = int(os.getenv("LIVENESS_SLOTS", "512"))
+
+
+class _Peer:
+    __slots__ = ("cp_id", "close", "timeout", "last_seen", "due_tick", "slot")
+
+    def __init__(self, cp_id, close, timeout, now):
+        self.cp_id = cp_id
+        self.close = close            # close()：關閉連線（可為 coroutine function）
+        self.timeout = timeout
+        self.last_seen = now
+        self.due_tick = None
+        self.slot = None
+
+
+class LivenessManager:
+    def __init__(self, multiplier=LIVENESS_MULTIPLIER, grace=LIVENESS_GRACE, tick=LIVENESS_TICK,
+                 slots=LIVENESS_SLOTS, on_stale=None, clock=time.monotonic):
+        self.multiplier = multiplier
+        self.grace = grace
+        self.tick_seconds = tick
+        self.on_stale = on_stale
+        self.clock = clock
+        self.wheel = [set() for _ in range(slots)]
+        self.peers = {}                  # cp_id -> _Peer
+        self.started = clock()
+        self.current_tick = 0
+        self.stats = {"reaped": 0, "rescheduled": 0, "ticks": 0}
+
+    @property
+    def enabled(self):
+        return self.multiplier > 0
+
+    def _tick_of(self, t):
+        return math.ceil((t - self.started) / self.tick_seconds)
+
+    def _schedule(self, peer):
+        due = max(self._tick_of(peer.last_seen + peer.timeout), self.current_tick + 1)
+        slot = self.wheel[due % len(self.wheel)]
+        if peer.slot is not None:
+            peer.slot.discard(peer.cp_id)
+        peer.due_tick = due
+        peer.slot = slot
+        slot.add(peer.cp_id)
+
+    # === 連線 ===
+
+    def timeout_for(self, interval):
+        return interval * self.multiplier + self.grace
+
+    def register(self, cp_id, close, interval):
+        if not self.enabled:
+            return
+        self.unregister(cp_id)
+        peer = self.peers[cp_id] = _Peer(cp_id, close, self.timeout_for(interval), self.clock())
+        self._schedule(peer)
+
+    def unregister(self, cp_id, close=None):
+        # close 有給時只在仍是同一條連線時移除（同一充電樁重連後舊連線才結束的情況）
+        peer = self.peers.get(cp_id)
+        if peer is None or (close is not None and peer.close != close):
+            return
+        del self.peers[cp_id]
+        if peer.slot is not None:
+            peer.slot.discard(cp_id)
+
+    def touch(self, cp_id):
+        peer = self.peers.get(cp_id)
+        if peer is not None:
+            peer.last_seen = self.clock()
+
+    def set_interval(self, cp_id, interval):
+        # BootNotification 回覆的間隔（Accepted 為 heartbeat，Pending 為重試）
+        peer = self.peers.get(cp_id)
+        if peer is not None:
+            peer.timeout = self.timeout_for(interval)
+            self._schedule(peer)
+
+    # === 時間輪 ===
+
+    def advance(self):
+        # 處理到目前時間為止的每一格；回傳這次關閉的充電樁
+        stale = []
+        target = self._tick_of(self.clock())
+        while self.current_tick < target:
+            self.current_tick += 1
+            self.stats["ticks"] += 1
+            slot = self.wheel[self.current_tick % len(self.wheel)]
+            for cp_id in list(slot):
+                peer = self.peers[cp_id]
+                if peer.due_tick > self.current_tick:
+                    continue                      # 下一圈以後才到期
+                if self._tick_of(peer.last_seen + peer.timeout) > self.current_tick:
+                    self.stats["rescheduled"] += 1
+                    self._schedule(peer)
+                    continue
+                slot.discard(cp_id)
+                del self.peers[cp_id]
+                stale.append(peer)
+        for peer in stale:
+            self.stats["reaped"] += 1
+            logging.warning(f"💤 充電樁 {peer.cp_id} 已 {self.clock() - peer.last_seen:.0f} 秒沒有訊息，關閉連線")
+            result = peer.close()
+            if inspect.isawaitable(result):
+                asyncio.ensure_future(result)
+            if self.on_stale is not None:
+                self.on_stale(peer.cp_id)
+        return [peer.cp_id for peer in stale]
+
+    async def run(self):
+        if not self.enabled:
+            return
+        while True:
+            await asyncio.sleep(self.tick_seconds)
+            try:
+                self.advance()
+            except Exception:
+                logging.exception("⚠️ 連線存活檢查失敗")
+
+    def info(self):
+        now = self.clock()
+        return {
+            "enabled": self.enabled,
+            "tracked": len(self.peers),
+            "multiplier": self.multiplier,
+            "graceS": self.grace,
+            "tickS": self.tick_seconds,
+            "slots": len(self.wheel),
+            "oldestSilenceS": round(max((now - p.last_seen for p in list(self.peers.values())), default=0), 1),
+            **self.stats,
+        }
@@ -0,0 +1,203 @@
+# 站點功率分配（Load Management）
+#
+# 依據 on_meter_values 的即時量測與連接器狀態，在站點容量上限內
+# 重新計算每個充電中連接器的功率上限（W）。
+# 優先順序：目前電價時段下卡片餘額足以支付 1 小時滿載充電者優先，
+# 餘額偏低者只分配剩餘容量。
+# 只有「變動過」的上限才會回傳給呼叫端，用來送出 SetChargingProfile。
+
+from datetime import datetime, timezone
+from operator import itemgetter
+
+ENERGY_MEASURAND = "Energy.Active.Import.Register"
+POWER_MEASURAND = "Power.Active.Import"
+
+
+def _parse_ts(ts):
+    if not ts:
+        return None
+    try:
+        dt = datetime.fromisoformat(ts)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class ConnectorLoad:
+    __slots__ = (
+        "cp_id", "connector_id", "transaction_id", "id_tag", "balance",
+        "max_w", "power_w", "energy_wh", "energy_ts", "status",
+        "sent_w", "seq",
+    )
+
+    def __init__(self, cp_id, connector_id, max_w):
+        self.cp_id = cp_id
+        self.connector_id = connector_id
+        self.transaction_id = None
+        self.id_tag = None
+        self.balance = 0.0
+        self.max_w = max_w
+        self.power_w = None      # 最近一次量測/推算的實際功率
+        self.energy_wh = None    # 最近一次電表讀數（推算功率用）
+        self.energy_ts = None
+        self.status = None       # StatusNotification 狀態
+        self.sent_w = None       # 最近一次送出的上限
+        self.seq = 0             # 交易開始順序（容量不足時先開始者先保留）
+
+
+class SiteAllocator:
+    def __init__(
+        self,
+        capacity_w,
+        default_max_w=22000,
+        min_w=1380,               # 6A 單相，低於此值多數車輛會停止充電
+        change_threshold_w=200,   # 變動小於此值不重送 profile
+        low_balance=100,          # 與餘額通知門檻一致
+    ):
+        self.capacity_w = float(capacity_w)
+        self.default_max_w = float(default_max_w)
+        self.min_w = float(min_w)
+        self.change_threshold_w = float(change_threshold_w)
+        self.low_balance = float(low_balance)
+        self.connectors = {}       # (cp_id, connector_id) -> ConnectorLoad
+        self.by_transaction = {}   # transaction_id -> ConnectorLoad
+        self._seq = 0
+
+    def _get(self, cp_id, connector_id):
+        key = (cp_id, int(connector_id))
+        c = self.connectors.get(key)
+        if c is None:
+            c = ConnectorLoad(cp_id, int(connector_id), self.default_max_w)
+            self.connectors[key] = c
+        return c
+
+    # === 狀態更新（由 OCPP handler 呼叫） ===
+
+    def start_transaction(self, cp_id, connector_id, transaction_id, id_tag, balance):
+        c = self._get(cp_id, connector_id)
+        if c.transaction_id is not None:
+            self.by_transaction.pop(c.transaction_id, None)
+        self._seq += 1
+        c.transaction_id = transaction_id
+        c.id_tag = id_tag
+        c.balance = float(balance or 0)
+        c.power_w = None
+        c.energy_wh = None
+        c.energy_ts = None
+        c.sent_w = None
+        c.seq = self._seq
+        self.by_transaction[transaction_id] = c
+
+    def stop_transaction(self, transaction_id):
+        c = self.by_transaction.pop(transaction_id, None)
+        if c is None:
+            return
+        c.transaction_id = None
+        c.id_tag = None
+        c.power_w = None
+        c.sent_w = None
+
+    def set_status(self, cp_id, connector_id, status):
+        if int(connector_id) == 0:
+            return
+        self._get(cp_id, connector_id).status = status
+
+    def update_meter(self, cp_id, connector_id, measurand, value, unit, timestamp):
+        if int(connector_id) == 0:
+            return
+        c = self._get(cp_id, connector_id)
+        unit = unit or ""
+        if measurand == POWER_MEASURAND:
+            c.power_w = value * 1000 if unit == "kW" else value
+        elif measurand == ENERGY_MEASURAND:
+            wh = value * 1000 if unit == "kWh" else value
+            ts = _parse_ts(timestamp)
+            if ts is not None and c.energy_ts is not None and ts > c.energy_ts:
+                c.power_w = max(wh - c.energy_wh, 0) * 3600 / (ts - c.energy_ts)
+            if ts is not None:
+                c.energy_wh = wh
+                c.energy_ts = ts
+
+    def update_balances(self, balances):
+        # balances: id_tag -> 餘額
+        for c in self.by_transaction.values():
+            if c.id_tag in balances:
+                c.balance = float(balances[c.id_tag])
+
+    def drop_charge_point(self, cp_id):
+        # 斷線後不再保留已送出的上限，重新連線時需重送
+        for c in self.connectors.values():
+            if c.cp_id == cp_id:
+                c.sent_w = None
+
+    def mark_sent(self, cp_id, connector_id, limit_w):
+        c = self.connectors.get((cp_id, int(connector_id)))
+        if c is not None:
+            c.sent_w = limit_w
+
+    # === 分配 ===
+
+    def _allocate(self, price):
+        # 依優先等級由高到低做 water-filling；回傳 [(ConnectorLoad, limit_w)]
+        # 需求估計與優先等級直接在迴圈內計算，避免每個連接器多次方法呼叫
+        high, low = [], []
+        min_w = self.min_w
+        low_balance = self.low_balance
+        for c in self.by_transaction.values():
+            max_w = c.max_w
+            power = c.power_w
+            sent = c.sent_w
+            if c.status == "SuspendedEV":
+                d = min_w
+            elif power is None or sent is None or power >= sent * 0.9:
+                d = max_w
+            else:
+                d = power * 1.1
+                if d < min_w:
+                    d = min_w
+                elif d > max_w:
+                    d = max_w
+            balance = c.balance
+            if balance < low_balance or (price > 0 and balance < price * max_w / 1000):
+                low.append((d, c.seq, c))
+            else:
+                high.append((d, c.seq, c))
+
+        result = []
+        remaining = self.capacity_w
+        for group in (high, low):
+            n = len(group)
+            if not n:
+                continue
+            if remaining < n * min_w:
+                # 容量不足以讓全部維持最低功率：先開始充電者保留最低功率，其餘暫停
+                group.sort(key=itemgetter(1))
+                keep = int(remaining // min_w)
+                for i, (_, _, c) in enumerate(group):
+                    result.append((c, int(min_w) if i < keep else 0))
+                remaining -= keep * min_w
+                continue
+
+            group.sort(key=itemgetter(0))
+            for i, (d, _, c) in enumerate(group):
+                share = remaining / (n - i)
+                give = d if d < share else share
+                result.append((c, int(give)))
+                remaining -= give
+        return result
+
+    def allocate(self, price=0.0):
+        # {(cp_id, connector_id): limit_w}
+        return {(c.cp_id, c.connector_id): limit for c, limit in self._allocate(price)}
+
+    def changes(self, price=0.0):
+        # 只回傳與上次送出值差異超過門檻的上限：[(cp_id, connector_id, transaction_id, limit_w)]
+        out = []
+        threshold = self.change_threshold_w
+        for c, limit in self._allocate(price):
+            sent = c.sent_w
+            if sent is None or abs(limit - sent) >= threshold or (limit == 0) != (sent == 0):
+                out.append((c.cp_id, c.connector_id, c.transaction_id, limit))
+        return out
@@ -0,0 +1,180 @@
+# 非阻塞、可抽樣的 logging 設定
+#
+# - root logger 只掛一個 QueueHandler：呼叫端（OCPP 事件迴圈）只建立 LogRecord 放進佇列，
+#   訊息格式化與寫出由 QueueListener 的背景執行緒處理；%s 參數延後到背景執行緒才組字串
+# - 抽樣 / 限流依 logger 名稱（或名稱最後一段）比對；action_logger() 在建立 LogRecord 前判斷，
+#   其他 logger 在放進佇列前判斷：
+#     LOG_SAMPLE="Heartbeat=1000,ocpp=100"   每 N 筆只記 1 筆
+#     LOG_RATE="StatusNotification=20"        每秒最多 N 筆
+#   WARNING 以上的紀錄一律保留；被略過的筆數記在下一筆紀錄的 skipped 欄位
+# - LOG_FORMAT=text（預設，與 basicConfig 相同）| json（每行一個 JSON 物件）
+# - LOG_LEVEL（預設 INFO）、LOG_FILE（預設輸出到 stderr）
+#
+# OCPP handler 以 action_logger("Heartbeat") 取得各 action 的 logger（名稱 ocpp.Heartbeat），
+# 函式庫自身的收送 frame 紀錄使用 "ocpp" logger。
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+LOG_RATE = os.getenv("LOG_RATE", "")
+
+TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+_listener = None
+
+
+def parse_rules(text):
+    # "Heartbeat=1000,ocpp=100" -> {"Heartbeat": 1000, "ocpp": 100}
+    rules = {}
+    for item in text.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            rules[name.strip()] = int(value)
+    return rules
+
+
+class Sampler:
+    def __init__(self, sample=None, rate=None, clock=time.monotonic):
+        self.clock = clock
+        self.configure(sample, rate)
+
+    def configure(self, sample=None, rate=None):
+        self.sample = sample or {}
+        self.rate = rate or {}
+        self._seen = {}       # key -> 已看到的筆數（抽樣）
+        self._window = {}     # key -> [視窗開始秒, 本秒已記錄筆數]
+        self.skipped = {}     # logger 名稱 -> 上一筆保留的紀錄之後被略過的筆數
+
+    def _key(self, name, rules):
+        if name in rules:
+            return name
+        short = name.rpartition(".")[2]
+        return short if short in rules else None
+
+    def allow(self, name):
+        # 計數不加鎖：多執行緒同時記錄時抽樣比例可能有些微誤差
+        if not (self.sample or self.rate):
+            return True
+        key = self._key(name, self.sample)
+        if key is not None:
+            seen = self._seen.get(key, 0)
+            self._seen[key] = seen + 1
+            if seen % self.sample[key]:
+                self.skipped[name] = self.skipped.get(name, 0) + 1
+                return False
+        key = self._key(name, self.rate)
+        if key is not None:
+            now = int(self.clock())
+            window = self._window.setdefault(key, [now, 0])
+            if window[0] != now:
+                window[0], window[1] = now, 0
+            if window[1] >= self.rate[key]:
+                self.skipped[name] = self.skipped.get(name, 0) + 1
+                return False
+            window[1] += 1
+        return True
+
+    def take_skipped(self, name):
+        return self.skipped.pop(name, 0) if self.skipped else 0
+
+
+_sampler = Sampler()
+
+
+class ActionLogger(logging.LoggerAdapter):
+    # 在建立 LogRecord 之前就做抽樣判斷，被略過的呼叫幾乎沒有成本
+    def isEnabledFor(self, level):
+        if not self.logger.isEnabledFor(level):
+            return False
+        return level >= logging.WARNING or _sampler.allow(self.logger.name)
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {"skipped": _sampler.take_skipped(self.logger.name)}
+        return msg, kwargs
+
+
+def action_logger(action):
+    return ActionLogger(logging.getLogger(f"ocpp.{action}"), {})
+
+
+class SamplingFilter(logging.Filter):
+    # 其他 logger（例如 ocpp 函式庫的收送 frame 紀錄）在放進佇列前抽樣
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or hasattr(record, "skipped"):
+            return True
+        if not _sampler.allow(record.name):
+            return False
+        record.skipped = _sampler.take_skipped(record.name)
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # 同一個 process 內的佇列不需要先格式化，原樣放入 LogRecord，由背景執行緒格式化
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "skipped", 0):
+            entry["skipped"] = record.skipped
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup(level=LOG_LEVEL, fmt=LOG_FORMAT, log_file=LOG_FILE, sample=LOG_SAMPLE, rate=LOG_RATE):
+    # 重複呼叫只有第一次有效；會取代 root logger 既有的 handler（例如先前的 basicConfig）
+    global _listener
+    if _listener is not None:
+        return _listener
+    if log_file:
+        output = logging.FileHandler(log_file, encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    # 不需要的 LogRecord 欄位不收集（呼叫端位置、執行緒 / process 名稱）
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    _sampler.configure(parse_rules(sample), parse_rules(rate))
+    handler = LazyQueueHandler(queue.SimpleQueue())
+    handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+    return _listener
+
+
+def shutdown():
+    # 寫完佇列中剩下的紀錄
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -6,12 +6,16 @@ import os
 import uuid
 import asyncio
 import logging
+import re
 import sqlite3
+import contextlib
 from datetime import datetime, timezone
+from http import HTTPStatus
 
 from fastapi import FastAPI, Request, Query, Body, Path, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import StreamingResponse, Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.base import BaseHTTPMiddleware
 
 import uvicorn
 from websockets.server import serve
@@ -26,11 +30,19 @@ from ocpp.v16.call_result import (
     MeterValuesPayload,
     StartTransactionPayload,
     StopTransactionPayload,
-    StatusNotificationPayload
+    StatusNotificationPayload,
+    FirmwareStatusNotificationPayload,
+    DiagnosticsStatusNotificationPayload
 )
 from ocpp.v16.enums import Action, RegistrationStatus
 from ocpp.routing import on
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+import log_pipeline
+import tracing
+from log_pipeline import action_logger
 
 
 
@@ -45,12 +57,13 @@ app.add_middleware(
 # 初始化狀態儲存
 charging_point_status = {}
 
-logging.basicConfig(level=logging.INFO)
+# 背景執行緒寫出、可抽樣的 logging（LOG_LEVEL、LOG_FORMAT、LOG_SAMPLE、LOG_RATE，見 log_pipeline.py）
+log_pipeline.setup()
 
 # HTTP 端點：查詢狀態
 @app.get("/status/{cp_id}")
 async def get_status(cp_id: str):
-    return JSONResponse(charging_point_status.get(cp_id, {}))
+    return FastJSONResponse(charging_point_status.get(cp_id, {}))
 
 # 假設的授權 API
 @app.post("/authorize/{cp_id}")
@@ -63,9 +76,6 @@ async def authorize(cp_id: str, badge_id: str = Body(..., embed=True)):
 
 
 app = FastAPI()
-logging.basicConfig(level=logging.INFO)
-# 啟用 logging
-logging.basicConfig(level=logging.INFO)
 
 # 用於記錄所有充電樁的狀態
 charging_point_status = {}
@@ -73,7 +83,11 @@ charging_point_status = {}
 
 # 初始化 SQLite 資料庫
 DB_FILE = "ocpp_data.db"
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+# journal_mode / synchronous / cache / mmap 依 SQLITE_PROFILE 設定（見 storage.py）
+# TracedConnection：SQL 計時、慢查詢紀錄與 tracing 子 span（見 tracing.py）
+conn = storage.apply_profile(
+    sqlite3.connect(DB_FILE, check_same_thread=False, factory=tracing.TracedConnection), background_checkpoint=True
+)
 cursor = conn.cursor()
 
 
@@ -106,6 +120,19 @@ CREATE TABLE IF NOT EXISTS transactions (
 )
 ''')
 
+# 交易編號的配發序號（repository.next_transaction_id）：啟用分片時各場域也由主資料庫這一列配發，不會重複
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS id_sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+)
+''')
+cursor.execute('''
+INSERT OR IGNORE INTO id_sequences (name, value)
+SELECT 'transactions', COALESCE(MAX(transaction_id), 0) FROM transactions
+''')
+conn.commit()
+
 
 cursor.execute('''
 CREATE TABLE IF NOT EXISTS id_tags (
@@ -162,59 +189,326 @@ CREATE TABLE meter_values (
     measurand TEXT,
     unit TEXT,
     context TEXT,
-    format TEXT
+    format TEXT,
+    phase TEXT,
+    location TEXT
 )
 ''')
+# 補傳資料去重（backlog.py）依充電樁與時間範圍查詢
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_meter_values_cp_ts ON meter_values (charge_point_id, timestamp)")
 
 
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS status_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    charge_point_id TEXT,
-    connector_id INTEGER,
-    status TEXT,
-    timestamp TEXT
-)
-''')
+# 充電樁狀態歷史（只記錄狀態轉換，見 repository.py；舊的 status_logs 以 compact_status_logs.py 轉換）
+from repository import STATUS_INTERVALS_SCHEMA
+for statement in STATUS_INTERVALS_SCHEMA:
+    cursor.execute(statement)
 
 
 conn.commit()
 
+from response_cache import TableVersions, ResponseCache, etag_matches
+from codec import FastChargePoint, FastJSONResponse
+
 # FastAPI 建立與 CORS
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
+
+
+# === 回應快取（ETag / If-None-Match） ===
+# 路由 -> 相依資料表；資料表版本沒變時直接回 304 或快取內容
+CACHED_ROUTES = [
+    (re.compile(r"^/api/summary/pricing-matrix$"), ("pricing_rules",)),
+    # "replica"：唯讀副本每次更新時遞增（READ_REPLICA，統計改查快照）
+    (re.compile(r"^/api/summary(/top|/daily-by-chargepoint|/daily-by-chargepoint-range)?$"), ("transactions", "replica")),
+    (re.compile(r"^/api/weekly-pricing$"), ("weekly_pricing",)),
+    (re.compile(r"^/api/daily-pricing$"), ("daily_pricing_rules",)),
+    (re.compile(r"^/api/holiday/[^/]+$"), ()),
+    (re.compile(r"^/api/id_tags$"), ("id_tags",)),
+    (re.compile(r"^/api/users$"), ("users",)),
+]
+
+# 寫入端點（POST/PUT/DELETE）路徑前綴 -> 會異動的資料表
+WRITE_ROUTES = [
+    ("/api/pricing-rules", ("pricing_rules",)),
+    ("/api/weekly-pricing", ("weekly_pricing",)),
+    ("/api/daily-pricing", ("daily_pricing_rules",)),
+    ("/api/tariff-calendar", ("daily_pricing_rules", "weekly_pricing")),
+    ("/api/id_tags", ("id_tags",)),
+    ("/api/users", ("users",)),
+    ("/api/cards", ("cards",)),
+    ("/api/reservations", ("reservations",)),
+    ("/webhook", ("users",)),
+]
+
+table_versions = TableVersions()
+response_cache = ResponseCache(int(float(os.getenv("RESPONSE_CACHE_MB", "32")) * 1024 * 1024))
+
+
+async def cached_responses(request: Request, call_next):
+    path = request.url.path
+    if request.method != "GET":
+        response = await call_next(request)
+        for prefix, tables in WRITE_ROUTES:
+            if path.startswith(prefix):
+                table_versions.bump(*tables)
+                break
+        return response
+
+    tables = next((t for pattern, t in CACHED_ROUTES if pattern.match(path)), None)
+    if tables is None:
+        return await call_next(request)
+
+    key = f"{path}?{'&'.join(sorted(f'{k}={v}' for k, v in request.query_params.multi_items()))}"
+    versions, etag = table_versions.etag(key, tables)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+
+    entry = response_cache.get(key, versions)
+    if entry is not None:
+        return Response(content=entry[2], media_type=entry[3], headers=headers)
+
+    response = await call_next(request)
+    if response.status_code != 200:
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    media_type = response.headers.get("content-type", "application/json")
+    response_cache.put(key, versions, etag, body, media_type)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+# 需在 CORS 之前加入，讓 304 / 快取回應同樣帶有 CORS 標頭
+app.add_middleware(BaseHTTPMiddleware, dispatch=cached_responses)
+
+
+async def traced_requests(request: Request, call_next):
+    with tracing.span(f"{request.method} {request.url.path}", tracing.SERVER, **{
+        "http.method": request.method, "http.target": request.url.path,
+    }) as s:
+        response = await call_next(request)
+        if s is not None:
+            s.set("http.status_code", response.status_code)
+        return response
+
+
+# 有開啟取樣時才加上 tracing middleware（含快取命中的請求）
+if tracing.TRACE_SAMPLE_RATE > 0:
+    app.add_middleware(BaseHTTPMiddleware, dispatch=traced_requests)
+
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    return response_cache.stats()
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"],  # 明確允許前端開發網址
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],  # /api/status/logs 的分頁
 )
 
 
-from ocpp.v16 import ChargePoint as OcppChargePoint
+from load_management import SiteAllocator
+from reservation_index import ReservationIndex, ReservationConflict, to_epoch
+import bulk_import
+import tariff_calendar
+import monthly_report
+import billing
+import jobs
+import repository
+import frame_journal
+import profiler
+import sharding
+import replica
+import mux
+import density
+import commands
+import firmware
+import diagnostics
+from repository import DuplicateError, WriteError
+from backlog import BacklogBuffer, meter_rows
+from admission import AdmissionController
+from liveness import LivenessManager
+
+# === 站點功率分配（Load Management）設定 ===
+SITE_CAPACITY_KW = float(os.getenv("SITE_CAPACITY_KW", "200"))
+CONNECTOR_MAX_KW = float(os.getenv("CONNECTOR_MAX_KW", "22"))
+LOAD_REBALANCE_DELAY = float(os.getenv("LOAD_REBALANCE_DELAY", "2"))  # 秒，合併短時間內的多次更新
+
+load_manager = SiteAllocator(
+    capacity_w=SITE_CAPACITY_KW * 1000,
+    default_max_w=CONNECTOR_MAX_KW * 1000,
+)
 
-class ChargePoint(OcppChargePoint):
+# OCPP handler 與主要 API 的資料存取（DB_BACKEND=sqlite | postgres，見 repository.py）
+repo = repository.create_repository(conn)
+# DB_SHARDS：依場域把交易、電錶、狀態紀錄寫到各自的資料庫檔（見 sharding.py）；未設定時 shards 為 None
+repo, shards = sharding.create_sharded_repository(repo, DB_FILE)
+
+POSTGRES = repository.DB_BACKEND == "postgres"
+
+
+@contextlib.contextmanager
+def batch_repository():
+    # 批次匯入與電價整批替換：SQLite 以獨立連線在單一交易內寫入，失敗還原時不影響共用連線上的其他寫入；
+    # PostgreSQL 的每個方法本來就各自取得連線與交易，直接使用 repo
+    if POSTGRES:
+        yield repo
+        return
+    batch_conn = storage.connect(DB_FILE)
+    try:
+        yield repository.SQLiteRepository(batch_conn)
+    finally:
+        batch_conn.close()
+
+
+# READ_REPLICA：統計 / 匯出路由改查定期更新的唯讀快照（見 replica.py）；未啟用時為 None
+if replica.READ_REPLICA and POSTGRES:
+    raise ValueError("READ_REPLICA 只支援 DB_BACKEND=sqlite")
+read_replica = replica.ReadReplica(
+    shards.files() if shards is not None else [DB_FILE],
+    on_refresh=lambda: table_versions.bump("replica"),
+) if replica.READ_REPLICA else None
+
+# 統計與匯出查詢用的 repository：有唯讀副本時查副本，否則與 repo 相同
+analytics = replica.ReplicaRepository(read_replica) if read_replica is not None else repo
+
+# 重連風暴的連線 / BootNotification 速率限制與 heartbeat 間隔分散
+admission = AdmissionController()
+
+# 目前連線中的充電樁：cp_id -> ChargePoint
+connected_charge_points = {}
+
+
+def set_live_status(cp_id, online, connector_id=None, status=None):
+    # /api/status 的即時狀態：{cp_id: {"online": bool, "connectors": {connector_id: status}}}
+    entry = charging_point_status.setdefault(cp_id, {"online": online, "connectors": {}})
+    entry["online"] = online
+    if connector_id is not None:
+        entry["connectors"][connector_id] = status
+
+
+def mark_stale(cp_id):
+    # 存活檢查逾時：連線視為已中斷，所有連接器標為 Unavailable
+    set_live_status(cp_id, False)
+    entry = charging_point_status[cp_id]
+    entry["connectors"] = {c: "Unavailable" for c in entry["connectors"]}
+    entry["stale"] = True
+
+
+# 直接連線的充電樁太久沒有任何訊息時關閉連線（見 liveness.py）；經集中器的由集中器自行檢查
+liveness = LivenessManager(on_stale=mark_stale)
+# 事件迴圈：api（uvicorn）、ocpp（WebSocket 執行緒）、firmware（韌體下載伺服器），供 /api/admin/profile 監測
+event_loops = {}
+_rebalance_handle = None
+
+
+async def _refresh_balances():
+    id_tags = [c.id_tag for c in load_manager.by_transaction.values() if c.id_tag]
+    if not id_tags:
+        return
+    load_manager.update_balances(await repo.get_balances(id_tags))
+
+
+async def refresh_authorization_caches():
+    # 卡片餘額或授權資料批次變更後呼叫一次：更新充電中交易的餘額快照。
+    # load_manager 只在 OCPP 事件迴圈上讀寫（SiteAllocator 沒有鎖），API 端的呼叫轉到 OCPP 迴圈執行
+    loop = event_loops.get("ocpp")
+    if loop is None:
+        return
+    await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_refresh_balances(), loop))
+
+
+def schedule_rebalance():
+    # 在 OCPP 事件迴圈上延遲執行一次重新分配，期間的其他更新會被合併
+    global _rebalance_handle
+    if _rebalance_handle is not None:
+        return
+    loop = asyncio.get_event_loop()
+    _rebalance_handle = loop.call_later(
+        LOAD_REBALANCE_DELAY, lambda: asyncio.ensure_future(rebalance_site())
+    )
+
+
+async def rebalance_site():
+    global _rebalance_handle
+    _rebalance_handle = None
+    price = await repo.current_price(datetime.now())
+    for cp_id, connector_id, transaction_id, limit in load_manager.changes(price):
+        cp = connected_charge_points.get(cp_id)
+        if cp is None:
+            continue
+        # 先記錄為已送出，避免下一輪重複送出同一個值；失敗時再清除
+        load_manager.mark_sent(cp_id, connector_id, limit)
+        asyncio.ensure_future(send_charging_limit(cp, connector_id, transaction_id, limit))
+
+
+async def send_charging_limit(cp, connector_id, transaction_id, limit):
+    request = call.SetChargingProfilePayload(
+        connector_id=connector_id,
+        cs_charging_profiles={
+            "charging_profile_id": connector_id,
+            "transaction_id": transaction_id,
+            "stack_level": 1,
+            "charging_profile_purpose": "TxProfile",
+            "charging_profile_kind": "Relative",
+            "charging_schedule": {
+                "charging_rate_unit": "W",
+                "charging_schedule_period": [{"start_period": 0, "limit": limit}],
+            },
+        },
+    )
+    try:
+        response = await cp.call(request)
+    except Exception as e:
+        logging.warning(f"⚠️ SetChargingProfile 失敗 | CP={cp.id} | connector={connector_id} | {e}")
+        response = None
+    if not response or response.status != "Accepted":
+        load_manager.mark_sent(cp.id, connector_id, None)
+        return
+    logging.info(f"⚖️ SetChargingProfile | CP={cp.id} | connector={connector_id} | limit={limit} W")
+
+
+# OCPP handler 依 action 分開的 logger，可用 LOG_SAMPLE / LOG_RATE 個別抽樣
+boot_log = action_logger("BootNotification")
+heartbeat_log = action_logger("Heartbeat")
+authorize_log = action_logger("Authorize")
+start_log = action_logger("StartTransaction")
+meter_log = action_logger("MeterValues")
+stop_log = action_logger("StopTransaction")
+status_log = action_logger("StatusNotification")
+
+
+class ChargePoint(FastChargePoint):
+
+    async def route_message(self, raw_msg):
+        liveness.touch(self.id)
+        await super().route_message(raw_msg)
 
     @on(Action.BootNotification)
     async def on_boot_notification(self, charge_point_model, charge_point_vendor, **kwargs):
         now = datetime.utcnow().replace(tzinfo=timezone.utc)
-        logging.info(f"🔌 BootNotification | 模型={charge_point_model} | 廠商={charge_point_vendor}")
+        # 重連風暴時以 Pending + 隨機重試間隔分散，Accepted 的 heartbeat 間隔依充電樁分散（見 admission.py）
+        status, interval = admission.admit_boot(self.id)
+        liveness.set_interval(self.id, interval)
+        boot_log.info("🔌 BootNotification | CP=%s | 模型=%s | 廠商=%s | %s interval=%s", self.id, charge_point_model, charge_point_vendor, status, interval)
         return BootNotificationPayload(
             current_time=now.isoformat(),
-            interval=10,
-            status="Accepted"
+            interval=interval,
+            status=status
         )
 
     @on(Action.Heartbeat)
     async def on_heartbeat(self):
         now = datetime.utcnow().replace(tzinfo=timezone.utc)
-        logging.info(f"❤️ Heartbeat | CP={self.id}")
+        heartbeat_log.info("❤️ Heartbeat | CP=%s", self.id)
         return HeartbeatPayload(current_time=now.isoformat())
 
     @on(Action.Authorize)
     async def on_authorize(self, id_tag, **kwargs):
-        cursor.execute("SELECT status, valid_until FROM id_tags WHERE id_tag = ?", (id_tag,))
-        row = cursor.fetchone()
+        row = await repo.get_id_tag(id_tag)
         if not row:
             status = "Invalid"
         else:
@@ -225,15 +519,14 @@ class ChargePoint(OcppChargePoint):
                 logging.warning(f"⚠️ 無法解析 valid_until 格式：{valid_until}")
                 valid_until_dt = datetime.min.replace(tzinfo=timezone.utc)
             now = datetime.utcnow().replace(tzinfo=timezone.utc)
-            logging.info(f"🔎 驗證有效期限valid_until={valid_until_dt.isoformat()} / now={now.isoformat()}")
+            authorize_log.info("🔎 驗證有效期限valid_until=%s / now=%s", valid_until_dt, now)
             status = "Accepted" if status_db == "Accepted" and valid_until_dt > now else "Expired"
-        logging.info(f"🆔 Authorize | idTag: {id_tag} | 查詢結果: {status}")
+        authorize_log.info("🆔 Authorize | idTag: %s | 查詢結果: %s", id_tag, status)
         return call.AuthorizePayload(id_tag_info={"status": status})
 
     @on(Action.StartTransaction)
     async def on_start_transaction(self, connector_id, id_tag, meter_start, timestamp, **kwargs):
-        cursor.execute("SELECT status, valid_until FROM id_tags WHERE id_tag = ?", (id_tag,))
-        row = cursor.fetchone()
+        row = await repo.get_id_tag(id_tag)
         if not row:
             status = "Invalid"
         else:
@@ -245,36 +538,29 @@ class ChargePoint(OcppChargePoint):
                 logging.warning(f"⚠️ 無法解析 valid_until 格式：{valid_until}")
                 valid_until_dt = datetime.min.replace(tzinfo=timezone.utc)
             now = datetime.utcnow().replace(tzinfo=timezone.utc)
-            logging.info(f"🔎 驗證有效期限valid_until={valid_until_dt.isoformat()} / now={now.isoformat()}")
+            start_log.info("🔎 驗證有效期限valid_until=%s / now=%s", valid_until_dt, now)
             status = "Accepted" if status_db == "Accepted" and valid_until_dt > now else "Expired"
 
-        # 驗證是否有符合條件的有效預約
-        now = datetime.utcnow().isoformat()
-        cursor.execute('''
-        SELECT id FROM reservations
-        WHERE charge_point_id = ? AND id_tag = ? AND status = 'active'
-        AND start_time <= ? AND end_time >= ?
-        ''', (self.id, id_tag, now, now))
-        res = cursor.fetchone()
+        # 驗證是否有符合條件的有效預約（由預約區間索引查詢）
+        res = reservation_index.find_active(self.id, datetime.utcnow().replace(tzinfo=timezone.utc).timestamp())
 
-        if not res:
+        if not res or res[1] != id_tag:
             logging.warning(f"⛔ StartTransaction 拒絕 | 無有效預約")
-            return StartTransaction(transaction_id=0, id_tag_info={"status": "Expired"})
+            return StartTransactionPayload(transaction_id=0, id_tag_info={"status": "Expired"})
         else:
-            cursor.execute("UPDATE reservations SET status = 'completed' WHERE id = ?", (res[0],))
-            conn.commit()
+            await repo.set_reservation_status([res[0]], "completed")
+            reservation_index.remove(res[0])
+            table_versions.bump("reservations")
 
         # ✅ 新增：餘額檢查
-        cursor.execute("SELECT balance FROM cards WHERE card_id = ?", (id_tag,))
-        card = cursor.fetchone()
-        if not card:
+        balance = await repo.get_balance(id_tag)
+        if balance is None:
             logging.warning(f"⛔ 無此卡片帳戶資料，StartTransaction 拒絕")
-            return StartTransaction(transaction_id=0, id_tag_info={"status": "Invalid"})
+            return StartTransactionPayload(transaction_id=0, id_tag_info={"status": "Invalid"})
 
-        balance = card[0]
         if balance < 10:
             logging.warning(f"💳 餘額不足：{balance} 元，StartTransaction 拒絕")
-            return StartTransaction(transaction_id=0, id_tag_info={"status": "Blocked"})
+            return StartTransactionPayload(transaction_id=0, id_tag_info={"status": "Blocked"})
 
         # 🟢 原本的交易建立邏輯繼續執行
         transaction_id = int(datetime.utcnow().timestamp() * 1000)
@@ -282,138 +568,148 @@ class ChargePoint(OcppChargePoint):
 
         if status != "Accepted":
             logging.warning(f"⛔ StartTransaction 拒絕 | idTag={id_tag} | status={status}")
-            return StartTransaction(transaction_id=0, id_tag_info={"status": status})
+            return StartTransactionPayload(transaction_id=0, id_tag_info={"status": status})
 
         # ✅ 新增：確認卡片餘額是否足夠（預設最低 10 元才能啟動）
-        cursor.execute("SELECT balance FROM cards WHERE card_id = ?", (id_tag,))
-        balance_row = cursor.fetchone()
-        if not balance_row or balance_row[0] < 10:
-            logging.warning(f"⛔ StartTransaction 拒絕 | idTag={id_tag} | 餘額不足 {balance_row[0] if balance_row else '無資料'} 元")
-            return StartTransaction(transaction_id=0, id_tag_info={"status": "Blocked"})
-
-
-        transaction_id = int(datetime.utcnow().timestamp() * 1000)
-        cursor.execute('''
-            INSERT INTO transactions (
-                transaction_id, charge_point_id, connector_id, id_tag,
-                meter_start, start_timestamp, meter_stop, stop_timestamp, reason
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            transaction_id, self.id, connector_id, id_tag,
-            meter_start, timestamp, None, None, None
-        ))
-        conn.commit()
-        logging.info(f"🚗 StartTransaction 成功 | CP={self.id} | idTag={id_tag} | transactionId={transaction_id}")
+        balance = await repo.get_balance(id_tag)
+        if balance is None or balance < 10:
+            logging.warning(f"⛔ StartTransaction 拒絕 | idTag={id_tag} | 餘額不足 {balance if balance is not None else '無資料'} 元")
+            return StartTransactionPayload(transaction_id=0, id_tag_info={"status": "Blocked"})
+
+
+        transaction_id = await repo.next_transaction_id()
+        await repo.start_transaction(transaction_id, self.id, connector_id, id_tag, meter_start, timestamp)
+        table_versions.bump("transactions")
+        load_manager.start_transaction(self.id, connector_id, transaction_id, id_tag, balance)
+        schedule_rebalance()
+        start_log.info("🚗 StartTransaction 成功 | CP=%s | idTag=%s | transactionId=%s", self.id, id_tag, transaction_id)
         return StartTransactionPayload(
             transaction_id=transaction_id,
             id_tag_info={"status": "Accepted"}
         )
 
     @on(Action.MeterValues)
-    async def on_meter_values(self, connector_id, meter_value, **kwargs):
-        for entry in meter_value:
-            timestamp = entry.get("timestamp")
-            for sampled_value in entry.get("sampled_value", []):
-                value = float(sampled_value.get("value"))
-                measurand = sampled_value.get("measurand", "Energy.Active.Import.Register")
-                unit = sampled_value.get("unit", "Wh")
-                cursor.execute('''
-                    INSERT INTO meter_values (charge_point_id, connector_id, timestamp, measurand, value, unit)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    self.id, connector_id, timestamp, measurand, value, unit
-                ))
-        conn.commit()
-        logging.info(f"📈 MeterValues | CP={self.id} | 筆數={len(meter_value)}")
+    async def on_meter_values(self, connector_id, meter_value, transaction_id=None, **kwargs):
+        rows = meter_rows(transaction_id, self.id, connector_id, meter_value)
+        # 斷線後補傳的舊資料先放進緩衝區，補傳結束時一次寫入（見 backlog.py）
+        if self.backlog.wants([entry.get("timestamp") for entry in meter_value]):
+            self.backlog.add(rows)
+            return MeterValuesPayload()
+        await self.backlog.drain()
+
+        for row in rows:
+            load_manager.update_meter(self.id, connector_id, row[5], row[4], row[6], row[3])
+        await repo.add_meter_values(rows)
+        table_versions.bump("meter_values")
+        schedule_rebalance()
+        meter_log.info("📈 MeterValues | CP=%s | 筆數=%d", self.id, len(meter_value))
         return MeterValuesPayload()
 
-
     @on(Action.StopTransaction)
-    async def on_stop_transaction(self, transaction_id, meter_stop, timestamp, id_tag, reason, **kwargs):
-        # 更新交易紀錄
-        cursor.execute('''
-            UPDATE transactions
-            SET meter_stop = ?, stop_timestamp = ?, reason = ?
-            WHERE transaction_id = ?
-        ''', (meter_stop, timestamp, reason, transaction_id))
-        conn.commit()
-
-        # 查詢啟始資料
-        cursor.execute("SELECT meter_start, start_timestamp FROM transactions WHERE transaction_id = ?", (transaction_id,))
-        row = cursor.fetchone()
-        if not row:
+    async def on_stop_transaction(self, transaction_id, meter_stop, timestamp, id_tag, reason,
+                                  transaction_data=None, **kwargs):
+        txn = await repo.get_transaction(transaction_id)
+        rows = meter_rows(transaction_id, self.id, txn[2] if txn else None, transaction_data) if transaction_data else []
+        if txn and txn[6] is None:
+            # 寫入結束紀錄前先記下待扣款；扣款時認領標記，程序在扣款前中止時由下次啟動補扣（見 resume_pending_billing）
+            await repo.add_pending_billing(transaction_id, id_tag, meter_stop, timestamp)
+        backlog = self.backlog.wants([timestamp])
+        if not backlog:
+            await self.backlog.drain()
+
+        # 更新交易紀錄（含月報彙總），回傳更新前的資料
+        prev = await repo.stop_transaction(transaction_id, meter_stop, timestamp, reason)
+        table_versions.bump("transactions")
+        load_manager.stop_transaction(transaction_id)
+        schedule_rebalance()
+
+        if backlog:
+            self.backlog.add(rows)
+        elif rows:
+            await repo.add_meter_values(rows)
+            table_versions.bump("meter_values")
+
+        if not prev:
             logging.warning("❌ StopTransaction | 查無交易記錄")
-            return StopTransaction(id_tag_info={"status": "Expired"})
-
-        meter_start, start_time_str = row
-        start_time = datetime.fromisoformat(start_time_str)
-        stop_time = datetime.fromisoformat(timestamp)
-        kwh = max((meter_stop - meter_start) / 1000, 0)
-
-        # 計算時間點的電價
-        def is_summer(dt):
-            return datetime(dt.year, 6, 1) <= dt <= datetime(dt.year, 9, 30)
-
-        def is_holiday(dt):
-            return dt.weekday() >= 5
-
-        def get_price(dt):
-            season = "summer" if is_summer(dt) else "non_summer"
-            day_type = "holiday" if is_holiday(dt) else "weekday"
-            t = dt.time().strftime("%H:%M")
-
-        # 新增例外處理：00:00–00:00 表示全天
-            cursor.execute('''
-                SELECT price FROM pricing_rules
-                WHERE season = ? AND day_type = ? AND start_time = '00:00' AND end_time = '00:00'
-                ORDER BY start_time DESC LIMIT 1
-            ''', (season, day_type))
-            full_day = cursor.fetchone()
-            if full_day:
-                return full_day[0]
-
-            cursor.execute('''
-                SELECT price FROM pricing_rules
-                WHERE season = ? AND day_type = ? AND (
-                    (start_time <= end_time AND start_time <= ? AND end_time > ?) OR
-                    (start_time > end_time AND (? >= start_time OR ? < end_time))
-                )
-                ORDER BY start_time DESC LIMIT 1
-            ''', (season, day_type, t, t, t, t))
-            row = cursor.fetchone()
-            return row[0] if row else 0
-
-        price = get_price(start_time)
-        cost = round(kwh * price, 2)
-
-        # 扣除卡片餘額
-        cursor.execute("SELECT balance FROM cards WHERE card_id = ?", (id_tag,))
-        card = cursor.fetchone()
-        if card:
-            new_balance = round(card[0] - cost, 2)
-            if new_balance < 0:
-                new_balance = 0
-            cursor.execute("UPDATE cards SET balance = ? WHERE card_id = ?", (new_balance, id_tag))
-            conn.commit()
-            logging.info(f"💳 扣款完成 | 卡片={id_tag} | 原餘額={card[0]} | 扣款={cost} 元 | 剩餘={new_balance} 元")
-
-            # 儲存扣款紀錄
-            cursor.execute('''
-                INSERT INTO payments (transaction_id, id_tag, amount, timestamp)
-                VALUES (?, ?, ?, ?)
-            ''', (transaction_id, id_tag, cost, timestamp))
-            conn.commit()
-
-            # 若餘額過低，自動通知
-            if new_balance < 100:
-                try:
-                    send_line_message(f"⚠️ 卡片 {id_tag} 餘額僅剩 {new_balance} 元，請儘速儲值")
-                except Exception as e:
-                    logging.warning(f"LINE 通知失敗：{e}")
-
-        logging.info(f"🛑 StopTransaction 成功 | CP={self.id} | idTag={id_tag} | transactionId={transaction_id}")
+            return StopTransactionPayload(id_tag_info={"status": "Expired"})
+
+        if prev[4] is not None:
+            # 重連後重送的 StopTransaction：交易已結束並扣過款，不重複扣款
+            stop_log.info("🛑 StopTransaction 重送 | CP=%s | transactionId=%s", self.id, transaction_id)
+        elif backlog:
+            # 補傳中：扣款等量測資料寫入後再執行
+            self.backlog.defer(lambda: bill_transaction(transaction_id, id_tag, prev, meter_stop, timestamp))
+        else:
+            await bill_transaction(transaction_id, id_tag, prev, meter_stop, timestamp)
+
+        stop_log.info("🛑 StopTransaction 成功 | CP=%s | idTag=%s | transactionId=%s", self.id, id_tag, transaction_id)
         return StopTransactionPayload(id_tag_info={"status": "Accepted"})
 
+    @on(Action.StatusNotification)
+    async def on_status_notification(self, connector_id, status, timestamp=None, **kwargs):
+        # 狀態歷史只記錄轉換，重連時重送的相同狀態不寫入
+        if await repo.record_status(self.id, connector_id, status, timestamp):
+            table_versions.bump("status_intervals")
+        load_manager.set_status(self.id, connector_id, status)
+        set_live_status(self.id, True, connector_id, status)
+        schedule_rebalance()
+        status_log.info("📡 StatusNotification | CP=%s | connector=%s | status=%s", self.id, connector_id, status)
+        return StatusNotificationPayload()
+
+    @on(Action.FirmwareStatusNotification)
+    async def on_firmware_status_notification(self, status, **kwargs):
+        firmware_campaigns.status_notification(self.id, status)
+        logging.info(f"📦 FirmwareStatusNotification | CP={self.id} | status={status}")
+        return FirmwareStatusNotificationPayload()
+
+    @on(Action.DiagnosticsStatusNotification)
+    async def on_diagnostics_status_notification(self, status, **kwargs):
+        diagnostics_store.status_notification(self.id, status)
+        logging.info(f"🩺 DiagnosticsStatusNotification | CP={self.id} | status={status}")
+        return DiagnosticsStatusNotificationPayload()
+
+
+async def bill_transaction(transaction_id, id_tag, prev, meter_stop, timestamp):
+    start_time_str, meter_start = prev[2], prev[3]
+    # 充電樁送來的時間通常帶 Z；電價時段以時間字串上的時刻判斷
+    start_time = datetime.fromisoformat(start_time_str).replace(tzinfo=None)
+    kwh = max((meter_stop - meter_start) / 1000, 0)
+
+    price = await repo.rule_price(*repository.season_and_day_type(start_time), start_time.strftime("%H:%M"))
+    cost = round(kwh * price, 2)
+
+    # 扣除卡片餘額（認領待扣款標記、扣款與扣款紀錄在同一個交易內寫入，同一筆交易只扣一次）
+    charged = await repo.charge(id_tag, cost, transaction_id, timestamp)
+    if charged:
+        old_balance, new_balance = charged
+        logging.info(f"💳 扣款完成 | 卡片={id_tag} | 原餘額={old_balance} | 扣款={cost} 元 | 剩餘={new_balance} 元")
+        table_versions.bump("cards", "payments")
+
+        # 若餘額過低，自動通知
+        if new_balance < 100:
+            try:
+                send_line_message(f"⚠️ 卡片 {id_tag} 餘額僅剩 {new_balance} 元，請儘速儲值")
+            except Exception as e:
+                logging.warning(f"LINE 通知失敗：{e}")
+
+
+async def resume_pending_billing():
+    # 上次程序結束前已寫入結束紀錄、但還沒扣款的交易（例如補傳期間延後的扣款）
+    for transaction_id, id_tag, meter_stop, timestamp in await repo.list_pending_billing():
+        txn = await repo.get_transaction(transaction_id)
+        if txn is None or txn[6] is None:
+            # 結束紀錄沒寫入：充電樁沒收到回覆會重送 StopTransaction，屆時照常扣款
+            continue
+        try:
+            await bill_transaction(transaction_id, id_tag, (txn[3], txn[1], txn[5], txn[4], None), meter_stop, timestamp)
+            logging.info(f"💳 補扣款 | transactionId={transaction_id}")
+        except Exception:
+            logging.exception(f"⚠️ 補扣款失敗 | transactionId={transaction_id}")
+
+
+# OCPP_JOURNAL_DIR 有設定時記錄所有收送的 frame（見 frame_journal.py、replay_journal.py）
+ChargePoint.journal = frame_journal.from_env()
+
 
 # 建立扣款紀錄表
 cursor.execute('''
@@ -426,21 +722,27 @@ CREATE TABLE IF NOT EXISTS payments (
 )
 ''')
 
+# 已結束、尚未扣款的交易（扣款時刪除，見 repository.charge）
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS pending_billing (
+    transaction_id INTEGER PRIMARY KEY,
+    id_tag TEXT,
+    meter_stop INTEGER,
+    stop_timestamp TEXT
+)
+''')
+
 # ✅ 時段電價設定管理：新增與刪除
 @app.post("/api/pricing-rules")
 async def add_pricing_rule(rule: dict = Body(...)):
     try:
-        cursor.execute('''
-            INSERT INTO pricing_rules (season, day_type, start_time, end_time, price)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
+        await repo.add_pricing_rule(
             rule["season"],
             rule["day_type"],
             rule["start_time"],
             rule["end_time"],
             float(rule["price"])
-        ))
-        conn.commit()
+        )
         return {"message": "新增成功"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -449,17 +751,13 @@ async def add_pricing_rule(rule: dict = Body(...)):
 @app.delete("/api/pricing-rules")
 async def delete_pricing_rule(rule: dict = Body(...)):
     try:
-        cursor.execute('''
-            DELETE FROM pricing_rules
-            WHERE season = ? AND day_type = ? AND start_time = ? AND end_time = ? AND price = ?
-        ''', (
+        await repo.delete_pricing_rule(
             rule["season"],
             rule["day_type"],
             rule["start_time"],
             rule["end_time"],
             float(rule["price"])
-        ))
-        conn.commit()
+        )
         return {"message": "刪除成功"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -469,8 +767,7 @@ conn.commit()
 
 @app.get("/api/payments")
 async def list_payments():
-    cursor.execute("SELECT transaction_id, id_tag, amount, timestamp FROM payments ORDER BY timestamp DESC")
-    rows = cursor.fetchall()
+    rows = await repo.list_payments()
     return [
         {
             "transactionId": r[0],
@@ -483,16 +780,6 @@ async def list_payments():
 
 ...
 
-@on(Action.StatusNotification)
-async def on_status_notification(self, connector_id, status, timestamp, **kwargs):
-    cursor.execute('''
-        INSERT INTO status_logs (charge_point_id, connector_id, status, timestamp)
-        VALUES (?, ?, ?, ?)
-    ''', (self.id, connector_id, status, timestamp))
-    conn.commit()
-    logging.info(f"📡 StatusNotification | CP={self.id} | connector={connector_id} | status={status}")
-    return StatusNotificationPayload()
-
 
 
 @app.get("/api/transactions")
@@ -502,24 +789,9 @@ async def get_transactions(
     start: str = Query(None),
     end: str = Query(None)
 ):
-    query = "SELECT * FROM transactions WHERE 1=1"
-    params = []
-
-    if idTag:
-        query += " AND id_tag = ?"
-        params.append(idTag)
-    if chargePointId:
-        query += " AND charge_point_id = ?"
-        params.append(chargePointId)
-    if start:
-        query += " AND start_timestamp >= ?"
-        params.append(start)
-    if end:
-        query += " AND start_timestamp <= ?"
-        params.append(end)
-
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
+    rows = await repo.list_transactions(idTag, chargePointId, start, end)
+    # 一次查詢取回所有交易的電錶數據
+    meter_values = await repo.list_meter_values([row[0] for row in rows])
 
     result = {}
     for row in rows:
@@ -536,12 +808,7 @@ async def get_transactions(
             "meterValues": []
         }
 
-        cursor.execute("""
-            SELECT timestamp, value, measurand, unit, context, format
-            FROM meter_values WHERE transaction_id = ?
-        """, (txn_id,))
-        mv_rows = cursor.fetchall()
-        for mv in mv_rows:
+        for mv in meter_values[txn_id]:
             result[txn_id]["meterValues"].append({
                 "timestamp": mv[0],
                 "sampledValue": [{
@@ -553,7 +820,7 @@ async def get_transactions(
                 }]
             })
 
-    return JSONResponse(content=result)
+    return FastJSONResponse(content=result)
 
 
 
@@ -562,36 +829,9 @@ async def transaction_cost_summary(
     start: str = Query(None),
     end: str = Query(None)
 ):
-    # SQL 查詢語句（查找已結束交易）
-    query = """
-        SELECT transaction_id FROM transactions
-        WHERE meter_stop IS NOT NULL
-    """
-    params = []
-    if start:
-        query += " AND start_timestamp >= ?"
-        params.append(start)
-    if end:
-        query += " AND start_timestamp <= ?"
-        params.append(end)
-
-    # 執行查詢
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    txn_ids = [row[0] for row in cursor.fetchall()]
-
-    result = []
-
-    # 對每個交易 ID 進行費用計算
-    for txn_id in txn_ids:
-        try:
-            cost_data = await calculate_transaction_cost(txn_id)
-            result.append(cost_data)
-        except Exception as e:
-            print(f"⚠️ 計算交易 {txn_id} 失敗：{e}")
-            continue
-
-    return result
+    # 已結束的交易（依 transaction_id 排序）
+    txns = [txn for txn in await analytics.list_transactions(start=start, end=end) if txn[6] is not None]
+    return await billing.transaction_costs(analytics, txns)
 
 
 
@@ -601,8 +841,7 @@ async def transaction_cost_summary(
 @app.get("/api/transactions/{transaction_id}")
 async def get_transaction_detail(transaction_id: int):
     # 查詢交易主資料
-    cursor.execute("SELECT * FROM transactions WHERE transaction_id = ?", (transaction_id,))
-    row = cursor.fetchone()
+    row = await repo.get_transaction(transaction_id)
 
     if not row:
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -621,13 +860,7 @@ async def get_transaction_detail(transaction_id: int):
     }
 
     # 查詢對應電錶數據
-    cursor.execute("""
-        SELECT timestamp, value, measurand, unit, context, format
-        FROM meter_values WHERE transaction_id = ?
-        ORDER BY timestamp ASC
-    """, (transaction_id,))
-    mv_rows = cursor.fetchall()
-    for mv in mv_rows:
+    for mv in (await repo.list_meter_values([transaction_id]))[transaction_id]:
         result["meterValues"].append({
             "timestamp": mv[0],
             "sampledValue": [{
@@ -639,106 +872,14 @@ async def get_transaction_detail(transaction_id: int):
             }]
         })
 
-    return JSONResponse(content=result)
+    return FastJSONResponse(content=result)
 
 @app.get("/api/transactions/{transaction_id}/cost")
 async def calculate_transaction_cost(transaction_id: int):
-    from datetime import datetime, time
-    import calendar
-
-    # 查詢交易資料
-    cursor.execute("SELECT start_timestamp, stop_timestamp, meter_start, meter_stop FROM transactions WHERE transaction_id = ?", (transaction_id,))
-    txn = cursor.fetchone()
-    if not txn or txn[3] is None:
-        raise HTTPException(status_code=404, detail="Transaction not found or not completed.")
-
-    start_time = datetime.fromisoformat(txn[0])
-    stop_time = datetime.fromisoformat(txn[1])
-    total_kwh = (txn[3] - txn[2]) / 1000  # 以 Wh 計算轉換為 kWh
-
-    # 查詢所有 meter_values，依照 timestamp 排序
-    cursor.execute("""
-        SELECT timestamp, value
-        FROM meter_values
-        WHERE transaction_id = ?
-        ORDER BY timestamp ASC
-    """, (transaction_id,))
-    mv_rows = cursor.fetchall()
-
-    # 計費規則
-    def is_summer(dt):
-        return datetime(dt.year, 6, 1) <= dt <= datetime(dt.year, 9, 30)
-
-    def is_holiday(dt):
-        return dt.weekday() >= 5  # 週六週日視為假日
-
-    def get_price(dt):
-        season = "summer" if is_summer(dt) else "non_summer"
-        day_type = "holiday" if is_holiday(dt) else "weekday"
-        t = dt.time().strftime("%H:%M")
-        cursor.execute("""
-            SELECT price FROM pricing_rules
-            WHERE season = ? AND day_type = ? AND (
-                (start_time <= end_time AND start_time <= ? AND end_time > ?) OR
-                (start_time > end_time AND ( ? >= start_time OR ? < end_time ))
-            )
-            ORDER BY start_time DESC LIMIT 1
-        """, (season, day_type, t, t, t, t))
-        result = cursor.fetchone()
-        return result[0] if result else 0
-
-
-    # 若資料筆數不足，直接以平均價計算
-    if len(mv_rows) < 2:
-        price = get_price(start_time)
-        energy_cost = total_kwh * price
-        detail = [{
-            "from": start_time.isoformat(),
-            "to": stop_time.isoformat(),
-            "kWh": round(total_kwh, 3),
-            "price": price,
-            "cost": round(energy_cost, 2)
-        }]
-    else:
-        detail = []
-        energy_cost = 0
-        for i in range(1, len(mv_rows)):
-            t1 = datetime.fromisoformat(mv_rows[i - 1][0])
-            t2 = datetime.fromisoformat(mv_rows[i][0])
-            v1 = float(mv_rows[i - 1][1])
-            v2 = float(mv_rows[i][1])
-            kwh = max((v2 - v1) / 1000, 0)
-            price = get_price(t1)
-            cost = kwh * price
-            energy_cost += cost
-            detail.append({
-                "from": t1.isoformat(),
-                "to": t2.isoformat(),
-                "kWh": round(kwh, 3),
-                "price": price,
-                "cost": round(cost, 2)
-            })
-
-    # 查詢基本費與加價設定
-    cursor.execute("SELECT monthly_basic_fee, threshold_kwh, overuse_price_delta FROM base_rates WHERE id = 1")
-    base_row = cursor.fetchone()
-    basic_fee = base_row[0]
-    threshold = base_row[1]
-    delta = base_row[2]
-
-    over_kwh = max(total_kwh - threshold, 0)
-    overuse_fee = over_kwh * delta if over_kwh > 0 else 0
-
-    return {
-        "transactionId": transaction_id,
-        "totalCost": round(basic_fee + energy_cost + overuse_fee, 2),
-        "basicFee": round(basic_fee, 2),
-        "energyCost": round(energy_cost, 2),
-        "overuseFee": round(overuse_fee, 2),
-        "totalKWh": round(total_kwh, 3),
-        "unit": "kWh",
-        "details": detail
-    }
+    try:
+        return await billing.transaction_cost(repo, transaction_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
 
 
@@ -754,24 +895,7 @@ async def export_transactions_csv(
     start: str = Query(None),
     end: str = Query(None)
 ):
-    query = "SELECT * FROM transactions WHERE 1=1"
-    params = []
-
-    if idTag:
-        query += " AND id_tag = ?"
-        params.append(idTag)
-    if chargePointId:
-        query += " AND charge_point_id = ?"
-        params.append(chargePointId)
-    if start:
-        query += " AND start_timestamp >= ?"
-        params.append(start)
-    if end:
-        query += " AND start_timestamp <= ?"
-        params.append(end)
-
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
+    rows = await analytics.list_transactions(idTag, chargePointId, start, end)
 
     # 建立 CSV 內容
     output = io.StringIO()
@@ -795,60 +919,47 @@ async def export_transactions_csv(
 # REST API - 查詢所有充電樁狀態
 @app.get("/api/status")
 async def get_status():
-    return JSONResponse(content=charging_point_status)
+    return FastJSONResponse(content=charging_point_status)
 
 from fastapi import HTTPException, Body, Path
 
 
 
+# 狀態歷史：每個連接器的狀態區間（from ~ to，to 為 null 表示目前狀態），新到舊；
+# start / end 篩選與該時段重疊的區間。keyset 分頁：回應標頭 X-Next-Cursor 帶入下一次的 cursor
 @app.get("/api/status/logs")
 async def get_status_logs(
     chargePointId: str = Query(None),
     start: str = Query(None),
     end: str = Query(None),
-    limit: int = Query(100)
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str = Query(None)
 ):
-    query = "SELECT charge_point_id, connector_id, status, timestamp FROM status_logs WHERE 1=1"
-    params = []
-
-    if chargePointId:
-        query += " AND charge_point_id = ?"
-        params.append(chargePointId)
-    if start:
-        query += " AND timestamp >= ?"
-        params.append(start)
-    if end:
-        query += " AND timestamp <= ?"
-        params.append(end)
-
-    query += " ORDER BY timestamp DESC LIMIT ?"
-    params.append(limit)
-
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-
-    return JSONResponse(content=[
+    try:
+        after = repository.decode_cursor(cursor) if cursor else None
+        start_ms = repository.parse_epoch_ms(start) if start else None
+        end_ms = repository.parse_epoch_ms(end) if end else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"start / end / cursor 格式錯誤：{e}")
+    rows = await repo.list_status_intervals(chargePointId, start_ms, end_ms, limit, after)
+
+    headers = {"X-Next-Cursor": repository.encode_cursor(rows[-1])} if len(rows) == limit else {}
+    return FastJSONResponse(content=[
         {
             "chargePointId": row[0],
             "connectorId": row[1],
             "status": row[2],
-            "timestamp": row[3]
+            "timestamp": repository.iso_ms(row[3]),
+            "from": repository.iso_ms(row[3]),
+            "to": repository.iso_ms(row[4]) if row[4] is not None else None
         } for row in rows
-    ])
+    ], headers=headers)
 
 
 # ✅ 新增：即時電量查詢 API
 @app.get("/api/charge-points/{charge_point_id}/latest-meter")
 async def get_latest_meter_value(charge_point_id: str):
-    query = '''
-        SELECT connector_id, timestamp, measurand, value, unit
-        FROM meter_values
-        WHERE charge_point_id = ?
-        ORDER BY datetime(timestamp) DESC
-        LIMIT 1
-    '''
-    cursor.execute(query, (charge_point_id,))
-    row = cursor.fetchone()
+    row = await repo.latest_meter_value(charge_point_id)
 
     if row:
         return {
@@ -866,9 +977,8 @@ async def get_latest_meter_value(charge_point_id: str):
 
 @app.get("/api/id_tags")
 async def list_id_tags():
-    cursor.execute("SELECT id_tag, status, valid_until FROM id_tags")
-    rows = cursor.fetchall()
-    return JSONResponse(content=[
+    rows = await repo.list_id_tags()
+    return FastJSONResponse(content=[
         {"idTag": row[0], "status": row[1], "validUntil": row[2]} for row in rows
     ])
 
@@ -881,9 +991,8 @@ async def add_id_tag(data: dict = Body(...)):
         raise HTTPException(status_code=400, detail="idTag is required")
 
     try:
-        cursor.execute('INSERT INTO id_tags (id_tag, status, valid_until) VALUES (?, ?, ?)', (id_tag, status, valid_until))
-        conn.commit()
-    except sqlite3.IntegrityError:
+        await repo.add_id_tag(id_tag, status, valid_until)
+    except DuplicateError:
         raise HTTPException(status_code=409, detail="idTag already exists")
     return {"message": "Added successfully"}
 
@@ -898,43 +1007,39 @@ async def update_id_tag(
     if not (status or valid_until):
         raise HTTPException(status_code=400, detail="No update fields provided")
 
-    if status:
-        cursor.execute("UPDATE id_tags SET status = ? WHERE id_tag = ?", (status, id_tag))
-    if valid_until:
-        cursor.execute("UPDATE id_tags SET valid_until = ? WHERE id_tag = ?", (valid_until, id_tag))
-    conn.commit()
+    await repo.update_id_tag(id_tag, status or None, valid_until or None)
     return {"message": "Updated successfully"}
 
 @app.delete("/api/id_tags/{id_tag}")
 async def delete_id_tag(id_tag: str = Path(...)):
-    cursor.execute("DELETE FROM id_tags WHERE id_tag = ?", (id_tag,))
-    conn.commit()
+    await repo.delete_id_tag(id_tag)
     return {"message": "Deleted successfully"}
 
+# 批次匯入共用：write 為 batch_repository() 的批次寫入方法名稱
+async def _import_rows(request, fmt, validate, write):
+    with batch_repository() as batch_repo:
+        return await bulk_import.import_rows(request, fmt, validate, getattr(batch_repo, write))
+
+# 批次匯入 idTag：CSV（含標題列 idTag,status,validUntil）或 NDJSON，已存在者更新
+@app.post("/api/id_tags/import")
+async def import_id_tags(request: Request, format: str = Query(None)):
+    try:
+        fmt = bulk_import.detect_format(request, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result = await _import_rows(request, fmt, bulk_import.validate_id_tag, "import_id_tags")
+    await refresh_authorization_caches()
+    return result
+
 
 
 
 @app.get("/api/summary")
 async def get_summary(group_by: str = Query("day")):
-    if group_by == "day":
-        date_expr = "strftime('%Y-%m-%d', start_timestamp)"
-    elif group_by == "week":
-        date_expr = "strftime('%Y-W%W', start_timestamp)"
-    elif group_by == "month":
-        date_expr = "strftime('%Y-%m', start_timestamp)"
-    else:
-        return JSONResponse(status_code=400, content={"error": "Invalid group_by. Use 'day', 'week', or 'month'."})
+    if group_by not in repository.PERIODS:
+        return FastJSONResponse(status_code=400, content={"error": "Invalid group_by. Use 'day', 'week', or 'month'."})
 
-    cursor.execute(f"""
-        SELECT {date_expr} as period,
-               COUNT(*) as transaction_count,
-               SUM(meter_stop - meter_start) as total_energy
-        FROM transactions
-        WHERE meter_stop IS NOT NULL
-        GROUP BY period
-        ORDER BY period ASC
-    """)
-    rows = cursor.fetchall()
+    rows = await analytics.energy_by_period(group_by)
 
     result = []
     for row in rows:
@@ -944,7 +1049,7 @@ async def get_summary(group_by: str = Query("day")):
             "totalEnergy": row[2] or 0
         })
 
-    return JSONResponse(content=result)
+    return FastJSONResponse(content=result)
 
 
 
@@ -958,19 +1063,9 @@ async def get_top_consumers(
     elif group_by == "chargePointId":
         group_field = "charge_point_id"
     else:
-        return JSONResponse(status_code=400, content={"error": "Invalid group_by. Use 'idTag' or 'chargePointId'."})
+        return FastJSONResponse(status_code=400, content={"error": "Invalid group_by. Use 'idTag' or 'chargePointId'."})
 
-    cursor.execute(f"""
-        SELECT {group_field} as key,
-               COUNT(*) as transaction_count,
-               SUM(meter_stop - meter_start) as total_energy
-        FROM transactions
-        WHERE meter_stop IS NOT NULL
-        GROUP BY {group_field}
-        ORDER BY total_energy DESC
-        LIMIT ?
-    """, (limit,))
-    rows = cursor.fetchall()
+    rows = sorted(await analytics.energy_by_group(group_field), key=lambda row: row[2] or 0, reverse=True)[:limit]
 
     result = []
     for row in rows:
@@ -980,60 +1075,94 @@ async def get_top_consumers(
             "totalEnergy": row[2] or 0
         })
 
-    return JSONResponse(content=result)  
+    return FastJSONResponse(content=result)  
 
 # WebSocket 充電樁接入時呼叫的處理函式
 async def on_connect(websocket, path):
-    cp_id = path.strip("/")
+    if path.startswith(mux.PATH_PREFIX):
+        # 場域集中器的多工連線（見 mux.py / central_system.py）
+        site = path[len(mux.PATH_PREFIX):].strip("/")
+        await mux.serve_uplink(websocket, site, serve_charge_point,
+                               admit=lambda cp_id: admission.admit_connection(cp_id)[0])
+        return
+    await serve_charge_point(path.strip("/"), websocket)
+
+async def serve_charge_point(cp_id, websocket):
     cp = ChargePoint(cp_id, websocket)
+    cp.backlog = BacklogBuffer(cp_id, repo, on_flush=lambda n: table_versions.bump("meter_values"))
     logging.info(f"🔌 充電樁已連線：{cp_id}")
-    await cp.start()
+    connected_charge_points[cp_id] = cp
+    set_live_status(cp_id, True)
+    charging_point_status[cp_id].pop("stale", None)
+    direct = not isinstance(websocket, mux.VirtualConnection)
+    if direct:
+        liveness.register(cp_id, websocket.close, admission.heartbeat_interval(cp_id))
+    if ChargePoint.journal is not None:
+        ChargePoint.journal.record(cp_id, frame_journal.CONNECT, "")
+    try:
+        await cp.start()
+    finally:
+        await cp.backlog.drain()
+        if direct:
+            liveness.unregister(cp_id, websocket.close)
+        if ChargePoint.journal is not None:
+            ChargePoint.journal.record(cp_id, frame_journal.CLOSE, "")
+        if connected_charge_points.get(cp_id) is cp:
+            del connected_charge_points[cp_id]
+            set_live_status(cp_id, False)
+            load_manager.drop_charge_point(cp_id)
+
+# 連線速率超過上限時在握手前回 503，不建立 ChargePoint
+async def admission_check(path, request_headers):
+    if path.startswith(mux.PATH_PREFIX):
+        # 集中器本身不受連線速率限制，改由它轉送的每個充電樁各自檢查
+        if not mux.accept_token(request_headers):
+            return HTTPStatus.FORBIDDEN, [], "集中器驗證失敗\n".encode()
+        return None
+    accepted, retry_after = admission.admit_connection(path.strip("/"))
+    if not accepted:
+        return HTTPStatus.SERVICE_UNAVAILABLE, [("Retry-After", str(retry_after))], "伺服器忙碌，請稍後重試\n".encode()
+    return None
 
 # 啟動 WebSocket Server
 async def start_websocket():
+    event_loops["ocpp"] = asyncio.get_running_loop()
+    asyncio.ensure_future(liveness.run())
     server = await serve(
         on_connect,
         "0.0.0.0",  # 可依需求改為 localhost
         9000,
-        subprotocols=["ocpp1.6"]
+        subprotocols=["ocpp1.6"],
+        process_request=admission_check,
+        **density.serve_options()  # 連線緩衝與壓縮設定（OCPP_HIGH_DENSITY，見 density.py）
     )
     logging.info("✅ WebSocket Server 已啟動 ws://0.0.0.0:9000")
     await server.wait_closed()
 
 
 
-import requests
 
 
 from datetime import datetime, timedelta
-import threading
 
-# 每週定時通知任務
-def weekly_notify_task():
-    import time
+# 每週定時通知任務（API 事件迴圈上的背景 task）
+async def weekly_notify_task():
     while True:
         now = datetime.now()
         # 只在每週一上午 9:00 傳送
         if now.weekday() == 0 and now.hour == 9 and now.minute == 0:
             try:
-                cursor.execute("""
-                    SELECT id_tag, SUM(meter_stop - meter_start) as total_energy
-                    FROM transactions
-                    WHERE meter_stop IS NOT NULL
-                    AND start_timestamp >= datetime('now', '-7 days')
-                    GROUP BY id_tag
-                    ORDER BY total_energy DESC
-                    LIMIT 5
-                """)
-                rows = cursor.fetchall()
+                since = (datetime.utcnow() - timedelta(days=7)).isoformat()
+                rows = await analytics.energy_by_group("id_tag", start=since)
+                rows = sorted(rows, key=lambda row: row[2] or 0, reverse=True)[:5]
                 if rows:
                     message = "📊 一週用電排行（依 idTag）:\n"
-                    for idx, (id_tag, energy) in enumerate(rows, start=1):
+                    for idx, (id_tag, _, energy) in enumerate(rows, start=1):
                         message += f"{idx}. {id_tag}：{round(energy/1000, 2)} kWh\n"
-                    send_line_message(message)
+                    await asyncio.to_thread(send_line_message, message)
             except Exception as e:
                 logging.error(f"📉 用電排行通知錯誤：{e}")
-        time.sleep(60)  # 每分鐘檢查一次是否符合發送條件
+        await asyncio.sleep(60)  # 每分鐘檢查一次是否符合發送條件
 
 
 
@@ -1061,7 +1190,7 @@ def send_line_message(message: str):
             "to": user_id,
             "messages": [{"type": "text", "text": message}]
         }
-        resp = requests.post(url, headers=headers, data=json.dumps(payload))
+        resp = tracing.traced_request("POST", url, headers=headers, data=json.dumps(payload))
         logging.info(f"🔔 發送至 {user_id}：{resp.status_code} | 回應：{resp.text}")
 
 
@@ -1076,10 +1205,7 @@ async def test_line_messaging(payload: dict = Body(...)):
     # 查詢對應的 user_id
     recipient_ids = []
     if targets and isinstance(targets, list):
-        query = f"SELECT card_number FROM users WHERE id_tag IN ({','.join(['?']*len(targets))})"
-        cursor.execute(query, targets)
-        rows = cursor.fetchall()
-        recipient_ids = [row[0] for row in rows if row[0]]
+        recipient_ids = await repo.user_card_numbers(targets)
     else:
         recipient_ids = LINE_USER_IDS  # 預設全部
 
@@ -1094,7 +1220,7 @@ async def test_line_messaging(payload: dict = Body(...)):
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {LINE_TOKEN}"
             }
-            resp = requests.post("https://api.line.me/v2/bot/message/push", headers=headers, data=json.dumps(payload))
+            resp = tracing.traced_request("POST", "https://api.line.me/v2/bot/message/push", headers=headers, data=json.dumps(payload))
             logging.info(f"🔔 發送至 {user_id}：{resp.status_code} | 回應：{resp.text}")
         except Exception as e:
             logging.error(f"發送至 {user_id} 失敗：{e}")
@@ -1106,13 +1232,39 @@ async def test_line_messaging(payload: dict = Body(...)):
 # Thread 啟動 WebSocket 與 FastAPI 共存
 @app.on_event("startup")
 async def start_ws_server():
+    event_loops["api"] = asyncio.get_running_loop()
+    await repo.open()
+    await load_reservation_index()
+    await resume_pending_billing()
+
     def run_ws():
         asyncio.run(start_websocket())
     Thread(target=run_ws, daemon=True).start()
 
-    def run_notify():
-        weekly_notify_task()
-    Thread(target=run_notify, daemon=True).start()
+    if firmware.FIRMWARE_PORT:
+        Thread(target=lambda: asyncio.run(start_firmware_server()), daemon=True).start()
+
+    asyncio.create_task(weekly_notify_task())
+    asyncio.create_task(reservation_expiry_task())
+    asyncio.create_task(job_manager.cleanup_task())
+    if storage.PROFILE["journal_mode"] == "WAL":
+        asyncio.create_task(checkpointer.run())
+        for shard in (shards.shards.values() if shards is not None else ()):
+            if shard.checkpointer is not None:
+                asyncio.create_task(shard.checkpointer.run())
+    if read_replica is not None:
+        asyncio.create_task(read_replica.run())
+
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    job_manager.shutdown()
+    await repo.close()
+    if read_replica is not None:
+        read_replica.close()
+    if ChargePoint.journal is not None:
+        ChargePoint.journal.close()
+    tracing.shutdown()
 
 @app.post("/webhook")
 async def webhook(request: Request):
@@ -1128,22 +1280,17 @@ async def webhook(request: Request):
             text = message.get("text", "").strip()
             if text.startswith("綁定 ") or text.startswith("綁定:"):
                 id_tag = text.replace("綁定:", "").replace("綁定 ", "").strip()
-                cursor.execute("SELECT * FROM users WHERE id_tag = ?", (id_tag,))
-                row = cursor.fetchone()
-                if row:
-                    cursor.execute("UPDATE users SET card_number = ? WHERE id_tag = ?", (user_id, id_tag))
-                    conn.commit()
+                if await repo.get_user(id_tag):
+                    await repo.update_user(id_tag, {"card_number": user_id})
                     reply_text = f"✅ 已成功綁定 {id_tag}"
                 else:
                     reply_text = f"❌ 找不到使用者 IDTag：{id_tag}"
 
             elif text in ["取消綁定", "解除綁定"]:
-                cursor.execute("SELECT id_tag FROM users WHERE card_number = ?", (user_id,))
-                row = cursor.fetchone()
-                if row:
-                    cursor.execute("UPDATE users SET card_number = NULL WHERE id_tag = ?", (row[0],))
-                    conn.commit()
-                    reply_text = f"🔓 已取消綁定：{row[0]}"
+                bound = await repo.find_user_by_card(user_id)
+                if bound:
+                    await repo.update_user(bound, {"card_number": None})
+                    reply_text = f"🔓 已取消綁定：{bound}"
                 else:
                     reply_text = "⚠️ 尚未綁定任何帳號"
 
@@ -1158,16 +1305,15 @@ async def webhook(request: Request):
                 "replyToken": event.get("replyToken"),
                 "messages": [{"type": "text", "text": reply_text}]
             }
-            requests.post("https://api.line.me/v2/bot/message/reply", headers=headers, data=json.dumps(reply_payload))
+            tracing.traced_request("POST", "https://api.line.me/v2/bot/message/reply", headers=headers, data=json.dumps(reply_payload))
 
     return {"status": "ok"}
 
 
 @app.get("/api/users")
 async def list_users():
-    cursor.execute("SELECT id_tag, name, department, card_number FROM users")
-    rows = cursor.fetchall()
-    return JSONResponse(content=[
+    rows = await repo.list_users()
+    return FastJSONResponse(content=[
         {"idTag": row[0], "name": row[1], "department": row[2], "cardNumber": row[3]} for row in rows
     ])
 
@@ -1178,16 +1324,56 @@ CREATE TABLE IF NOT EXISTS reservations (
     id_tag TEXT,
     start_time TEXT,
     end_time TEXT,
-    status TEXT  -- 'active', 'cancelled', 'completed'
+    status TEXT  -- 'active', 'cancelled', 'completed', 'expired'
 )
 ''')
 conn.commit()
 
 
+# === 預約區間索引：啟動時載入所有 active 預約，之後與 /api/reservations 同步 ===
+reservation_index = ReservationIndex()
+
+
+def index_reservation(res_id, cp_id, id_tag, start_time, end_time):
+    reservation_index.add(res_id, cp_id, id_tag, to_epoch(start_time), to_epoch(end_time))
+
+
+async def load_reservation_index():
+    for res_id, cp_id, id_tag, start_time, end_time in await repo.list_active_reservations():
+        try:
+            index_reservation(res_id, cp_id, id_tag, start_time, end_time)
+        except ReservationConflict as e:
+            logging.warning(f"⚠️ 預約 {res_id} 與預約 {e.reservation_id} 時段重疊，未載入索引")
+        except (TypeError, ValueError):
+            logging.warning(f"⚠️ 預約 {res_id} 時間格式錯誤，未載入索引")
+
+
+_reservation_wakeup = asyncio.Event()
+
+
+async def reservation_expiry_task():
+    # 依 heap 最早的結束時間休眠，到期後將預約標為 expired，不再掃描整張表
+    while True:
+        now = datetime.now(timezone.utc).timestamp()
+        expired = reservation_index.pop_expired(now)
+        if expired:
+            await repo.set_reservation_status(expired, "expired", only_active=True)
+            table_versions.bump("reservations")
+            logging.info(f"⌛ 預約到期 | ids={expired}")
+
+        next_end = reservation_index.next_expiry()
+        # 最多 60 秒重新檢查一次，OCPP 執行緒移除的預約不會喚醒此迴圈
+        delay = 60 if next_end is None else min(max(next_end - now, 0) + 0.001, 60)
+        _reservation_wakeup.clear()
+        try:
+            await asyncio.wait_for(_reservation_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+
 @app.get("/api/users/{id_tag}")
 async def get_user(id_tag: str = Path(...)):
-    cursor.execute("SELECT id_tag, name, department, card_number FROM users WHERE id_tag = ?", (id_tag,))
-    row = cursor.fetchone()
+    row = await repo.get_user(id_tag)
     if not row:
         raise HTTPException(status_code=404, detail="User not found")
     return {
@@ -1209,31 +1395,52 @@ async def add_user(data: dict = Body(...)):
         raise HTTPException(status_code=400, detail="idTag is required")
 
     try:
-        cursor.execute('''
-            INSERT INTO users (id_tag, name, department, card_number)
-            VALUES (?, ?, ?, ?)
-        ''', (id_tag, name, department, card_number))
-        conn.commit()
-    except sqlite3.IntegrityError:
+        await repo.add_user(id_tag, name, department, card_number)
+    except DuplicateError:
         raise HTTPException(status_code=409, detail="User already exists")
     return {"message": "User added successfully"}
 
+# 批次匯入使用者：CSV（含標題列 idTag,name,department,cardNumber）或 NDJSON，已存在者更新
+@app.post("/api/users/import")
+async def import_users(request: Request, format: str = Query(None)):
+    try:
+        fmt = bulk_import.detect_format(request, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result = await _import_rows(request, fmt, bulk_import.validate_user, "import_users")
+    await refresh_authorization_caches()
+    return result
+
+def _reservation_interval(start_time, end_time):
+    try:
+        start, end = to_epoch(start_time), to_epoch(end_time)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="startTime/endTime 格式錯誤")
+    if start >= end:
+        raise HTTPException(status_code=400, detail="endTime 必須晚於 startTime")
+    return start, end
+
+
 @app.post("/api/reservations")
 async def create_reservation(data: dict = Body(...)):
-    cursor.execute('''
-        INSERT INTO reservations (charge_point_id, id_tag, start_time, end_time, status)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (
-        data["chargePointId"], data["idTag"],
-        data["startTime"], data["endTime"], "active"
-    ))
-    conn.commit()
-    return {"message": "Reservation created"}
+    start, end = _reservation_interval(data["startTime"], data["endTime"])
+    other = reservation_index.check_conflict(data["chargePointId"], start, end)
+    if other is not None:
+        raise HTTPException(status_code=409, detail=f"與預約 {other} 時段重疊")
+
+    res_id = await repo.create_reservation(data["chargePointId"], data["idTag"], data["startTime"], data["endTime"])
+    try:
+        reservation_index.add(res_id, data["chargePointId"], data["idTag"], start, end)
+    except ReservationConflict as e:
+        # 寫入資料庫期間另一個重疊的預約已先加入索引：撤回這一筆
+        await repo.delete_reservation(res_id)
+        raise HTTPException(status_code=409, detail=str(e))
+    _reservation_wakeup.set()
+    return {"message": "Reservation created", "id": res_id}
 
 @app.get("/api/reservations")
 async def list_reservations():
-    cursor.execute("SELECT * FROM reservations")
-    rows = cursor.fetchall()
+    rows = await repo.list_reservations()
     return [{
         "id": r[0], "chargePointId": r[1], "idTag": r[2],
         "startTime": r[3], "endTime": r[4], "status": r[5]
@@ -1241,8 +1448,7 @@ async def list_reservations():
 
 @app.get("/api/reservations/{id}")
 async def get_reservation(id: int = Path(...)):
-    cursor.execute("SELECT * FROM reservations WHERE id = ?", (id,))
-    row = cursor.fetchone()
+    row = await repo.get_reservation(id)
     if not row:
         raise HTTPException(status_code=404, detail="Reservation not found")
     return {
@@ -1252,25 +1458,45 @@ async def get_reservation(id: int = Path(...)):
 
 @app.put("/api/reservations/{id}")
 async def update_reservation(id: int, data: dict = Body(...)):
-    fields = []
-    values = []
-    for field in ["chargePointId", "idTag", "startTime", "endTime", "status"]:
-        if field in data:
-            fields.append(f"{field.lower()} = ?")
-            values.append(data[field])
+    columns = {
+        "chargePointId": "charge_point_id", "idTag": "id_tag",
+        "startTime": "start_time", "endTime": "end_time", "status": "status",
+    }
+    fields = {column: data[field] for field, column in columns.items() if field in data}
     if not fields:
         raise HTTPException(status_code=400, detail="No fields to update")
-    values.append(id)
-    cursor.execute(f'''
-        UPDATE reservations SET {", ".join(fields)} WHERE id = ?
-    ''', values)
-    conn.commit()
+
+    row = await repo.get_reservation(id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    merged = dict(zip(columns, row[1:]))
+    merged.update({k: data[k] for k in columns if k in data})
+
+    # 更新後仍為 active 的預約需重新檢查時段衝突
+    if merged["status"] == "active":
+        start, end = _reservation_interval(merged["startTime"], merged["endTime"])
+        other = reservation_index.check_conflict(merged["chargePointId"], start, end, ignore_id=id)
+        if other is not None:
+            raise HTTPException(status_code=409, detail=f"與預約 {other} 時段重疊")
+
+    await repo.update_reservation(id, fields)
+
+    if merged["status"] == "active":
+        try:
+            reservation_index.add(id, merged["chargePointId"], merged["idTag"], start, end)
+        except ReservationConflict as e:
+            # 寫入資料庫期間另一個重疊的預約已先加入索引：還原這一筆的欄位，索引仍是原本的時段
+            await repo.update_reservation(id, {c: old for c, old in zip(columns.values(), row[1:]) if c in fields})
+            raise HTTPException(status_code=409, detail=str(e))
+        _reservation_wakeup.set()
+    else:
+        reservation_index.remove(id)
     return {"message": "Reservation updated"}
 
 @app.delete("/api/reservations/{id}")
 async def delete_reservation(id: int = Path(...)):
-    cursor.execute("DELETE FROM reservations WHERE id = ?", (id,))
-    conn.commit()
+    await repo.delete_reservation(id)
+    reservation_index.remove(id)
     return {"message": "Reservation deleted"}
 
 
@@ -1283,31 +1509,19 @@ async def update_user(id_tag: str = Path(...), data: dict = Body(...)):
     if not any([name, department, card_number]):
         raise HTTPException(status_code=400, detail="No fields to update")
 
-    if name:
-        cursor.execute("UPDATE users SET name = ? WHERE id_tag = ?", (name, id_tag))
-    if department:
-        cursor.execute("UPDATE users SET department = ? WHERE id_tag = ?", (department, id_tag))
-    if card_number:
-        cursor.execute("UPDATE users SET card_number = ? WHERE id_tag = ?", (card_number, id_tag))
-
-    conn.commit()
+    fields = {"name": name, "department": department, "card_number": card_number}
+    await repo.update_user(id_tag, {column: value for column, value in fields.items() if value})
     return {"message": "User updated successfully"}
 
 @app.delete("/api/users/{id_tag}")
 async def delete_user(id_tag: str = Path(...)):
-    cursor.execute("DELETE FROM users WHERE id_tag = ?", (id_tag,))
-    conn.commit()
+    await repo.delete_user(id_tag)
     return {"message": "User deleted successfully"}
 
 
 @app.get("/api/summary/pricing-matrix")
 async def get_pricing_matrix():
-    cursor.execute("""
-        SELECT season, day_type, start_time, end_time, price
-        FROM pricing_rules
-        ORDER BY season, day_type, start_time
-    """)
-    rows = cursor.fetchall()
+    rows = await repo.list_pricing_rules()
     return [
         {
             "season": r[0],
@@ -1321,16 +1535,7 @@ async def get_pricing_matrix():
 
 @app.get("/api/summary/daily-by-chargepoint")
 async def get_daily_by_chargepoint():
-    cursor.execute("""
-        SELECT strftime('%Y-%m-%d', start_timestamp) as day,
-               charge_point_id,
-               SUM(meter_stop - meter_start) as total_energy
-        FROM transactions
-        WHERE meter_stop IS NOT NULL
-        GROUP BY day, charge_point_id
-        ORDER BY day ASC
-    """)
-    rows = cursor.fetchall()
+    rows = await analytics.daily_energy_by_charge_point()
 
     result_map = {}
     for day, cp_id, energy in rows:
@@ -1347,8 +1552,7 @@ import csv
 
 @app.get("/api/users/export")
 async def export_users_csv():
-    cursor.execute("SELECT id_tag, name, department, card_number FROM users")
-    rows = cursor.fetchall()
+    rows = await analytics.list_users()
 
     output = io.StringIO()
     writer = csv.writer(output)
@@ -1368,8 +1572,7 @@ import csv
 
 @app.get("/api/reservations/export")
 async def export_reservations_csv():
-    cursor.execute("SELECT id, charge_point_id, id_tag, start_time, end_time, status FROM reservations")
-    rows = cursor.fetchall()
+    rows = await analytics.list_reservations()
 
     output = io.StringIO()
     writer = csv.writer(output)
@@ -1383,55 +1586,457 @@ async def export_reservations_csv():
     })
 
 
-from fastapi.responses import StreamingResponse
-import io
-from reportlab.pdfgen import canvas
+# === 月報：預先彙總的 monthly_usage 與磁碟快取的 PDF ===
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS monthly_usage (
+    month TEXT,              -- yyyy-mm（依交易開始時間）
+    id_tag TEXT,
+    charge_point_id TEXT,
+    total_energy REAL DEFAULT 0,
+    txn_count INTEGER DEFAULT 0,
+    PRIMARY KEY (month, id_tag, charge_point_id)
+)
+''')
+cursor.execute("SELECT COUNT(*) FROM monthly_usage")
+if cursor.fetchone()[0] == 0:
+    # 第一次啟動：由既有交易回填
+    cursor.execute('''
+        INSERT INTO monthly_usage (month, id_tag, charge_point_id, total_energy, txn_count)
+        SELECT substr(start_timestamp, 1, 7), id_tag, charge_point_id,
+               SUM(meter_stop - meter_start), COUNT(*)
+        FROM transactions
+        WHERE meter_stop IS NOT NULL AND start_timestamp IS NOT NULL
+        GROUP BY 1, 2, 3
+    ''')
+conn.commit()
+
+
+report_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="report")
+_report_renders = {}   # 報表路徑 -> 產生中的 Future，避免同一版本重複產生
+
 
 @app.get("/api/report/monthly")
 async def generate_monthly_pdf(month: str):
-    # 取得指定月份的起始與結束日期
     try:
-        start_date = f"{month}-01"
-        end_date = f"{month}-31"
-    except:
+        month = monthly_report.normalize_month(month)
+    except ValueError:
         return {"error": "Invalid month format"}
 
-    # 查詢交易資料
-    cursor.execute("""
-        SELECT id_tag, charge_point_id, SUM(meter_stop - meter_start) AS total_energy, COUNT(*) as txn_count
-        FROM transactions
-        WHERE start_timestamp >= ? AND start_timestamp <= ? AND meter_stop IS NOT NULL
-        GROUP BY id_tag, charge_point_id
-    """, (start_date, end_date))
-    rows = cursor.fetchall()
-
-    # PDF 產出
-    buffer = io.BytesIO()
-    p = canvas.Canvas(buffer)
-    p.setTitle(f"Monthly Report - {month}")
-
-    p.drawString(50, 800, f"🔌 Monthly Electricity Report - {month}")
-    p.drawString(50, 780, "----------------------------------------")
-    y = 760
-    for row in rows:
-        id_tag, cp_id, energy, count = row
-        kwh = round(energy / 1000, 2)
-        p.drawString(50, y, f"ID: {id_tag} | 樁: {cp_id} | 次數: {count} | 用電: {kwh} kWh")
-        y -= 20
-        if y < 50:
-            p.showPage()
-            y = 800
-
-    if not rows:
-        p.drawString(50, 760, "⚠️ 本月無任何有效交易紀錄")
-
-    p.showPage()
-    p.save()
-    buffer.seek(0)
-
-    return StreamingResponse(buffer, media_type="application/pdf", headers={
-        "Content-Disposition": f"attachment; filename=monthly_report_{month}.pdf"
-    })
+    rows = await analytics.monthly_usage(month)
+    path = monthly_report.report_path(month, monthly_report.data_version(rows))
+
+    if not os.path.exists(path):
+        future = _report_renders.get(path)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(report_executor, monthly_report.render_pdf, month, rows, path)
+            _report_renders[path] = future
+            future.add_done_callback(lambda _: _report_renders.pop(path, None))
+        await future
+
+    return FileResponse(path, media_type="application/pdf", filename=f"monthly_report_{month}.pdf")
+
+
+
+# === SQLite 維護：設定檢視、checkpoint、線上備份 ===
+checkpointer = storage.Checkpointer(DB_FILE)
+
+
+@app.get("/api/admin/storage")
+async def storage_info():
+    return {
+        **storage.info(conn, DB_FILE),
+        "checkpointRuns": checkpointer.runs,
+        "lastCheckpoint": checkpointer.last,
+        "shards": shards.info() if shards is not None else None,
+        "replica": read_replica.info() if read_replica is not None else None,
+    }
+
+
+@app.get("/api/admin/admission")
+async def admission_info():
+    return {**admission.info(), "connected": len(connected_charge_points), "websocket": density.info(),
+            "liveness": liveness.info()}
+
+
+def charge_point_site(cp_id, cp):
+    # 經集中器連線的以集中器場域為準，其餘依 DB_SHARDS 的規則
+    site = getattr(cp._connection, "site", None)
+    if site is None and shards is not None:
+        site = shards.route(cp_id).name
+    return site
+
+
+@app.post("/api/commands")
+async def run_command(data: dict = Body(...)):
+    # 對一個、一批或符合條件的充電樁送出 OCPP 指令，以 NDJSON 串流回傳每個充電樁的結果（見 commands.py）
+    action = data.get("action")
+    try:
+        payload = commands.build_payload(action, data.get("params") or {})
+        targets, offline = commands.select(
+            connected_charge_points, data.get("chargePointIds"), data.get("match"), data.get("site"), charge_point_site
+        )
+        concurrency = int(data.get("concurrency", commands.COMMAND_CONCURRENCY))
+        timeout = float(data.get("timeoutS", commands.COMMAND_TIMEOUT))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if concurrency < 1 or timeout <= 0:
+        raise HTTPException(status_code=400, detail="concurrency 必須 ≥ 1，timeoutS 必須 > 0")
+    if not targets and not offline:
+        raise HTTPException(status_code=404, detail="沒有符合條件的連線中充電樁")
+    logging.info(f"📣 {action} | 目標 {len(targets)} 個（離線 {len(offline)}）| 並行 {concurrency} | 逾時 {timeout} 秒")
+    return StreamingResponse(
+        commands.stream(event_loops["ocpp"], action, targets, offline, payload, concurrency, timeout),
+        media_type="application/x-ndjson",
+    )
+
+
+# === 韌體庫與 UpdateFirmware 分批推送（見 firmware.py）===
+firmware_store = firmware.FirmwareStore()
+firmware_server = firmware.DownloadServer(firmware_store)
+firmware_campaigns = firmware.CampaignManager(connected_charge_points)
+
+
+async def start_firmware_server():
+    event_loops["firmware"] = asyncio.get_running_loop()
+    await firmware_server.serve_forever()
+
+
+def firmware_base_url(request):
+    # 充電樁下載韌體用的位址；未設定 FIRMWARE_BASE_URL 時以本次 API 請求的主機名稱加上 FIRMWARE_PORT
+    return firmware.FIRMWARE_BASE_URL or f"http://{request.url.hostname}:{firmware.FIRMWARE_PORT}"
+
+
+# 上傳：request body 為映像檔本身，例如 curl --data-binary @fw.bin "/api/firmware?version=1.2.0&model=AC22"
+@app.post("/api/firmware")
+async def upload_firmware(
+    request: Request,
+    version: str = Query(...),
+    model: str = Query(None),
+    filename: str = Query(None),
+    sha256: str = Query(None)
+):
+    try:
+        image = await firmware_store.add(request.stream(), version, model, filename, sha256)
+    except firmware.DuplicateVersion as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except firmware.ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logging.info(f"📦 韌體已上傳 | {image['model']} {image['version']} | {image['size']} bytes | {image['sha256']}")
+    return {**image, "location": firmware.location(image, firmware_base_url(request))}
+
+
+@app.get("/api/firmware")
+async def list_firmware(request: Request):
+    base_url = firmware_base_url(request)
+    return [{**image, "location": firmware.location(image, base_url)} for image in firmware_store.list()]
+
+
+@app.get("/api/firmware/campaigns")
+async def list_firmware_campaigns():
+    return sorted((c.view() for c in firmware_campaigns.campaigns.values()),
+                  key=lambda c: c["createdAt"], reverse=True)
+
+
+@app.get("/api/firmware/campaigns/{campaign_id}")
+async def get_firmware_campaign(campaign_id: str):
+    campaign = firmware_campaigns.campaigns.get(campaign_id)
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return campaign.view(detail=True)
+
+
+# 建立推送活動：{"firmwareId": "...", "match": "TPE-*", "batchSize": 50, "batchIntervalS": 60,
+#   "batchTimeoutS": 1800, "maxFailureRate": 0.1, "retries": 3, "retryInterval": 60}
+@app.post("/api/firmware/campaigns")
+async def create_firmware_campaign(request: Request, data: dict = Body(...)):
+    image = firmware_store.images.get(data.get("firmwareId"))
+    if not image:
+        raise HTTPException(status_code=404, detail="Firmware not found")
+    params = {k: data[k] for k in ("retrieveDate", "retries", "retryInterval") if data.get(k) is not None}
+    url = firmware.location(image, firmware_base_url(request))
+    try:
+        commands.build_payload("UpdateFirmware", {"location": url, "retrieveDate": firmware.now_iso(), **params})
+        targets, offline = commands.select(
+            connected_charge_points, data.get("chargePointIds"), data.get("match"), data.get("site"), charge_point_site
+        )
+        batch_size = int(data.get("batchSize", 50))
+        batch_interval = float(data.get("batchIntervalS", 60))
+        batch_timeout = float(data.get("batchTimeoutS", 1800))
+        max_failure_rate = float(data.get("maxFailureRate", 0.1))
+        command_timeout = float(data.get("timeoutS", commands.COMMAND_TIMEOUT))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if batch_size < 1 or batch_interval < 0 or batch_timeout < 0 or command_timeout <= 0 \
+            or not 0 <= max_failure_rate <= 1:
+        raise HTTPException(status_code=400, detail="batchSize 必須 ≥ 1，maxFailureRate 必須在 0 到 1 之間，時間不可為負數")
+    if not targets and not offline:
+        raise HTTPException(status_code=404, detail="沒有符合條件的連線中充電樁")
+    campaign = firmware.Campaign(image, url, [cp_id for cp_id, _ in targets] + offline, params, batch_size,
+                                 batch_interval, batch_timeout, max_failure_rate, command_timeout)
+    firmware_campaigns.start(campaign, event_loops["ocpp"])
+    logging.info(f"📦 韌體推送 {campaign.id} | {image['version']} | 目標 {len(campaign.chargers)} 個"
+                 f"（{campaign.batches} 批，每批 {batch_size}）")
+    return campaign.view()
+
+
+@app.delete("/api/firmware/campaigns/{campaign_id}")
+async def cancel_firmware_campaign(campaign_id: str):
+    campaign = firmware_campaigns.campaigns.get(campaign_id)
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    if campaign.status != "running":
+        raise HTTPException(status_code=409, detail=f"Campaign is {campaign.status}")
+    firmware_campaigns.cancel(campaign)
+    return {"message": "Cancelling"}
+
+
+@app.get("/api/firmware/{firmware_id}")
+async def get_firmware(request: Request, firmware_id: str):
+    image = firmware_store.images.get(firmware_id)
+    if not image:
+        raise HTTPException(status_code=404, detail="Firmware not found")
+    return {**image, "location": firmware.location(image, firmware_base_url(request))}
+
+
+@app.delete("/api/firmware/{firmware_id}")
+async def delete_firmware(firmware_id: str):
+    if firmware_id not in firmware_store.images:
+        raise HTTPException(status_code=404, detail="Firmware not found")
+    if firmware_campaigns.running(firmware_id):
+        raise HTTPException(status_code=409, detail="韌體推送進行中，無法刪除")
+    firmware_store.delete(firmware_id)
+    return {"message": "Deleted"}
+
+
+@app.get("/api/admin/firmware")
+async def firmware_server_info():
+    return {**firmware_server.info(), "images": len(firmware_store.images),
+            "runningCampaigns": len(firmware_campaigns.running())}
+
+
+# === 診斷檔收集（GetDiagnostics，見 diagnostics.py）===
+diagnostics_store = diagnostics.DiagnosticsStore()
+
+
+# 對選定的充電樁送出 GetDiagnostics：{"match": "TPE-*", "startTime": "...", "stopTime": "...", "retries": 3}
+@app.post("/api/diagnostics")
+async def request_diagnostics(request: Request, data: dict = Body(...)):
+    params = {k: data[k] for k in ("startTime", "stopTime", "retries", "retryInterval") if data.get(k) is not None}
+    base_url = diagnostics.DIAGNOSTICS_BASE_URL or str(request.base_url)
+    try:
+        payload = commands.build_payload("GetDiagnostics", {"location": base_url, **params})
+        targets, offline = commands.select(
+            connected_charge_points, data.get("chargePointIds"), data.get("match"), data.get("site"), charge_point_site
+        )
+        concurrency = int(data.get("concurrency", commands.COMMAND_CONCURRENCY))
+        timeout = float(data.get("timeoutS", commands.COMMAND_TIMEOUT))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if concurrency < 1 or timeout <= 0:
+        raise HTTPException(status_code=400, detail="concurrency 必須 ≥ 1，timeoutS 必須 > 0")
+    if not targets and not offline:
+        raise HTTPException(status_code=404, detail="沒有符合條件的連線中充電樁")
+    records = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+        diagnostics.request_all(diagnostics_store, targets, base_url, payload, concurrency, timeout), event_loops["ocpp"]
+    ))
+    logging.info(f"🩺 GetDiagnostics | 目標 {len(targets)} 個（離線 {len(offline)}）")
+    return {"requests": [diagnostics.view(r) for r in records], "offline": offline}
+
+
+@app.get("/api/diagnostics")
+async def list_diagnostics(charge_point_id: str = Query(None, alias="chargePointId")):
+    return [diagnostics.view(r) for r in diagnostics_store.list(charge_point_id)]
+
+
+@app.get("/api/diagnostics/{request_id}")
+async def get_diagnostics(request_id: str):
+    record = diagnostics_store.requests.get(request_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Diagnostics request not found")
+    diagnostics_store.expire()
+    return diagnostics.view(record)
+
+
+@app.get("/api/diagnostics/{request_id}/file")
+async def download_diagnostics(request_id: str):
+    record = diagnostics_store.requests.get(request_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Diagnostics request not found")
+    if record["status"] != diagnostics.RECEIVED:
+        raise HTTPException(status_code=409, detail=f"Diagnostics request is {record['status']}")
+    return FileResponse(diagnostics_store.path(record), media_type="application/octet-stream",
+                        filename=f"{record['chargePointId']}-{record['fileName']}")
+
+
+@app.delete("/api/diagnostics/{request_id}")
+async def delete_diagnostics(request_id: str):
+    if request_id not in diagnostics_store.requests:
+        raise HTTPException(status_code=404, detail="Diagnostics request not found")
+    diagnostics_store.delete(request_id)
+    return {"message": "Deleted"}
+
+
+# 充電樁上傳診斷檔（GetDiagnostics 的 location）：PUT / POST 原始 body 或 multipart/form-data，串流寫入磁碟
+@app.api_route("/diagnostics/{token}", methods=["PUT", "POST"])
+@app.api_route("/diagnostics/{token}/{file_name}", methods=["PUT", "POST"])
+async def receive_diagnostics(request: Request, token: str, file_name: str = None):
+    length = request.headers.get("content-length")
+    try:
+        record = diagnostics_store.check_upload(token, int(length) if length and length.isdigit() else None)
+        content_type = request.headers.get("content-type", "")
+        chunks = request.stream()
+        if content_type.lower().startswith("multipart/form-data"):
+            boundary = re.search(r'boundary="?([^";]+)"?', content_type)
+            if boundary is None:
+                raise HTTPException(status_code=400, detail="multipart 缺少 boundary")
+            part = diagnostics.MultipartFile(chunks, boundary.group(1))
+            file_name = await part.open()
+            chunks = part.body()
+        record = await diagnostics_store.receive(record, chunks, file_name)
+    except diagnostics.UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logging.info(f"🩺 診斷檔已上傳 | CP={record['chargePointId']} | {record['fileName']} | {record['size']} bytes")
+    return {"fileName": record["fileName"], "size": record["size"], "sha256": record["sha256"]}
+
+
+profile_lock = asyncio.Lock()
+
+
+@app.get("/api/admin/profile")
+async def run_profile(
+    seconds: float = Query(10, gt=0, le=profiler.MAX_SECONDS),
+    interval_ms: float = Query(5, ge=1, le=100),
+    slow_ms: float = Query(100, ge=1),
+    format: str = Query("json"),
+    idle: bool = Query(False)
+):
+    # 取樣所有執行緒 seconds 秒，並量測兩個事件迴圈的延遲與卡住的 callback（見 profiler.py）
+    if format not in ("json", "collapsed", "speedscope"):
+        raise HTTPException(status_code=400, detail="format 必須為 json、collapsed 或 speedscope")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="已有 profiling 進行中")
+    async with profile_lock:
+        result = profiler.Profiler(event_loops, interval_ms / 1000, slow_ms, idle)
+        await asyncio.to_thread(result.run, seconds)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if format == "collapsed":
+        return Response(result.collapsed(), media_type="text/plain; charset=utf-8",
+                        headers={"Content-Disposition": f'attachment; filename="profile-{stamp}.txt"'})
+    if format == "speedscope":
+        return FastJSONResponse(result.speedscope(),
+                                headers={"Content-Disposition": f'attachment; filename="profile-{stamp}.speedscope.json"'})
+    return FastJSONResponse(result.summary())
+
+
+@app.post("/api/admin/checkpoint")
+async def run_checkpoint(data: dict = Body(default={})):
+    mode = (data.get("mode") or "PASSIVE").upper()
+    if mode not in storage.CHECKPOINT_MODES:
+        raise HTTPException(status_code=400, detail=f"mode 必須為 {', '.join(sorted(storage.CHECKPOINT_MODES))}")
+    if mode == "PASSIVE":
+        return await asyncio.to_thread(checkpointer.run_once)
+    busy, log, done = await asyncio.to_thread(_checkpoint_with_own_connection, mode)
+    return {"mode": mode, "busy": busy, "walPages": log, "checkpointedPages": done}
+
+
+def _checkpoint_with_own_connection(mode):
+    c = sqlite3.connect(DB_FILE, timeout=5)
+    try:
+        return storage.checkpoint(c, mode)
+    finally:
+        c.close()
+
+
+# 線上備份：在執行緒中以 backup API 複製，不阻塞 API 與 OCPP 寫入
+@app.post("/api/admin/backup")
+async def run_backup():
+    try:
+        result = await asyncio.to_thread(storage.backup, DB_FILE)
+        if shards is not None:
+            # 各場域分片各自備份（不在同一個時間點，跨分片不保證一致）
+            result["shards"] = await asyncio.gather(*(
+                asyncio.to_thread(storage.backup, shard.db_file)
+                for shard in shards.shards.values() if shard is not shards.default
+            ))
+    except (sqlite3.Error, OSError) as e:
+        raise HTTPException(status_code=500, detail=f"備份失敗：{e}")
+    logging.info(f"💾 資料庫備份完成 | {result['path']} | {result['bytes']} bytes | {result['durationMs']} ms")
+    return result
+
+
+# === 背景工作：長區間費用統計、月報、交易匯出 ===
+job_manager = jobs.JobManager(
+    DB_FILE, shard_files=shards.files()[1:] if shards is not None else (),
+    dsn=repository.DATABASE_URL if POSTGRES else None
+)
+
+
+def _job_view(job):
+    view = {k: job[k] for k in ("id", "type", "params", "status", "progress", "error", "createdAt", "finishedAt")}
+    view["resultUrl"] = f"/api/jobs/{job['id']}/result" if job["status"] == "done" else None
+    return view
+
+
+# 建立工作：{"type": "cost_summary" | "monthly_report" | "transactions_export", "params": {...}}
+@app.post("/api/jobs")
+async def submit_job(data: dict = Body(...)):
+    params = data.get("params") or {}
+    if not isinstance(params, dict):
+        raise HTTPException(status_code=400, detail="params 必須為物件")
+    if data.get("type") == "monthly_report":
+        try:
+            params["month"] = monthly_report.normalize_month(params.get("month", ""))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid month format")
+    try:
+        job, deduplicated = job_manager.submit(data.get("type"), params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {**_job_view(job), "deduplicated": deduplicated}
+
+
+@app.get("/api/jobs")
+async def list_jobs():
+    return sorted((_job_view(j) for j in job_manager.jobs.values()), key=lambda j: j["createdAt"], reverse=True)
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_view(job)
+
+
+@app.get("/api/jobs/{job_id}/result")
+async def download_job_result(job_id: str):
+    job = job_manager.jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    path = job_manager.result_path(job)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=410, detail="Result expired")
+    return FileResponse(path, media_type=job["mediaType"], filename=job["filename"])
+
+
+# 未完成的工作會被取消；已結束的工作則刪除結果
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_manager.jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] in ("pending", "running"):
+        job_manager.cancel(job_id)
+        return {"message": "Cancelling", "status": job["status"]}
+    job_manager.delete(job_id)
+    return {"message": "Deleted"}
 
 
 
@@ -1481,8 +2086,7 @@ from fastapi import HTTPException
 
 @app.get("/api/cards")
 async def get_cards():
-    cursor.execute("SELECT card_id, balance FROM cards")
-    rows = cursor.fetchall()
+    rows = await repo.list_cards()
     return [{"id": row[0], "card_id": row[0], "balance": row[1]} for row in rows]
 
 @app.post("/api/cards/{card_id}/topup")
@@ -1491,30 +2095,31 @@ async def topup_card(card_id: str = Path(...), data: dict = Body(...)):
     if amount is None or not isinstance(amount, (int, float)) or amount <= 0:
         raise HTTPException(status_code=400, detail="儲值金額錯誤")
 
-    cursor.execute("SELECT balance FROM cards WHERE card_id = ?", (card_id,))
-    row = cursor.fetchone()
+    # 沒有這張卡時自動新增，初始餘額就是此次儲值金額
+    created, new_balance = await repo.top_up(card_id, amount)
+    await refresh_authorization_caches()
+    return {"status": "created" if created else "success", "card_id": card_id, "new_balance": round(new_balance, 2)}
 
-    if not row:
-        # ⛳️ 沒有這張卡 → 幫他自動新增，初始餘額就是此次儲值金額
-        cursor.execute("INSERT INTO cards (card_id, balance) VALUES (?, ?)", (card_id, amount))
-        conn.commit()
-        return {"status": "created", "card_id": card_id, "new_balance": round(amount, 2)}
-    else:
-        # ✅ 已存在 → 正常加值
-        new_balance = row[0] + amount
-        cursor.execute("UPDATE cards SET balance = ? WHERE card_id = ?", (new_balance, card_id))
-        conn.commit()
-        return {"status": "success", "card_id": card_id, "new_balance": round(new_balance, 2)}
+
+# 批次儲值：CSV（含標題列 cardId,amount）或 NDJSON；與單筆儲值相同，無此卡片時自動新增
+@app.post("/api/cards/import")
+async def import_card_topups(request: Request, format: str = Query(None)):
+    try:
+        fmt = bulk_import.detect_format(request, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result = await _import_rows(request, fmt, bulk_import.validate_card_topup, "import_card_topups")
+    await refresh_authorization_caches()
+    return result
 
 
 
 @app.get("/api/cards/{card_id}")
 async def get_card_balance(card_id: str):
-    cursor.execute("SELECT balance FROM cards WHERE card_id = ?", (card_id,))
-    row = cursor.fetchone()
-    if not row:
+    balance = await repo.get_balance(card_id)
+    if balance is None:
         raise HTTPException(status_code=404, detail="卡片不存在")
-    return {"cardId": card_id, "balance": round(row[0], 2)}
+    return {"cardId": card_id, "balance": round(balance, 2)}
 
 
 
@@ -1533,30 +2138,10 @@ async def get_dashboard_summary():
     today = datetime.now().strftime("%Y-%m-%d")
 
     try:
-        cursor.execute("SELECT COUNT(*) FROM transactions WHERE meter_stop IS NULL")
-        charging_count = cursor.fetchone()[0] or 0
-    except:
-        charging_count = 0
-
-    try:
-        cursor.execute("""
-            SELECT SUM(value) FROM (
-                SELECT MAX(id) as latest_id FROM meter_values GROUP BY charge_point_id
-            ) AS latest_ids
-            JOIN meter_values ON meter_values.id = latest_ids.latest_id
-        """)
-        total_power = cursor.fetchone()[0] or 0
-    except:
-        total_power = 0
-
-    try:
-        cursor.execute("""
-            SELECT SUM(meter_stop - meter_start) FROM transactions
-            WHERE DATE(start_timestamp) = ? AND meter_stop IS NOT NULL
-        """, (today,))
-        energy_today = cursor.fetchone()[0] or 0
-    except:
-        energy_today = 0
+        charging_count, total_power, energy_today = await repo.live_totals(today)
+    except Exception as e:
+        logging.warning(f"儀表板統計失敗：{e}")
+        charging_count, total_power, energy_today = 0, 0, 0
 
     return {
         "chargingCount": charging_count,
@@ -1572,27 +2157,15 @@ async def get_dashboard_summary():
 @app.get("/api/dashboard/trend")
 async def dashboard_trend(group_by: str = Query("day")):
     try:
-        if group_by == "day":
-            date_expr = "strftime('%Y-%m-%d', start_timestamp)"
-        elif group_by == "week":
-            date_expr = "strftime('%Y-W%W', start_timestamp)"
-        else:
+        if group_by not in ("day", "week"):
             raise HTTPException(status_code=400, detail="group_by must be 'day' or 'week'")
 
-        cursor.execute(f"""
-            SELECT {date_expr} as period,
-                   SUM(meter_stop - meter_start) / 1000.0 as total_kwh
-            FROM transactions
-            WHERE meter_stop IS NOT NULL
-            GROUP BY period
-            ORDER BY period ASC
-        """)
-        rows = cursor.fetchall()
+        rows = await analytics.energy_by_period(group_by)
 
         return [
             {
                 "period": row[0],
-                "kWh": round(row[1] or 0, 2)
+                "kWh": round((row[2] or 0) / 1000, 2)
             } for row in rows
         ]
     except Exception as e:
@@ -1607,18 +2180,7 @@ async def get_daily_by_chargepoint_range(
     start: str = Query(...),
     end: str = Query(...)
 ):
-    cursor.execute("""
-        SELECT strftime('%Y-%m-%d', start_timestamp) as day,
-               charge_point_id,
-               SUM(meter_stop - meter_start) as total_energy
-        FROM transactions
-        WHERE meter_stop IS NOT NULL
-          AND start_timestamp >= ?
-          AND start_timestamp <= ?
-        GROUP BY day, charge_point_id
-        ORDER BY day ASC
-    """, (start, end))
-    rows = cursor.fetchall()
+    rows = await analytics.daily_energy_by_charge_point(start, end)
 
     result_map = {}
     for day, cp_id, energy in rows:
@@ -1647,18 +2209,30 @@ CREATE TABLE IF NOT EXISTS daily_pricing_rules (
     label TEXT DEFAULT ''
 )
 ''')
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_daily_pricing_date ON daily_pricing_rules (date)")
 conn.commit()
 
+
+def _check_pricing_overlap(rows, key, start_time, end_time, exclude_id=None):
+    # rows: [(id, start_time, end_time)]，與新時段重疊時回傳 409
+    try:
+        groups = {key: [(st, et, f"#{rid} {st}-{et}") for rid, st, et in rows if rid != exclude_id]}
+        groups[key].append((start_time, end_time, f"{start_time}-{end_time}"))
+        errors = tariff_calendar.find_overlaps(groups)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if errors:
+        raise HTTPException(status_code=409, detail=errors)
+
+
+async def _check_daily_overlap(data, exclude_id=None):
+    rows = await repo.daily_slots(data["date"])
+    _check_pricing_overlap(rows, data["date"], data["startTime"], data["endTime"], exclude_id)
+
 # 取得指定日期的設定
 @app.get("/api/daily-pricing")
 async def get_daily_pricing(date: str = Query(...)):
-    cursor.execute('''
-        SELECT id, date, start_time, end_time, price, label
-        FROM daily_pricing_rules
-        WHERE date = ?
-        ORDER BY start_time ASC
-    ''', (date,))
-    rows = cursor.fetchall()
+    rows = await repo.list_daily_pricing(date)
     return [
         {
             "id": r[0], "date": r[1], "startTime": r[2],
@@ -1669,49 +2243,100 @@ async def get_daily_pricing(date: str = Query(...)):
 # 新增設定
 @app.post("/api/daily-pricing")
 async def add_daily_pricing(data: dict = Body(...)):
-    cursor.execute('''
-        INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (data["date"], data["startTime"], data["endTime"], float(data["price"]), data.get("label", "")))
-    conn.commit()
+    await _check_daily_overlap(data)
+    await repo.add_daily_pricing(data["date"], data["startTime"], data["endTime"], float(data["price"]), data.get("label", ""))
     return {"message": "新增成功"}
 
 # 修改設定
 @app.put("/api/daily-pricing/{id}")
 async def update_daily_pricing(id: int = Path(...), data: dict = Body(...)):
-    cursor.execute('''
-        UPDATE daily_pricing_rules
-        SET date = ?, start_time = ?, end_time = ?, price = ?, label = ?
-        WHERE id = ?
-    ''', (data["date"], data["startTime"], data["endTime"], float(data["price"]), data.get("label", ""), id))
-    conn.commit()
+    await _check_daily_overlap(data, exclude_id=id)
+    await repo.update_daily_pricing(id, data["date"], data["startTime"], data["endTime"], float(data["price"]), data.get("label", ""))
     return {"message": "更新成功"}
 
 # 刪除設定
 @app.delete("/api/daily-pricing/{id}")
 async def delete_daily_pricing(id: int = Path(...)):
-    cursor.execute("DELETE FROM daily_pricing_rules WHERE id = ?", (id,))
-    conn.commit()
+    await repo.delete_daily_pricing(id)
     return {"message": "已刪除"}
 
 # 複製到多個日期
+# targetDates: list of yyyy-mm-dd，或 targetRange: {"from", "to", "weekdays"}
+# replace=true 時先清除目標日期原有設定，否則與原有設定重疊即拒絕
 @app.post("/api/daily-pricing/duplicate")
 async def duplicate_pricing(data: dict = Body(...)):
     source_date = data["sourceDate"]
-    target_dates = data["targetDates"]  # list of yyyy-mm-dd
+    target_dates = list(data.get("targetDates") or [])
+    try:
+        if data.get("targetRange"):
+            r = data["targetRange"]
+            target_dates += tariff_calendar.expand_dates(r["from"], r["to"], r.get("weekdays"))
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    target_dates = sorted(set(target_dates) - {source_date})
+    replace = bool(data.get("replace"))
+
+    rows = [r[2:] for r in await repo.list_daily_pricing(source_date)]
+    new_rows = [(target, *r) for target in target_dates for r in rows]
+
+    if not replace and target_dates:
+        groups = {}
+        for target, st, et, _, _ in new_rows:
+            groups.setdefault(target, []).append((st, et, f"{st}-{et}"))
+        for d, st, et in await repo.daily_pricing_slots(target_dates):
+            groups.setdefault(d, []).append((st, et, f"原有 {st}-{et}"))
+        errors = tariff_calendar.find_overlaps(groups)
+        if errors:
+            raise HTTPException(status_code=409, detail=errors)
 
-    cursor.execute("SELECT start_time, end_time, price, label FROM daily_pricing_rules WHERE date = ?", (source_date,))
-    rows = cursor.fetchall()
+    try:
+        with batch_repository() as batch_repo:
+            await batch_repo.replace_pricing(new_rows, dates=target_dates if replace else ())
+    except WriteError as e:
+        raise HTTPException(status_code=500, detail=f"複製失敗，已還原：{e}")
+    return {"message": f"已複製 {len(rows)} 筆設定至 {len(target_dates)} 天"}
 
-    for target in target_dates:
-        for r in rows:
-            cursor.execute("""
-                INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
-                VALUES (?, ?, ?, ?, ?)
-            """, (target, r[0], r[1], r[2], r[3]))
 
-    conn.commit()
-    return {"message": f"已複製 {len(rows)} 筆設定至 {len(target_dates)} 天"}
+# 電價行事曆批次匯入：一次寫入整季/整年的 daily_pricing_rules 與 weekly_pricing
+# {
+#   "daily": [單日規則或 {"from", "to", "weekdays", "rules"} 區間展開],
+#   "weekly": [{"season", "weekday", "type", "startTime", "endTime", "price"}],
+#   "replaceRange": {"from": "2025-07-01", "to": "2025-09-30"}   # 選填：一併清除此區間內舊的每日設定
+# }
+# 匯入內容中出現的日期與季節，原有設定會在同一個交易內被整批替換。
+@app.post("/api/tariff-calendar/import")
+async def import_tariff_calendar(data: dict = Body(...)):
+    try:
+        daily_rows = tariff_calendar.build_daily_rows(data.get("daily") or [])
+        weekly_rows = tariff_calendar.build_weekly_rows(data.get("weekly") or [])
+        replace_range = data.get("replaceRange")
+        if replace_range:
+            tariff_calendar.expand_dates(replace_range["from"], replace_range["to"])
+    except tariff_calendar.CalendarError as e:
+        raise HTTPException(status_code=400, detail=e.errors)
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    dates = sorted({row[0] for row in daily_rows})
+    seasons = sorted({row[0] for row in weekly_rows})
+
+    # 整批刪除與寫入在同一個交易內完成，其他連線只會看到舊或新的行事曆
+    try:
+        with batch_repository() as batch_repo:
+            await batch_repo.replace_pricing(
+                daily_rows, weekly_rows, dates=dates, seasons=seasons,
+                date_range=(replace_range["from"], replace_range["to"]) if replace_range else None,
+            )
+    except WriteError as e:
+        raise HTTPException(status_code=500, detail=f"匯入失敗，已還原：{e}")
+
+    return {
+        "message": "匯入成功",
+        "dailyRules": len(daily_rows),
+        "dates": len(dates),
+        "weeklyRules": len(weekly_rows),
+        "seasons": seasons,
+    }
 
 
 @app.get("/")
@@ -1726,13 +2351,7 @@ from fastapi import Query
 # 取得
 @app.get("/api/weekly-pricing")
 async def get_weekly_pricing(season: str = Query(...)):
-    cursor.execute('''
-        SELECT id, season, weekday, type, start_time, end_time, price
-        FROM weekly_pricing
-        WHERE season = ?
-        ORDER BY weekday, start_time
-    ''', (season,))
-    rows = cursor.fetchall()
+    rows = await repo.list_weekly_pricing(season)
     return [
         {
             "id": r[0], "season": r[1], "weekday": r[2],
@@ -1740,38 +2359,37 @@ async def get_weekly_pricing(season: str = Query(...)):
         } for r in rows
     ]
 
+async def _check_weekly_overlap(data, exclude_id=None):
+    rows = await repo.weekly_slots(data["season"], data["weekday"])
+    _check_pricing_overlap(
+        rows, f"{data['season']}/{data['weekday']}",
+        data["startTime"], data["endTime"], exclude_id
+    )
+
 # 新增
 @app.post("/api/weekly-pricing")
 async def add_weekly_pricing(data: dict = Body(...)):
-    cursor.execute('''
-        INSERT INTO weekly_pricing (season, weekday, type, start_time, end_time, price)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (
+    await _check_weekly_overlap(data)
+    await repo.add_weekly_pricing(
         data["season"], data["weekday"], data["type"],
         data["startTime"], data["endTime"], float(data["price"])
-    ))
-    conn.commit()
+    )
     return {"message": "新增成功"}
 
 # 更新
 @app.put("/api/weekly-pricing/{id}")
 async def update_weekly_pricing(id: int = Path(...), data: dict = Body(...)):
-    cursor.execute('''
-        UPDATE weekly_pricing
-        SET season = ?, weekday = ?, type = ?, start_time = ?, end_time = ?, price = ?
-        WHERE id = ?
-    ''', (
-        data["season"], data["weekday"], data["type"],
-        data["startTime"], data["endTime"], float(data["price"]), id
-    ))
-    conn.commit()
+    await _check_weekly_overlap(data, exclude_id=id)
+    await repo.update_weekly_pricing(
+        id, data["season"], data["weekday"], data["type"],
+        data["startTime"], data["endTime"], float(data["price"])
+    )
     return {"message": "更新成功"}
 
 # 刪除
 @app.delete("/api/weekly-pricing/{id}")
 async def delete_weekly_pricing(id: int = Path(...)):
-    cursor.execute('DELETE FROM weekly_pricing WHERE id = ?', (id,))
-    conn.commit()
+    await repo.delete_weekly_pricing(id)
     return {"message": "刪除成功"}
 
 
@@ -0,0 +1,72 @@
+# 月報 PDF 產生
+#
+# 由 monthly_usage 預先彙總的資料繪製，不在事件迴圈上執行；
+# 完成的 PDF 依「月份 + 資料版本」存放在 REPORT_DIR，同一版本重複下載直接回傳檔案。
+
+import hashlib
+import os
+from datetime import datetime
+
+REPORT_DIR = os.getenv("REPORT_DIR", "reports")
+
+
+def normalize_month(month):
+    # 2025-7 -> 2025-07，與 monthly_usage.month 的格式一致；格式錯誤時拋出 ValueError
+    return datetime.strptime(month, "%Y-%m").strftime("%Y-%m")
+
+
+def data_version(rows):
+    digest = hashlib.blake2s(digest_size=8)
+    for row in rows:
+        digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+
+def report_path(month, version):
+    return os.path.join(REPORT_DIR, f"monthly_report_{month}_{version}.pdf")
+
+
+def render_pdf(month, rows, path):
+    # rows: [(id_tag, charge_point_id, total_energy_wh, txn_count)]
+    from reportlab.pdfgen import canvas
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    p = canvas.Canvas(tmp_path)
+    p.setTitle(f"Monthly Report - {month}")
+
+    p.drawString(50, 800, f"🔌 Monthly Electricity Report - {month}")
+    p.drawString(50, 780, "----------------------------------------")
+    y = 760
+    for id_tag, cp_id, energy, count in rows:
+        kwh = round((energy or 0) / 1000, 2)
+        p.drawString(50, y, f"ID: {id_tag} | 樁: {cp_id} | 次數: {count} | 用電: {kwh} kWh")
+        y -= 20
+        if y < 50:
+            p.showPage()
+            y = 800
+
+    if not rows:
+        p.drawString(50, 760, "⚠️ 本月無任何有效交易紀錄")
+
+    p.showPage()
+    p.save()
+    os.replace(tmp_path, path)
+
+    # 同月份的舊版本只保留上一版：其他請求可能剛取得上一版的路徑、還在下載
+    directory = os.path.dirname(path) or "."
+    prefix = f"monthly_report_{month}_"
+    keep = os.path.basename(path)
+    older = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(".pdf") and name != keep:
+            try:
+                older.append((os.path.getmtime(os.path.join(directory, name)), name))
+            except OSError:
+                pass
+    for _, name in sorted(older, reverse=True)[1:]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+    return path
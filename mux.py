@@ -0,0 +1,150 @@
+# 場域集中器（central_system.py）與主程式之間的多工連線
+#
+# 集中器在場域端終止所有充電樁的 WebSocket，只用一條連線 ws://<主程式>:9000/concentrator/<場域>
+# 連到主程式。連線上每則訊息都是一個 JSON 陣列：
+#
+#   集中器 -> 主程式
+#   ["connect", cp_id]              充電樁連上集中器
+#   ["connect", cp_id, true]        上行連線重連後，對仍連在集中器上的充電樁重送（既有連線，不受連線速率限制）
+#   ["disconnect", cp_id]           充電樁離線
+#   ["frame", cp_id, raw]           原始 OCPP-J frame，主程式照常處理並回覆
+#   ["batch", [[cp_id, raw], ...]]  集中器已在本地回覆過的 frame（MeterValues、BootNotification），
+#                                   主程式照常處理但不再回覆
+#   主程式 -> 集中器
+#   ["frame", cp_id, raw]           回覆或主程式發出的 Call（RemoteStart、SetChargingProfile...）
+#   ["close", cp_id]                主程式拒絕這個充電樁（例如連線速率限制），集中器應關閉它的連線
+#
+# 主程式端每個經由集中器的充電樁是一個 VirtualConnection，提供 ChargePoint 需要的 recv()/send()，
+# 因此 handler、BacklogBuffer、connected_charge_points 與直接連線的充電樁完全相同。
+# CONCENTRATOR_TOKEN 設定時，集中器須在握手時帶 X-Concentrator-Token 標頭。
+
+import asyncio
+import logging
+import os
+
+from ocpp.messages import MessageType
+from websockets.exceptions import ConnectionClosed, ConnectionClosedOK
+
+from codec import dumps, loads, JSONDecodeError
+
+CONCENTRATOR_TOKEN = os.getenv("CONCENTRATOR_TOKEN", "")
+PATH_PREFIX = "/concentrator/"
+TOKEN_HEADER = "X-Concentrator-Token"
+
+CONNECT, DISCONNECT, FRAME, BATCH, CLOSE = "connect", "disconnect", "frame", "batch", "close"
+
+# 回覆類 frame 的開頭（"[3," / "[4,"），判斷是否要比對 _answered 時不必先解析整個 frame
+_RESPONSE_TYPES = (str(int(MessageType.CallResult)), str(int(MessageType.CallError)))
+
+
+def unique_id(raw):
+    # OCPP-J frame 的 uniqueId；格式錯誤時回傳 None，交給 ChargePoint 回報
+    try:
+        msg = loads(raw)
+        return msg[1]
+    except (JSONDecodeError, TypeError, IndexError, KeyError):
+        return None
+
+
+class VirtualConnection:
+    # 經由集中器轉送的充電樁連線
+    __slots__ = ("cp_id", "site", "uplink", "remote_address", "_inbox", "_answered")
+
+    def __init__(self, cp_id, uplink, site=None):
+        self.cp_id = cp_id
+        self.site = site
+        self.uplink = uplink
+        self.remote_address = uplink.remote_address
+        self._inbox = asyncio.Queue()
+        self._answered = set()     # 集中器已回覆的 Call，主程式的回覆不再轉送
+
+    def feed(self, raw, answered=False):
+        if answered:
+            uid = unique_id(raw)
+            if uid is not None:
+                self._answered.add(uid)
+        self._inbox.put_nowait(raw)
+
+    def close(self):
+        self._inbox.put_nowait(None)
+
+    async def recv(self):
+        raw = await self._inbox.get()
+        if raw is None:
+            raise ConnectionClosedOK(None, None)
+        return raw
+
+    async def send(self, raw):
+        if self._answered and raw[1:2] in _RESPONSE_TYPES:
+            uid = unique_id(raw)
+            if uid in self._answered:
+                self._answered.discard(uid)
+                return
+        await self.uplink.send(dumps([FRAME, self.cp_id, raw]))
+
+
+def accept_token(request_headers):
+    return not CONCENTRATOR_TOKEN or request_headers.get(TOKEN_HEADER) == CONCENTRATOR_TOKEN
+
+
+async def serve_uplink(websocket, site, serve_charge_point, admit=None):
+    # serve_charge_point(cp_id, connection)：與直接連線相同的充電樁處理流程
+    # admit(cp_id) -> bool：新連上集中器的充電樁的准入檢查（例如連線速率限制），拒絕時通知集中器關閉它。
+    # 上行重連後重送的既有連線不檢查：短暫斷線就把大半個場域的充電樁踢掉，反而造成重連風暴
+    links = {}   # cp_id -> (VirtualConnection, task)
+
+    def disconnect(cp_id):
+        link = links.pop(cp_id, None)
+        if link is not None:
+            link[0].close()
+
+    async def run(cp_id, connection):
+        try:
+            await serve_charge_point(cp_id, connection)
+        except ConnectionClosed:
+            pass
+        except Exception:
+            logging.exception(f"⚠️ 集中器 {site} 的充電樁 {cp_id} 處理失敗")
+        finally:
+            if links.get(cp_id, (None,))[0] is connection:
+                del links[cp_id]
+
+    logging.info(f"🛰️ 集中器已連線：{site}")
+    try:
+        async for message in websocket:
+            try:
+                msg = loads(message)
+                kind = msg[0]
+            except (JSONDecodeError, TypeError, IndexError, KeyError):
+                logging.warning(f"⚠️ 集中器 {site} 送來無法解析的訊息：{message[:200]!r}")
+                continue
+            if kind == BATCH:
+                for cp_id, raw in msg[1]:
+                    link = links.get(cp_id)
+                    if link is not None:
+                        link[0].feed(raw, answered=True)
+            elif kind == FRAME:
+                link = links.get(msg[1])
+                if link is not None:
+                    link[0].feed(msg[2])
+            elif kind == CONNECT:
+                cp_id = msg[1]
+                resumed = len(msg) > 2 and msg[2] is True
+                disconnect(cp_id)
+                if admit is not None and not resumed and not admit(cp_id):
+                    await websocket.send(dumps([CLOSE, cp_id]))
+                    continue
+                connection = VirtualConnection(cp_id, websocket, site)
+                links[cp_id] = (connection, asyncio.ensure_future(run(cp_id, connection)))
+            elif kind == DISCONNECT:
+                disconnect(msg[1])
+    except ConnectionClosed:
+        pass
+    finally:
+        # 上行連線中斷：所有經由它的充電樁都視為離線，等集中器重連後再重送 connect
+        tasks = [task for _, task in links.values()]
+        for cp_id in list(links):
+            disconnect(cp_id)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        logging.info(f"🛰️ 集中器已離線：{site}")
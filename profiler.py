@@ -0,0 +1,210 @@
+# 線上取樣 profiler 與事件迴圈延遲監測
+#
+# 主程式有兩個事件迴圈（uvicorn 的 API 迴圈、OCPP 執行緒的迴圈）與數個背景執行緒，
+# 一般工具看不到各自在忙什麼。Profiler.run() 在獨立執行緒執行 N 秒：
+# - 每 interval 以 sys._current_frames() 取樣所有執行緒的 Python 呼叫堆疊（不需重新啟動、不改程式碼）
+# - 在每個事件迴圈上跑一個 ticker 量測排程延遲（loop lag）
+# - ticker 超過 slow_ms 沒有前進時，表示該迴圈被某個 callback 卡住，當下擷取迴圈執行緒的堆疊，
+#   迴圈恢復後記下卡住的時間（slow callbacks）
+# 結果可輸出為摘要 JSON、collapsed stacks（flamegraph.pl / speedscope 可讀）或 speedscope JSON。
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# 葉節點是這些函式的堆疊視為閒置（等待 I/O 或佇列），預設不列入
+IDLE_FRAMES = {
+    ("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"), ("queues.py", "get"),
+    ("threading.py", "_wait_for_tstate_lock"), ("connection.py", "_poll"), ("connection.py", "wait"),
+    ("thread.py", "_worker"), ("handlers.py", "dequeue"),
+    ("main.py", "weekly_notify_task"),   # 每分鐘檢查一次的通知執行緒，其餘時間在 time.sleep
+}
+
+MAX_SECONDS = 120
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def frame_stack(frame):
+    # 由外而內的 (函式, 檔名, 行號)
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def format_stack(stack):
+    return [f"{name} ({file}:{line})" for name, file, line in stack]
+
+
+class LoopWatch:
+    def __init__(self, name, loop, interval):
+        self.name = name
+        self.loop = loop
+        self.interval = interval
+        self.thread_id = None
+        self.last_tick = time.monotonic()
+        self.lags = []
+        self.stalls = []
+        self.stall = None        # 進行中的卡住紀錄
+        self.active = True
+
+    async def tick(self):
+        self.thread_id = threading.get_ident()
+        while self.active:
+            self.last_tick = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(time.monotonic() - self.last_tick - self.interval, 0))
+
+    def summary(self):
+        lags = [lag * 1000 for lag in self.lags]
+        return {
+            "loop": self.name,
+            "ticks": len(lags),
+            "lagP50Ms": round(percentile(lags, 0.5), 2),
+            "lagP99Ms": round(percentile(lags, 0.99), 2),
+            "lagMaxMs": round(max(lags, default=0), 2),
+            "slowCallbacks": len(self.stalls),
+        }
+
+
+class Profiler:
+    def __init__(self, loops, interval=0.005, slow_ms=100, include_idle=False):
+        self.loops = loops                  # 名稱 -> 事件迴圈
+        self.interval = interval
+        self.slow = slow_ms / 1000
+        self.include_idle = include_idle
+        self.stacks = Counter()             # (執行緒名稱, stack) -> 取樣次數
+        self.samples = 0
+        self.duration = 0.0
+
+    def _thread_names(self, watches):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for watch in watches:
+            if watch.thread_id is not None:
+                names[watch.thread_id] = f"loop:{watch.name}"
+        return names
+
+    def _check_stalls(self, watches, frames, now):
+        for watch in watches:
+            behind = now - watch.last_tick - watch.interval
+            if watch.stall is None and behind > self.slow and watch.thread_id in frames:
+                watch.stall = {"startedAt": watch.last_tick + watch.interval,
+                               "stack": format_stack(frame_stack(frames[watch.thread_id]))}
+            elif watch.stall is not None and behind <= self.slow:
+                stall, watch.stall = watch.stall, None
+                stall["durationMs"] = round((watch.last_tick - stall.pop("startedAt")) * 1000, 1)
+                watch.stalls.append(stall)
+
+    def run(self, seconds):
+        # 阻塞 seconds 秒；請在事件迴圈以外的執行緒呼叫（例如 asyncio.to_thread）
+        watches = [LoopWatch(name, loop, self.interval) for name, loop in self.loops.items() if loop.is_running()]
+        futures = [asyncio.run_coroutine_threadsafe(w.tick(), w.loop) for w in watches]
+        # 等 ticker 開始執行，才知道各事件迴圈所在的執行緒（迴圈已卡住時最多等 1 秒）
+        waited = time.monotonic()
+        while any(w.thread_id is None for w in watches) and time.monotonic() - waited < 1:
+            time.sleep(0.001)
+        me = threading.get_ident()
+        started = time.monotonic()
+        deadline = started + seconds
+        names = {}
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if self.samples % 200 == 0:
+                    names = self._thread_names(watches)
+                frames = sys._current_frames()
+                for thread_id, frame in frames.items():
+                    if thread_id == me:
+                        continue
+                    stack = frame_stack(frame)
+                    if not self.include_idle and stack and (stack[-1][1], stack[-1][0]) in IDLE_FRAMES:
+                        continue
+                    self.stacks[(names.get(thread_id, str(thread_id)), stack)] += 1
+                self._check_stalls(watches, frames, now)
+                self.samples += 1
+                del frames
+                time.sleep(max(self.interval - (time.monotonic() - now), 0))
+        finally:
+            for watch in watches:
+                watch.active = False
+            for future in futures:
+                try:
+                    future.result(timeout=1)
+                except Exception:
+                    future.cancel()
+        self.duration = time.monotonic() - started
+        for watch in watches:
+            if watch.stall is not None:
+                stall, watch.stall = watch.stall, None
+                stall["durationMs"] = round((time.monotonic() - stall.pop("startedAt")) * 1000, 1)
+                stall["unfinished"] = True
+                watch.stalls.append(stall)
+        self.watches = watches
+        return self
+
+    # === 輸出 ===
+
+    def summary(self, top=20):
+        per_thread = Counter()
+        leaf = Counter()
+        for (thread, stack), count in self.stacks.items():
+            per_thread[thread] += count
+            if stack:
+                leaf[(thread, format_stack(stack[-1:])[0])] += count
+        interval_ms = self.interval * 1000
+        return {
+            "durationS": round(self.duration, 2),
+            "intervalMs": interval_ms,
+            "samples": self.samples,
+            "threads": [{"thread": t, "samples": n, "approxMs": round(n * interval_ms)} for t, n in per_thread.most_common()],
+            "topFunctions": [{"thread": t, "function": f, "samples": n} for (t, f), n in leaf.most_common(top)],
+            "loops": [w.summary() for w in self.watches],
+            "slowCallbacks": [{"loop": w.name, **stall} for w in self.watches for stall in w.stalls],
+        }
+
+    def collapsed(self):
+        lines = []
+        for (thread, stack), count in self.stacks.most_common():
+            lines.append(";".join([thread] + format_stack(stack)) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self):
+        frames, index = [], {}
+        profiles = {}
+        interval_ms = self.interval * 1000
+        for (thread, stack), count in self.stacks.items():
+            ids = []
+            for name, file, line in stack:
+                key = (name, file, line)
+                if key not in index:
+                    index[key] = len(frames)
+                    frames.append({"name": name, "file": file, "line": line})
+                ids.append(index[key])
+            profile = profiles.setdefault(thread, {"samples": [], "weights": []})
+            profile["samples"].append(ids)
+            profile["weights"].append(count * interval_ms)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled", "name": thread, "unit": "milliseconds",
+                "startValue": 0, "endValue": sum(p["weights"]),
+                "samples": p["samples"], "weights": p["weights"],
+            } for thread, p in profiles.items()],
+            "name": "ocpp-csms profile",
+            "exporter": "profiler.py",
+        }
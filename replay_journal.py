@@ -0,0 +1,162 @@
+# OCPP journal 重播工具：把 frame_journal 記錄的充電樁訊息重新送進執行中的中央系統
+#
+#   python replay_journal.py journal/ [--url ws://localhost:9000] [--speed 1|10|max] [--max-gap 5]
+#
+# - 每個充電樁各開一條 WebSocket，依原始時間間隔（除以 speed）送出當初收到的 Call；
+#   speed=max 時不等待，只在收到上一個 Call 的回覆後送下一個
+# - 中央系統主動送出的 Call（如 SetChargingProfile）以當初充電樁的回覆內容依序回應
+# - StartTransaction 取得的新 transactionId 會替換後續 MeterValues / StopTransaction 裡的舊 ID
+# - 兩筆紀錄間隔超過 --max-gap 秒（例如伺服器重新啟動前後）時以 max-gap 計算
+
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+
+import websockets
+
+from frame_journal import IN, OUT, read_journal
+
+CALL, CALL_RESULT, CALL_ERROR = 2, 3, 4
+
+
+def load(path, max_gap):
+    # 回傳 cp_id -> {"calls": [(offset 秒, frame)], "responses": action -> deque(payload), "tx_ids": unique_id -> 舊 transactionId}
+    sessions = defaultdict(lambda: {"calls": [], "responses": defaultdict(deque), "tx_ids": {}})
+    server_calls = {}          # (cp_id, unique_id) -> action
+    start_calls = {}           # (cp_id, unique_id)：充電樁送出的 StartTransaction
+    clock, last_ts = 0.0, None
+    for ts, direction, cp_id, frame in read_journal(path):
+        if last_ts is not None:
+            clock += min(max((ts - last_ts) / 1e9, 0), max_gap)
+        last_ts = ts
+        if direction not in (IN, OUT) or not frame:
+            continue
+        try:
+            msg = json.loads(frame)
+        except ValueError:
+            continue
+        session = sessions[cp_id]
+        key = (cp_id, msg[1])
+        if direction == IN and msg[0] == CALL:
+            session["calls"].append((clock, msg))
+            if msg[2] == "StartTransaction":
+                start_calls[key] = True
+        elif direction == IN and key in server_calls:
+            session["responses"][server_calls.pop(key)].append(msg)
+        elif direction == OUT and msg[0] == CALL:
+            server_calls[key] = msg[2]
+        elif direction == OUT and msg[0] == CALL_RESULT and key in start_calls:
+            del start_calls[key]
+            session["tx_ids"][msg[1]] = msg[2].get("transactionId")
+    return sessions
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+class Replayer:
+    def __init__(self, url, speed, timeout):
+        self.url = url.rstrip("/")
+        self.speed = speed
+        self.timeout = timeout
+        self.sent = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latencies = []
+
+    async def run_session(self, cp_id, session, started):
+        calls, responses, tx_ids = session["calls"], session["responses"], session["tx_ids"]
+        if not calls:
+            return
+        tx_map = {}
+        pending = {}
+        async with websockets.connect(f"{self.url}/{cp_id}", subprotocols=["ocpp1.6"]) as ws:
+            async def reader():
+                async for raw in ws:
+                    msg = json.loads(raw)
+                    if msg[0] == CALL:
+                        queued = responses.get(msg[2])
+                        if queued:
+                            reply = queued.popleft()
+                            reply[1] = msg[1]
+                        else:
+                            reply = [CALL_ERROR, msg[1], "NotSupported", "replay 沒有此 action 的紀錄", {}]
+                        await ws.send(json.dumps(reply))
+                    elif msg[1] in pending:
+                        pending.pop(msg[1]).set_result(msg)
+
+            reader_task = asyncio.ensure_future(reader())
+            try:
+                for offset, msg in calls:
+                    if self.speed:
+                        delay = started + offset / self.speed - time.monotonic()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    payload = msg[3]
+                    if isinstance(payload, dict) and payload.get("transactionId") in tx_map:
+                        payload = dict(payload, transactionId=tx_map[payload["transactionId"]])
+                    future = asyncio.get_running_loop().create_future()
+                    pending[msg[1]] = future
+                    t0 = time.perf_counter()
+                    await ws.send(json.dumps([CALL, msg[1], msg[2], payload]))
+                    self.sent += 1
+                    try:
+                        reply = await asyncio.wait_for(future, self.timeout)
+                    except asyncio.TimeoutError:
+                        pending.pop(msg[1], None)
+                        self.timeouts += 1
+                        continue
+                    self.latencies.append((time.perf_counter() - t0) * 1000)
+                    if reply[0] == CALL_ERROR:
+                        self.errors += 1
+                    elif msg[2] == "StartTransaction" and msg[1] in tx_ids:
+                        tx_map[tx_ids[msg[1]]] = reply[2].get("transactionId")
+            finally:
+                reader_task.cancel()
+
+    async def run(self, sessions):
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *(self.run_session(cp_id, s, started) for cp_id, s in sessions.items()),
+            return_exceptions=True
+        )
+        for cp_id, result in zip(sessions, results):
+            if isinstance(result, Exception):
+                print(f"⚠️ {cp_id} 重播失敗：{result!r}")
+        return time.monotonic() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="重播 OCPP journal")
+    parser.add_argument("journal", help="journal 目錄或單一 .bin 檔")
+    parser.add_argument("--url", default="ws://localhost:9000")
+    parser.add_argument("--speed", default="1", help="倍速，例如 1、10；max 表示不等待")
+    parser.add_argument("--max-gap", type=float, default=5.0, help="兩筆紀錄間隔上限（秒）")
+    parser.add_argument("--timeout", type=float, default=30.0, help="等待回覆的秒數")
+    parser.add_argument("--only", help="只重播指定充電樁（逗號分隔）")
+    args = parser.parse_args(argv)
+
+    sessions = load(args.journal, args.max_gap)
+    if args.only:
+        wanted = set(args.only.split(","))
+        sessions = {cp: s for cp, s in sessions.items() if cp in wanted}
+    total = sum(len(s["calls"]) for s in sessions.values())
+    speed = 0 if args.speed == "max" else float(args.speed)
+    print(f"▶️ 重播 {len(sessions)} 個充電樁、{total} 個 Call（speed={args.speed}）")
+
+    replayer = Replayer(args.url, speed, args.timeout)
+    elapsed = asyncio.run(replayer.run(sessions))
+    print(f"sent={replayer.sent} errors={replayer.errors} timeouts={replayer.timeouts} elapsed={elapsed:.2f} s"
+          f" rate={replayer.sent / max(elapsed, 1e-9):,.0f} calls/s")
+    print(f"latency p50={percentile(replayer.latencies, 0.5):.2f} ms"
+          f" p99={percentile(replayer.latencies, 0.99):.2f} ms max={max(replayer.latencies, default=0):.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# 統計 / 匯出用的唯讀快照副本（READ_REPLICA）
+#
+# /api/summary*、費用統計、月報、CSV 匯出這類大量讀取原本與 OCPP 寫入共用同一條連線與同一個檔案。
+# READ_REPLICA=1 時，以 sqlite 線上備份 API（storage.backup）定期把主資料庫（與 DB_SHARDS 的各分片）
+# 複製成 REPLICA_DIR 下的快照，統計路由改查快照，OCPP handler 與其他 API 繼續獨占主資料庫：
+# - 每 REPLICA_REFRESH 秒（預設 30）在背景執行緒重建一次快照；每次寫到新的一代（generation）目錄，
+#   完成後才切換，查詢中的舊連線不受影響
+# - REPLICA_MAX_STALENESS 秒（預設 120）是資料延遲上限：快照比這個舊（例如背景更新失敗或太慢）時，
+#   請求會先等一次更新完成再查詢
+# - 快照不會再被寫入，以 immutable 唯讀方式開啟，查詢不需要任何鎖；查詢在讀取執行緒上執行，
+#   不占用 API 事件迴圈
+# - 分片的快照 ATTACH 主資料庫的快照，與 sharding.py 相同，電價等共用資料表可直接查詢
+# - 路由透過 ReplicaRepository 查詢快照：方法與 repository 的統計 / 匯出查詢相同（見 sharding.FleetQueries）
+# 各檔案依序複製，跨分片不保證是同一個時間點。
+
+import asyncio
+import contextvars
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+import tracing
+from repository import SQLiteRepository
+from sharding import FleetQueries, run_sync
+
+READ_REPLICA = os.getenv("READ_REPLICA", "0").lower() in ("1", "true", "yes")
+REPLICA_DIR = os.getenv("REPLICA_DIR", "replica")
+REPLICA_REFRESH = float(os.getenv("REPLICA_REFRESH", "30"))
+REPLICA_MAX_STALENESS = float(os.getenv("REPLICA_MAX_STALENESS", "120"))
+
+
+def _uri(path, **options):
+    query = "&".join(f"{k}={v}" for k, v in options.items())
+    return f"file:{os.path.abspath(path)}?{query}"
+
+
+class ReadReplica:
+    def __init__(self, sources, replica_dir=REPLICA_DIR, refresh_interval=REPLICA_REFRESH,
+                 max_staleness=REPLICA_MAX_STALENESS, on_refresh=None, clock=time.time):
+        self.sources = list(sources)          # [主資料庫, 分片...]
+        self.on_refresh = on_refresh          # 每次切換到新快照後呼叫（例如讓回應快取失效）
+        self.replica_dir = replica_dir
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.clock = clock
+        self.generation = 0
+        self.files = []                       # 目前這一代的快照檔，順序同 sources
+        self.snapshot_at = None               # 快照開始複製的時間（資料至少新到這個時間）
+        self.refreshes = 0
+        self.failures = 0
+        self.last_duration_ms = None
+        self.pool = ThreadPoolExecutor(max_workers=len(self.sources), thread_name_prefix="replica-read")
+        self._lock = asyncio.Lock()
+        self._local = threading.local()
+        # 先前執行留下的快照不再使用
+        shutil.rmtree(replica_dir, ignore_errors=True)
+
+    # === 快照 ===
+
+    def _snapshot(self, generation):
+        directory = os.path.join(self.replica_dir, str(generation))
+        files = []
+        for i, source in enumerate(self.sources):
+            dest = os.path.join(directory, f"{i}-{os.path.basename(source)}")
+            storage.backup(source, dest)
+            files.append(dest)
+        return files
+
+    def staleness(self):
+        return None if self.snapshot_at is None else self.clock() - self.snapshot_at
+
+    async def refresh(self):
+        # 同時只會有一個更新；等待中的請求共用同一次結果
+        generation = self.generation
+        async with self._lock:
+            if self.generation != generation and self.staleness() < self.max_staleness:
+                return
+            started = self.clock()
+            t0 = time.perf_counter()
+            try:
+                files = await asyncio.to_thread(self._snapshot, self.generation + 1)
+            except (sqlite3.Error, OSError):
+                self.failures += 1
+                raise
+            # 先換檔案再換代號：讀取執行緒看到新代號時一定拿到新檔案
+            self.files = files
+            self.generation += 1
+            self.snapshot_at = started
+            self.refreshes += 1
+            self.last_duration_ms = round((time.perf_counter() - t0) * 1000, 2)
+            # 保留上一代給剛開始的查詢，刪除再上一代；已開啟的舊連線在該執行緒下次查詢時關閉
+            shutil.rmtree(os.path.join(self.replica_dir, str(self.generation - 2)), ignore_errors=True)
+            if self.on_refresh is not None:
+                self.on_refresh()
+
+    async def ensure_fresh(self):
+        staleness = self.staleness()
+        if staleness is None or staleness > self.max_staleness:
+            await self.refresh()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except (sqlite3.Error, OSError) as e:
+                logging.warning(f"⚠️ 唯讀副本更新失敗：{e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    # === 查詢 ===
+
+    def reader(self, index):
+        # 目前執行緒、目前這一代第 index 個快照的連線
+        readers = getattr(self._local, "readers", None)
+        if readers is None or self._local.generation != self.generation:
+            for conn in (readers or {}).values():
+                conn.close()
+            readers = self._local.readers = {}
+            self._local.generation = self.generation
+        conn = readers.get(index)
+        if conn is None:
+            conn = sqlite3.connect(_uri(self.files[index], mode="ro", immutable=1), uri=True,
+                                   check_same_thread=False, factory=tracing.TracedConnection)
+            if index > 0:
+                conn.execute("ATTACH DATABASE ? AS shared", (_uri(self.files[0], mode="ro", immutable=1),))
+            readers[index] = conn
+        return conn
+
+    async def map(self, fn, main_only=False):
+        # fn(快照連線) 在各快照上平行執行；main_only 時只查主資料庫的快照
+        await self.ensure_fresh()
+        loop = asyncio.get_running_loop()
+        indexes = [0] if main_only else range(len(self.files))
+        return await asyncio.gather(*(
+            loop.run_in_executor(self.pool, contextvars.copy_context().run, lambda i=i: fn(self.reader(i)))
+            for i in indexes
+        ))
+
+
+    def info(self):
+        staleness = self.staleness()
+        return {
+            "generation": self.generation,
+            "files": self.files,
+            "snapshotAt": self.snapshot_at,
+            "stalenessS": round(staleness, 1) if staleness is not None else None,
+            "refreshIntervalS": self.refresh_interval,
+            "maxStalenessS": self.max_staleness,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "lastRefreshMs": self.last_duration_ms,
+        }
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        shutil.rmtree(self.replica_dir, ignore_errors=True)
+
+
+class ReplicaRepository(FleetQueries):
+    # 統計 / 匯出路由使用的唯讀 repository：FleetQueries 的查詢在各快照上執行
+
+    def __init__(self, replica):
+        self.replica = replica
+
+    async def _each(self, method, *args, charge_point_id=None):
+        return await self.replica.map(lambda db: run_sync(getattr(SQLiteRepository(db), method)(*args)))
+
+    async def _main(self, method, *args):
+        results = await self.replica.map(lambda db: run_sync(getattr(SQLiteRepository(db), method)(*args)), main_only=True)
+        return results[0]
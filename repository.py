@@ -0,0 +1,674 @@
+# 資料存取層（repository）
+#
+# OCPP handler 與 REST API 透過這裡讀寫 users、transactions、meter_values、id_tags、cards、
+# payments、pending_billing（已結束待扣款的交易）、reservations、status_intervals（充電樁狀態歷史）
+# 與電價資料，以及統計 / 月報 / 匯出查詢，不直接操作 sqlite cursor。
+# 兩種後端介面相同，依 DB_BACKEND 選擇：
+#   sqlite（預設）：沿用主程式的 ocpp_data.db 連線
+#   postgres：asyncpg 連線池（DATABASE_URL），meter_values 以 COPY 批次寫入，見 repository_pg.py
+#
+# 所有方法都是 coroutine；SQLite 後端直接在呼叫端的事件迴圈上執行（與原本的寫法相同）。
+# 回傳值一律是 tuple / list，欄位順序與原本 SELECT 的順序一致。
+
+import base64
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+
+METER_VALUE_COLUMNS = (
+    "transaction_id", "charge_point_id", "connector_id", "timestamp",
+    "value", "measurand", "unit", "context", "format", "phase", "location",
+)
+
+
+# 充電樁狀態歷史：每個連接器一段段的狀態區間（from_ts / to_ts 為 UTC epoch 毫秒，to_ts 為 NULL 表示目前狀態），
+# 重複回報相同狀態時不寫入；取代逐則記錄的 status_logs（既有資料以 compact_status_logs.py 轉換）
+STATUS_INTERVALS_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS status_intervals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        charge_point_id TEXT,
+        connector_id INTEGER,
+        status TEXT,
+        from_ts INTEGER,
+        to_ts INTEGER
+    )
+    ''',
+    # keyset 分頁（全部 / 單一充電樁）
+    "CREATE INDEX IF NOT EXISTS idx_status_intervals_ts ON status_intervals (from_ts, charge_point_id, connector_id)",
+    "CREATE INDEX IF NOT EXISTS idx_status_intervals_cp ON status_intervals (charge_point_id, from_ts, connector_id)",
+    # 每個連接器只有一段目前的區間
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_status_intervals_open ON status_intervals (charge_point_id, connector_id) "
+    "WHERE to_ts IS NULL",
+]
+
+
+class DuplicateError(Exception):
+    pass
+
+
+class WriteError(Exception):
+    # 批次寫入失敗，整批已還原
+    pass
+
+
+def parse_epoch_ms(value):
+    # ISO 8601 時間字串 -> UTC epoch 毫秒（無時區視為 UTC）；格式錯誤時 ValueError
+    dt = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def epoch_ms(timestamp):
+    # StatusNotification 的 timestamp 可省略、格式也不一定正確：無法解析時以收到的時間為準
+    if timestamp:
+        try:
+            return parse_epoch_ms(timestamp)
+        except (AttributeError, ValueError):
+            pass
+    return int(time.time() * 1000)
+
+
+def iso_ms(ms):
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+# 狀態歷史的 keyset 分頁：排序鍵 (from_ts, charge_point_id, connector_id, id) 編成不透明的 cursor 字串
+def encode_cursor(row):
+    key = [row[3], row[0], row[1], row[5]]
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(text):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(text + "=" * (-len(text) % 4)))
+        from_ts, charge_point_id, connector_id, row_id = key
+        return int(from_ts), str(charge_point_id), connector_id, int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError("cursor 格式錯誤")
+
+
+def status_interval_key(row):
+    # list_status_intervals 的排序鍵（跨分片合併用）
+    return row[3], row[0], row[1] if row[1] is not None else -1, row[5]
+
+
+# 統計的期間（依交易開始時間，SQLite strftime 格式；PostgreSQL 後端見 repository_pg.PERIODS）
+PERIODS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+# 可分組統計的交易欄位
+GROUP_FIELDS = ("id_tag", "charge_point_id")
+
+
+def season_and_day_type(dt):
+    season = "summer" if datetime(dt.year, 6, 1) <= dt <= datetime(dt.year, 9, 30) else "non_summer"
+    day_type = "holiday" if dt.weekday() >= 5 else "weekday"
+    return season, day_type
+
+
+def where_clause(column_values, placeholder):
+    # [(欄位條件, 值)] -> (" AND ...", [值])，值為空的條件略過；placeholder(i) 產生第 i 個參數符號
+    sql, params = "", []
+    for condition, value in column_values:
+        if value:
+            params.append(value)
+            sql += " AND " + condition.format(placeholder(len(params)))
+    return sql, params
+
+
+class SQLiteRepository:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def _one(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchone()
+
+    def _all(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchall()
+
+    def _write(self, sql, params=()):
+        cur = self.conn.execute(sql, params)
+        self.conn.commit()
+        return cur
+
+    # === id_tags ===
+
+    async def get_id_tag(self, id_tag):
+        return self._one("SELECT status, valid_until FROM id_tags WHERE id_tag = ?", (id_tag,))
+
+    async def list_id_tags(self):
+        return self._all("SELECT id_tag, status, valid_until FROM id_tags")
+
+    async def add_id_tag(self, id_tag, status, valid_until):
+        try:
+            self._write("INSERT INTO id_tags (id_tag, status, valid_until) VALUES (?, ?, ?)", (id_tag, status, valid_until))
+        except sqlite3.IntegrityError:
+            raise DuplicateError(id_tag)
+
+    async def update_id_tag(self, id_tag, status=None, valid_until=None):
+        self._write('''
+            UPDATE id_tags SET status = COALESCE(?, status), valid_until = COALESCE(?, valid_until)
+            WHERE id_tag = ?
+        ''', (status, valid_until, id_tag))
+
+    async def delete_id_tag(self, id_tag):
+        self._write("DELETE FROM id_tags WHERE id_tag = ?", (id_tag,))
+
+    async def import_id_tags(self, rows):
+        # 批次匯入 [(id_tag, status, valid_until)]，已存在者更新；整批在同一個交易內寫入
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO id_tags (id_tag, status, valid_until) VALUES (?, ?, ?)
+                ON CONFLICT(id_tag) DO UPDATE SET status = excluded.status, valid_until = excluded.valid_until
+            ''', rows)
+
+    # === users ===
+
+    async def list_users(self):
+        return self._all("SELECT id_tag, name, department, card_number FROM users")
+
+    async def get_user(self, id_tag):
+        return self._one("SELECT id_tag, name, department, card_number FROM users WHERE id_tag = ?", (id_tag,))
+
+    async def add_user(self, id_tag, name, department, card_number):
+        try:
+            self._write('''
+                INSERT INTO users (id_tag, name, department, card_number) VALUES (?, ?, ?, ?)
+            ''', (id_tag, name, department, card_number))
+        except sqlite3.IntegrityError:
+            raise DuplicateError(id_tag)
+
+    async def update_user(self, id_tag, fields):
+        # fields: 欄位名稱 -> 新值（呼叫端負責限制可更新的欄位）
+        self._write(
+            f"UPDATE users SET {', '.join(f'{c} = ?' for c in fields)} WHERE id_tag = ?",
+            list(fields.values()) + [id_tag]
+        )
+
+    async def delete_user(self, id_tag):
+        self._write("DELETE FROM users WHERE id_tag = ?", (id_tag,))
+
+    async def find_user_by_card(self, card_number):
+        # card_number 存放 LINE 綁定的 userId
+        row = self._one("SELECT id_tag FROM users WHERE card_number = ?", (card_number,))
+        return row[0] if row else None
+
+    async def user_card_numbers(self, id_tags):
+        if not id_tags:
+            return []
+        return [row[0] for row in self._all(
+            f"SELECT card_number FROM users WHERE id_tag IN ({','.join(['?'] * len(id_tags))})", list(id_tags)
+        ) if row[0]]
+
+    async def import_users(self, rows):
+        # 批次匯入 [(id_tag, name, department, card_number)]，已存在者只更新有值的欄位；整批在同一個交易內寫入
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO users (id_tag, name, department, card_number) VALUES (?, ?, ?, ?)
+                ON CONFLICT(id_tag) DO UPDATE SET
+                    name = COALESCE(excluded.name, users.name),
+                    department = COALESCE(excluded.department, users.department),
+                    card_number = COALESCE(excluded.card_number, users.card_number)
+            ''', rows)
+
+    # === cards / payments ===
+
+    async def get_balance(self, card_id):
+        row = self._one("SELECT balance FROM cards WHERE card_id = ?", (card_id,))
+        return row[0] if row else None
+
+    async def get_balances(self, card_ids):
+        if not card_ids:
+            return {}
+        return dict(self._all(
+            f"SELECT card_id, balance FROM cards WHERE card_id IN ({','.join(['?'] * len(card_ids))})",
+            list(card_ids)
+        ))
+
+    async def list_cards(self):
+        return self._all("SELECT card_id, balance FROM cards")
+
+    async def top_up(self, card_id, amount):
+        # 回傳 (是否新建卡片, 新餘額)；無此卡片時以儲值金額建立
+        created = self._one("SELECT 1 FROM cards WHERE card_id = ?", (card_id,)) is None
+        self.conn.execute('''
+            INSERT INTO cards (card_id, balance) VALUES (?, ?)
+            ON CONFLICT(card_id) DO UPDATE SET balance = balance + excluded.balance
+        ''', (card_id, amount))
+        balance = self._one("SELECT balance FROM cards WHERE card_id = ?", (card_id,))[0]
+        self.conn.commit()
+        return created, balance
+
+    async def add_pending_billing(self, transaction_id, id_tag, meter_stop, timestamp):
+        # 交易結束、尚未扣款的標記（已有標記時不變）
+        self._write('''
+            INSERT INTO pending_billing (transaction_id, id_tag, meter_stop, stop_timestamp) VALUES (?, ?, ?, ?)
+            ON CONFLICT(transaction_id) DO NOTHING
+        ''', (transaction_id, id_tag, meter_stop, timestamp))
+
+    async def list_pending_billing(self):
+        return self._all(
+            "SELECT transaction_id, id_tag, meter_stop, stop_timestamp FROM pending_billing ORDER BY transaction_id"
+        )
+
+    async def charge(self, card_id, amount, transaction_id, timestamp):
+        # 認領交易的待扣款標記後扣款（餘額不低於 0）並寫入扣款紀錄，三者在同一個交易內；
+        # 回傳 (原餘額, 新餘額)，沒有標記（已扣過款）或無此卡片時回傳 None
+        claimed = self.conn.execute("DELETE FROM pending_billing WHERE transaction_id = ?", (transaction_id,)).rowcount
+        row = self._one("SELECT balance FROM cards WHERE card_id = ?", (card_id,)) if claimed else None
+        if not row:
+            self.conn.commit()
+            return None
+        new_balance = max(round(row[0] - amount, 2), 0)
+        self.conn.execute("UPDATE cards SET balance = ? WHERE card_id = ?", (new_balance, card_id))
+        self.conn.execute('''
+            INSERT INTO payments (transaction_id, id_tag, amount, timestamp)
+            VALUES (?, ?, ?, ?)
+        ''', (transaction_id, card_id, amount, timestamp))
+        self.conn.commit()
+        return row[0], new_balance
+
+    async def import_card_topups(self, rows):
+        # 批次儲值 [(card_id, amount)]，無此卡片時以儲值金額建立；整批在同一個交易內寫入
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO cards (card_id, balance) VALUES (?, ?)
+                ON CONFLICT(card_id) DO UPDATE SET balance = cards.balance + excluded.balance
+            ''', rows)
+
+    async def list_payments(self):
+        return self._all("SELECT transaction_id, id_tag, amount, timestamp FROM payments ORDER BY timestamp DESC")
+
+    # === transactions ===
+
+    async def next_transaction_id(self):
+        # 毫秒時間為基礎、嚴格遞增的交易編號，由 id_sequences 配發：同一毫秒開始的交易也不會重複
+        row = self.conn.execute('''
+            UPDATE id_sequences SET value = MAX(value + 1, ?) WHERE name = 'transactions' RETURNING value
+        ''', (int(time.time() * 1000),)).fetchone()
+        self.conn.commit()
+        return row[0]
+
+    async def start_transaction(self, transaction_id, charge_point_id, connector_id, id_tag, meter_start, timestamp):
+        self._write('''
+            INSERT INTO transactions (
+                transaction_id, charge_point_id, connector_id, id_tag,
+                meter_start, start_timestamp, meter_stop, stop_timestamp, reason
+            ) VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, NULL)
+        ''', (transaction_id, charge_point_id, connector_id, id_tag, meter_start, timestamp))
+
+    async def stop_transaction(self, transaction_id, meter_stop, timestamp, reason):
+        # 回傳更新前的 (id_tag, charge_point_id, start_timestamp, meter_start, meter_stop)；
+        # 月報彙總只在交易第一次結束時累加，重送的 StopTransaction 不重複計算
+        prev = self._one('''
+            SELECT id_tag, charge_point_id, start_timestamp, meter_start, meter_stop
+            FROM transactions WHERE transaction_id = ?
+        ''', (transaction_id,))
+        self.conn.execute('''
+            UPDATE transactions SET meter_stop = ?, stop_timestamp = ?, reason = ?
+            WHERE transaction_id = ?
+        ''', (meter_stop, timestamp, reason, transaction_id))
+        if prev and prev[4] is None and prev[2]:
+            self.conn.execute('''
+                INSERT INTO monthly_usage (month, id_tag, charge_point_id, total_energy, txn_count)
+                VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT(month, id_tag, charge_point_id) DO UPDATE SET
+                    total_energy = total_energy + excluded.total_energy,
+                    txn_count = txn_count + 1
+            ''', (prev[2][:7], prev[0], prev[1], meter_stop - (prev[3] or 0)))
+        self.conn.commit()
+        return prev
+
+    async def get_transaction(self, transaction_id):
+        return self._one("SELECT * FROM transactions WHERE transaction_id = ?", (transaction_id,))
+
+    async def list_transactions(self, id_tag=None, charge_point_id=None, start=None, end=None, after=None, limit=None):
+        # 依 transaction_id 排序；after / limit 為匯出用的 keyset 分頁（上一頁最後一筆的 transaction_id）
+        where, params = where_clause([
+            ("id_tag = {}", id_tag), ("charge_point_id = {}", charge_point_id),
+            ("start_timestamp >= {}", start), ("start_timestamp <= {}", end), ("transaction_id > {}", after),
+        ], lambda i: "?")
+        sql = "SELECT * FROM transactions WHERE 1=1" + where + " ORDER BY transaction_id"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._all(sql, params)
+
+    # === 統計（已結束的交易；分片 / 唯讀副本的合併見 sharding.FleetQueries） ===
+
+    async def energy_by_period(self, group_by):
+        # [(期間, 交易數, 總電量 Wh)]，group_by 為 PERIODS 的鍵
+        return self._all(f'''
+            SELECT strftime('{PERIODS[group_by]}', start_timestamp) AS period, COUNT(*), SUM(meter_stop - meter_start)
+            FROM transactions WHERE meter_stop IS NOT NULL
+            GROUP BY period ORDER BY period
+        ''')
+
+    async def energy_by_group(self, group_field, start=None):
+        # [(idTag 或充電樁, 交易數, 總電量 Wh)]；start：只計開始時間不早於 start 的交易
+        if group_field not in GROUP_FIELDS:
+            raise ValueError(f"無法依 {group_field} 分組")
+        where, params = where_clause([("start_timestamp >= {}", start)], lambda i: "?")
+        return self._all(f'''
+            SELECT {group_field}, COUNT(*), SUM(meter_stop - meter_start)
+            FROM transactions WHERE meter_stop IS NOT NULL{where}
+            GROUP BY {group_field}
+        ''', params)
+
+    async def daily_energy_by_charge_point(self, start=None, end=None):
+        # [(日期, 充電樁, 總電量 Wh)]
+        where, params = where_clause([
+            ("start_timestamp >= {}", start), ("start_timestamp <= {}", end),
+        ], lambda i: "?")
+        return self._all(f'''
+            SELECT strftime('%Y-%m-%d', start_timestamp) AS day, charge_point_id, SUM(meter_stop - meter_start)
+            FROM transactions WHERE meter_stop IS NOT NULL{where}
+            GROUP BY day, charge_point_id ORDER BY day
+        ''', params)
+
+    async def live_totals(self, day):
+        # (充電中交易數, 各充電樁最新一筆量測值的總和, day 當天開始的交易總電量 Wh)
+        charging = self._one("SELECT COUNT(*) FROM transactions WHERE meter_stop IS NULL")[0]
+        power = self._one('''
+            SELECT SUM(value) FROM (
+                SELECT MAX(id) AS latest_id FROM meter_values GROUP BY charge_point_id
+            ) AS latest_ids
+            JOIN meter_values ON meter_values.id = latest_ids.latest_id
+        ''')[0]
+        energy = self._one('''
+            SELECT SUM(meter_stop - meter_start) FROM transactions
+            WHERE DATE(start_timestamp) = ? AND meter_stop IS NOT NULL
+        ''', (day,))[0]
+        return charging, power or 0, energy or 0
+
+    async def monthly_usage(self, month):
+        # 月報：[(id_tag, charge_point_id, 總電量 Wh, 交易數)]
+        return self._all('''
+            SELECT id_tag, charge_point_id, total_energy, txn_count
+            FROM monthly_usage WHERE month = ?
+            ORDER BY id_tag, charge_point_id
+        ''', (month,))
+
+    # === meter_values ===
+
+    async def add_meter_values(self, rows):
+        # rows: [(transaction_id, charge_point_id, connector_id, timestamp, value, measurand, unit, context, format,
+        #         phase, location)]
+        self.conn.executemany(
+            f"INSERT INTO meter_values ({', '.join(METER_VALUE_COLUMNS)}) VALUES ({', '.join(['?'] * len(METER_VALUE_COLUMNS))})",
+            rows
+        )
+        self.conn.commit()
+
+    async def list_meter_values(self, transaction_ids):
+        # 回傳 transaction_id -> [(timestamp, value, measurand, unit, context, format)]，一次查詢取回
+        result = {tid: [] for tid in transaction_ids}
+        ids = list(result)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for row in self._all(f'''
+                SELECT transaction_id, timestamp, value, measurand, unit, context, format
+                FROM meter_values WHERE transaction_id IN ({','.join(['?'] * len(chunk))})
+                ORDER BY timestamp ASC
+            ''', chunk):
+                result[row[0]].append(row[1:])
+        return result
+
+    async def meter_value_keys(self, charge_point_id, start, end):
+        # 指定時間範圍內已存在的 (transaction_id, connector_id, timestamp, measurand, phase, location)，供補傳資料去重
+        return set(self._all('''
+            SELECT transaction_id, connector_id, timestamp, measurand, phase, location FROM meter_values
+            WHERE charge_point_id = ? AND timestamp BETWEEN ? AND ?
+        ''', (charge_point_id, start, end)))
+
+    async def latest_meter_value(self, charge_point_id):
+        return self._one('''
+            SELECT connector_id, timestamp, measurand, value, unit
+            FROM meter_values
+            WHERE charge_point_id = ?
+            ORDER BY datetime(timestamp) DESC
+            LIMIT 1
+        ''', (charge_point_id,))
+
+    # === reservations ===
+
+    async def list_active_reservations(self):
+        return self._all("SELECT id, charge_point_id, id_tag, start_time, end_time FROM reservations WHERE status = 'active'")
+
+    async def list_reservations(self):
+        return self._all("SELECT id, charge_point_id, id_tag, start_time, end_time, status FROM reservations")
+
+    async def get_reservation(self, reservation_id):
+        return self._one(
+            "SELECT id, charge_point_id, id_tag, start_time, end_time, status FROM reservations WHERE id = ?",
+            (reservation_id,)
+        )
+
+    async def create_reservation(self, charge_point_id, id_tag, start_time, end_time):
+        cur = self._write('''
+            INSERT INTO reservations (charge_point_id, id_tag, start_time, end_time, status)
+            VALUES (?, ?, ?, ?, 'active')
+        ''', (charge_point_id, id_tag, start_time, end_time))
+        return cur.lastrowid
+
+    async def update_reservation(self, reservation_id, fields):
+        # fields: 欄位名稱 -> 新值（呼叫端負責限制可更新的欄位）
+        self._write(
+            f"UPDATE reservations SET {', '.join(f'{c} = ?' for c in fields)} WHERE id = ?",
+            list(fields.values()) + [reservation_id]
+        )
+
+    async def set_reservation_status(self, reservation_ids, status, only_active=False):
+        sql = "UPDATE reservations SET status = ? WHERE id = ?"
+        if only_active:
+            sql += " AND status = 'active'"
+        self.conn.executemany(sql, [(status, rid) for rid in reservation_ids])
+        self.conn.commit()
+
+    async def delete_reservation(self, reservation_id):
+        self._write("DELETE FROM reservations WHERE id = ?", (reservation_id,))
+
+    # === status_intervals ===
+
+    async def record_status(self, charge_point_id, connector_id, status, timestamp):
+        # 只記錄狀態轉換：與目前（to_ts 為 NULL）的區間相同時不寫入；回傳是否有轉換
+        ts = epoch_ms(timestamp)
+        current = self._one('''
+            SELECT id, status, from_ts FROM status_intervals
+            WHERE charge_point_id = ? AND connector_id = ? AND to_ts IS NULL
+        ''', (charge_point_id, connector_id))
+        if current and current[1] == status:
+            return False
+        if current:
+            # 時間比目前區間還早的（補傳、時鐘不準）接在目前區間之後，區間不會倒退
+            ts = max(ts, current[2])
+            self.conn.execute("UPDATE status_intervals SET to_ts = ? WHERE id = ?", (ts, current[0]))
+        self.conn.execute('''
+            INSERT INTO status_intervals (charge_point_id, connector_id, status, from_ts) VALUES (?, ?, ?, ?)
+        ''', (charge_point_id, connector_id, status, ts))
+        self.conn.commit()
+        return True
+
+    async def list_status_intervals(self, charge_point_id=None, start=None, end=None, limit=100, after=None):
+        # start / end（epoch 毫秒）：與 [start, end] 重疊的區間；after：上一頁最後一筆的排序鍵（decode_cursor）
+        # 回傳 (charge_point_id, connector_id, status, from_ts, to_ts, id)，新到舊
+        where, params = where_clause([
+            ("charge_point_id = {}", charge_point_id), ("(to_ts IS NULL OR to_ts >= {})", start), ("from_ts <= {}", end),
+        ], lambda i: "?")
+        if after is not None:
+            where += " AND (from_ts, charge_point_id, connector_id, id) < (?, ?, ?, ?)"
+            params += list(after)
+        return self._all(
+            "SELECT charge_point_id, connector_id, status, from_ts, to_ts, id FROM status_intervals WHERE 1=1"
+            + where + " ORDER BY from_ts DESC, charge_point_id DESC, connector_id DESC, id DESC LIMIT ?",
+            params + [limit]
+        )
+
+    # === 電價 ===
+
+    async def rule_price(self, season, day_type, hhmm):
+        # pricing_rules：00:00–00:00 表示全天，其餘依時段（可跨午夜）比對
+        try:
+            row = self._one('''
+                SELECT price FROM pricing_rules
+                WHERE season = ? AND day_type = ? AND start_time = '00:00' AND end_time = '00:00'
+                LIMIT 1
+            ''', (season, day_type)) or self._one('''
+                SELECT price FROM pricing_rules
+                WHERE season = ? AND day_type = ? AND (
+                    (start_time <= end_time AND start_time <= ? AND end_time > ?) OR
+                    (start_time > end_time AND (? >= start_time OR ? < end_time))
+                )
+                ORDER BY start_time DESC LIMIT 1
+            ''', (season, day_type, hhmm, hhmm, hhmm, hhmm))
+        except sqlite3.OperationalError:
+            return 0
+        return row[0] if row else 0
+
+    async def list_pricing_rules(self):
+        return self._all('''
+            SELECT season, day_type, start_time, end_time, price
+            FROM pricing_rules ORDER BY season, day_type, start_time
+        ''')
+
+    async def get_base_rate(self):
+        # (基本費, 超量門檻 kWh, 超量加價)；未設定時回傳 None
+        try:
+            return self._one(
+                "SELECT monthly_basic_fee, threshold_kwh, overuse_price_delta FROM base_rates WHERE id = 1"
+            )
+        except sqlite3.OperationalError:
+            return None
+
+    async def add_pricing_rule(self, season, day_type, start_time, end_time, price):
+        self._write('''
+            INSERT INTO pricing_rules (season, day_type, start_time, end_time, price)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (season, day_type, start_time, end_time, price))
+
+    async def delete_pricing_rule(self, season, day_type, start_time, end_time, price):
+        self._write('''
+            DELETE FROM pricing_rules
+            WHERE season = ? AND day_type = ? AND start_time = ? AND end_time = ? AND price = ?
+        ''', (season, day_type, start_time, end_time, price))
+
+    async def current_price(self, dt):
+        # 優先使用每日電價設定，沒有時退回季節/平假日時段電價
+        d, t = dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M")
+        row = self._one('''
+            SELECT price FROM daily_pricing_rules
+            WHERE date = ? AND (
+                (start_time <= end_time AND start_time <= ? AND end_time > ?) OR
+                (start_time >= end_time AND (? >= start_time OR ? < end_time))
+            )
+            ORDER BY start_time DESC LIMIT 1
+        ''', (d, t, t, t, t))
+        if row:
+            return row[0]
+        return await self.rule_price(*season_and_day_type(dt), t)
+
+    async def list_daily_pricing(self, date):
+        return self._all('''
+            SELECT id, date, start_time, end_time, price, label
+            FROM daily_pricing_rules WHERE date = ? ORDER BY start_time ASC
+        ''', (date,))
+
+    async def daily_slots(self, date):
+        return self._all("SELECT id, start_time, end_time FROM daily_pricing_rules WHERE date = ?", (date,))
+
+    async def daily_pricing_slots(self, dates):
+        # 多個日期的 (date, start_time, end_time)，供批次複製前檢查重疊
+        if not dates:
+            return []
+        return self._all(
+            f"SELECT date, start_time, end_time FROM daily_pricing_rules WHERE date IN ({','.join(['?'] * len(dates))})",
+            list(dates)
+        )
+
+    async def add_daily_pricing(self, date, start_time, end_time, price, label):
+        self._write('''
+            INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (date, start_time, end_time, price, label))
+
+    async def update_daily_pricing(self, rule_id, date, start_time, end_time, price, label):
+        self._write('''
+            UPDATE daily_pricing_rules SET date = ?, start_time = ?, end_time = ?, price = ?, label = ?
+            WHERE id = ?
+        ''', (date, start_time, end_time, price, label, rule_id))
+
+    async def delete_daily_pricing(self, rule_id):
+        self._write("DELETE FROM daily_pricing_rules WHERE id = ?", (rule_id,))
+
+    async def list_weekly_pricing(self, season):
+        return self._all('''
+            SELECT id, season, weekday, type, start_time, end_time, price
+            FROM weekly_pricing WHERE season = ? ORDER BY weekday, start_time
+        ''', (season,))
+
+    async def weekly_slots(self, season, weekday):
+        return self._all(
+            "SELECT id, start_time, end_time FROM weekly_pricing WHERE season = ? AND weekday = ?",
+            (season, weekday)
+        )
+
+    async def add_weekly_pricing(self, season, weekday, type_, start_time, end_time, price):
+        self._write('''
+            INSERT INTO weekly_pricing (season, weekday, type, start_time, end_time, price)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (season, weekday, type_, start_time, end_time, price))
+
+    async def update_weekly_pricing(self, rule_id, season, weekday, type_, start_time, end_time, price):
+        self._write('''
+            UPDATE weekly_pricing SET season = ?, weekday = ?, type = ?, start_time = ?, end_time = ?, price = ?
+            WHERE id = ?
+        ''', (season, weekday, type_, start_time, end_time, price, rule_id))
+
+    async def delete_weekly_pricing(self, rule_id):
+        self._write("DELETE FROM weekly_pricing WHERE id = ?", (rule_id,))
+
+    async def replace_pricing(self, daily_rows, weekly_rows=(), dates=(), seasons=(), date_range=None):
+        # 電價整批替換（行事曆匯入、複製每日設定）：清除 date_range（from, to）區間與 dates 的每日設定、
+        # seasons 的每週設定後寫入新規則，全部在同一個交易內完成；失敗時整批還原並拋出 WriteError
+        # daily_rows: [(date, start_time, end_time, price, label)]
+        # weekly_rows: [(season, weekday, type, start_time, end_time, price)]
+        try:
+            with self.conn:
+                if date_range:
+                    self.conn.execute("DELETE FROM daily_pricing_rules WHERE date BETWEEN ? AND ?", tuple(date_range))
+                self.conn.executemany("DELETE FROM daily_pricing_rules WHERE date = ?", [(d,) for d in dates])
+                self.conn.executemany('''
+                    INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', daily_rows)
+                self.conn.executemany("DELETE FROM weekly_pricing WHERE season = ?", [(s,) for s in seasons])
+                self.conn.executemany('''
+                    INSERT INTO weekly_pricing (season, weekday, type, start_time, end_time, price)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', weekly_rows)
+        except sqlite3.Error as e:
+            raise WriteError(str(e))
+
+
+def create_repository(sqlite_conn, backend=DB_BACKEND, dsn=DATABASE_URL):
+    if backend == "sqlite":
+        return SQLiteRepository(sqlite_conn)
+    if backend == "postgres":
+        if not dsn:
+            raise ValueError("DB_BACKEND=postgres 需要設定 DATABASE_URL")
+        # 只有使用 PostgreSQL 時才需要安裝 asyncpg
+        from repository_pg import PostgresRepository
+        return PostgresRepository(dsn)
+    raise ValueError(f"未知的 DB_BACKEND：{backend}（可用：sqlite、postgres）")
@@ -0,0 +1,709 @@
+# PostgreSQL 後端（asyncpg）
+#
+# - 主程式有兩個事件迴圈（FastAPI 與 OCPP 執行緒），asyncpg 連線池不能跨迴圈使用，
+#   因此每個事件迴圈各自建立一個連線池（第一次使用時建立）
+# - meter_values 以 COPY（copy_records_to_table）批次寫入
+# - 時間欄位沿用 SQLite 的 ISO 8601 字串，API 的比較與排序行為與 SQLite 後端一致
+#
+# 環境變數：DATABASE_URL、PG_POOL_MIN（預設 1）、PG_POOL_MAX（預設 10）
+
+import asyncio
+import os
+import threading
+import time
+
+import asyncpg
+
+import tracing
+from repository import (
+    GROUP_FIELDS, METER_VALUE_COLUMNS, DuplicateError, WriteError, epoch_ms, where_clause, season_and_day_type
+)
+
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id_tag TEXT PRIMARY KEY,
+    name TEXT,
+    department TEXT,
+    card_number TEXT
+);
+CREATE TABLE IF NOT EXISTS cards (
+    id BIGSERIAL PRIMARY KEY,
+    card_id TEXT UNIQUE,
+    balance DOUBLE PRECISION DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    transaction_id BIGINT PRIMARY KEY,
+    charge_point_id TEXT,
+    connector_id INTEGER,
+    id_tag TEXT,
+    meter_start BIGINT,
+    start_timestamp TEXT,
+    meter_stop BIGINT,
+    stop_timestamp TEXT,
+    reason TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_start ON transactions (start_timestamp);
+CREATE TABLE IF NOT EXISTS id_sequences (
+    name TEXT PRIMARY KEY,
+    value BIGINT NOT NULL
+);
+INSERT INTO id_sequences (name, value)
+SELECT 'transactions', COALESCE(MAX(transaction_id), 0) FROM transactions
+ON CONFLICT (name) DO NOTHING;
+CREATE TABLE IF NOT EXISTS id_tags (
+    id_tag TEXT PRIMARY KEY,
+    status TEXT,
+    valid_until TEXT
+);
+CREATE TABLE IF NOT EXISTS meter_values (
+    id BIGSERIAL PRIMARY KEY,
+    transaction_id BIGINT,
+    charge_point_id TEXT,
+    connector_id INTEGER,
+    timestamp TEXT,
+    value DOUBLE PRECISION,
+    measurand TEXT,
+    unit TEXT,
+    context TEXT,
+    format TEXT,
+    phase TEXT,
+    location TEXT
+);
+ALTER TABLE meter_values ADD COLUMN IF NOT EXISTS phase TEXT;
+ALTER TABLE meter_values ADD COLUMN IF NOT EXISTS location TEXT;
+CREATE INDEX IF NOT EXISTS idx_meter_values_txn ON meter_values (transaction_id);
+CREATE INDEX IF NOT EXISTS idx_meter_values_cp_ts ON meter_values (charge_point_id, timestamp);
+CREATE TABLE IF NOT EXISTS status_intervals (
+    id BIGSERIAL PRIMARY KEY,
+    charge_point_id TEXT,
+    connector_id INTEGER,
+    status TEXT,
+    from_ts BIGINT,
+    to_ts BIGINT
+);
+CREATE INDEX IF NOT EXISTS idx_status_intervals_ts ON status_intervals (from_ts, charge_point_id, connector_id);
+CREATE INDEX IF NOT EXISTS idx_status_intervals_cp ON status_intervals (charge_point_id, from_ts, connector_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_status_intervals_open ON status_intervals (charge_point_id, connector_id)
+    WHERE to_ts IS NULL;
+CREATE TABLE IF NOT EXISTS payments (
+    id BIGSERIAL PRIMARY KEY,
+    transaction_id BIGINT,
+    id_tag TEXT,
+    amount DOUBLE PRECISION,
+    timestamp TEXT
+);
+CREATE TABLE IF NOT EXISTS pending_billing (
+    transaction_id BIGINT PRIMARY KEY,
+    id_tag TEXT,
+    meter_stop BIGINT,
+    stop_timestamp TEXT
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    id BIGSERIAL PRIMARY KEY,
+    charge_point_id TEXT,
+    id_tag TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS monthly_usage (
+    month TEXT,
+    id_tag TEXT,
+    charge_point_id TEXT,
+    total_energy DOUBLE PRECISION DEFAULT 0,
+    txn_count INTEGER DEFAULT 0,
+    PRIMARY KEY (month, id_tag, charge_point_id)
+);
+CREATE TABLE IF NOT EXISTS pricing_rules (
+    id BIGSERIAL PRIMARY KEY,
+    season TEXT,
+    day_type TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    price DOUBLE PRECISION
+);
+CREATE TABLE IF NOT EXISTS base_rates (
+    id INTEGER PRIMARY KEY,
+    monthly_basic_fee DOUBLE PRECISION,
+    threshold_kwh INTEGER,
+    overuse_price_delta DOUBLE PRECISION
+);
+CREATE TABLE IF NOT EXISTS daily_pricing_rules (
+    id BIGSERIAL PRIMARY KEY,
+    date TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    price DOUBLE PRECISION,
+    label TEXT DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_daily_pricing_date ON daily_pricing_rules (date);
+CREATE TABLE IF NOT EXISTS weekly_pricing (
+    id BIGSERIAL PRIMARY KEY,
+    season TEXT,
+    weekday TEXT,
+    type TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    price DOUBLE PRECISION
+);
+'''
+
+# 交易開始時間（ISO 8601 字串）轉成 UTC 時間；連線的時區設為 UTC，沒有時區的字串視為 UTC，與 SQLite 的 strftime 相同
+START_TS = "(start_timestamp::timestamptz AT TIME ZONE 'UTC')"
+
+# 與 repository.PERIODS 相同的期間格式；week 同 SQLite 的 %W：週一起算，第一個週一之前為第 00 週
+PERIODS = {
+    "day": f"to_char({START_TS}, 'YYYY-MM-DD')",
+    "week": f"to_char({START_TS}, 'YYYY') || '-W' || "
+            f"lpad(((extract(doy FROM {START_TS})::int + 7 - extract(isodow FROM {START_TS})::int) / 7)::text, 2, '0')",
+    "month": f"to_char({START_TS}, 'YYYY-MM')",
+}
+
+
+def _pg(i):
+    return f"${i}"
+
+
+def _tuples(records):
+    return [tuple(r) for r in records]
+
+
+class PostgresRepository:
+    def __init__(self, dsn, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pools = {}          # 事件迴圈 -> 建立連線池的 Task
+        self._lock = threading.Lock()
+
+    async def _pool(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._pools.get(loop)
+            if task is None:
+                # create_pool 回傳的 Pool 是 awaitable 而不是 coroutine，以 ensure_future 包成 Task
+                task = asyncio.ensure_future(asyncpg.create_pool(
+                    self.dsn, min_size=self.min_size, max_size=self.max_size, server_settings={"timezone": "UTC"}
+                ), loop=loop)
+                self._pools[loop] = task
+        return await task
+
+    async def open(self):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            await conn.execute(SCHEMA)
+
+    async def close(self):
+        # 只關閉目前事件迴圈的連線池；其他迴圈的連線池隨執行緒結束
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._pools.pop(loop, None)
+        if task is not None:
+            await (await task).close()
+
+    async def _timed(self, method, sql, params):
+        # 記錄 tracing 子 span；超過 SLOW_QUERY_MS 時另外取得 EXPLAIN 寫入慢查詢紀錄
+        pool = await self._pool()
+        started = time.perf_counter()
+        try:
+            return await getattr(pool, method)(sql, *params)
+        finally:
+            elapsed = time.perf_counter() - started
+            plan = None
+            if elapsed * 1000 >= tracing.SLOW_QUERY_MS:
+                try:
+                    plan = "; ".join(r[0] for r in await pool.fetch("EXPLAIN " + sql, *params))
+                except asyncpg.PostgresError:
+                    plan = ""
+            tracing.query_span("postgresql", sql, elapsed, plan)
+
+    async def _one(self, sql, *params):
+        row = await self._timed("fetchrow", sql, params)
+        return tuple(row) if row is not None else None
+
+    async def _all(self, sql, *params):
+        return _tuples(await self._timed("fetch", sql, params))
+
+    async def _write(self, sql, *params):
+        return await self._timed("execute", sql, params)
+
+    # === id_tags ===
+
+    async def get_id_tag(self, id_tag):
+        return await self._one("SELECT status, valid_until FROM id_tags WHERE id_tag = $1", id_tag)
+
+    async def list_id_tags(self):
+        return await self._all("SELECT id_tag, status, valid_until FROM id_tags")
+
+    async def add_id_tag(self, id_tag, status, valid_until):
+        try:
+            await self._write("INSERT INTO id_tags (id_tag, status, valid_until) VALUES ($1, $2, $3)", id_tag, status, valid_until)
+        except asyncpg.UniqueViolationError:
+            raise DuplicateError(id_tag)
+
+    async def update_id_tag(self, id_tag, status=None, valid_until=None):
+        await self._write('''
+            UPDATE id_tags SET status = COALESCE($1, status), valid_until = COALESCE($2, valid_until)
+            WHERE id_tag = $3
+        ''', status, valid_until, id_tag)
+
+    async def delete_id_tag(self, id_tag):
+        await self._write("DELETE FROM id_tags WHERE id_tag = $1", id_tag)
+
+    async def _batch(self, statements):
+        # statements: [(sql, rows)]，依序 executemany，全部在同一個交易內完成
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                for sql, rows in statements:
+                    if rows:
+                        await conn.executemany(sql, rows)
+
+    async def import_id_tags(self, rows):
+        await self._batch([('''
+            INSERT INTO id_tags (id_tag, status, valid_until) VALUES ($1, $2, $3)
+            ON CONFLICT (id_tag) DO UPDATE SET status = excluded.status, valid_until = excluded.valid_until
+        ''', rows)])
+
+    # === users ===
+
+    async def list_users(self):
+        return await self._all("SELECT id_tag, name, department, card_number FROM users")
+
+    async def get_user(self, id_tag):
+        return await self._one("SELECT id_tag, name, department, card_number FROM users WHERE id_tag = $1", id_tag)
+
+    async def add_user(self, id_tag, name, department, card_number):
+        try:
+            await self._write('''
+                INSERT INTO users (id_tag, name, department, card_number) VALUES ($1, $2, $3, $4)
+            ''', id_tag, name, department, card_number)
+        except asyncpg.UniqueViolationError:
+            raise DuplicateError(id_tag)
+
+    async def update_user(self, id_tag, fields):
+        columns = list(fields)
+        sets = ", ".join(f"{c} = ${i}" for i, c in enumerate(columns, 1))
+        await self._write(
+            f"UPDATE users SET {sets} WHERE id_tag = ${len(columns) + 1}",
+            *fields.values(), id_tag
+        )
+
+    async def delete_user(self, id_tag):
+        await self._write("DELETE FROM users WHERE id_tag = $1", id_tag)
+
+    async def find_user_by_card(self, card_number):
+        row = await self._one("SELECT id_tag FROM users WHERE card_number = $1", card_number)
+        return row[0] if row else None
+
+    async def user_card_numbers(self, id_tags):
+        if not id_tags:
+            return []
+        return [row[0] for row in await self._all(
+            "SELECT card_number FROM users WHERE id_tag = ANY($1::text[])", list(id_tags)
+        ) if row[0]]
+
+    async def import_users(self, rows):
+        await self._batch([('''
+            INSERT INTO users (id_tag, name, department, card_number) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (id_tag) DO UPDATE SET
+                name = COALESCE(excluded.name, users.name),
+                department = COALESCE(excluded.department, users.department),
+                card_number = COALESCE(excluded.card_number, users.card_number)
+        ''', rows)])
+
+    # === cards / payments ===
+
+    async def get_balance(self, card_id):
+        row = await self._one("SELECT balance FROM cards WHERE card_id = $1", card_id)
+        return row[0] if row else None
+
+    async def get_balances(self, card_ids):
+        if not card_ids:
+            return {}
+        return dict(await self._all("SELECT card_id, balance FROM cards WHERE card_id = ANY($1::text[])", list(card_ids)))
+
+    async def list_cards(self):
+        return await self._all("SELECT card_id, balance FROM cards")
+
+    async def top_up(self, card_id, amount):
+        # xmax = 0 表示這一列是 INSERT 新建的
+        row = await self._one('''
+            INSERT INTO cards (card_id, balance) VALUES ($1, $2)
+            ON CONFLICT (card_id) DO UPDATE SET balance = cards.balance + excluded.balance
+            RETURNING (xmax = 0), balance
+        ''', card_id, float(amount))
+        return row[0], row[1]
+
+    async def add_pending_billing(self, transaction_id, id_tag, meter_stop, timestamp):
+        await self._write('''
+            INSERT INTO pending_billing (transaction_id, id_tag, meter_stop, stop_timestamp) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (transaction_id) DO NOTHING
+        ''', transaction_id, id_tag, meter_stop, timestamp)
+
+    async def list_pending_billing(self):
+        return await self._all(
+            "SELECT transaction_id, id_tag, meter_stop, stop_timestamp FROM pending_billing ORDER BY transaction_id"
+        )
+
+    async def charge(self, card_id, amount, transaction_id, timestamp):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                claimed = await conn.fetchval(
+                    "DELETE FROM pending_billing WHERE transaction_id = $1 RETURNING 1", transaction_id
+                )
+                if claimed is None:
+                    return None
+                row = await conn.fetchrow("SELECT balance FROM cards WHERE card_id = $1 FOR UPDATE", card_id)
+                if row is None:
+                    return None
+                new_balance = max(round(row[0] - amount, 2), 0)
+                await conn.execute("UPDATE cards SET balance = $1 WHERE card_id = $2", new_balance, card_id)
+                await conn.execute('''
+                    INSERT INTO payments (transaction_id, id_tag, amount, timestamp)
+                    VALUES ($1, $2, $3, $4)
+                ''', transaction_id, card_id, float(amount), timestamp)
+        return row[0], new_balance
+
+    async def import_card_topups(self, rows):
+        await self._batch([('''
+            INSERT INTO cards (card_id, balance) VALUES ($1, $2)
+            ON CONFLICT (card_id) DO UPDATE SET balance = cards.balance + excluded.balance
+        ''', rows)])
+
+    async def list_payments(self):
+        return await self._all("SELECT transaction_id, id_tag, amount, timestamp FROM payments ORDER BY timestamp DESC")
+
+    # === transactions ===
+
+    async def next_transaction_id(self):
+        return (await self._one('''
+            UPDATE id_sequences SET value = GREATEST(value + 1, $1) WHERE name = 'transactions' RETURNING value
+        ''', int(time.time() * 1000)))[0]
+
+    async def start_transaction(self, transaction_id, charge_point_id, connector_id, id_tag, meter_start, timestamp):
+        await self._write('''
+            INSERT INTO transactions (
+                transaction_id, charge_point_id, connector_id, id_tag,
+                meter_start, start_timestamp, meter_stop, stop_timestamp, reason
+            ) VALUES ($1, $2, $3, $4, $5, $6, NULL, NULL, NULL)
+        ''', transaction_id, charge_point_id, connector_id, id_tag, meter_start, timestamp)
+
+    async def stop_transaction(self, transaction_id, meter_stop, timestamp, reason):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                prev = await conn.fetchrow('''
+                    SELECT id_tag, charge_point_id, start_timestamp, meter_start, meter_stop
+                    FROM transactions WHERE transaction_id = $1 FOR UPDATE
+                ''', transaction_id)
+                await conn.execute('''
+                    UPDATE transactions SET meter_stop = $1, stop_timestamp = $2, reason = $3
+                    WHERE transaction_id = $4
+                ''', meter_stop, timestamp, reason, transaction_id)
+                if prev and prev[4] is None and prev[2]:
+                    await conn.execute('''
+                        INSERT INTO monthly_usage (month, id_tag, charge_point_id, total_energy, txn_count)
+                        VALUES ($1, $2, $3, $4, 1)
+                        ON CONFLICT (month, id_tag, charge_point_id) DO UPDATE SET
+                            total_energy = monthly_usage.total_energy + excluded.total_energy,
+                            txn_count = monthly_usage.txn_count + 1
+                    ''', prev[2][:7], prev[0], prev[1], float(meter_stop - (prev[3] or 0)))
+        return tuple(prev) if prev else None
+
+    async def get_transaction(self, transaction_id):
+        return await self._one("SELECT * FROM transactions WHERE transaction_id = $1", transaction_id)
+
+    async def list_transactions(self, id_tag=None, charge_point_id=None, start=None, end=None, after=None, limit=None):
+        where, params = where_clause([
+            ("id_tag = {}", id_tag), ("charge_point_id = {}", charge_point_id),
+            ("start_timestamp >= {}", start), ("start_timestamp <= {}", end), ("transaction_id > {}", after),
+        ], _pg)
+        sql = "SELECT * FROM transactions WHERE 1=1" + where + " ORDER BY transaction_id"
+        if limit:
+            params.append(limit)
+            sql += f" LIMIT ${len(params)}"
+        return await self._all(sql, *params)
+
+    # === 統計（SUM 的結果轉回整數，與 SQLite 後端相同） ===
+
+    async def energy_by_period(self, group_by):
+        return await self._all(f'''
+            SELECT {PERIODS[group_by]} AS period, COUNT(*), SUM(meter_stop - meter_start)::bigint
+            FROM transactions WHERE meter_stop IS NOT NULL
+            GROUP BY period ORDER BY period
+        ''')
+
+    async def energy_by_group(self, group_field, start=None):
+        if group_field not in GROUP_FIELDS:
+            raise ValueError(f"無法依 {group_field} 分組")
+        where, params = where_clause([("start_timestamp >= {}", start)], _pg)
+        return await self._all(f'''
+            SELECT {group_field}, COUNT(*), SUM(meter_stop - meter_start)::bigint
+            FROM transactions WHERE meter_stop IS NOT NULL{where}
+            GROUP BY {group_field}
+        ''', *params)
+
+    async def daily_energy_by_charge_point(self, start=None, end=None):
+        where, params = where_clause([
+            ("start_timestamp >= {}", start), ("start_timestamp <= {}", end),
+        ], _pg)
+        return await self._all(f'''
+            SELECT {PERIODS["day"]} AS day, charge_point_id, SUM(meter_stop - meter_start)::bigint
+            FROM transactions WHERE meter_stop IS NOT NULL{where}
+            GROUP BY day, charge_point_id ORDER BY day
+        ''', *params)
+
+    async def live_totals(self, day):
+        row = await self._one(f'''
+            SELECT
+                (SELECT COUNT(*) FROM transactions WHERE meter_stop IS NULL),
+                (SELECT SUM(value) FROM (
+                    SELECT DISTINCT ON (charge_point_id) value FROM meter_values ORDER BY charge_point_id, id DESC
+                ) AS latest),
+                (SELECT SUM(meter_stop - meter_start)::bigint FROM transactions
+                 WHERE {PERIODS["day"]} = $1 AND meter_stop IS NOT NULL)
+        ''', day)
+        return row[0], row[1] or 0, row[2] or 0
+
+    async def monthly_usage(self, month):
+        return await self._all('''
+            SELECT id_tag, charge_point_id, total_energy, txn_count
+            FROM monthly_usage WHERE month = $1
+            ORDER BY id_tag, charge_point_id
+        ''', month)
+
+    # === meter_values ===
+
+    async def add_meter_values(self, rows):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            await conn.copy_records_to_table("meter_values", records=rows, columns=METER_VALUE_COLUMNS)
+
+    async def list_meter_values(self, transaction_ids):
+        result = {tid: [] for tid in transaction_ids}
+        for row in await self._all('''
+            SELECT transaction_id, timestamp, value, measurand, unit, context, format
+            FROM meter_values WHERE transaction_id = ANY($1::bigint[])
+            ORDER BY timestamp ASC
+        ''', list(result)):
+            result[row[0]].append(row[1:])
+        return result
+
+    async def meter_value_keys(self, charge_point_id, start, end):
+        return set(await self._all('''
+            SELECT transaction_id, connector_id, timestamp, measurand, phase, location FROM meter_values
+            WHERE charge_point_id = $1 AND timestamp BETWEEN $2 AND $3
+        ''', charge_point_id, start, end))
+
+    async def latest_meter_value(self, charge_point_id):
+        return await self._one('''
+            SELECT connector_id, timestamp, measurand, value, unit
+            FROM meter_values WHERE charge_point_id = $1
+            ORDER BY timestamp DESC LIMIT 1
+        ''', charge_point_id)
+
+    # === reservations ===
+
+    async def list_active_reservations(self):
+        return await self._all("SELECT id, charge_point_id, id_tag, start_time, end_time FROM reservations WHERE status = 'active'")
+
+    async def list_reservations(self):
+        return await self._all("SELECT id, charge_point_id, id_tag, start_time, end_time, status FROM reservations")
+
+    async def get_reservation(self, reservation_id):
+        return await self._one(
+            "SELECT id, charge_point_id, id_tag, start_time, end_time, status FROM reservations WHERE id = $1",
+            reservation_id
+        )
+
+    async def create_reservation(self, charge_point_id, id_tag, start_time, end_time):
+        row = await self._one('''
+            INSERT INTO reservations (charge_point_id, id_tag, start_time, end_time, status)
+            VALUES ($1, $2, $3, $4, 'active') RETURNING id
+        ''', charge_point_id, id_tag, start_time, end_time)
+        return row[0]
+
+    async def update_reservation(self, reservation_id, fields):
+        columns = list(fields)
+        sets = ", ".join(f"{c} = ${i}" for i, c in enumerate(columns, 1))
+        await self._write(
+            f"UPDATE reservations SET {sets} WHERE id = ${len(columns) + 1}",
+            *fields.values(), reservation_id
+        )
+
+    async def set_reservation_status(self, reservation_ids, status, only_active=False):
+        sql = "UPDATE reservations SET status = $1 WHERE id = ANY($2::bigint[])"
+        if only_active:
+            sql += " AND status = 'active'"
+        await self._write(sql, status, list(reservation_ids))
+
+    async def delete_reservation(self, reservation_id):
+        await self._write("DELETE FROM reservations WHERE id = $1", reservation_id)
+
+    # === status_intervals ===
+
+    async def record_status(self, charge_point_id, connector_id, status, timestamp):
+        # 只記錄狀態轉換（與 SQLite 後端相同）；回傳是否有轉換
+        ts = epoch_ms(timestamp)
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                current = await conn.fetchrow('''
+                    SELECT id, status, from_ts FROM status_intervals
+                    WHERE charge_point_id = $1 AND connector_id = $2 AND to_ts IS NULL FOR UPDATE
+                ''', charge_point_id, connector_id)
+                if current is not None and current[1] == status:
+                    return False
+                if current is not None:
+                    ts = max(ts, current[2])
+                    await conn.execute("UPDATE status_intervals SET to_ts = $1 WHERE id = $2", ts, current[0])
+                await conn.execute('''
+                    INSERT INTO status_intervals (charge_point_id, connector_id, status, from_ts) VALUES ($1, $2, $3, $4)
+                ''', charge_point_id, connector_id, status, ts)
+        return True
+
+    async def list_status_intervals(self, charge_point_id=None, start=None, end=None, limit=100, after=None):
+        where, params = where_clause([
+            ("charge_point_id = {}", charge_point_id), ("(to_ts IS NULL OR to_ts >= {})", start), ("from_ts <= {}", end),
+        ], _pg)
+        if after is not None:
+            n = len(params)
+            where += f" AND (from_ts, charge_point_id, connector_id, id) < (${n + 1}, ${n + 2}, ${n + 3}, ${n + 4})"
+            params += list(after)
+        return await self._all(
+            "SELECT charge_point_id, connector_id, status, from_ts, to_ts, id FROM status_intervals WHERE 1=1"
+            + where + f" ORDER BY from_ts DESC, charge_point_id DESC, connector_id DESC, id DESC LIMIT ${len(params) + 1}",
+            *params, limit
+        )
+
+    # === 電價 ===
+
+    async def rule_price(self, season, day_type, hhmm):
+        row = await self._one('''
+            SELECT price FROM pricing_rules
+            WHERE season = $1 AND day_type = $2 AND start_time = '00:00' AND end_time = '00:00'
+            LIMIT 1
+        ''', season, day_type) or await self._one('''
+            SELECT price FROM pricing_rules
+            WHERE season = $1 AND day_type = $2 AND (
+                (start_time <= end_time AND start_time <= $3 AND end_time > $3) OR
+                (start_time > end_time AND ($3 >= start_time OR $3 < end_time))
+            )
+            ORDER BY start_time DESC LIMIT 1
+        ''', season, day_type, hhmm)
+        return row[0] if row else 0
+
+    async def list_pricing_rules(self):
+        return await self._all('''
+            SELECT season, day_type, start_time, end_time, price
+            FROM pricing_rules ORDER BY season, day_type, start_time
+        ''')
+
+    async def get_base_rate(self):
+        return await self._one("SELECT monthly_basic_fee, threshold_kwh, overuse_price_delta FROM base_rates WHERE id = 1")
+
+    async def add_pricing_rule(self, season, day_type, start_time, end_time, price):
+        await self._write('''
+            INSERT INTO pricing_rules (season, day_type, start_time, end_time, price)
+            VALUES ($1, $2, $3, $4, $5)
+        ''', season, day_type, start_time, end_time, price)
+
+    async def delete_pricing_rule(self, season, day_type, start_time, end_time, price):
+        await self._write('''
+            DELETE FROM pricing_rules
+            WHERE season = $1 AND day_type = $2 AND start_time = $3 AND end_time = $4 AND price = $5
+        ''', season, day_type, start_time, end_time, price)
+
+    async def current_price(self, dt):
+        d, t = dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M")
+        row = await self._one('''
+            SELECT price FROM daily_pricing_rules
+            WHERE date = $1 AND (
+                (start_time <= end_time AND start_time <= $2 AND end_time > $2) OR
+                (start_time >= end_time AND ($2 >= start_time OR $2 < end_time))
+            )
+            ORDER BY start_time DESC LIMIT 1
+        ''', d, t)
+        if row:
+            return row[0]
+        return await self.rule_price(*season_and_day_type(dt), t)
+
+    async def list_daily_pricing(self, date):
+        return await self._all('''
+            SELECT id, date, start_time, end_time, price, label
+            FROM daily_pricing_rules WHERE date = $1 ORDER BY start_time ASC
+        ''', date)
+
+    async def daily_slots(self, date):
+        return await self._all("SELECT id, start_time, end_time FROM daily_pricing_rules WHERE date = $1", date)
+
+    async def daily_pricing_slots(self, dates):
+        return await self._all(
+            "SELECT date, start_time, end_time FROM daily_pricing_rules WHERE date = ANY($1::text[])", list(dates)
+        )
+
+    async def add_daily_pricing(self, date, start_time, end_time, price, label):
+        await self._write('''
+            INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
+            VALUES ($1, $2, $3, $4, $5)
+        ''', date, start_time, end_time, price, label)
+
+    async def update_daily_pricing(self, rule_id, date, start_time, end_time, price, label):
+        await self._write('''
+            UPDATE daily_pricing_rules SET date = $1, start_time = $2, end_time = $3, price = $4, label = $5
+            WHERE id = $6
+        ''', date, start_time, end_time, price, label, rule_id)
+
+    async def delete_daily_pricing(self, rule_id):
+        await self._write("DELETE FROM daily_pricing_rules WHERE id = $1", rule_id)
+
+    async def list_weekly_pricing(self, season):
+        return await self._all('''
+            SELECT id, season, weekday, type, start_time, end_time, price
+            FROM weekly_pricing WHERE season = $1 ORDER BY weekday, start_time
+        ''', season)
+
+    async def weekly_slots(self, season, weekday):
+        return await self._all(
+            "SELECT id, start_time, end_time FROM weekly_pricing WHERE season = $1 AND weekday = $2",
+            season, str(weekday)
+        )
+
+    async def add_weekly_pricing(self, season, weekday, type_, start_time, end_time, price):
+        await self._write('''
+            INSERT INTO weekly_pricing (season, weekday, type, start_time, end_time, price)
+            VALUES ($1, $2, $3, $4, $5, $6)
+        ''', season, str(weekday), type_, start_time, end_time, price)
+
+    async def update_weekly_pricing(self, rule_id, season, weekday, type_, start_time, end_time, price):
+        await self._write('''
+            UPDATE weekly_pricing SET season = $1, weekday = $2, type = $3, start_time = $4, end_time = $5, price = $6
+            WHERE id = $7
+        ''', season, str(weekday), type_, start_time, end_time, price, rule_id)
+
+    async def delete_weekly_pricing(self, rule_id):
+        await self._write("DELETE FROM weekly_pricing WHERE id = $1", rule_id)
+
+    async def replace_pricing(self, daily_rows, weekly_rows=(), dates=(), seasons=(), date_range=None):
+        # 與 SQLite 後端相同：清除與寫入在同一個交易內完成，失敗時拋出 WriteError
+        try:
+            await self._batch([
+                ("DELETE FROM daily_pricing_rules WHERE date BETWEEN $1 AND $2", [tuple(date_range)] if date_range else []),
+                ("DELETE FROM daily_pricing_rules WHERE date = $1", [(d,) for d in dates]),
+                ('''
+                    INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
+                    VALUES ($1, $2, $3, $4, $5)
+                ''', daily_rows),
+                ("DELETE FROM weekly_pricing WHERE season = $1", [(s,) for s in seasons]),
+                ('''
+                    INSERT INTO weekly_pricing (season, weekday, type, start_time, end_time, price)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                ''', [(s, str(w), *rest) for s, w, *rest in weekly_rows]),
+            ])
+        except (asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            raise WriteError(str(e))
@@ -0,0 +1,127 @@
+# 預約區間索引
+#
+# 每個充電樁維護一份依開始時間排序、互不重疊的 active 預約清單：
+# - find_active：bisect 查詢某時間點的有效預約，O(log n)
+# - add：插入前檢查前後相鄰預約，重疊即拒絕
+# - 以 heap 依結束時間排序，供計時器取出已過期的預約
+#
+# OCPP 執行緒與 FastAPI 事件迴圈都會存取，因此以 lock 保護。
+
+import bisect
+import heapq
+import threading
+from datetime import datetime, timezone
+
+
+def to_epoch(value):
+    # 無時區的時間字串視為 UTC（與 datetime.utcnow().isoformat() 一致）
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class ReservationConflict(Exception):
+    def __init__(self, reservation_id):
+        super().__init__(f"與預約 {reservation_id} 時段重疊")
+        self.reservation_id = reservation_id
+
+
+class ReservationIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._starts = {}    # cp_id -> [start, ...]（排序）
+        self._entries = {}   # cp_id -> [(start, end, id, id_tag), ...]，與 _starts 對齊
+        self._by_id = {}     # id -> (cp_id, start, end, id_tag)
+        self._heap = []      # (end, id)，已移除的項目在取出時略過
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def _conflict(self, cp_id, start, end, ignore_id=None):
+        starts = self._starts.get(cp_id)
+        if not starts:
+            return None
+        entries = self._entries[cp_id]
+        # 第一個開始時間 >= end 的位置；只有它前面的預約可能重疊
+        i = bisect.bisect_left(starts, end)
+        while i > 0:
+            i -= 1
+            s, e, res_id, _ = entries[i]
+            if res_id == ignore_id:
+                continue
+            return res_id if e > start else None
+        return None
+
+    def check_conflict(self, cp_id, start, end, ignore_id=None):
+        with self._lock:
+            return self._conflict(cp_id, start, end, ignore_id)
+
+    def add(self, res_id, cp_id, id_tag, start, end):
+        # 已在索引中的預約改為新的時段；重疊時拋出 ReservationConflict，原本的時段保留不變
+        with self._lock:
+            other = self._conflict(cp_id, start, end, ignore_id=res_id)
+            if other is not None:
+                raise ReservationConflict(other)
+            self._remove(res_id)
+            starts = self._starts.setdefault(cp_id, [])
+            entries = self._entries.setdefault(cp_id, [])
+            i = bisect.bisect_right(starts, start)
+            starts.insert(i, start)
+            entries.insert(i, (start, end, res_id, id_tag))
+            self._by_id[res_id] = (cp_id, start, end, id_tag)
+            heapq.heappush(self._heap, (end, res_id))
+
+    def _remove(self, res_id):
+        item = self._by_id.pop(res_id, None)
+        if item is None:
+            return False
+        cp_id, start, end, id_tag = item
+        starts = self._starts[cp_id]
+        entries = self._entries[cp_id]
+        i = bisect.bisect_left(starts, start)
+        while entries[i][2] != res_id:
+            i += 1
+        del starts[i]
+        del entries[i]
+        if not starts:
+            del self._starts[cp_id]
+            del self._entries[cp_id]
+        return True
+
+    def remove(self, res_id):
+        with self._lock:
+            return self._remove(res_id)
+
+    def find_active(self, cp_id, at):
+        # 回傳 (id, id_tag)；start <= at <= end
+        with self._lock:
+            starts = self._starts.get(cp_id)
+            if not starts:
+                return None
+            i = bisect.bisect_right(starts, at) - 1
+            if i < 0:
+                return None
+            _, end, res_id, id_tag = self._entries[cp_id][i]
+            return (res_id, id_tag) if end >= at else None
+
+    def next_expiry(self):
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][1] not in self._by_id:
+                heapq.heappop(heap)
+            return heap[0][0] if heap else None
+
+    def pop_expired(self, now):
+        # 取出 end < now 的預約並自索引移除，回傳 id 清單
+        expired = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] < now:
+                end, res_id = heapq.heappop(heap)
+                item = self._by_id.get(res_id)
+                if item is None or item[2] != end:
+                    continue
+                self._remove(res_id)
+                expired.append(res_id)
+        return expired
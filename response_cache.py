@@ -0,0 +1,82 @@
+# 讀多寫少 API 的回應快取（ETag / If-None-Match）
+#
+# - TableVersions：每張資料表一個版本號，寫入端點與 OCPP handler 寫入後遞增
+# - ETag 由「路由 + 查詢字串 + 相依資料表版本」組成，版本沒變就能直接回 304，
+#   不必查詢 SQLite
+# - ResponseCache：以位元組為上限的 LRU，保存已序列化的回應內容
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class TableVersions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        # 重新啟動後舊的 ETag 一律失效（例如 holidays/*.json 更新後重新部署）
+        self._epoch = format(int(time.time()), "x")
+
+    def bump(self, *tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def snapshot(self, tables):
+        with self._lock:
+            return tuple(self._versions.get(t, 0) for t in tables)
+
+    def etag(self, key, tables):
+        versions = self.snapshot(tables)
+        digest = hashlib.blake2s(key.encode(), digest_size=6).hexdigest()
+        return versions, f'"{self._epoch}-{digest}-{".".join(map(str, versions))}"'
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match 是以逗號分隔的 ETag 清單，或 *；GET 用弱比較（忽略 W/ 前綴）
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class ResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()   # key -> (versions, etag, body, media_type)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, versions):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != versions:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, versions, etag, body, media_type):
+        cost = len(body) + len(key)
+        if cost > self.max_bytes // 4:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[2]) + len(key)
+        self._entries[key] = (versions, etag, body, media_type)
+        self.size += cost
+        while self.size > self.max_bytes:
+            old_key, old = self._entries.popitem(last=False)
+            self.size -= len(old[2]) + len(old_key)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "maxBytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
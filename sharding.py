@@ -0,0 +1,462 @@
+# 依場域（site）分片的 SQLite 儲存
+#
+# 整個車隊寫同一個 ocpp_data.db 時，SQLite 的單一寫入鎖讓所有充電樁的寫入排隊。
+# 設定 DB_SHARDS 後，transactions、meter_values、status_intervals、monthly_usage 依充電樁 ID
+# 寫到各場域自己的資料庫檔（SHARD_DIR/<場域>.db）：
+#   DB_SHARDS="taipei=TPE-*,TPE2-*;kaohsiung=KHH-*"   （fnmatch 樣式，依場域順序比對）
+# 沒有對應到任何場域的充電樁（以及啟用分片前的既有資料）留在主資料庫，分片名稱 "default"；
+# 卡片、idTag、扣款、預約、電價等共用資料一律在主資料庫。
+#
+# - 每個分片有自己的寫入連線與寫入執行緒，不同場域的 commit（含 fsync）可以同時進行；
+#   寫入執行緒忙碌時排隊的寫入（最多 SHARD_WRITE_BATCH 筆）合併成一次 commit（group commit），
+#   其中任一筆失敗時整批 rollback 後逐筆重做，結果與逐筆 commit 相同
+# - ShardedRepository 與 SQLiteRepository 介面相同，供 OCPP handler 使用：依 charge_point_id 路由，
+#   只有 transaction_id 時先查本程序記下的對應，沒有記錄才平行查詢所有分片
+# - 全車隊的統計 / 匯出查詢（FleetQueries）以各分片的唯讀連線平行執行 SQLiteRepository 的方法後合併；
+#   分片的唯讀連線 ATTACH 主資料庫，電價等共用資料表可在同一個查詢中直接使用
+
+import asyncio
+import contextvars
+import fnmatch
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import storage
+import tracing
+from repository import STATUS_INTERVALS_SCHEMA, SQLiteRepository, status_interval_key
+
+DB_SHARDS = os.getenv("DB_SHARDS", "")
+SHARD_DIR = os.getenv("SHARD_DIR", "shards")
+SHARD_WRITE_BATCH = int(os.getenv("SHARD_WRITE_BATCH", "200"))
+
+DEFAULT = "default"
+
+# 分片資料庫的資料表（與主資料庫的同名資料表相同）
+SHARD_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS transactions (
+        transaction_id INTEGER PRIMARY KEY,
+        charge_point_id TEXT,
+        connector_id INTEGER,
+        id_tag TEXT,
+        meter_start INTEGER,
+        start_timestamp TEXT,
+        meter_stop INTEGER,
+        stop_timestamp TEXT,
+        reason TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS meter_values (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        transaction_id INTEGER,
+        charge_point_id TEXT,
+        connector_id INTEGER,
+        timestamp TEXT,
+        value REAL,
+        measurand TEXT,
+        unit TEXT,
+        context TEXT,
+        format TEXT,
+        phase TEXT,
+        location TEXT
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_meter_values_cp_ts ON meter_values (charge_point_id, timestamp)",
+    *STATUS_INTERVALS_SCHEMA,
+    '''
+    CREATE TABLE IF NOT EXISTS monthly_usage (
+        month TEXT,
+        id_tag TEXT,
+        charge_point_id TEXT,
+        total_energy REAL DEFAULT 0,
+        txn_count INTEGER DEFAULT 0,
+        PRIMARY KEY (month, id_tag, charge_point_id)
+    )
+    ''',
+]
+
+
+def parse_sites(text):
+    # "taipei=TPE-*,TPE2-*;kaohsiung=KHH-*" -> [("taipei", ["TPE-*", "TPE2-*"]), ("kaohsiung", ["KHH-*"])]
+    sites = []
+    for item in text.split(";"):
+        name, _, patterns = item.partition("=")
+        name = name.strip()
+        if not name:
+            continue
+        if name == DEFAULT or not name.replace("-", "").replace("_", "").isalnum():
+            raise ValueError(f"DB_SHARDS 場域名稱不合法：{name}")
+        sites.append((name, [p.strip() for p in patterns.split(",") if p.strip()]))
+    return sites
+
+
+def run_sync(coro):
+    # SQLiteRepository 的方法內沒有真正的 await，在執行緒中直接跑完即可，不需要事件迴圈
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("repository 方法不應暫停")
+
+
+async def _in_thread(executor, fn):
+    # 與 asyncio.to_thread 相同，帶著目前的 contextvars（tracing span）到執行緒
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, ctx.run, fn)
+
+
+def merge_groups(rows, keys=1):
+    # 各分片的 GROUP BY 結果：前 keys 欄相同者，其餘欄位相加（None 視為 0）；
+    # 回傳依鍵排序的 list（與 SQLite 相同，NULL 排在最前面）
+    merged = {}
+    for row in rows:
+        key = tuple(row[:keys])
+        values = row[keys:]
+        if key in merged:
+            merged[key] = [(a or 0) + (b or 0) if a is not None or b is not None else None
+                           for a, b in zip(merged[key], values)]
+        else:
+            merged[key] = list(values)
+    return [key + tuple(values) for key, values in sorted(merged.items(), key=lambda kv: [(k is not None, k) for k in kv[0]])]
+
+
+class FleetQueries:
+    # 全車隊的統計 / 匯出查詢：在主資料庫與各分片（或它們的唯讀快照）上分別執行 SQLiteRepository 的同名方法，
+    # 再合併成與單一資料庫相同的結果。子類別提供：
+    #   _each(method, *args, charge_point_id=None)：各資料庫的結果 list（有 charge_point_id 時可只查相關的分片）
+    #   _main(method, *args)：主資料庫的結果（使用者、預約、電價等共用資料表）
+
+    async def list_transactions(self, id_tag=None, charge_point_id=None, start=None, end=None, after=None, limit=None):
+        results = await self._each("list_transactions", id_tag, charge_point_id, start, end, after, limit,
+                                   charge_point_id=charge_point_id)
+        rows = sorted((row for rows in results for row in rows), key=lambda row: row[0])
+        return rows[:limit] if limit else rows
+
+    async def list_meter_values(self, transaction_ids):
+        results = await self._each("list_meter_values", transaction_ids)
+        merged = {tid: [] for tid in transaction_ids}
+        for result in results:
+            for tid, values in result.items():
+                if values:
+                    if merged[tid]:
+                        merged[tid] = sorted(merged[tid] + values, key=lambda mv: mv[0])
+                    else:
+                        merged[tid] = values
+        return merged
+
+    async def energy_by_period(self, group_by):
+        return merge_groups(row for rows in await self._each("energy_by_period", group_by) for row in rows)
+
+    async def energy_by_group(self, group_field, start=None):
+        # 同一個 idTag 可能在多個分片都有交易
+        return merge_groups(row for rows in await self._each("energy_by_group", group_field, start) for row in rows)
+
+    async def daily_energy_by_charge_point(self, start=None, end=None):
+        results = await self._each("daily_energy_by_charge_point", start, end)
+        return merge_groups((row for rows in results for row in rows), keys=2)
+
+    async def live_totals(self, day):
+        # 每個充電樁的資料只在一個分片，各分片的加總可直接相加
+        return tuple(sum(values) for values in zip(*await self._each("live_totals", day)))
+
+    async def monthly_usage(self, month):
+        return merge_groups((row for rows in await self._each("monthly_usage", month) for row in rows), keys=2)
+
+    async def list_users(self):
+        return await self._main("list_users")
+
+    async def list_reservations(self):
+        return await self._main("list_reservations")
+
+    async def list_pricing_rules(self):
+        return await self._main("list_pricing_rules")
+
+    async def get_base_rate(self):
+        return await self._main("get_base_rate")
+
+
+class BatchConnection(tracing.TracedConnection):
+    # group commit 期間 repository 方法內的 commit() 延到整批結束才執行
+    batching = False
+
+    def commit(self):
+        if not self.batching:
+            super().commit()
+
+
+class Shard:
+    def __init__(self, name, db_file, pool, main_file=None, batch=SHARD_WRITE_BATCH):
+        self.name = name
+        self.db_file = db_file
+        self.main_file = main_file      # 非 None 時唯讀連線 ATTACH 主資料庫
+        self.pool = pool                # 所有分片共用的讀取執行緒
+        self.batch = max(batch, 1)
+        self.conn = storage.apply_profile(
+            sqlite3.connect(db_file, check_same_thread=False, factory=BatchConnection),
+            background_checkpoint=True
+        )
+        if main_file is not None:
+            for statement in SHARD_SCHEMA:
+                self.conn.execute(statement)
+            # 舊版建立的分片沒有 phase / location 欄位
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(meter_values)")}
+            for column in ("phase", "location"):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE meter_values ADD COLUMN {column} TEXT")
+            self.conn.commit()
+        self.repo = SQLiteRepository(self.conn)
+        # 主資料庫由主程式的 checkpointer 負責
+        self.checkpointer = storage.Checkpointer(db_file) if main_file is not None else None
+        self._local = threading.local()
+        self._readers = []
+        self.commits = 0
+        self.writes = 0
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop, name=f"shard-{name}", daemon=True)
+        self._writer.start()
+
+    def reader(self):
+        # 目前執行緒的唯讀連線（讀取執行緒各自一條）
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{os.path.abspath(self.db_file)}?mode=ro", uri=True,
+                                   check_same_thread=False, factory=tracing.TracedConnection)
+            if self.main_file is not None:
+                conn.execute("ATTACH DATABASE ? AS shared", (f"file:{os.path.abspath(self.main_file)}?mode=ro",))
+            self._local.conn = conn
+            self._readers.append(conn)
+        return conn
+
+    async def write(self, method, *args):
+        # 在本分片的寫入執行緒上執行 SQLiteRepository 的方法，commit 之後才回傳
+        future = Future()
+        self._queue.put((contextvars.copy_context(), method, args, future))
+        return await asyncio.wrap_future(future)
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)   # 做完這一批再結束
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+
+    def _apply(self, item):
+        ctx, method, args, _ = item
+        return ctx.run(lambda: run_sync(getattr(self.repo, method)(*args)))
+
+    def _write_batch(self, batch):
+        if len(batch) > 1:
+            self.conn.batching = True
+            try:
+                results = [self._apply(item) for item in batch]
+                self.conn.batching = False
+                self.conn.commit()
+            except Exception:
+                self.conn.batching = False
+                self.conn.rollback()
+            else:
+                self.commits += 1
+                self.writes += len(batch)
+                for item, result in zip(batch, results):
+                    item[3].set_result(result)
+                return
+        # 單筆，或整批失敗後逐筆重做（各自 commit，錯誤只回給該筆）
+        for item in batch:
+            try:
+                result = self._apply(item)
+            except Exception as e:
+                self.conn.rollback()
+                item[3].set_exception(e)
+            else:
+                item[3].set_result(result)
+            self.commits += 1
+            self.writes += 1
+
+    async def read(self, method, *args):
+        return await _in_thread(self.pool, lambda: run_sync(getattr(SQLiteRepository(self.reader()), method)(*args)))
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self.conn.close()
+        for conn in self._readers:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass    # 其他執行緒建立的連線，程序結束時一併釋放
+
+
+class ShardSet:
+    def __init__(self, main_file, sites, shard_dir=SHARD_DIR):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=len(sites) + 1, thread_name_prefix="shard-read")
+        self.default = Shard(DEFAULT, main_file, self.pool)
+        self.shards = {DEFAULT: self.default}
+        for name, _ in sites:
+            self.shards[name] = Shard(name, os.path.join(shard_dir, f"{name}.db"), self.pool, main_file)
+        self.rules = [(self.shards[name], pattern) for name, patterns in sites for pattern in patterns]
+        self._routes = {}
+
+    def route(self, charge_point_id):
+        shard = self._routes.get(charge_point_id)
+        if shard is None:
+            shard = next((s for s, pattern in self.rules if fnmatch.fnmatchcase(charge_point_id, pattern)), self.default)
+            self._routes[charge_point_id] = shard
+        return shard
+
+    def candidates(self, charge_point_id):
+        # 可能有此充電樁資料的分片：對應的場域，以及存放啟用分片前資料的主資料庫
+        shard = self.route(charge_point_id)
+        return [shard] if shard is self.default else [shard, self.default]
+
+    async def gather(self, fn, shards=None):
+        # fn(Shard) -> coroutine；在各分片平行執行，回傳依分片順序的結果
+        return await asyncio.gather(*(fn(s) for s in (shards or self.shards.values())))
+
+    def files(self):
+        return [s.db_file for s in self.shards.values()]
+
+    def info(self):
+        return [{
+            "name": s.name,
+            "file": s.db_file,
+            "dbBytes": os.path.getsize(s.db_file) if os.path.exists(s.db_file) else 0,
+            "walBytes": storage.wal_size(s.db_file),
+            "patterns": [p for shard, p in self.rules if shard is s],
+            "writes": s.writes,
+            "commits": s.commits,
+            "checkpointRuns": s.checkpointer.runs if s.checkpointer else None,
+        } for s in self.shards.values()]
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self.pool.shutdown(wait=False)
+
+
+class ShardedRepository(FleetQueries):
+    # 與 SQLiteRepository 介面相同；分片資料表依充電樁路由，其餘方法交給主資料庫的 repository
+
+    def __init__(self, main, shards):
+        self.main = main
+        self.shards = shards
+        self._transactions = {}     # transaction_id -> Shard（本程序開始、尚未結束的交易）
+
+    def __getattr__(self, name):
+        return getattr(self.main, name)
+
+    async def open(self):
+        await self.main.open()
+
+    async def close(self):
+        await self.main.close()
+        self.shards.close()
+
+    async def _each(self, method, *args, charge_point_id=None):
+        shards = self.shards.candidates(charge_point_id) if charge_point_id else None
+        return await self.shards.gather(lambda s: s.read(method, *args), shards)
+
+    async def _main(self, method, *args):
+        return await getattr(self.main, method)(*args)
+
+    async def locate(self, transaction_id):
+        # 交易所在的分片；找不到時回傳 None
+        shard = self._transactions.get(transaction_id)
+        if shard is not None:
+            return shard
+        rows = await self.shards.gather(lambda s: s.read("get_transaction", transaction_id))
+        return next((s for s, row in zip(self.shards.shards.values(), rows) if row), None)
+
+    # === transactions ===
+
+    async def next_transaction_id(self):
+        # 交易編號一律由主資料庫配發，再依充電樁路由到分片
+        return await self.main.next_transaction_id()
+
+    async def start_transaction(self, transaction_id, charge_point_id, connector_id, id_tag, meter_start, timestamp):
+        shard = self.shards.route(charge_point_id)
+        await shard.write("start_transaction", transaction_id, charge_point_id, connector_id, id_tag, meter_start, timestamp)
+        self._transactions[transaction_id] = shard
+
+    async def stop_transaction(self, transaction_id, meter_stop, timestamp, reason):
+        shard = await self.locate(transaction_id) or self.shards.default
+        prev = await shard.write("stop_transaction", transaction_id, meter_stop, timestamp, reason)
+        self._transactions.pop(transaction_id, None)
+        return prev
+
+    async def get_transaction(self, transaction_id):
+        shard = self._transactions.get(transaction_id)
+        if shard is not None:
+            return await shard.read("get_transaction", transaction_id)
+        rows = await self.shards.gather(lambda s: s.read("get_transaction", transaction_id))
+        return next((row for row in rows if row), None)
+
+    # === meter_values ===
+
+    async def add_meter_values(self, rows):
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(self.shards.route(row[1]), []).append(row)
+        await asyncio.gather(*(shard.write("add_meter_values", part) for shard, part in by_shard.items()))
+
+    async def meter_value_keys(self, charge_point_id, start, end):
+        # 補傳資料只會寫進目前對應的分片，去重也只需查該分片
+        return await self.shards.route(charge_point_id).read("meter_value_keys", charge_point_id, start, end)
+
+    async def latest_meter_value(self, charge_point_id):
+        for shard in self.shards.candidates(charge_point_id):
+            row = await shard.read("latest_meter_value", charge_point_id)
+            if row:
+                return row
+        return None
+
+    # === status_intervals ===
+
+    async def record_status(self, charge_point_id, connector_id, status, timestamp):
+        return await self.shards.route(charge_point_id).write(
+            "record_status", charge_point_id, connector_id, status, timestamp
+        )
+
+    async def list_status_intervals(self, charge_point_id=None, start=None, end=None, limit=100, after=None):
+        # 各分片各取 limit 筆，依相同的排序鍵合併（排序鍵含 charge_point_id，跨分片也不會重複或遺漏）
+        shards = self.shards.candidates(charge_point_id) if charge_point_id else None
+        results = await self.shards.gather(
+            lambda s: s.read("list_status_intervals", charge_point_id, start, end, limit, after), shards
+        )
+        rows = sorted((row for rows in results for row in rows), key=status_interval_key, reverse=True)
+        return rows[:limit]
+
+
+def file_router(sites=DB_SHARDS, shard_dir=SHARD_DIR):
+    # 離線工具用：不開啟分片，只依 DB_SHARDS 決定充電樁資料所在的分片檔（比對規則與 ShardSet.route 相同）；
+    # 沒有對應的場域時回傳 None（主資料庫）
+    rules = [(os.path.join(shard_dir, f"{name}.db"), pattern) for name, patterns in parse_sites(sites) for pattern in patterns]
+    return lambda charge_point_id: next(
+        (f for f, pattern in rules if fnmatch.fnmatchcase(charge_point_id, pattern)), None
+    )
+
+
+def create_sharded_repository(main_repo, main_file, sites=DB_SHARDS, shard_dir=SHARD_DIR):
+    # 沒有設定 DB_SHARDS 時回傳 (原 repository, None)
+    parsed = parse_sites(sites) if sites else []
+    if not parsed:
+        return main_repo, None
+    if not isinstance(main_repo, SQLiteRepository):
+        raise ValueError("DB_SHARDS 只支援 DB_BACKEND=sqlite")
+    shards = ShardSet(main_file, parsed, shard_dir)
+    return ShardedRepository(main_repo, shards), shards
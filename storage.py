@@ -0,0 +1,215 @@
+# SQLite 儲存設定（storage profile）、checkpoint 與線上備份
+#
+# - SQLITE_PROFILE 選擇一組 pragma：journal_mode、synchronous、cache_size、mmap_size，
+#   個別項目可再用 SQLITE_JOURNAL_MODE / SQLITE_SYNCHRONOUS / SQLITE_CACHE_MB / SQLITE_MMAP_MB 覆寫
+# - WAL 模式下讀取不會被 OCPP 寫入擋住；WAL 檔由背景 checkpointer 定期寫回主檔，
+#   寫入端不必自己做 auto-checkpoint
+# - 線上備份使用 sqlite backup API，在 WAL 下只持有讀取交易，不會卡住寫入
+#
+# 命令列：
+#   python storage.py info [db]
+#   python storage.py checkpoint [db] [--mode PASSIVE|FULL|RESTART|TRUNCATE]
+#   python storage.py backup [db] [--dest 路徑]
+
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+CHECKPOINT_INTERVAL = float(os.getenv("SQLITE_CHECKPOINT_INTERVAL", "30"))
+WAL_TRUNCATE_MB = float(os.getenv("SQLITE_WAL_TRUNCATE_MB", "64"))
+
+PROFILES = {
+    # 原本的行為：rollback journal、synchronous FULL、預設快取
+    "legacy": {"journal_mode": "DELETE", "synchronous": "FULL", "cache_mb": 2, "mmap_mb": 0},
+    # 斷電也不遺失已 commit 的交易
+    "durable": {"journal_mode": "WAL", "synchronous": "FULL", "cache_mb": 32, "mmap_mb": 128},
+    # 預設：WAL + NORMAL，斷電最多遺失最後幾筆 commit，但資料庫不會損壞
+    "balanced": {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_mb": 64, "mmap_mb": 256},
+    # 大量匯入/壓測用
+    "fast": {"journal_mode": "WAL", "synchronous": "OFF", "cache_mb": 128, "mmap_mb": 1024},
+}
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_LEVELS = {"OFF", "NORMAL", "FULL", "EXTRA"}
+CHECKPOINT_MODES = {"PASSIVE", "FULL", "RESTART", "TRUNCATE"}
+
+
+def load_profile(name=None):
+    name = name or os.getenv("SQLITE_PROFILE", "balanced")
+    if name not in PROFILES:
+        raise ValueError(f"未知的 SQLITE_PROFILE：{name}（可用：{', '.join(PROFILES)}）")
+    profile = dict(PROFILES[name], name=name)
+    if os.getenv("SQLITE_JOURNAL_MODE"):
+        profile["journal_mode"] = os.getenv("SQLITE_JOURNAL_MODE").upper()
+    if os.getenv("SQLITE_SYNCHRONOUS"):
+        profile["synchronous"] = os.getenv("SQLITE_SYNCHRONOUS").upper()
+    if os.getenv("SQLITE_CACHE_MB"):
+        profile["cache_mb"] = float(os.getenv("SQLITE_CACHE_MB"))
+    if os.getenv("SQLITE_MMAP_MB"):
+        profile["mmap_mb"] = float(os.getenv("SQLITE_MMAP_MB"))
+    if profile["journal_mode"] not in JOURNAL_MODES:
+        raise ValueError(f"journal_mode 不合法：{profile['journal_mode']}")
+    if profile["synchronous"] not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"synchronous 不合法：{profile['synchronous']}")
+    return profile
+
+
+PROFILE = load_profile()
+
+
+def apply_profile(conn, profile=PROFILE, background_checkpoint=False):
+    cur = conn.cursor()
+    # journal_mode 會寫入資料庫檔，其餘 pragma 只對這條連線有效
+    cur.execute(f"PRAGMA journal_mode={profile['journal_mode']}")
+    cur.execute(f"PRAGMA synchronous={profile['synchronous']}")
+    cur.execute(f"PRAGMA cache_size={-int(profile['cache_mb'] * 1024)}")
+    cur.execute(f"PRAGMA mmap_size={int(profile['mmap_mb'] * 1024 * 1024)}")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    if background_checkpoint and profile["journal_mode"] == "WAL":
+        # 交給 checkpointer；保留較大的門檻當作它沒在跑時的保險
+        cur.execute("PRAGMA wal_autocheckpoint=20000")
+    cur.close()
+    return conn
+
+
+def connect(db_file, profile=PROFILE, **kwargs):
+    return apply_profile(sqlite3.connect(db_file, **kwargs), profile)
+
+
+def wal_size(db_file):
+    try:
+        return os.path.getsize(f"{db_file}-wal")
+    except OSError:
+        return 0
+
+
+def checkpoint(conn, mode="PASSIVE"):
+    # 回傳 (busy, WAL 頁數, 已寫回頁數)；非 WAL 模式時為 (0, -1, -1)
+    mode = mode.upper()
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f"checkpoint 模式不合法：{mode}")
+    return tuple(conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+
+
+class Checkpointer:
+    # 以獨立連線定期 PASSIVE checkpoint；WAL 超過門檻且已全部寫回時再 TRUNCATE 縮檔
+
+    def __init__(self, db_file, interval=CHECKPOINT_INTERVAL, truncate_mb=WAL_TRUNCATE_MB):
+        self.db_file = db_file
+        self.interval = interval
+        self.truncate_bytes = int(truncate_mb * 1024 * 1024)
+        self.runs = 0
+        self.last = None
+        self._conn = None
+
+    def run_once(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_file, timeout=1, check_same_thread=False)
+        started = time.perf_counter()
+        busy, log, done = checkpoint(self._conn, "PASSIVE")
+        mode = "PASSIVE"
+        if not busy and log == done and log > 0 and wal_size(self.db_file) > self.truncate_bytes:
+            # 所有頁面都已寫回，TRUNCATE 只需短暫取得寫鎖
+            try:
+                busy, log, done = checkpoint(self._conn, "TRUNCATE")
+                mode = "TRUNCATE"
+            except sqlite3.OperationalError as e:
+                logging.warning(f"⚠️ WAL TRUNCATE 失敗：{e}")
+        self.runs += 1
+        self.last = {
+            "mode": mode, "busy": busy, "walPages": log, "checkpointedPages": done,
+            "durationMs": round((time.perf_counter() - started) * 1000, 2), "at": time.time(),
+        }
+        return self.last
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.run_once)
+            except sqlite3.Error as e:
+                logging.warning(f"⚠️ 背景 checkpoint 失敗：{e}")
+
+
+def backup(db_file, dest=None, pages=-1, sleep=0.0):
+    # pages=-1：一次複製完，在單一讀取交易內取得一致的快照。
+    # 分段複製（pages>0）時若其他連線寫入，sqlite 會從頭重來，寫入頻繁時可能一直做不完。
+    if dest is None:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        dest = os.path.join(BACKUP_DIR, f"{os.path.splitext(os.path.basename(db_file))[0]}-{stamp}.db")
+    else:
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    started = time.perf_counter()
+    src = sqlite3.connect(db_file, timeout=30)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.backup(dst, pages=pages, sleep=sleep)
+        # 備份檔本身用 rollback journal，單一檔案方便搬移
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, dest)
+    return {
+        "path": dest,
+        "bytes": os.path.getsize(dest),
+        "durationMs": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+
+def info(conn, db_file):
+    cur = conn.cursor()
+
+    def pragma(name):
+        return cur.execute(f"PRAGMA {name}").fetchone()[0]
+
+    return {
+        "profile": PROFILE["name"],
+        "journalMode": pragma("journal_mode"),
+        "synchronous": {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"}.get(pragma("synchronous")),
+        "cacheSize": pragma("cache_size"),
+        "mmapSize": pragma("mmap_size"),
+        "pageSize": pragma("page_size"),
+        "pageCount": pragma("page_count"),
+        "freelistCount": pragma("freelist_count"),
+        "walAutocheckpoint": pragma("wal_autocheckpoint"),
+        "dbBytes": os.path.getsize(db_file) if os.path.exists(db_file) else 0,
+        "walBytes": wal_size(db_file),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SQLite 儲存維護工具")
+    parser.add_argument("command", choices=["info", "checkpoint", "backup"])
+    parser.add_argument("db", nargs="?", default="ocpp_data.db")
+    parser.add_argument("--mode", default="PASSIVE", help="checkpoint 模式")
+    parser.add_argument("--dest", help="備份檔路徑（預設 BACKUP_DIR/<db>-<時間>.db）")
+    parser.add_argument("--pages", type=int, default=-1, help="backup 每一步複製的頁數")
+    args = parser.parse_args(argv)
+
+    if args.command == "backup":
+        result = backup(args.db, args.dest, pages=args.pages)
+        print(f"✅ 備份完成：{result['path']}（{result['bytes']} bytes，{result['durationMs']} ms）")
+        return
+    conn = connect(args.db)
+    try:
+        if args.command == "checkpoint":
+            busy, log, done = checkpoint(conn, args.mode)
+            print(f"checkpoint {args.mode.upper()}：busy={busy} wal={log} 已寫回={done}")
+        else:
+            for key, value in info(conn, args.db).items():
+                print(f"{key}: {value}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
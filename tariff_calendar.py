@@ -0,0 +1,148 @@
+# 電價行事曆批次匯入
+#
+# 將整季/整年的 daily_pricing_rules 與 weekly_pricing 展開成資料列，
+# 一次排序檢查同一天（或同一季同一星期）內的時段是否重疊。
+#
+# daily 項目可為單日規則：
+#   {"date": "2025-07-01", "startTime": "08:00", "endTime": "12:00", "price": 5.2, "label": "尖峰"}
+# 或日期區間展開：
+#   {"from": "2025-07-01", "to": "2025-07-31", "weekdays": "weekday",
+#    "rules": [{"startTime": "08:00", "endTime": "12:00", "price": 5.2}]}
+# weekdays 可為 "all"、"weekday"、"weekend" 或 0（週一）~6（週日）的清單。
+
+from datetime import date, timedelta
+
+MAX_RANGE_DAYS = 731
+
+WEEKDAY_SETS = {
+    "all": {0, 1, 2, 3, 4, 5, 6},
+    "weekday": {0, 1, 2, 3, 4},
+    "weekend": {5, 6},
+}
+
+
+class CalendarError(ValueError):
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def to_minutes(hhmm):
+    h, m = str(hhmm).split(":")
+    h, m = int(h), int(m)
+    if not (0 <= h <= 24 and 0 <= m < 60) or (h == 24 and m):
+        raise ValueError(f"時間格式錯誤：{hhmm}")
+    return h * 60 + m
+
+
+def segments(start_time, end_time):
+    # 轉成 [start, end) 分鐘區段；00:00–00:00 表示全天，start > end 表示跨午夜
+    s, e = to_minutes(start_time), to_minutes(end_time)
+    if e == 0:
+        e = 1440
+    if s == e or (s == 0 and e == 1440):
+        return [(0, 1440)]
+    if s < e:
+        return [(s, e)]
+    return [(s, 1440), (0, e)]
+
+
+def find_overlaps(groups):
+    # groups: key -> [(start_time, end_time, 描述), ...]；回傳重疊訊息清單
+    errors = []
+    for key, rules in groups.items():
+        spans = []
+        for start_time, end_time, desc in rules:
+            for s, e in segments(start_time, end_time):
+                spans.append((s, e, desc))
+        spans.sort()
+        for (s1, e1, d1), (s2, e2, d2) in zip(spans, spans[1:]):
+            if s2 < e1:
+                errors.append(f"{key}：{d1} 與 {d2} 時段重疊")
+    return errors
+
+
+def _weekday_set(value):
+    if value is None:
+        return WEEKDAY_SETS["all"]
+    if isinstance(value, str):
+        if value not in WEEKDAY_SETS:
+            raise ValueError(f"weekdays 不合法：{value}")
+        return WEEKDAY_SETS[value]
+    days = {int(d) for d in value}
+    if not days <= WEEKDAY_SETS["all"]:
+        raise ValueError(f"weekdays 必須介於 0~6：{value}")
+    return days
+
+
+def expand_dates(start, end, weekdays=None):
+    first, last = date.fromisoformat(start), date.fromisoformat(end)
+    if last < first:
+        raise ValueError(f"日期區間錯誤：{start} ~ {end}")
+    if (last - first).days >= MAX_RANGE_DAYS:
+        raise ValueError(f"日期區間超過 {MAX_RANGE_DAYS} 天：{start} ~ {end}")
+    days = _weekday_set(weekdays)
+    d = first
+    out = []
+    while d <= last:
+        if d.weekday() in days:
+            out.append(d.isoformat())
+        d += timedelta(days=1)
+    return out
+
+
+def _describe(e):
+    return f"缺少欄位 {e.args[0]}" if isinstance(e, KeyError) else str(e)
+
+
+def _daily_row(day, rule):
+    to_minutes(rule["startTime"])
+    to_minutes(rule["endTime"])
+    return (day, rule["startTime"], rule["endTime"], float(rule["price"]), rule.get("label", "") or "")
+
+
+def build_daily_rows(items):
+    # 回傳 [(date, start_time, end_time, price, label), ...]
+    rows, errors = [], []
+    for i, item in enumerate(items):
+        try:
+            if "date" in item:
+                date.fromisoformat(item["date"])
+                rows.append(_daily_row(item["date"], item))
+            else:
+                for day in expand_dates(item["from"], item["to"], item.get("weekdays")):
+                    for rule in item["rules"]:
+                        rows.append(_daily_row(day, rule))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(f"daily[{i}]：{_describe(e)}")
+
+    groups = {}
+    for day, start_time, end_time, price, label in rows:
+        groups.setdefault(day, []).append((start_time, end_time, f"{start_time}-{end_time}"))
+    errors += find_overlaps(groups)
+    if errors:
+        raise CalendarError(errors)
+    return rows
+
+
+def build_weekly_rows(items):
+    # 回傳 [(season, weekday, type, start_time, end_time, price), ...]
+    rows, errors = [], []
+    for i, item in enumerate(items):
+        try:
+            to_minutes(item["startTime"])
+            to_minutes(item["endTime"])
+            rows.append((
+                item["season"], str(item["weekday"]), item.get("type", ""),
+                item["startTime"], item["endTime"], float(item["price"])
+            ))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(f"weekly[{i}]：{_describe(e)}")
+
+    groups = {}
+    for season, weekday, _, start_time, end_time, _ in rows:
+        groups.setdefault(f"{season}/{weekday}", []).append((start_time, end_time, f"{start_time}-{end_time}"))
+    errors += find_overlaps(groups)
+    if errors:
+        raise CalendarError(errors)
+    return rows
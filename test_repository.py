@@ -0,0 +1,407 @@
+# repository 測試：SQLite 與 PostgreSQL 兩種後端執行同一組測試
+#
+#   python -m pytest -q test_repository.py
+#
+# PostgreSQL：設定 TEST_DATABASE_URL（例如 postgresql://postgres@localhost/ocpp_test）指向本機測試用資料庫，
+# 未設定時略過；測試會建立資料表並清空其中的資料，不要指向正式資料庫。
+
+import asyncio
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import billing
+import repository
+from repository import DuplicateError, WriteError, SQLiteRepository, decode_cursor, encode_cursor
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+# 與 main.py 建立的資料表相同（repository 用到的部分）
+SQLITE_SCHEMA = [
+    "CREATE TABLE users (id_tag TEXT PRIMARY KEY, name TEXT, department TEXT, card_number TEXT)",
+    "CREATE TABLE cards (id INTEGER PRIMARY KEY AUTOINCREMENT, card_id TEXT UNIQUE, balance REAL DEFAULT 0)",
+    '''
+    CREATE TABLE transactions (
+        transaction_id INTEGER PRIMARY KEY, charge_point_id TEXT, connector_id INTEGER, id_tag TEXT,
+        meter_start INTEGER, start_timestamp TEXT, meter_stop INTEGER, stop_timestamp TEXT, reason TEXT
+    )
+    ''',
+    "CREATE TABLE id_sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    "INSERT INTO id_sequences (name, value) VALUES ('transactions', 0)",
+    "CREATE TABLE id_tags (id_tag TEXT PRIMARY KEY, status TEXT, valid_until TEXT)",
+    '''
+    CREATE TABLE meter_values (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_id INTEGER, charge_point_id TEXT, connector_id INTEGER,
+        timestamp TEXT, value REAL, measurand TEXT, unit TEXT, context TEXT, format TEXT, phase TEXT, location TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_id INTEGER, id_tag TEXT, amount REAL, timestamp TEXT
+    )
+    ''',
+    "CREATE TABLE pending_billing (transaction_id INTEGER PRIMARY KEY, id_tag TEXT, meter_stop INTEGER, stop_timestamp TEXT)",
+    '''
+    CREATE TABLE reservations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, charge_point_id TEXT, id_tag TEXT,
+        start_time TEXT, end_time TEXT, status TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE monthly_usage (
+        month TEXT, id_tag TEXT, charge_point_id TEXT, total_energy REAL DEFAULT 0, txn_count INTEGER DEFAULT 0,
+        PRIMARY KEY (month, id_tag, charge_point_id)
+    )
+    ''',
+    '''
+    CREATE TABLE pricing_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, season TEXT, day_type TEXT, start_time TEXT, end_time TEXT, price REAL
+    )
+    ''',
+    "CREATE TABLE base_rates (id INTEGER PRIMARY KEY, monthly_basic_fee REAL, threshold_kwh INTEGER, overuse_price_delta REAL)",
+    '''
+    CREATE TABLE daily_pricing_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, date TEXT, start_time TEXT, end_time TEXT, price REAL, label TEXT DEFAULT ''
+    )
+    ''',
+    '''
+    CREATE TABLE weekly_pricing (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, season TEXT, weekday TEXT, type TEXT,
+        start_time TEXT, end_time TEXT, price REAL
+    )
+    ''',
+] + repository.STATUS_INTERVALS_SCHEMA
+
+PG_TABLES = (
+    "users, cards, transactions, id_tags, meter_values, status_intervals, payments, pending_billing, reservations, "
+    "monthly_usage, pricing_rules, base_rates, daily_pricing_rules, weekly_pricing"
+)
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def run(request, tmp_path):
+    # run(scenario)：以全新的資料庫建立 repository，在新的事件迴圈上執行 await scenario(repo)
+    backend = request.param
+    if backend == "postgres" and not TEST_DATABASE_URL:
+        pytest.skip("未設定 TEST_DATABASE_URL")
+
+    async def with_repo(scenario):
+        if backend == "sqlite":
+            conn = sqlite3.connect(tmp_path / "repository.db")
+            for sql in SQLITE_SCHEMA:
+                conn.execute(sql)
+            conn.commit()
+            repo = SQLiteRepository(conn)
+        else:
+            from repository_pg import PostgresRepository
+            repo = PostgresRepository(TEST_DATABASE_URL, min_size=1, max_size=4)
+            await repo.open()
+            await repo._write(f"TRUNCATE {PG_TABLES} RESTART IDENTITY")
+            await repo._write("UPDATE id_sequences SET value = 0 WHERE name = 'transactions'")
+        try:
+            return await scenario(repo)
+        finally:
+            await repo.close()
+            if backend == "sqlite":
+                conn.close()
+
+    return lambda scenario: asyncio.run(with_repo(scenario))
+
+
+def test_id_tags(run):
+    async def scenario(repo):
+        await repo.add_id_tag("TAG1", "Accepted", "2099-12-31T23:59:59")
+        with pytest.raises(DuplicateError):
+            await repo.add_id_tag("TAG1", "Blocked", "2099-12-31T23:59:59")
+        await repo.update_id_tag("TAG1", status="Blocked")
+        assert await repo.get_id_tag("TAG1") == ("Blocked", "2099-12-31T23:59:59")
+
+        await repo.import_id_tags([("TAG1", "Accepted", "2030-01-01T00:00:00"), ("TAG2", "Expired", "2020-01-01T00:00:00")])
+        assert sorted(await repo.list_id_tags()) == [
+            ("TAG1", "Accepted", "2030-01-01T00:00:00"),
+            ("TAG2", "Expired", "2020-01-01T00:00:00"),
+        ]
+        await repo.delete_id_tag("TAG2")
+        assert await repo.get_id_tag("TAG2") is None
+    run(scenario)
+
+
+def test_users(run):
+    async def scenario(repo):
+        await repo.add_user("TAG1", "王小明", "研發", None)
+        with pytest.raises(DuplicateError):
+            await repo.add_user("TAG1", "重複", None, None)
+        await repo.update_user("TAG1", {"department": "業務", "card_number": "U1"})
+        assert await repo.get_user("TAG1") == ("TAG1", "王小明", "業務", "U1")
+        assert await repo.find_user_by_card("U1") == "TAG1"
+        assert await repo.find_user_by_card("U2") is None
+
+        # 匯入：已存在者只更新有值的欄位
+        await repo.import_users([("TAG1", None, "客服", None), ("TAG2", "陳小華", None, "U2")])
+        assert sorted(await repo.list_users()) == [("TAG1", "王小明", "客服", "U1"), ("TAG2", "陳小華", None, "U2")]
+        assert sorted(await repo.user_card_numbers(["TAG1", "TAG2", "NONE"])) == ["U1", "U2"]
+
+        await repo.update_user("TAG1", {"card_number": None})
+        await repo.delete_user("TAG2")
+        assert await repo.list_users() == [("TAG1", "王小明", "客服", None)]
+    run(scenario)
+
+
+def test_cards_and_payments(run):
+    async def scenario(repo):
+        assert await repo.top_up("CARD1", 100) == (True, 100)
+        assert await repo.top_up("CARD1", 50) == (False, 150)
+        await repo.import_card_topups([("CARD1", 10.5), ("CARD2", 20.0)])
+        assert await repo.get_balances(["CARD1", "CARD2", "NONE"]) == {"CARD1": 160.5, "CARD2": 20}
+
+        await repo.add_pending_billing(7, "CARD2", 5000, "2025-01-01T10:00:00")
+        await repo.add_pending_billing(7, "CARD2", 9999, "2025-01-01T11:00:00")
+        await repo.add_pending_billing(8, "NONE", 1000, "2025-01-01T10:00:00")
+        assert await repo.list_pending_billing() == [
+            (7, "CARD2", 5000, "2025-01-01T10:00:00"), (8, "NONE", 1000, "2025-01-01T10:00:00"),
+        ]
+        assert await repo.charge("CARD2", 30, 7, "2025-01-01T10:00:00") == (20, 0)
+        # 標記已被認領：同一筆交易不再扣款
+        assert await repo.charge("CARD2", 30, 7, "2025-01-01T10:00:00") is None
+        assert await repo.charge("NONE", 1, 8, "2025-01-01T10:00:00") is None
+        assert await repo.list_pending_billing() == []
+        assert await repo.get_balance("CARD2") == 0
+        assert await repo.list_payments() == [(7, "CARD2", 30, "2025-01-01T10:00:00")]
+    run(scenario)
+
+
+def test_transactions(run):
+    async def scenario(repo):
+        ids = await asyncio.gather(*(repo.next_transaction_id() for _ in range(20)))
+        assert len(set(ids)) == 20
+
+        tid = await repo.next_transaction_id()
+        assert tid > max(ids)
+        await repo.start_transaction(tid, "CP1", 1, "TAG1", 1000, "2025-03-01T08:00:00")
+        assert await repo.stop_transaction(tid, 6000, "2025-03-01T09:00:00", "Local") == (
+            "TAG1", "CP1", "2025-03-01T08:00:00", 1000, None
+        )
+        # 重送的 StopTransaction：回傳已結束的狀態，月報彙總不重複累加
+        assert (await repo.stop_transaction(tid, 6000, "2025-03-01T09:00:00", "Local"))[4] == 6000
+
+        row = await repo.get_transaction(tid)
+        assert tuple(row) == (tid, "CP1", 1, "TAG1", 1000, "2025-03-01T08:00:00", 6000, "2025-03-01T09:00:00", "Local")
+        assert len(await repo.list_transactions(charge_point_id="CP1", start="2025-03-01")) == 1
+        assert await repo.list_transactions(id_tag="OTHER") == []
+    run(scenario)
+
+
+async def add_finished_transaction(repo, tid, charge_point_id, id_tag, meter_start, start, meter_stop, stop):
+    await repo.start_transaction(tid, charge_point_id, 1, id_tag, meter_start, start)
+    await repo.stop_transaction(tid, meter_stop, stop, "Local")
+
+
+async def set_base_rate(repo, basic_fee, threshold_kwh, delta):
+    if isinstance(repo, SQLiteRepository):
+        repo._write("INSERT INTO base_rates VALUES (1, ?, ?, ?)", (basic_fee, threshold_kwh, delta))
+    else:
+        await repo._write("INSERT INTO base_rates VALUES (1, $1, $2, $3)", basic_fee, threshold_kwh, delta)
+
+
+def test_statistics(run):
+    async def scenario(repo):
+        # 2025-01-06 是週一：之前的 1/1–1/5 為第 00 週；帶時區的時間以 UTC 計算
+        await add_finished_transaction(repo, 1, "CP1", "TAG1", 0, "2025-01-05T10:00:00Z", 5000, "2025-01-05T11:00:00Z")
+        await add_finished_transaction(repo, 2, "CP2", "TAG1", 1000, "2025-01-06T10:00:00", 4000, "2025-01-06T11:00:00")
+        await add_finished_transaction(repo, 3, "CP1", "TAG2", 0, "2025-01-06T02:00:00+08:00", 2000, "2025-01-06T03:00:00+08:00")
+        await repo.start_transaction(4, "CP2", 1, "TAG2", 0, "2025-02-01T00:00:00")
+        await repo.add_meter_values([
+            (4, cp, 1, f"2025-02-01T00:0{i}:00", value, "Power.Active.Import", "W", None, None, None, None)
+            for i, (cp, value) in enumerate([("CP1", 100.0), ("CP2", 70.0), ("CP1", 150.0)])
+        ])
+
+        assert await repo.energy_by_period("day") == [("2025-01-05", 2, 7000), ("2025-01-06", 1, 3000)]
+        assert await repo.energy_by_period("week") == [("2025-W00", 2, 7000), ("2025-W01", 1, 3000)]
+        assert await repo.energy_by_period("month") == [("2025-01", 3, 10000)]
+        assert sorted(await repo.energy_by_group("id_tag")) == [("TAG1", 2, 8000), ("TAG2", 1, 2000)]
+        assert sorted(await repo.energy_by_group("charge_point_id", start="2025-01-06")) == [
+            ("CP1", 1, 2000), ("CP2", 1, 3000),
+        ]
+        with pytest.raises(ValueError):
+            await repo.energy_by_group("reason")
+        assert await repo.daily_energy_by_charge_point() == [("2025-01-05", "CP1", 7000), ("2025-01-06", "CP2", 3000)]
+        assert await repo.daily_energy_by_charge_point("2025-01-06", "2025-01-07") == [
+            ("2025-01-05", "CP1", 2000), ("2025-01-06", "CP2", 3000),
+        ]
+        assert await repo.live_totals("2025-01-06") == (1, 220, 3000)
+        assert await repo.monthly_usage("2025-01") == [
+            ("TAG1", "CP1", 5000, 1), ("TAG1", "CP2", 3000, 1), ("TAG2", "CP1", 2000, 1),
+        ]
+
+        # 匯出用的 keyset 分頁
+        first = await repo.list_transactions(after=None, limit=3)
+        assert [row[0] for row in first] == [1, 2, 3]
+        assert [row[0] for row in await repo.list_transactions(after=3, limit=3)] == [4]
+        assert await repo.list_transactions(id_tag="TAG2", after=4, limit=3) == []
+    run(scenario)
+
+
+def test_transaction_cost(run):
+    async def scenario(repo):
+        await repo.add_pricing_rule("non_summer", "weekday", "00:00", "12:00", 2.0)
+        await repo.add_pricing_rule("non_summer", "weekday", "12:00", "00:00", 3.0)
+        await add_finished_transaction(repo, 1, "CP1", "TAG1", 0, "2025-01-06T11:00:00Z", 4000, "2025-01-06T13:00:00Z")
+        await repo.add_meter_values([
+            (1, "CP1", 1, f"2025-01-06T{hour}:00:00Z", value, "Energy.Active.Import.Register", "Wh", None, None, None, None)
+            for hour, value in [(11, 0.0), (12, 1000.0), (13, 4000.0)]
+        ])
+        with pytest.raises(LookupError):
+            await billing.transaction_cost(repo, 1)      # 尚未設定基本費
+
+        await set_base_rate(repo, 10, 1, 0.5)
+        cost = await billing.transaction_cost(repo, 1)
+        # 11–12 時 1 kWh × 2 元、12–13 時 3 kWh × 3 元，超過 1 kWh 的 3 kWh 各加 0.5 元
+        assert (cost["energyCost"], cost["overuseFee"], cost["totalCost"]) == (11, 1.5, 22.5)
+        assert [d["price"] for d in cost["details"]] == [2.0, 3.0]
+        assert await billing.transaction_costs(repo, [await repo.get_transaction(1)]) == [cost]
+        with pytest.raises(LookupError):
+            await billing.transaction_cost(repo, 2)
+    run(scenario)
+
+
+def test_meter_values(run):
+    async def scenario(repo):
+        rows = [
+            (1, "CP1", 1, f"2025-03-01T08:00:0{i}", 230.0 + i, "Voltage", "V", "Sample.Periodic", "Raw", phase, "Outlet")
+            for i, phase in enumerate(["L1", "L2", "L3"])
+        ]
+        await repo.add_meter_values(rows)
+        values = (await repo.list_meter_values([1, 2]))
+        assert [v[1] for v in values[1]] == [230.0, 231.0, 232.0]
+        assert values[2] == []
+
+        keys = await repo.meter_value_keys("CP1", "2025-03-01T08:00:00", "2025-03-01T08:00:01")
+        assert keys == {
+            (1, 1, "2025-03-01T08:00:00", "Voltage", "L1", "Outlet"),
+            (1, 1, "2025-03-01T08:00:01", "Voltage", "L2", "Outlet"),
+        }
+        assert await repo.latest_meter_value("CP1") == (1, "2025-03-01T08:00:02", "Voltage", 232.0, "V")
+    run(scenario)
+
+
+def test_reservations(run):
+    async def scenario(repo):
+        first = await repo.create_reservation("CP1", "TAG1", "2025-03-01T08:00:00", "2025-03-01T09:00:00")
+        second = await repo.create_reservation("CP2", "TAG2", "2025-03-01T10:00:00", "2025-03-01T11:00:00")
+        await repo.update_reservation(first, {"end_time": "2025-03-01T09:30:00"})
+        assert await repo.get_reservation(first) == (
+            first, "CP1", "TAG1", "2025-03-01T08:00:00", "2025-03-01T09:30:00", "active"
+        )
+
+        await repo.set_reservation_status([first], "completed")
+        await repo.set_reservation_status([first, second], "expired", only_active=True)
+        assert sorted(r[5] for r in await repo.list_reservations()) == ["completed", "expired"]
+        assert await repo.list_active_reservations() == []
+
+        await repo.delete_reservation(second)
+        assert await repo.get_reservation(second) is None
+    run(scenario)
+
+
+def test_status_intervals(run):
+    async def scenario(repo):
+        assert await repo.record_status("CP1", 1, "Available", "2025-03-01T08:00:00Z")
+        assert not await repo.record_status("CP1", 1, "Available", "2025-03-01T08:05:00Z")
+        assert await repo.record_status("CP1", 1, "Charging", "2025-03-01T08:10:00Z")
+        # 比目前區間還早的狀態接在目前區間之後
+        assert await repo.record_status("CP1", 1, "Finishing", "2025-03-01T08:09:00Z")
+        assert await repo.record_status("CP2", 1, "Faulted", "2025-03-01T08:20:00Z")
+
+        rows = await repo.list_status_intervals(limit=2)
+        assert [(r[0], r[2], r[4]) for r in rows] == [("CP2", "Faulted", None), ("CP1", "Finishing", None)]
+        rows += await repo.list_status_intervals(limit=10, after=decode_cursor(encode_cursor(rows[-1])))
+        assert [r[2] for r in rows] == ["Faulted", "Finishing", "Charging", "Available"]
+        charging, finishing = rows[2], rows[1]
+        assert charging[4] == finishing[3] == charging[3]
+
+        cp1 = await repo.list_status_intervals(charge_point_id="CP1", end=repository.parse_epoch_ms("2025-03-01T08:05:00Z"))
+        assert [r[2] for r in cp1] == ["Available"]
+    run(scenario)
+
+
+def test_pricing(run):
+    async def scenario(repo):
+        await repo.add_pricing_rule("non_summer", "weekday", "00:00", "00:00", 3.0)
+        await repo.add_pricing_rule("summer", "weekday", "22:00", "06:00", 2.0)
+        await repo.add_pricing_rule("summer", "weekday", "06:00", "22:00", 5.0)
+        assert await repo.rule_price("non_summer", "weekday", "12:00") == 3.0
+        assert await repo.rule_price("summer", "weekday", "23:30") == 2.0
+        assert await repo.rule_price("summer", "weekday", "12:00") == 5.0
+        assert await repo.rule_price("summer", "holiday", "12:00") == 0
+
+        await repo.delete_pricing_rule("summer", "weekday", "06:00", "22:00", 5.0)
+        assert [r[4] for r in await repo.list_pricing_rules()] == [3.0, 2.0]
+
+        await repo.add_daily_pricing("2025-07-01", "10:00", "12:00", 9.0, "尖峰")
+        assert await repo.current_price(datetime(2025, 7, 1, 11, 0)) == 9.0
+        assert await repo.current_price(datetime(2025, 7, 1, 23, 0)) == 2.0
+        rule_id = (await repo.list_daily_pricing("2025-07-01"))[0][0]
+        await repo.update_daily_pricing(rule_id, "2025-07-01", "10:00", "13:00", 8.0, "尖峰")
+        assert await repo.daily_pricing_slots(["2025-07-01", "2025-07-02"]) == [("2025-07-01", "10:00", "13:00")]
+
+        await repo.add_weekly_pricing("summer", "1", "peak", "09:00", "12:00", 6.0)
+        weekly_id = (await repo.list_weekly_pricing("summer"))[0][0]
+        assert await repo.weekly_slots("summer", "1") == [(weekly_id, "09:00", "12:00")]
+        await repo.delete_weekly_pricing(weekly_id)
+        assert await repo.list_weekly_pricing("summer") == []
+    run(scenario)
+
+
+def test_replace_pricing(run):
+    async def scenario(repo):
+        await repo.add_daily_pricing("2025-07-01", "00:00", "12:00", 1.0, "")
+        await repo.add_daily_pricing("2025-07-05", "00:00", "12:00", 1.0, "")
+        await repo.add_daily_pricing("2025-08-01", "00:00", "12:00", 1.0, "")
+        await repo.add_weekly_pricing("summer", "1", "peak", "09:00", "12:00", 6.0)
+
+        await repo.replace_pricing(
+            [("2025-07-02", "08:00", "10:00", 4.0, "新")],
+            [("summer", "2", "off_peak", "00:00", "08:00", 1.5)],
+            dates=["2025-07-02"], seasons=["summer"], date_range=("2025-07-01", "2025-07-31"),
+        )
+        assert await repo.daily_pricing_slots(["2025-07-01", "2025-07-02", "2025-07-05", "2025-08-01"]) in (
+            [("2025-07-02", "08:00", "10:00"), ("2025-08-01", "00:00", "12:00")],
+            [("2025-08-01", "00:00", "12:00"), ("2025-07-02", "08:00", "10:00")],
+        )
+        assert [r[2:] for r in await repo.list_weekly_pricing("summer")] == [("2", "off_peak", "00:00", "08:00", 1.5)]
+
+        # 寫入失敗時整批還原（刪除也不生效）
+        with pytest.raises(WriteError):
+            await repo.replace_pricing([("2025-08-01", "08:00", "10:00", 4.0, "新"), ("2025-08-01", "10:00")],
+                                       dates=["2025-08-01"])
+        assert [r[2:] for r in await repo.list_daily_pricing("2025-08-01")] == [("00:00", "12:00", 1.0, "")]
+    run(scenario)
+
+
+def test_fleet_queries_merge_databases(tmp_path):
+    # 分片 / 唯讀副本 / 背景工作共用的合併邏輯（sharding.FleetQueries）：結果與單一資料庫相同
+    from jobs import FileRepository
+
+    files = [str(tmp_path / "main.db"), str(tmp_path / "taipei.db")]
+    for i, path in enumerate(files):
+        conn = sqlite3.connect(path)
+        for sql in SQLITE_SCHEMA:
+            conn.execute(sql)
+        conn.commit()
+        repo = SQLiteRepository(conn)
+        asyncio.run(add_finished_transaction(repo, i + 1, f"CP{i}", "TAG1", 0, "2025-01-06T10:00:00", 1000, "2025-01-06T11:00:00"))
+        conn.close()
+
+    async def scenario():
+        fleet = FileRepository(files)
+        try:
+            assert await fleet.energy_by_period("day") == [("2025-01-06", 2, 2000)]
+            assert await fleet.energy_by_group("id_tag") == [("TAG1", 2, 2000)]
+            assert await fleet.monthly_usage("2025-01") == [("TAG1", "CP0", 1000, 1), ("TAG1", "CP1", 1000, 1)]
+            assert [row[0] for row in await fleet.list_transactions(limit=1)] == [1]
+            assert await fleet.live_totals("2025-01-06") == (0, 0, 2000)
+        finally:
+            await fleet.close()
+    asyncio.run(scenario())
@@ -0,0 +1,284 @@
+# 輕量 tracing 與慢查詢紀錄
+#
+# - 每個 OCPP 訊息（codec.FastChargePoint）與 REST 請求（main.py middleware）各是一個 trace 的根 span，
+#   其下的 SQL 陳述式（TracedConnection）與對外 HTTP 呼叫（traced_request）是子 span
+# - 取樣在根 span 決定：TRACE_SAMPLE_RATE（0~1，預設 0 即關閉）；未取樣的請求只多一次 contextvar 查詢
+# - 根 span 結束時整個 trace 以 OTLP JSON（ExportTraceServiceRequest，每行一筆）寫入 TRACE_FILE，
+#   由背景執行緒寫出並依 TRACE_MAX_MB / TRACE_FILES 輪替
+# - 慢查詢：任何 SQL 超過 SLOW_QUERY_MS（預設 200）時不論是否取樣都以 WARNING 記錄，
+#   附上 EXPLAIN QUERY PLAN；在取樣中的 trace 內則同時寫進該 span 的 db.plan 屬性
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from log_pipeline import LazyQueueHandler
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 依部署環境而定
+    orjson = None
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces/traces.jsonl")
+TRACE_MAX_MB = float(os.getenv("TRACE_MAX_MB", "32"))
+TRACE_FILES = int(os.getenv("TRACE_FILES", "5"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "ocpp-csms")
+
+# OTLP SpanKind
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+
+SLOW_LOG = logging.getLogger("tracing.slow_query")
+
+_current = contextvars.ContextVar("tracing_span", default=None)
+_NOT_SAMPLED = object()
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, trace, parent_id, name, kind, attributes, start=None):
+        self.trace = trace
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = start or time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, end=None):
+        self.end = end or time.time_ns()
+        self.trace.append(self)
+
+
+class _Trace(list):
+    # 已結束的 span；根 span 結束後匯出，之後才結束的子 span（例如背景工作）不再記錄
+    __slots__ = ("trace_id", "exported")
+
+    def __init__(self):
+        super().__init__()
+        self.trace_id = random.getrandbits(128)
+        self.exported = False
+
+    def append(self, s):
+        if not self.exported:
+            super().append(s)
+
+
+def current_span():
+    s = _current.get()
+    return None if s is _NOT_SAMPLED else s
+
+
+@contextmanager
+def span(name, kind=INTERNAL, **attributes):
+    # 沒有上層 span 時是新的 trace（依 TRACE_SAMPLE_RATE 取樣）；未取樣時 yield None
+    parent = _current.get()
+    if parent is _NOT_SAMPLED or (parent is None and TRACE_SAMPLE_RATE <= 0):
+        yield None
+        return
+    if parent is None and random.random() >= TRACE_SAMPLE_RATE:
+        token = _current.set(_NOT_SAMPLED)
+        try:
+            yield None
+        finally:
+            _current.reset(token)
+        return
+    trace = parent.trace if parent is not None else _Trace()
+    s = Span(trace, parent.span_id if parent is not None else None, name, kind, attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        s.finish()
+        if parent is None:
+            trace.exported = True
+            export(trace)
+
+
+def record_span(name, kind, start_ns, end_ns, **attributes):
+    # 已完成的操作（例如 SQL）直接補一個子 span；沒有取樣中的 trace 時不做事
+    parent = _current.get()
+    if parent is None or parent is _NOT_SAMPLED:
+        return None
+    s = Span(parent.trace, parent.span_id, name, kind, attributes, start=start_ns)
+    s.finish(end_ns)
+    return s
+
+
+# === SQL ===
+
+def explain(conn, sql, params=()):
+    # 直接用 sqlite3.Cursor，避免 EXPLAIN 本身又被記錄
+    try:
+        rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except (sqlite3.Error, ValueError):
+        return ""
+    return "; ".join(str(row[-1]) for row in rows)
+
+
+def sql_done(conn, sql, params, started, many=False):
+    elapsed = time.perf_counter() - started
+    plan = None
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        plan = explain(conn, sql, params) if not many else ""
+    query_span("sqlite", sql, elapsed, plan)
+
+
+def query_span(system, sql, elapsed, plan=None):
+    # plan 不是 None 表示慢查詢（已超過 SLOW_QUERY_MS）
+    parent = _current.get()
+    sampled = parent is not None and parent is not _NOT_SAMPLED
+    if plan is None and not sampled:
+        return
+    statement = " ".join(sql.split())
+    if plan is not None:
+        SLOW_LOG.warning("🐢 慢查詢 %.1f ms | %s | plan=%s", elapsed * 1000, statement[:500], plan or "-")
+    if not sampled:
+        return
+    end = time.time_ns()
+    attributes = {"db.system": system, "db.statement": statement[:2000]}
+    if plan is not None:
+        attributes["db.slow"] = True
+        attributes["db.plan"] = plan
+    record_span(statement.split(" ", 1)[0].upper() or "SQL", CLIENT, end - int(elapsed * 1e9), end, **attributes)
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            sql_done(self.connection, sql, params, started)
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            sql_done(self.connection, sql, (), started, many=True)
+
+
+class TracedConnection(sqlite3.Connection):
+    # sqlite3.connect(..., factory=TracedConnection)：connection 與其 cursor 上的 SQL 都會被計時
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+# === 對外 HTTP ===
+
+def traced_request(method, url, **kwargs):
+    import requests
+
+    with span(f"{method} {url.split('://', 1)[-1].split('/', 1)[0]}", CLIENT,
+              **{"http.method": method, "http.url": url}) as s:
+        resp = requests.request(method, url, **kwargs)
+        if s is not None:
+            s.set("http.status_code", resp.status_code)
+        return resp
+
+
+# === OTLP JSON 匯出 ===
+
+def _attr(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def to_otlp(trace):
+    trace_id = f"{trace.trace_id:032x}"
+    spans = []
+    for s in trace:
+        item = {
+            "traceId": trace_id,
+            "spanId": f"{s.span_id:016x}",
+            "name": s.name,
+            "kind": s.kind,
+            "startTimeUnixNano": str(s.start),
+            "endTimeUnixNano": str(s.end),
+            "attributes": [_attr(k, v) for k, v in s.attributes.items()],
+        }
+        if s.parent_id is not None:
+            item["parentSpanId"] = f"{s.parent_id:016x}"
+        if s.error:
+            item["status"] = {"code": STATUS_ERROR, "message": s.error}
+        spans.append(item)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attr("service.name", SERVICE_NAME)]},
+        "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+    }]}
+
+
+def export(trace):
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = _start_exporter()
+    _exporter.info("%s", trace)
+
+
+class _OtlpFormatter(logging.Formatter):
+    def format(self, record):
+        data = to_otlp(record.args[0])
+        if orjson is not None:
+            return orjson.dumps(data).decode()
+        return json.dumps(data, separators=(",", ":"))
+
+
+def _start_exporter():
+    # 寫檔沿用 logging 的 QueueListener + RotatingFileHandler，在背景執行緒轉成 JSON
+    os.makedirs(os.path.dirname(TRACE_FILE) or ".", exist_ok=True)
+    output = logging.handlers.RotatingFileHandler(
+        TRACE_FILE, maxBytes=int(TRACE_MAX_MB * 1024 * 1024), backupCount=TRACE_FILES, encoding="utf-8"
+    )
+    output.setFormatter(_OtlpFormatter())
+    handler = LazyQueueHandler(queue.SimpleQueue())
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    logger = logging.getLogger("tracing.export")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    logger.listener = listener
+    return logger
+
+
+def shutdown():
+    global _exporter
+    if _exporter is not None:
+        _exporter.listener.stop()
+        _exporter = None